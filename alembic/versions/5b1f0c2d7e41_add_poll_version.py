@@ -0,0 +1,28 @@
+"""add version counter to polls
+
+Revision ID: 5b1f0c2d7e41
+Revises: 44aee0960ac6
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b1f0c2d7e41'
+down_revision: Union[str, None] = '44aee0960ac6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('polls', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('polls', schema=None) as batch_op:
+        batch_op.drop_column('version')
@@ -0,0 +1,31 @@
+"""add image_file_ids registry
+
+Revision ID: 7c2e9a4d1f63
+Revises: 5b1f0c2d7e41
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c2e9a4d1f63'
+down_revision: Union[str, None] = '5b1f0c2d7e41'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'image_file_ids',
+        sa.Column('digest', sa.String(length=64), nullable=False),
+        sa.Column('file_id', sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint('digest'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('image_file_ids')
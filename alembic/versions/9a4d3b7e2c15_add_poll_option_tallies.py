@@ -0,0 +1,46 @@
+"""add poll_option_tallies and polls.voter_count
+
+Revision ID: 9a4d3b7e2c15
+Revises: 7c2e9a4d1f63
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9a4d3b7e2c15'
+down_revision: Union[str, None] = '7c2e9a4d1f63'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'poll_option_tallies',
+        sa.Column('poll_id', sa.Integer(), nullable=False),
+        sa.Column('response', sa.Text(), nullable=False),
+        sa.Column('votes', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('poll_id', 'response'),
+    )
+    with op.batch_alter_table('polls', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('voter_count', sa.Integer(), nullable=False, server_default='0'))
+
+    # Backfill from existing responses.
+    op.execute(
+        "INSERT INTO poll_option_tallies (poll_id, response, votes) "
+        "SELECT poll_id, response, COUNT(*) FROM responses GROUP BY poll_id, response"
+    )
+    op.execute(
+        "UPDATE polls SET voter_count = ("
+        "SELECT COUNT(DISTINCT user_id) FROM responses WHERE responses.poll_id = polls.poll_id)"
+    )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('polls', schema=None) as batch_op:
+        batch_op.drop_column('voter_count')
+    op.drop_table('poll_option_tallies')
@@ -0,0 +1,108 @@
+"""store option index in responses
+
+Revision ID: b3e8f1a6c4d2
+Revises: 9a4d3b7e2c15
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b3e8f1a6c4d2'
+down_revision: Union[str, None] = '9a4d3b7e2c15'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Same values as database.FREE_TEXT_OPTION / WEBAPP_PLACEHOLDER_OPTIONS.
+FREE_TEXT_OPTION = -1
+WEBAPP_PLACEHOLDER_OPTIONS = 'Web App Poll'
+
+
+def _poll_options(bind):
+    options = {}
+    for poll_id, text in bind.execute(sa.text("SELECT poll_id, options FROM polls")):
+        if text and text != WEBAPP_PLACEHOLDER_OPTIONS:
+            options[poll_id] = [option.strip() for option in text.split(',')]
+    return options
+
+
+def _recreate_responses(columns, rows):
+    op.execute("DROP TABLE IF EXISTS responses_new")
+    op.create_table('responses_new', *columns, sa.PrimaryKeyConstraint(*(c.name for c in columns)),
+                    sa.ForeignKeyConstraint(['poll_id'], ['polls.poll_id']))
+    if rows:
+        table = sa.table('responses_new', *(sa.column(c.name) for c in columns))
+        op.bulk_insert(table, [dict(zip((c.name for c in columns), row)) for row in sorted(rows)])
+    op.drop_table('responses')
+    op.execute("ALTER TABLE responses_new RENAME TO responses")
+
+
+def _recreate_tallies(key_columns):
+    op.drop_table('poll_option_tallies')
+    op.create_table(
+        'poll_option_tallies',
+        sa.Column('poll_id', sa.Integer(), nullable=False),
+        *key_columns,
+        sa.Column('votes', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('poll_id', *(c.name for c in key_columns)),
+    )
+    names = ', '.join(c.name for c in key_columns)
+    op.execute(
+        f"INSERT INTO poll_option_tallies (poll_id, {names}, votes) "
+        f"SELECT poll_id, {names}, COUNT(*) FROM responses GROUP BY poll_id, {names}"
+    )
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    options = _poll_options(bind)
+
+    # Responses matching one of the poll's options become (index, ''); anything else is kept as free text.
+    rows = set()
+    for poll_id, user_id, response in bind.execute(sa.text("SELECT poll_id, user_id, response FROM responses")):
+        text = (response or '').strip()
+        poll_options = options.get(poll_id, [])
+        if text in poll_options:
+            rows.add((poll_id, user_id, poll_options.index(text), ''))
+        else:
+            rows.add((poll_id, user_id, FREE_TEXT_OPTION, response or ''))
+
+    _recreate_responses([
+        sa.Column('poll_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.BigInteger(), nullable=False),
+        sa.Column('option_index', sa.Integer(), nullable=False, server_default=str(FREE_TEXT_OPTION)),
+        sa.Column('response', sa.Text(), nullable=False, server_default=''),
+    ], rows)
+    _recreate_tallies([
+        sa.Column('option_index', sa.Integer(), nullable=False),
+        sa.Column('response', sa.Text(), nullable=False),
+    ])
+    op.execute(
+        "UPDATE polls SET voter_count = ("
+        "SELECT COUNT(DISTINCT user_id) FROM responses WHERE responses.poll_id = polls.poll_id)"
+    )
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    options = _poll_options(bind)
+
+    # Back to option texts; indices past the end of the options list keep their (empty) text.
+    rows = set()
+    for poll_id, user_id, option_index, response in bind.execute(
+            sa.text("SELECT poll_id, user_id, option_index, response FROM responses")):
+        poll_options = options.get(poll_id, [])
+        if 0 <= option_index < len(poll_options):
+            response = poll_options[option_index]
+        rows.add((poll_id, user_id, response))
+
+    _recreate_responses([
+        sa.Column('poll_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.BigInteger(), nullable=False),
+        sa.Column('response', sa.Text(), nullable=False),
+    ], rows)
+    _recreate_tallies([sa.Column('response', sa.Text(), nullable=False)])
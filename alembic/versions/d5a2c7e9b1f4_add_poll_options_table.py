@@ -0,0 +1,98 @@
+"""move poll options into poll_options
+
+Revision ID: d5a2c7e9b1f4
+Revises: b3e8f1a6c4d2
+Create Date: 2026-10-18 17:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd5a2c7e9b1f4'
+down_revision: Union[str, None] = 'b3e8f1a6c4d2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# polls.options of web app polls created without predefined options.
+WEBAPP_PLACEHOLDER_OPTIONS = 'Web App Poll'
+
+SETTING_COLUMNS = ('show_names', 'names_style', 'is_priority', 'contribution_amount', 'emoji', 'show_count', 'show_contribution')
+SETTING_DEFAULTS = {'is_priority': 0, 'contribution_amount': 0, 'show_contribution': 1}
+
+
+def _setting_columns():
+    return [
+        sa.Column('show_names', sa.Integer(), nullable=True),
+        sa.Column('names_style', sa.String(), nullable=True),
+        sa.Column('is_priority', sa.Integer(), nullable=True),
+        sa.Column('contribution_amount', sa.Float(), nullable=True),
+        sa.Column('emoji', sa.String(), nullable=True),
+        sa.Column('show_count', sa.Integer(), nullable=True),
+        sa.Column('show_contribution', sa.Integer(), nullable=True),
+    ]
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    columns = ', '.join(SETTING_COLUMNS)
+    settings = {
+        (row.poll_id, row.option_index): row._mapping
+        for row in bind.execute(sa.text(f"SELECT poll_id, option_index, {columns} FROM poll_option_settings"))
+    }
+
+    poll_options = op.create_table(
+        'poll_options',
+        sa.Column('poll_id', sa.Integer(), sa.ForeignKey('polls.poll_id'), nullable=False),
+        sa.Column('option_index', sa.Integer(), nullable=False),
+        sa.Column('text', sa.Text(), nullable=False),
+        *_setting_columns(),
+        sa.PrimaryKeyConstraint('poll_id', 'option_index'),
+    )
+
+    rows = []
+    for poll_id, options in bind.execute(sa.text("SELECT poll_id, options FROM polls")):
+        if not options or options == WEBAPP_PLACEHOLDER_OPTIONS:
+            continue
+        for index, text in enumerate(options.split(',')):
+            setting = settings.get((poll_id, index), {})
+            row = {'poll_id': poll_id, 'option_index': index, 'text': text.strip()}
+            for column in SETTING_COLUMNS:
+                value = setting.get(column)
+                row[column] = SETTING_DEFAULTS.get(column) if value is None and column in SETTING_DEFAULTS else value
+            rows.append(row)
+    if rows:
+        op.bulk_insert(poll_options, rows)
+
+    with op.batch_alter_table('polls', schema=None) as batch_op:
+        batch_op.drop_column('options')
+    op.drop_table('poll_option_settings')
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    op.create_table(
+        'poll_option_settings',
+        sa.Column('poll_id', sa.Integer(), nullable=False),
+        sa.Column('option_index', sa.Integer(), nullable=False),
+        *_setting_columns(),
+        sa.PrimaryKeyConstraint('poll_id', 'option_index'),
+    )
+    with op.batch_alter_table('polls', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('options', sa.String(), nullable=True))
+
+    columns = ', '.join(SETTING_COLUMNS)
+    op.execute(
+        f"INSERT INTO poll_option_settings (poll_id, option_index, {columns}) "
+        f"SELECT poll_id, option_index, {columns} FROM poll_options"
+    )
+    texts = {}
+    for poll_id, text in bind.execute(sa.text("SELECT poll_id, text FROM poll_options ORDER BY poll_id, option_index")):
+        texts.setdefault(poll_id, []).append(text)
+    for poll_id, options in texts.items():
+        bind.execute(sa.text("UPDATE polls SET options = :options WHERE poll_id = :poll_id"),
+                     {'options': ','.join(options), 'poll_id': poll_id})
+    op.drop_table('poll_options')
@@ -0,0 +1,32 @@
+"""add secondary indexes for hot lookups
+
+Revision ID: e8b4d1f7a3c9
+Revises: d5a2c7e9b1f4
+Create Date: 2026-10-18 18:00:00.000000
+
+responses(poll_id, user_id) needs no index of its own: it is the prefix of the
+responses primary key.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e8b4d1f7a3c9'
+down_revision: Union[str, None] = 'd5a2c7e9b1f4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_polls_chat_id_status', 'polls', ['chat_id', 'status'])
+    op.create_index('ix_responses_user_id', 'responses', ['user_id'])
+    op.create_index('ix_participants_user_id', 'participants', ['user_id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_participants_user_id', table_name='participants')
+    op.drop_index('ix_responses_user_id', table_name='responses')
+    op.drop_index('ix_polls_chat_id_status', table_name='polls')
@@ -0,0 +1,33 @@
+"""add processed_updates for webhook redelivery dedup
+
+Revision ID: f3a7c9e1b5d8
+Revises: e8b4d1f7a3c9
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3a7c9e1b5d8'
+down_revision: Union[str, None] = 'e8b4d1f7a3c9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'processed_updates',
+        sa.Column('update_id', sa.BigInteger(), nullable=False),
+        sa.Column('received_at', sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint('update_id'),
+    )
+    op.create_index('ix_processed_updates_received_at', 'processed_updates', ['received_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_processed_updates_received_at', table_name='processed_updates')
+    op.drop_table('processed_updates')
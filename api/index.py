@@ -13,6 +13,9 @@ from telegram import Update
 
 from src.config import BOT_TOKEN, logger
 from src.database import init_database
+from src.activity_buffer import activity_buffer
+from src.update_queue import parse_update
+from src.update_dedup import make_deduplicator
 from src.handlers import admin, dashboard, voting, text, results, misc, base, settings
 
 # Initialize DB (it's an empty function now, but good practice)
@@ -66,6 +69,9 @@ application = Application.builder().token(BOT_TOKEN).build()
 application.bot_data['BUNDLED_WEB_APPS'] = BUNDLED_WEB_APPS
 
 # Register all handlers
+# One unit of work (DB session) per update: opened before and committed after all other groups.
+application.add_handler(TypeHandler(Update, base.begin_unit_of_work), group=-100)
+application.add_handler(TypeHandler(Update, base.finish_unit_of_work), group=100)
 application.add_handler(TypeHandler(Update, base.track_chats), group=-1)
 application.add_handler(MessageHandler(filters.ChatType.GROUPS, base.register_user_activity), group=-2)
 application.add_handler(CommandHandler("start", base.start))
@@ -84,6 +90,12 @@ application.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, misc.w
 application.add_handler(MessageHandler(filters.FORWARDED, misc.forwarded_message_handler))
 application.add_error_handler(base.error_handler)
 
+# The instance may be frozen right after the response: a vote refreshes its poll message before it.
+voting.poll_refresher.inline = True
+
+# Instances come and go, so only UPDATE_DEDUP=database catches redeliveries reliably here.
+update_dedup = make_deduplicator()
+
 # --- Starlette Server Setup for Vercel ---
 async def root(request: Request):
     return PlainTextResponse("Web server is running.")
@@ -93,9 +105,21 @@ async def telegram_webhook(request: Request) -> JSONResponse:
     if not application.initialized:
         await application.initialize()
 
-    update_data = await request.json()
-    update = Update.de_json(data=update_data, bot=application.bot)
+    try:
+        update_data = await request.json()
+    except ValueError:
+        return JSONResponse({"ok": False, "error": "invalid JSON"}, status_code=400)
+    update = parse_update(update_data, application.bot)
+    if update is None:
+        return JSONResponse({"ok": False, "error": "not a Telegram update"}, status_code=400)
+    if not await update_dedup.claim(update.update_id):
+        return JSONResponse({"ok": True})  # a redelivery: processed (or being processed) already
+    # Always inline here: a serverless instance may be frozen as soon as the response is sent,
+    # so updates cannot be left to background workers (WEBHOOK_MODE=queue is for bot.py).
+    # Handler errors end in the error handler, not here: the update stays claimed.
     await application.process_update(update)
+    # The instance may be frozen right after the response: no background flushes here.
+    await activity_buffer.flush()
     return JSONResponse({"ok": True})
 
 routes = [
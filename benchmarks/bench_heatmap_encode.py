@@ -0,0 +1,97 @@
+"""
+Heatmap encoder benchmark: encode time versus bytes uploaded.
+
+Draws heatmaps for several typical poll sizes (participants x options, about
+40% of cells voted) and encodes each with every registered encoder and a few
+PNG compression levels. Reports the median encode time, the output size and
+the size relative to the default full-colour PNG. For lossy encoders the mean
+absolute pixel error against the drawn image is shown as well.
+
+Usage:
+    python benchmarks/bench_heatmap_encode.py
+    python benchmarks/bench_heatmap_encode.py --sizes 10x3 200x10 --repeat 3
+"""
+import argparse
+import functools
+import io
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--sizes', nargs='+', default=['10x3', '30x5', '80x7', '200x10'],
+                    help='poll sizes as PARTICIPANTSxOPTIONS')
+parser.add_argument('--repeat', type=int, default=5)
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import logging  # noqa: E402
+from PIL import Image, ImageChops, ImageStat  # noqa: E402
+from src import drawing, image_encoders  # noqa: E402
+from src.database import Participant, Poll, Response, User  # noqa: E402
+from src.snapshot import build_snapshot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def make_image(participants, options):
+    rng = random.Random(args.seed)
+    names = [f'Вариант {i + 1}' for i in range(options)]
+    poll = Poll(poll_id=1, chat_id=-100500, message='Benchmark', options=names, poll_type='native', status='active', version=0)
+    people = [Participant(user_id=uid, first_name=f'Участник {uid}', excluded=0) for uid in range(participants)]
+    users = [User(user_id=uid, first_name=f'Участник {uid}') for uid in range(participants)]
+    responses = [Response(user_id=uid, response=option) for uid in range(participants)
+                 for option in names if rng.random() < 0.4]
+    layout, cells = drawing.build_heatmap_model(1, build_snapshot(poll, responses=responses, participants=people, users=users))
+    return drawing.HeatmapRenderer(max_polls=0)._draw_full(layout, cells).image
+
+
+def encoders():
+    """(label, callable) pairs: every registered encoder plus PNG compression levels."""
+    names = sorted(image_encoders.available_encoders(), key=lambda name: name != 'png')  # baseline first
+    variants = [(name, functools.partial(image_encoders.encode_image, fmt=name)) for name in names]
+    for level in (1, 9):
+        def png_level(image, level=level):
+            buffer = io.BytesIO()
+            image.save(buffer, format='PNG', compress_level=level)
+            return buffer
+        variants.append((f'png level={level}', png_level))
+    def png_optimize(image):
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG', optimize=True)
+        return buffer
+    variants.append(('png optimize', png_optimize))
+    return variants
+
+
+def measure(encode, image):
+    times, data = [], b''
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        data = encode(image).getvalue()
+        times.append((time.perf_counter() - started) * 1000)
+    decoded = Image.open(io.BytesIO(data)).convert('RGB')
+    error = sum(ImageStat.Stat(ImageChops.difference(image, decoded)).mean) / 3
+    return statistics.median(times), len(data), error
+
+
+def main():
+    for size in args.sizes:
+        participants, options = (int(part) for part in size.lower().split('x'))
+        image = make_image(participants, options)
+        print(f"\n{participants} participants x {options} options ({image.width}x{image.height} px), median of {args.repeat}")
+        print(f"{'encoder':<16} {'encode':>9} {'bytes':>10} {'vs png':>7} {'error':>6}")
+        baseline = None
+        for label, encode in encoders():
+            ms, size_bytes, error = measure(encode, image)
+            if label == 'png':
+                baseline = size_bytes
+            ratio = f"{size_bytes / baseline:6.2f}x"
+            print(f"{label:<16} {ms:7.1f}ms {size_bytes:10d} {ratio:>7} {error:6.2f}")
+
+
+if __name__ == '__main__':
+    main()
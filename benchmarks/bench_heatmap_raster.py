@@ -0,0 +1,99 @@
+"""
+Vote-grid rasterizer benchmark: Pillow cell-by-cell loop vs. numpy stamps.
+
+Builds an in-memory poll with N participants x M options and times, for each
+rasterizer, the vote-grid phase (cells plus the layout tiles kept for
+incremental repaints) and the whole draw (layout, cells, grid lines and RGB
+conversion, without PNG encoding). Both images are checked to be
+pixel-identical.
+
+Usage:
+    python benchmarks/bench_heatmap_raster.py
+    python benchmarks/bench_heatmap_raster.py --participants 200 --options 10 --repeat 5
+"""
+import argparse
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--participants', type=int, default=200)
+parser.add_argument('--options', type=int, default=10)
+parser.add_argument('--repeat', type=int, default=5)
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import logging  # noqa: E402
+from PIL import Image, ImageChops, ImageDraw  # noqa: E402
+from src import drawing  # noqa: E402
+from src.database import Participant, Poll, Response, User  # noqa: E402
+from src.snapshot import build_snapshot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+if drawing.np is None:
+    sys.exit('numpy is not installed; only the Pillow rasterizer is available')
+
+OPTIONS = [f'Вариант {i + 1}' for i in range(args.options)]
+
+
+def make_model():
+    rng = random.Random(args.seed)
+    poll = Poll(poll_id=1, chat_id=-100500, message='Benchmark', options=OPTIONS, poll_type='native', status='active', version=0)
+    participants = [Participant(user_id=uid, first_name=f'Участник {uid}', excluded=0) for uid in range(args.participants)]
+    users = [User(user_id=uid, first_name=f'Участник {uid}') for uid in range(args.participants)]
+    responses = [Response(user_id=uid, response=option) for uid in range(args.participants)
+                 for option in OPTIONS if rng.random() < 0.4]
+    return drawing.build_heatmap_model(1, build_snapshot(poll, responses=responses, participants=participants, users=users))
+
+
+def paint_grid(vectorized, image, layout, geom, cells):
+    if vectorized:
+        drawing._paint_cells_vectorized(image, layout, geom, cells)
+        return
+    drawing._layout_tiles(image, layout, geom)
+    draw = ImageDraw.Draw(image, 'RGBA')
+    for p_idx, row in enumerate(cells):
+        for o_idx, state in enumerate(row):
+            x, y = drawing._cell_origin(geom, p_idx, o_idx)
+            drawing._draw_cell(draw, x, y, drawing._cell_radius(layout, p_idx, o_idx), state)
+
+
+def run(vectorized, layout, cells):
+    geom = drawing._geometry(layout)
+    background = Image.new('RGBA', (geom.width, geom.height), (255, 255, 255, 0))
+    drawing._draw_layout(ImageDraw.Draw(background, 'RGBA'), layout, geom)
+
+    drawing.VECTOR_CELLS = vectorized
+    grid_ms, full_ms, image = [], [], None
+    for _ in range(args.repeat):
+        canvas = background.copy()
+        started = time.perf_counter()
+        paint_grid(vectorized, canvas, layout, geom, cells)
+        grid_ms.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        image = drawing.HeatmapRenderer()._draw_full(layout, cells).image
+        full_ms.append((time.perf_counter() - started) * 1000)
+    return statistics.median(grid_ms), statistics.median(full_ms), image
+
+
+def main():
+    layout, cells = make_model()
+    pillow_grid, pillow_full, pillow_image = run(False, layout, cells)
+    numpy_grid, numpy_full, numpy_image = run(True, layout, cells)
+    if ImageChops.difference(pillow_image, numpy_image).getbbox() is not None:
+        sys.exit('numpy rasterizer output differs from Pillow')
+
+    print(f"{args.participants} participants x {args.options} options, median of {args.repeat}")
+    print(f"{'':<8} {'vote grid':>10} {'full draw':>10}")
+    print(f"{'pillow':<8} {pillow_grid:8.1f}ms {pillow_full:8.1f}ms")
+    print(f"{'numpy':<8} {numpy_grid:8.1f}ms {numpy_full:8.1f}ms")
+    print(f"speedup  {pillow_grid / numpy_grid:9.1f}x {pillow_full / numpy_full:9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
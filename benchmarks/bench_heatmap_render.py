@@ -0,0 +1,90 @@
+"""
+Heatmap render benchmark: full redraw vs. incremental repaint of changed cells.
+
+Builds an in-memory poll with N participants x M options and replays single-vote
+changes. Each change is rendered twice: from scratch (empty layer cache) and
+incrementally (cached layout, only changed cells repainted). PNG encoding is
+timed separately because both paths pay it, and every incremental image is
+checked to be pixel-identical to the full render.
+
+Usage:
+    python benchmarks/bench_heatmap_render.py
+    python benchmarks/bench_heatmap_render.py --participants 100 --options 8 --votes 50
+"""
+import argparse
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--participants', type=int, default=100)
+parser.add_argument('--options', type=int, default=8)
+parser.add_argument('--votes', type=int, default=50, help='number of single-vote changes to replay')
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import logging  # noqa: E402
+from PIL import Image, ImageChops  # noqa: E402
+from src import drawing  # noqa: E402
+from src.database import Participant, Poll, Response, User  # noqa: E402
+from src.snapshot import build_snapshot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+OPTIONS = [f'Вариант {i + 1}' for i in range(args.options)]
+
+
+def make_snapshot(votes):
+    poll = Poll(poll_id=1, chat_id=-100500, message='Benchmark', options=OPTIONS, poll_type='native', status='active', version=0)
+    participants = [Participant(user_id=uid, first_name=f'Участник {uid}', excluded=0) for uid in range(args.participants)]
+    users = [User(user_id=uid, first_name=f'Участник {uid}') for uid in range(args.participants)]
+    responses = [Response(user_id=uid, response=option) for uid, option in sorted(votes)]
+    return build_snapshot(poll, responses=responses, participants=participants, users=users)
+
+
+def timed(fn):
+    started = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - started) * 1000
+
+
+def main():
+    rng = random.Random(args.seed)
+    votes = {(uid, rng.choice(OPTIONS)) for uid in range(args.participants) if rng.random() < 0.7}
+
+    full = drawing.HeatmapRenderer()
+    incremental = drawing.HeatmapRenderer()
+    incremental.render(1, *drawing.build_heatmap_model(1, make_snapshot(votes)))
+
+    full_ms, incremental_ms, encode_ms, repainted = [], [], [], []
+    for _ in range(args.votes):
+        votes ^= {(rng.randrange(args.participants), rng.choice(OPTIONS))}
+        layout, cells = drawing.build_heatmap_model(1, make_snapshot(votes))
+
+        full.clear()
+        expected, ms = timed(lambda: full.render(1, layout, cells))
+        full_ms.append(ms)
+
+        before = drawing.metrics.get('heatmap_cells_repainted')
+        actual, ms = timed(lambda: incremental.render(1, layout, cells))
+        incremental_ms.append(ms)
+        repainted.append(drawing.metrics.get('heatmap_cells_repainted') - before)
+
+        image = Image.open(actual).convert('RGB')
+        _, ms = timed(lambda: drawing.encode_image(image))
+        encode_ms.append(ms)
+        if ImageChops.difference(Image.open(expected).convert('RGB'), image).getbbox() is not None:
+            sys.exit('incremental render differs from full render')
+
+    print(f"{args.participants} participants x {args.options} options, {args.votes} single-vote changes")
+    print(f"full        median={statistics.median(full_ms):8.1f} ms  max={max(full_ms):8.1f} ms")
+    print(f"incremental median={statistics.median(incremental_ms):8.1f} ms  max={max(incremental_ms):8.1f} ms  "
+          f"cells repainted median={statistics.median(repainted):.0f}")
+    print(f"encode      median={statistics.median(encode_ms):8.1f} ms  (included in both)")
+
+
+if __name__ == '__main__':
+    main()
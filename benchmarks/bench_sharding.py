@@ -0,0 +1,199 @@
+"""
+Sharded deployment scaling: the same vote traffic through the ShardRouter of
+WEBHOOK_MODE=sharded with 1, 2 and 4 worker processes.
+
+This process plays the web server: it routes every update by chat to a worker
+over the multiprocessing inboxes of src/sharding.py. Every worker runs a PTB
+Application with the keyed update processor of bot.py. Its vote handler records
+the vote in a shared SQLite database (record_vote through the DB executor),
+renders the poll (text and heatmap, through the render pool, as
+update_poll_message does) and waits --rtt milliseconds for the simulated
+answerCallbackQuery round-trip.
+
+Rendering is CPU work under the GIL, so one process tops out at roughly one
+core; the workers spread it over several cores, while the SQLite writes stay
+serialized by the database lock. Each worker counts how many updates it got
+(balance of the crc32 routing); every chat must have been handled by a single
+worker, in order, and the stored tallies must match the responses.
+
+Usage:
+    python benchmarks/bench_sharding.py
+    python benchmarks/bench_sharding.py --workers 1,2,4,8 --chats 200 --votes 10 --no-heatmap
+"""
+import argparse
+import asyncio
+import functools
+import multiprocessing
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--workers', default='1,2,4', help='comma-separated worker counts to compare')
+parser.add_argument('--chats', type=int, default=64)
+parser.add_argument('--votes', type=int, default=10, help='votes per chat')
+parser.add_argument('--rtt', type=float, default=20, help='simulated Telegram round-trip per vote, ms')
+parser.add_argument('--concurrency', type=int, default=8, help='updates running at once in each worker')
+parser.add_argument('--no-heatmap', action='store_true', help='render the text only')
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import logging  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from telegram import Update, User  # noqa: E402
+from telegram.ext import Application, CallbackQueryHandler, ExtBot  # noqa: E402
+from src import async_database as adb  # noqa: E402
+from src import database as db  # noqa: E402
+from src.display import generate_poll_content_async  # noqa: E402
+from src.render_pool import render_pool  # noqa: E402
+from src.sharding import ShardRouter, consume  # noqa: E402
+from src.update_processor import KeyedUpdateProcessor  # noqa: E402
+
+logging.disable(logging.WARNING)
+
+OPTIONS = ['Да', 'Нет', 'Может быть', 'Позже']
+
+
+class OfflineBot(ExtBot):
+    """Initializes without asking Telegram who it is; the vote handler never calls the API."""
+
+    async def get_me(self, *args, **kwargs) -> User:
+        self._bot_user = User(id=123, is_bot=True, first_name='Bench', username='bench_bot')
+        return self._bot_user
+
+
+def make_traffic():
+    rng = random.Random(args.seed)
+    chats = [chat for chat in range(args.chats) for _ in range(args.votes)]
+    rng.shuffle(chats)
+    return [{
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id), 'chat_instance': 'bench', 'data': f'vote:{chat + 1}:{rng.randrange(len(OPTIONS))}',
+            'from': {'id': 1000 + rng.randrange(200), 'is_bot': False, 'first_name': 'Участник'},
+            'message': {'message_id': 1, 'date': 0, 'chat': {'id': -100 - chat, 'type': 'supergroup'}},
+        },
+    } for update_id, chat in enumerate(chats)]
+
+
+def fresh_database(path):
+    for suffix in ('', '-wal', '-shm'):
+        Path(f'{path}{suffix}').unlink(missing_ok=True)
+    engine = db.make_engine(f'sqlite:///{path}')
+    db.Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+    session = factory()
+    for chat in range(args.chats):
+        session.add_all([db.Poll(poll_id=chat + 1, chat_id=-100 - chat, message=f'Опрос {chat}', options=OPTIONS, status='active'),
+                         db.PollSetting(poll_id=chat + 1, allow_multiple_answers=False, show_heatmap=not args.no_heatmap)])
+    session.commit()
+    session.close()
+    return engine, factory
+
+
+# --- Worker process ---
+
+def bench_worker(path, done, index, inbox):
+    engine = db.make_engine(f'sqlite:///{path}')
+    db.SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+    asyncio.run(serve(index, inbox, done))
+    engine.dispose()
+
+
+async def serve(index, inbox, done):
+    async def vote(update, context):
+        query = update.callback_query
+        _, poll_id, option = query.data.split(':')
+        await adb.record_vote(chat_id=query.message.chat.id, poll_id=int(poll_id), user_id=query.from_user.id,
+                              first_name=query.from_user.first_name, last_name=None, username=None,
+                              option_index=int(option))
+        await generate_poll_content_async(int(poll_id))
+        await asyncio.sleep(args.rtt / 1000)  # query.answer()
+        done.put((index, query.message.chat.id, update.update_id, time.monotonic()))
+
+    processor = KeyedUpdateProcessor(max_concurrent_updates=args.concurrency)
+    application = Application.builder().bot(OfflineBot('123:bench')).concurrent_updates(processor).build()
+    application.add_handler(CallbackQueryHandler(vote, pattern='^vote:'))
+    await application.initialize()
+
+    async def handle(payload):
+        # What handle_routed_update in bot.py does.
+        update = Update.de_json(payload, application.bot)
+        await processor.submit(update, application.process_update(update))
+
+    done.put('ready')
+    await consume(inbox, handle)
+    await processor.shutdown()
+    await application.shutdown()
+    render_pool.shutdown()
+    adb.shutdown_executor()
+
+
+# --- Web server side ---
+
+async def run(workers, traffic, path):
+    engine, factory = fresh_database(path)
+    done = multiprocessing.get_context('spawn').Queue()
+    router = ShardRouter(functools.partial(bench_worker, path, done), workers=workers, queue_size=len(traffic))
+    router.start()
+    for _ in range(workers):
+        assert await asyncio.to_thread(done.get, True, 60) == 'ready'
+
+    sent = {}
+    started = time.perf_counter()
+    for data in traffic:
+        sent[data['update_id']] = time.monotonic()
+        while not router.route(Update.de_json(data, None), data):
+            await asyncio.sleep(0.001)
+    handled = [await asyncio.to_thread(done.get, True, 120) for _ in traffic]
+    elapsed = time.perf_counter() - started
+    await router.stop()
+
+    per_chat = {}
+    for index, chat_id, update_id, _ in handled:
+        per_chat.setdefault(chat_id, []).append((index, update_id))
+    misrouted = sum(len({index for index, _ in votes}) > 1 for votes in per_chat.values())
+    out_of_order = sum([u for _, u in votes] != sorted(u for _, u in votes) for votes in per_chat.values())
+    session = factory()
+    try:
+        mismatches = db.check_poll_tallies(session)
+    finally:
+        session.close()
+    engine.dispose()
+    latencies = [finished - sent[update_id] for _, _, update_id, finished in handled]
+    balance = Counter(index for index, *_ in handled)
+    return elapsed, latencies, balance, misrouted + out_of_order, mismatches
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def main():
+    traffic = make_traffic()
+    counts = [int(n) for n in args.workers.split(',')]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in counts:
+            results[workers] = await run(workers, traffic, f'{tmp}/bench_shards.db')
+
+    print(f"{len(traffic)} votes in {args.chats} chats, rtt {args.rtt:g} ms, concurrency {args.concurrency} per worker, "
+          f"{'text only' if args.no_heatmap else 'text + heatmap'}")
+    base = results[counts[0]][0]
+    for workers, (elapsed, latencies, balance, violations, mismatches) in results.items():
+        shares = ' '.join(f'{balance[i]}' for i in range(workers))
+        print(f"{workers} workers {len(traffic) / elapsed:8.0f} votes/s  speedup {base / elapsed:4.1f}x"
+              f"  p50 {statistics.median(latencies) * 1000:8.1f} ms  p95 {percentile(latencies, 0.95) * 1000:8.1f} ms"
+              f"  votes per worker {shares}")
+        if violations or mismatches:
+            sys.exit(f'{workers} workers: chats split or out of order ({violations}), tallies inconsistent: {mismatches[:5]}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
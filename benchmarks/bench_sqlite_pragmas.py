@@ -0,0 +1,131 @@
+"""
+SQLite pragma profile benchmark: vote-write throughput with SQLite defaults
+(rollback journal, synchronous=FULL) vs. the tuned profile of make_engine
+(WAL, synchronous=NORMAL, busy_timeout, mmap, cache_size, temp_store).
+
+Every profile gets a fresh database file with one single-choice and one
+multiple-choice poll. --writers threads call record_vote (as the DB executor
+does) while --readers threads keep loading poll snapshots, as message refreshes
+do. Failed votes ("database is locked") are counted, and the vote tallies are
+checked afterwards.
+
+Usage:
+    python benchmarks/bench_sqlite_pragmas.py
+    python benchmarks/bench_sqlite_pragmas.py --votes 5000 --writers 8 --readers 4
+    python benchmarks/bench_sqlite_pragmas.py --dir /volume1/docker/tmp   # measure on the target disk
+"""
+import argparse
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--votes', type=int, default=2000)
+parser.add_argument('--users', type=int, default=200)
+parser.add_argument('--options', type=int, default=6)
+parser.add_argument('--writers', type=int, default=4, help='threads recording votes')
+parser.add_argument('--readers', type=int, default=2, help='threads loading poll snapshots meanwhile')
+parser.add_argument('--dir', default=None, help='directory for the database files (default: temporary)')
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import logging  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from src import database as db  # noqa: E402
+from src.snapshot import load_poll_snapshot  # noqa: E402
+
+logging.disable(logging.WARNING)
+
+CHAT_ID = -100500
+OPTIONS = [f'Вариант {i + 1}' for i in range(args.options)]
+
+
+def make_votes():
+    rng = random.Random(args.seed)
+    return [(rng.choice((1, 2)), rng.randrange(args.users), rng.randrange(args.options)) for _ in range(args.votes)]
+
+
+def fresh_database(path, profile):
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        Path(f'{path}{suffix}').unlink(missing_ok=True)
+    engine = db.make_engine(f'sqlite:///{path}', pragmas=db.sqlite_pragmas(profile), pool_size=args.writers + args.readers)
+    db.Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+    session = factory()
+    session.add_all([
+        db.Poll(poll_id=1, chat_id=CHAT_ID, message='Single', options=OPTIONS, status='active'),
+        db.PollSetting(poll_id=1, allow_multiple_answers=False),
+        db.Poll(poll_id=2, chat_id=CHAT_ID, message='Multiple', options=OPTIONS, status='active'),
+        db.PollSetting(poll_id=2, allow_multiple_answers=True),
+    ])
+    session.commit()
+    session.close()
+    db.SessionLocal = factory
+    return engine, factory
+
+
+def vote(poll_id, user_id, option_index):
+    try:
+        db.record_vote(chat_id=CHAT_ID, poll_id=poll_id, user_id=user_id, first_name=f'Участник {user_id}',
+                       last_name=None, username=None, option_index=option_index)
+        return True
+    except OperationalError:
+        return False
+
+
+def read_snapshots(stop, reads):
+    while not stop.is_set():
+        try:
+            load_poll_snapshot(random.choice((1, 2)))
+            reads.append(1)
+        except OperationalError:
+            pass
+
+
+def run(profile, path, votes):
+    engine, factory = fresh_database(path, profile)
+    stop, reads = threading.Event(), []
+    readers = [threading.Thread(target=read_snapshots, args=(stop, reads)) for _ in range(args.readers)]
+    for reader in readers:
+        reader.start()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.writers) as pool:
+        results = list(pool.map(lambda v: vote(*v), votes))
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    for reader in readers:
+        reader.join()
+    session = factory()
+    try:
+        mismatches = db.check_poll_tallies(session)
+    finally:
+        session.close()
+    engine.dispose()
+    return elapsed, results.count(False), len(reads), mismatches
+
+
+def main():
+    votes = make_votes()
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        path = f'{tmp}/bench_pragmas.db'
+        timings = {profile: run(profile, path, votes) for profile in ('default', 'tuned')}
+
+    print(f"{args.votes} votes, {args.writers} writer / {args.readers} reader threads, {args.users} users, {args.options} options")
+    for profile, (elapsed, failed, reads, mismatches) in timings.items():
+        print(f"{profile:8} {args.votes / elapsed:8.0f} votes/s  ({elapsed * 1000 / args.votes:.2f} ms/vote)"
+              f"  failed {failed:4}  snapshot reads {reads / elapsed:7.0f}/s")
+        if mismatches:
+            sys.exit(f'{profile}: vote tallies are inconsistent: {mismatches[:5]}')
+    print(f"speedup {timings['default'][0] / timings['tuned'][0]:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
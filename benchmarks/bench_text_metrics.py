@@ -0,0 +1,106 @@
+"""
+Text measuring microbenchmarks for the heatmap: name truncation and wrapping.
+
+Compares the previous character-by-character ``font.getlength`` loops with the
+glyph-metric cache (``drawing.truncate_text`` / ``drawing._wrap_text``) on
+Cyrillic participant names and option texts, and checks that both give the
+same result.
+
+Usage:
+    python benchmarks/bench_text_metrics.py
+    python benchmarks/bench_text_metrics.py --names 500 --repeat 5
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--names', type=int, default=200)
+parser.add_argument('--repeat', type=int, default=3)
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import logging  # noqa: E402
+from src import drawing  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+FIRST = ['Александр', 'Екатерина', 'Владимир', 'Анастасия', 'Константин', 'Маргарита', 'Святослав', 'Ярослава']
+LAST = ['Преображенский', 'Коновалова', 'Рождественский', 'Ворошилова', 'Щербаков', 'Голенищева-Кутузова']
+OPTIONS_WORDS = ['встреча', 'понедельник', 'вечером', 'после', 'работы', 'в', 'кафе', 'Достопримечательности']
+
+
+def truncate_loop(text, font, max_width):
+    """Name truncation as the heatmap did it before the glyph cache."""
+    if font.getlength(text) > max_width:
+        while font.getlength(text + '…') > max_width and len(text) > 1:
+            text = text[:-1]
+        text += '…'
+    return text
+
+
+def wrap_loop(text, font, max_width):
+    """Greedy word wrap with a getlength call per attempt, as before the glyph cache."""
+    if font.getlength(text) <= max_width:
+        return [text]
+    lines, words = [], text.split(' ')
+    while words:
+        line = ''
+        while words:
+            word = words[0]
+            if font.getlength(line + word + ' ') <= max_width:
+                line += words.pop(0) + ' '
+            elif not line:
+                truncated = ''
+                for char in word:
+                    if font.getlength(truncated + char) <= max_width:
+                        truncated += char
+                    else:
+                        break
+                lines.append(truncated)
+                if truncated and word[len(truncated):]:
+                    words[0] = word[len(truncated):]
+                else:
+                    words.pop(0)
+            else:
+                break
+        if line:
+            lines.append(line.strip())
+    return lines
+
+
+def bench(label, fn, items):
+    best = None
+    for _ in range(args.repeat):
+        drawing.glyph_metrics.cache_clear()  # every round starts cold
+        started = time.perf_counter()
+        result = [fn(item) for item in items]
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:<28} {best:8.2f} ms")
+    return result
+
+
+def main():
+    rng = random.Random(args.seed)
+    names = [f"{rng.choice(FIRST)} {rng.choice(LAST)} (@{rng.choice(LAST).lower()}{rng.randrange(100)})"
+             for _ in range(args.names)]
+    options = [' '.join(rng.choice(OPTIONS_WORDS) for _ in range(rng.randint(2, 8))) for _ in range(args.names)]
+    name_width = drawing.NAME_COLUMN_WIDTH - drawing.NUMBER_COL_WIDTH - 10
+    font = drawing.FONT_REGULAR
+
+    print(f"{args.names} Cyrillic names / option texts, best of {args.repeat}")
+    old = bench('truncate: getlength loop', lambda n: truncate_loop(n, font, name_width), names)
+    new = bench('truncate: glyph cache', lambda n: drawing.truncate_text(n, font, name_width), names)
+    assert old == new, 'truncation results differ'
+
+    old = bench('wrap: getlength loop', lambda o: wrap_loop(o, font, drawing.MIN_CELL_WIDTH - 10), options)
+    new = bench('wrap: glyph cache', lambda o: drawing._wrap_text(o, font, drawing.MIN_CELL_WIDTH - 10), options)
+    assert old == new, 'wrapping results differ'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+Update processor load test: interleaved vote traffic of many chats through a
+real PTB Application, once serialized (PTB's default, one update at a time) and
+once with the KeyedUpdateProcessor of bot.py.
+
+Every chat has one poll. The vote handler records the vote in a fresh SQLite
+database (record_vote through the DB executor, as voting.py does) and then
+waits --rtt milliseconds for the simulated answerCallbackQuery round-trip.
+--hot-share of all votes goes to chat 0, a group in the middle of a vote storm;
+the latency of the other ("quiet") chats shows whether it stalls them.
+
+The per-chat order of the handled votes is checked for both processors, and
+the stored tallies are checked against the responses.
+
+Usage:
+    python benchmarks/bench_update_processor.py
+    python benchmarks/bench_update_processor.py --chats 100 --votes 20 --rtt 30 --concurrency 16
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--chats', type=int, default=100)
+parser.add_argument('--votes', type=int, default=20, help='votes per chat (on average)')
+parser.add_argument('--hot-share', type=float, default=0.3, help='share of all votes going to chat 0')
+parser.add_argument('--rtt', type=float, default=20, help='simulated Telegram round-trip per vote, ms')
+parser.add_argument('--concurrency', type=int, default=16, help='updates running at once (keyed processor)')
+parser.add_argument('--rate', type=float, default=0, help='arrivals per second (0: all at once)')
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import logging  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from telegram import Update, User  # noqa: E402
+from telegram.ext import Application, CallbackQueryHandler, ExtBot, SimpleUpdateProcessor  # noqa: E402
+from src import async_database as adb  # noqa: E402
+from src import database as db  # noqa: E402
+from src.update_processor import KeyedUpdateProcessor  # noqa: E402
+
+logging.disable(logging.WARNING)
+
+OPTIONS = ['A', 'B', 'C', 'D']
+
+
+class OfflineBot(ExtBot):
+    """Initializes without asking Telegram who it is; the vote handler never calls the API."""
+
+    async def get_me(self, *args, **kwargs) -> User:
+        self._bot_user = User(id=123, is_bot=True, first_name='Bench', username='bench_bot')
+        return self._bot_user
+
+
+def make_traffic():
+    rng = random.Random(args.seed)
+    total = args.chats * args.votes
+    chats = [0 if rng.random() < args.hot_share else rng.randrange(1, args.chats) for _ in range(total)]
+    return [{
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id), 'chat_instance': 'bench', 'data': f'vote:{chat + 1}:{rng.randrange(len(OPTIONS))}',
+            'from': {'id': 1000 + rng.randrange(200), 'is_bot': False, 'first_name': 'Участник'},
+            'message': {'message_id': 1, 'date': 0, 'chat': {'id': -100 - chat, 'type': 'supergroup'}},
+        },
+    } for update_id, chat in enumerate(chats)]
+
+
+def fresh_database(path):
+    for suffix in ('', '-wal', '-shm'):
+        Path(f'{path}{suffix}').unlink(missing_ok=True)
+    engine = db.make_engine(f'sqlite:///{path}')
+    db.Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+    session = factory()
+    for chat in range(args.chats):
+        session.add_all([db.Poll(poll_id=chat + 1, chat_id=-100 - chat, message=f'Опрос {chat}', options=OPTIONS, status='active'),
+                         db.PollSetting(poll_id=chat + 1, allow_multiple_answers=False)])
+    session.commit()
+    session.close()
+    db.SessionLocal = factory
+    return engine, factory
+
+
+async def run(processor, traffic, path):
+    engine, factory = fresh_database(path)
+    handled, latencies = [], {}
+    arrived = {}
+
+    async def vote(update, context):
+        query = update.callback_query
+        _, poll_id, option = query.data.split(':')
+        await adb.record_vote(chat_id=query.message.chat.id, poll_id=int(poll_id), user_id=query.from_user.id,
+                              first_name=query.from_user.first_name, last_name=None, username=None,
+                              option_index=int(option))
+        await asyncio.sleep(args.rtt / 1000)  # query.answer()
+        handled.append((query.message.chat.id, update.update_id))
+        latencies[update.update_id] = time.perf_counter() - arrived[update.update_id]
+
+    application = Application.builder().bot(OfflineBot('123:bench')).concurrent_updates(processor).build()
+    application.add_handler(CallbackQueryHandler(vote, pattern='^vote:'))
+    await application.initialize()
+
+    started = time.perf_counter()
+    tasks = []
+    for data in traffic:
+        update = Update.de_json(data, application.bot)
+        arrived[update.update_id] = time.perf_counter()
+        # What the webhook endpoint does for every request.
+        tasks.append(asyncio.create_task(processor.process_update(update, application.process_update(update))))
+        if args.rate:
+            await asyncio.sleep(1 / args.rate)
+        else:
+            await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    await application.shutdown()
+
+    per_chat = {}
+    for chat_id, update_id in handled:
+        per_chat.setdefault(chat_id, []).append(update_id)
+    out_of_order = sum(ids != sorted(ids) for ids in per_chat.values())
+    session = factory()
+    try:
+        mismatches = db.check_poll_tallies(session)
+    finally:
+        session.close()
+    engine.dispose()
+    quiet = [latencies[d['update_id']] for d in traffic if d['callback_query']['message']['chat']['id'] != -100]
+    return elapsed, quiet, out_of_order, mismatches
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def main():
+    traffic = make_traffic()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, processor in (('serial', SimpleUpdateProcessor(1)),
+                                ('keyed', KeyedUpdateProcessor(max_concurrent_updates=args.concurrency))):
+            results[name] = await run(processor, traffic, f'{tmp}/bench_updates.db')
+    adb.shutdown_executor()
+
+    print(f"{len(traffic)} votes in {args.chats} chats ({args.hot_share:.0%} in the hot chat), rtt {args.rtt:g} ms, "
+          f"keyed concurrency {args.concurrency}")
+    for name, (elapsed, quiet, out_of_order, mismatches) in results.items():
+        print(f"{name:7} {len(traffic) / elapsed:8.0f} votes/s  quiet chats p50 {statistics.median(quiet) * 1000:8.1f} ms"
+              f"  p95 {percentile(quiet, 0.95) * 1000:8.1f} ms  chats out of order {out_of_order}")
+        if out_of_order or mismatches:
+            sys.exit(f'{name}: per-chat order violated or tallies inconsistent: {mismatches[:5]}')
+    print(f"speedup {results['serial'][0] / results['keyed'][0]:.1f}x")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
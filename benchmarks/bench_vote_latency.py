@@ -0,0 +1,113 @@
+"""
+Vote callback latency benchmark: blocking ORM calls vs. the async data-access layer.
+
+Simulates N voters pressing a button at the same moment. Each simulated callback
+does what ``vote_callback_handler`` does on the DB side (participant upsert +
+response toggle) and then awaits a fake Telegram round-trip. A probe task
+measures event-loop lag while the storm is running.
+
+Usage:
+    python benchmarks/bench_vote_latency.py                      # temp SQLite file
+    python benchmarks/bench_vote_latency.py postgresql://u:p@host/db
+    python benchmarks/bench_vote_latency.py --voters 50 --rounds 5
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('database_url', nargs='?', help='SQLAlchemy URL; defaults to a temporary SQLite file')
+parser.add_argument('--voters', type=int, default=50)
+parser.add_argument('--rounds', type=int, default=5)
+parser.add_argument('--network-ms', type=float, default=20.0, help='simulated Telegram API round-trip')
+args = parser.parse_args()
+
+_tmpdir = None
+if args.database_url:
+    os.environ['DATABASE_URL'] = args.database_url
+else:
+    _tmpdir = tempfile.TemporaryDirectory()
+    os.environ['DATABASE_URL'] = f"sqlite:///{Path(_tmpdir.name) / 'bench.db'}"
+
+# DATABASE_URL must be set before src.database creates the engine.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import logging  # noqa: E402
+from src import database as db  # noqa: E402
+from src import async_database as adb  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+CHAT_ID = -100500
+OPTIONS = ['Да', 'Нет', 'Может быть']
+
+
+def setup_poll() -> int:
+    db.Base.metadata.create_all(db.engine)
+    poll = db.Poll(chat_id=CHAT_ID, message='Benchmark', status='active', options=OPTIONS, poll_type='native')
+    return db.add_poll(poll)
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[k]
+
+
+async def vote_blocking(poll_id: int, user_id: int, option_index: int):
+    db.add_user_to_participants(chat_id=CHAT_ID, user_id=user_id, username=f'u{user_id}', first_name='User', last_name=str(user_id))
+    db.add_or_update_response(poll_id=poll_id, user_id=user_id, first_name='User', last_name=str(user_id), username=f'u{user_id}', option_index=option_index)
+    await asyncio.sleep(args.network_ms / 1000)
+
+
+async def vote_offloaded(poll_id: int, user_id: int, option_index: int):
+    await adb.add_user_to_participants(chat_id=CHAT_ID, user_id=user_id, username=f'u{user_id}', first_name='User', last_name=str(user_id))
+    await adb.add_or_update_response(poll_id=poll_id, user_id=user_id, first_name='User', last_name=str(user_id), username=f'u{user_id}', option_index=option_index)
+    await asyncio.sleep(args.network_ms / 1000)
+
+
+async def loop_lag_probe(stop: asyncio.Event, samples: list, interval: float = 0.005):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append((loop.time() - started - interval) * 1000)
+
+
+async def run_mode(name: str, handler, poll_id: int):
+    latencies, lags = [], []
+    for round_no in range(args.rounds):
+        stop = asyncio.Event()
+        probe = asyncio.create_task(loop_lag_probe(stop, lags))
+
+        # All updates arrive at once: latency counts from arrival, so time spent
+        # waiting for a blocked loop to reach the handler is included.
+        arrived = time.perf_counter()
+
+        async def one(user_id: int):
+            await handler(poll_id, user_id, (user_id + round_no) % len(OPTIONS))
+            latencies.append((time.perf_counter() - arrived) * 1000)
+
+        await asyncio.gather(*(one(1000 + i) for i in range(args.voters)))
+        stop.set()
+        await probe
+
+    print(f"{name:<10} p50={statistics.median(latencies):8.1f} ms  p99={percentile(latencies, 99):8.1f} ms  "
+          f"max loop lag={max(lags or [0]):8.1f} ms")
+
+
+async def main():
+    poll_id = setup_poll()
+    print(f"{db.engine.url.get_backend_name()}: {args.voters} concurrent voters x {args.rounds} rounds, "
+          f"{adb.DB_EXECUTOR_WORKERS} DB workers, {args.network_ms:.0f} ms simulated network")
+    await run_mode('blocking', vote_blocking, poll_id)
+    await run_mode('offloaded', vote_offloaded, poll_id)
+    adb.shutdown_executor()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -2,6 +2,7 @@ import asyncio
 import os
 import json
 import importlib.util
+import signal
 import sys
 from contextlib import asynccontextmanager
 
@@ -17,8 +18,16 @@ from starlette.staticfiles import StaticFiles
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler, TypeHandler
 from telegram import Update
 
-from src.config import BOT_TOKEN, logger, WEB_URL, DEV_MODE
-from src.database import init_database
+from src.config import BOT_TOKEN, logger, WEB_URL, DEV_MODE, WEBHOOK_MODE, METRICS_TOKEN
+from src.database import init_database, close_database
+from src import async_database as adb
+from src import metrics
+from src.render_pool import render_pool
+from src.activity_buffer import activity_buffer
+from src.update_queue import UpdateQueue, parse_update
+from src.update_processor import KeyedUpdateProcessor
+from src.update_dedup import make_deduplicator
+from src import sharding
 from src.handlers import admin, dashboard, voting, text, results, misc, base, settings
 from src.modules.base import PollModuleBase
 import pkgutil
@@ -93,11 +102,19 @@ def load_bundled_web_apps():
 
 
 # --- PTB Application Setup ---
-application = Application.builder().token(BOT_TOKEN).build()
+# Updates of different chats are processed concurrently, the updates of one chat strictly in order.
+update_processor = KeyedUpdateProcessor()
+application = Application.builder().token(BOT_TOKEN).concurrent_updates(update_processor).build()
+metrics.register_gauge('updates_running', update_processor.running)
+metrics.register_gauge('updates_pending', update_processor.pending)
+metrics.register_gauge('update_chats_busy', update_processor.busy_keys)
 
 discover_and_register_modules(application)
 
 # Register all handlers
+# One unit of work (DB session) per update: opened before and committed after all other groups.
+application.add_handler(TypeHandler(Update, base.begin_unit_of_work), group=-100)
+application.add_handler(TypeHandler(Update, base.finish_unit_of_work), group=100)
 application.add_handler(TypeHandler(Update, base.track_chats), group=-1)
 application.add_handler(TypeHandler(Update, base.log_all_updates), group=-1)
 application.add_handler(MessageHandler(filters.ChatType.GROUPS, base.register_user_activity), group=-2)
@@ -118,6 +135,58 @@ application.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, misc.w
 application.add_handler(MessageHandler(filters.FORWARDED, misc.forwarded_message_handler))
 application.add_error_handler(base.error_handler)
 
+async def hand_over_update(update: Update) -> None:
+    """Passes a queued update on to the update processor; returns once it is accepted, not processed."""
+    await update_processor.submit(update, application.process_update(update))
+
+# Redeliveries of an update already taken are acknowledged without processing it again.
+update_dedup = make_deduplicator()
+metrics.register_gauge('update_dedup_entries', lambda: len(update_dedup))
+
+# WEBHOOK_MODE=queue: the webhook answers Telegram at once, worker tasks hand the updates over.
+update_queue = UpdateQueue(hand_over_update) if WEBHOOK_MODE == 'queue' else None
+if update_queue is not None:
+    metrics.register_gauge('webhook_queue_depth', update_queue.depth)
+    metrics.register_gauge('webhook_workers_busy', update_queue.busy)
+
+
+# --- Shard workers (WEBHOOK_MODE=sharded) ---
+async def handle_routed_update(payload: dict) -> None:
+    """Hands an update routed to this worker over to the update processor."""
+    update = parse_update(payload, application.bot)
+    if update is not None:
+        await hand_over_update(update)
+
+async def serve_shard(index: int, inbox) -> None:
+    """Runs the bot in a shard worker process until the web server stops it."""
+    init_database()
+    application.bot_data['BUNDLED_WEB_APPS'] = BUNDLED_WEB_APPS
+    await application.initialize()
+    logger.info(f"Shard worker {index} started (pid {os.getpid()}).")
+    try:
+        await sharding.consume(inbox, handle_routed_update)
+    finally:
+        await update_processor.shutdown()
+        await voting.poll_refresher.shutdown()
+        await application.shutdown()
+        await activity_buffer.shutdown()
+        render_pool.shutdown()
+        adb.shutdown_executor()
+        close_database()
+        logger.info(f"Shard worker {index} shut down.")
+
+def run_shard(index: int, inbox) -> None:
+    """Entry point of a shard worker process, started by the ShardRouter of the web server."""
+    # Ctrl+C reaches the whole process group; the web server stops its workers itself.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_shard(index, inbox))
+
+# WEBHOOK_MODE=sharded: this process only routes; the updates of each chat go to the same worker process.
+shard_router = sharding.ShardRouter(run_shard) if WEBHOOK_MODE == 'sharded' else None
+if shard_router is not None:
+    metrics.register_gauge('shard_queue_depth', shard_router.depth)
+    metrics.register_gauge('shard_workers_alive', shard_router.alive)
+
 
 # --- Lifespan and Starlette Server Setup ---
 @asynccontextmanager
@@ -128,11 +197,26 @@ async def lifespan(app: Starlette):
     application.bot_data['BUNDLED_WEB_APPS'] = BUNDLED_WEB_APPS
     
     await application.initialize()
+    if update_queue is not None:
+        update_queue.start()
+    if shard_router is not None:
+        shard_router.start()
     await application.bot.set_webhook(url=f"{WEB_URL}/telegram", allowed_updates=Update.ALL_TYPES)
     logger.info("Bot initialized and webhook set.")
     yield
     logger.info("Server shutting down...")
+    if shard_router is not None:
+        await shard_router.stop()
+    if update_queue is not None:
+        await update_queue.stop()
+    # Let the accepted updates finish before their poll refreshes and the DB threads go away.
+    await update_processor.shutdown()
+    await voting.poll_refresher.shutdown()
     await application.shutdown()
+    await activity_buffer.shutdown()
+    render_pool.shutdown()
+    adb.shutdown_executor()
+    close_database()
     logger.info("Bot shut down.")
 
 
@@ -140,11 +224,42 @@ async def root(request: Request):
     """A simple root endpoint to confirm the server is running."""
     return PlainTextResponse("Web server is running.")
 
+async def metrics_endpoint(request: Request) -> JSONResponse:
+    """Exposes the process counters (edits sent/skipped, render cache hits, ...) to holders of METRICS_TOKEN."""
+    if not metrics.is_authorized(request.headers.get('authorization'), METRICS_TOKEN):
+        return JSONResponse({"ok": False, "error": "unauthorized"}, status_code=401)
+    return JSONResponse(metrics.snapshot())
+
 async def telegram_webhook(request: Request) -> JSONResponse:
-    """Handles incoming Telegram updates by passing them to the application for direct processing."""
-    update_data = await request.json()
-    update = Update.de_json(data=update_data, bot=application.bot)
-    await application.process_update(update)
+    """
+    Handles incoming Telegram updates: processes them directly or, in queue and sharded mode,
+    hands them over and answers at once.
+    """
+    try:
+        update_data = await request.json()
+    except ValueError:
+        return JSONResponse({"ok": False, "error": "invalid JSON"}, status_code=400)
+    update = parse_update(update_data, application.bot)
+    if update is None:
+        return JSONResponse({"ok": False, "error": "not a Telegram update"}, status_code=400)
+    if not await update_dedup.claim(update.update_id):
+        return JSONResponse({"ok": True})  # a redelivery: processed (or being processed) already
+
+    if update_queue is not None:
+        if not update_queue.enqueue(update):
+            # Telegram keeps the update and delivers it again later.
+            await update_dedup.release(update.update_id)
+            return JSONResponse({"ok": False, "error": "update queue is full"}, status_code=503)
+        return JSONResponse({"ok": True})
+
+    if shard_router is not None:
+        if not shard_router.route(update, update_data):
+            await update_dedup.release(update.update_id)
+            return JSONResponse({"ok": False, "error": "shard inbox is full"}, status_code=503)
+        return JSONResponse({"ok": True})
+
+    # Handler errors end in the error handler, not here: the update stays claimed.
+    await update_processor.process_update(update, application.process_update(update))
     return JSONResponse({"ok": True})
 
 # --- Dynamic Route Mounting ---
@@ -155,6 +270,8 @@ routes = [
     Route("/", endpoint=root),
     Route("/telegram", endpoint=telegram_webhook, methods=["POST"]),
 ]
+if METRICS_TOKEN:
+    routes.append(Route("/metrics", endpoint=metrics_endpoint))
 
 # Mount routes and static files for each bundled web app
 for app_id, app_data in BUNDLED_WEB_APPS.items():
@@ -193,7 +310,14 @@ async def main() -> None:
         finally:
             await application.updater.stop()
             await application.stop()
+            # Updates already handed to the processor finish before their poll refreshes are cancelled.
+            await update_processor.shutdown()
+            await voting.poll_refresher.shutdown()
+            await activity_buffer.shutdown()
 
+    render_pool.shutdown()
+    adb.shutdown_executor()
+    close_database()
     logger.info("Bot shutdown complete.")
 
 
@@ -0,0 +1,209 @@
+"""
+Write-behind buffer for chat and member activity.
+
+``track_chats`` sees every update and ``register_user_activity`` every group
+message. Writing each of them right away costs a SELECT plus a commit per
+update (two write transactions per group message), although the chat title and
+the sender are almost always the same as a moment ago. ``ActivityBuffer``
+instead:
+
+* skips entries that were written with the same values within ``seen_ttl``
+  seconds (the "seen recently" cache, LRU-bounded by ``max_seen``);
+* keeps the others in a dirty set keyed by chat / (chat, user), where newer
+  values replace older ones;
+* writes the dirty set every ``interval`` seconds, or as soon as it holds
+  ``max_pending`` entries, in one transaction (``database.record_activity``);
+* writes what is left on shutdown.
+
+A failed write keeps its entries in the dirty set for the next attempt.
+``interval=0`` writes every new entry right away (still skipping seen ones).
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from . import async_database as adb
+from . import database as db
+from . import metrics
+from .config import (logger, ACTIVITY_FLUSH_INTERVAL, ACTIVITY_MAX_PENDING, ACTIVITY_SEEN_TTL,
+                     ACTIVITY_SEEN_MAX_ENTRIES)
+from .database import ChatActivity, ParticipantActivity
+
+Writer = Callable[[List[ChatActivity], List[ParticipantActivity]], Awaitable[bool]]
+
+
+async def _write_to_database(chats: List[ChatActivity], participants: List[ParticipantActivity]) -> bool:
+    # Looked up at call time, so patching src.database.record_activity works.
+    return await adb.run_sync(db.record_activity, chats, participants)
+
+
+class _SeenCache:
+    """Values written recently, by key; entries expire after ``ttl`` seconds, the oldest go first."""
+
+    def __init__(self, ttl: float, max_entries: int, clock: Callable[[], float]):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+
+    def contains(self, key: Hashable, value: Any) -> bool:
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+        if entry[1] <= self._clock():
+            del self._entries[key]
+            return False
+        return entry[0] == value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        self._entries[key] = (value, self._clock() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard(self, predicate: Callable[[Hashable], bool]) -> None:
+        for key in [k for k in self._entries if predicate(k)]:
+            del self._entries[key]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+class ActivityBuffer:
+    """Coalesces known-chat and participant writes into periodic batches."""
+
+    def __init__(self, write: Optional[Writer] = None, interval: float = ACTIVITY_FLUSH_INTERVAL,
+                 max_pending: int = ACTIVITY_MAX_PENDING, seen_ttl: float = ACTIVITY_SEEN_TTL,
+                 max_seen: int = ACTIVITY_SEEN_MAX_ENTRIES, clock: Callable[[], float] = time.monotonic):
+        self._write = write or _write_to_database
+        self.interval = interval
+        self.max_pending = max(1, max_pending)
+        self._chats: Dict[int, ChatActivity] = {}
+        self._participants: Dict[Tuple[int, int], ParticipantActivity] = {}
+        self._seen_chats = _SeenCache(seen_ttl, max_seen, clock)
+        self._seen_participants = _SeenCache(seen_ttl, max_seen, clock)
+        # Entries of the batch being written right now.
+        self._writing_chats: Dict[int, ChatActivity] = {}
+        self._writing_participants: Dict[Tuple[int, int], ParticipantActivity] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._full: Optional[asyncio.Event] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._loop = None
+
+    def pending(self) -> int:
+        """Number of entries waiting to be written."""
+        return len(self._chats) + len(self._participants)
+
+    async def note_chat(self, chat_id: int, title: str, chat_type: str) -> None:
+        """Records that the bot saw the chat with this title and type."""
+        await self._note(self._chats, self._writing_chats, self._seen_chats, chat_id,
+                         ChatActivity(chat_id, title, chat_type))
+
+    async def note_participant(self, chat_id: int, user_id: int, username: Optional[str],
+                               first_name: str, last_name: str) -> None:
+        """Records that the user was active in the group (registers them as a participant)."""
+        await self._note(self._participants, self._writing_participants, self._seen_participants, (chat_id, user_id),
+                         ParticipantActivity(chat_id, user_id, username, first_name, last_name))
+
+    def forget_chat(self, chat_id: int) -> None:
+        """Drops the seen entries of the chat's members, e.g. after its participant list was cleared."""
+        self._seen_participants.discard(lambda key: key[0] == chat_id)
+
+    def forget_all(self) -> None:
+        """Drops all seen entries, e.g. after the tables were replaced by an import."""
+        self._seen_chats.clear()
+        self._seen_participants.clear()
+
+    async def _note(self, dirty: dict, writing: dict, seen: _SeenCache, key: Hashable, entry: Any) -> None:
+        # The newest known value of the row: buffered, being written, or written recently.
+        latest = dirty.get(key, writing.get(key))
+        if entry == latest or (latest is None and seen.contains(key, entry)):
+            metrics.increment('activity_skipped')
+            return
+        dirty[key] = entry
+        metrics.increment('activity_buffered')
+        if self.interval <= 0:
+            await self.flush()
+            return
+        self._bind_loop()
+        if self.pending() >= self.max_pending:
+            self._full.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def _bind_loop(self) -> None:
+        # asyncio primitives belong to one event loop (tests run each in a fresh one).
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._full = asyncio.Event()
+            self._lock = asyncio.Lock()
+            self._task = None
+
+    async def _run(self) -> None:
+        try:
+            while self.pending():
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._full.clear()
+                await self.flush()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"ActivityBuffer: background flush failed: {e}", exc_info=True)
+        finally:
+            self._task = None
+
+    async def flush(self) -> bool:
+        """Writes the buffered entries now. Returns False if the write failed (the entries stay buffered)."""
+        self._bind_loop()
+        async with self._lock:
+            if not self.pending():
+                return True
+            chats, self._chats = self._chats, {}
+            participants, self._participants = self._participants, {}
+            self._writing_chats, self._writing_participants = chats, participants
+            try:
+                written = await self._write(list(chats.values()), list(participants.values()))
+            except asyncio.CancelledError:
+                # The write may still finish in its thread; writing the entries again is harmless.
+                self._chats = {**chats, **self._chats}
+                self._participants = {**participants, **self._participants}
+                raise
+            except Exception as e:
+                logger.error(f"ActivityBuffer: writing {len(chats) + len(participants)} entries failed: {e}", exc_info=True)
+                written = False
+            finally:
+                self._writing_chats, self._writing_participants = {}, {}
+            if not written:
+                metrics.increment('activity_flush_failures')
+                # Entries noted meanwhile are newer and win.
+                self._chats = {**chats, **self._chats}
+                self._participants = {**participants, **self._participants}
+                return False
+            metrics.increment('activity_flushes')
+            metrics.increment('activity_rows_written', len(chats) + len(participants))
+            for chat_id, entry in chats.items():
+                self._seen_chats.put(chat_id, entry)
+            for key, entry in participants.items():
+                self._seen_participants.put(key, entry)
+            return True
+
+    async def shutdown(self) -> None:
+        """Stops the periodic flush and writes what is still buffered."""
+        task = self._task
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        if self.pending():
+            logger.info(f"ActivityBuffer: writing {self.pending()} buffered entries...")
+            await self.flush()
+
+
+activity_buffer = ActivityBuffer()
+metrics.register_gauge('activity_pending', activity_buffer.pending)
@@ -0,0 +1,173 @@
+"""Async data-access API for PTB handlers.
+
+The ORM layer in ``src.database`` is synchronous. Calling it directly from an
+``async def`` handler blocks the whole event loop for the duration of every
+SELECT/commit, so one slow write during a vote storm stalls all other updates.
+
+Every function here is an awaitable twin of the function with the same name in
+``src.database``: the blocking call runs in a small dedicated thread pool and
+the handler only awaits the result. Functions are looked up on the ``database``
+module at call time, so patching ``src.database.<name>`` in tests keeps working.
+"""
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, TypeVar
+
+from . import database as db
+from . import unit_of_work
+from .config import DB_EXECUTOR_WORKERS, logger
+
+T = TypeVar('T')
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='db')
+    return _executor
+
+
+def shutdown_executor(wait: bool = True) -> None:
+    """Stops the DB thread pool. Called on application shutdown."""
+    global _executor
+    if _executor is not None:
+        logger.info("Shutting down database executor...")
+        _executor.shutdown(wait=wait)
+        _executor = None
+
+
+async def run_sync(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Runs a blocking callable (usually something touching a Session) in the DB pool.
+
+    Context variables are copied into the worker thread, the same way
+    ``asyncio.to_thread`` does it. The unit of work of the update is passed on
+    only when the calling task owns it (see ``unit_of_work.current``).
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    ctx.run(unit_of_work.bind, unit_of_work.current())
+    call = functools.partial(ctx.run, func, *args, **kwargs)
+    return await loop.run_in_executor(_get_executor(), call)
+
+
+# --- Writes -----------------------------------------------------------------
+
+async def add_or_update_response(poll_id: int, user_id: int, first_name: str, last_name: str, username: str, option_index: int = None, option_text: str = None):
+    # Only the selector actually given is forwarded, exactly as a direct call would pass it.
+    selector = {'option_index': option_index} if option_text is None else {'option_text': option_text}
+    return await run_sync(
+        db.add_or_update_response,
+        poll_id=poll_id,
+        user_id=user_id,
+        first_name=first_name,
+        last_name=last_name,
+        username=username,
+        **selector,
+    )
+
+
+async def record_vote(chat_id: int, poll_id: int, user_id: int, first_name: str, last_name: str, username: str, option_index: int = None, option_text: str = None) -> Optional[int]:
+    selector = {'option_index': option_index} if option_text is None else {'option_text': option_text}
+    return await run_sync(
+        db.record_vote,
+        chat_id=chat_id,
+        poll_id=poll_id,
+        user_id=user_id,
+        first_name=first_name,
+        last_name=last_name,
+        username=username,
+        **selector,
+    )
+
+
+async def add_user_to_participants(chat_id: int, user_id: int, username: str, first_name: str, last_name: str):
+    return await run_sync(
+        db.add_user_to_participants,
+        chat_id=chat_id,
+        user_id=user_id,
+        username=username,
+        first_name=first_name,
+        last_name=last_name,
+    )
+
+
+async def update_user_standalone(user_id: int, first_name: str, last_name: str, username: str = None):
+    return await run_sync(db.update_user_standalone, user_id, first_name, last_name, username)
+
+
+async def update_known_chats(chat_id: int, title: str, chat_type: str) -> None:
+    return await run_sync(db.update_known_chats, chat_id=chat_id, title=title, chat_type=chat_type)
+
+
+async def add_poll(poll: db.Poll) -> int:
+    return await run_sync(db.add_poll, poll)
+
+
+async def commit_session(*instances):
+    return await run_sync(db.commit_session, *instances)
+
+
+async def toggle_poll_exclusion(poll_id: int, user_id: int) -> bool:
+    return await run_sync(db.toggle_poll_exclusion, poll_id, user_id)
+
+
+async def save_image_file_id(digest: str, file_id: str) -> None:
+    return await run_sync(db.save_image_file_id, digest, file_id)
+
+
+async def delete_image_file_id(digest: str) -> None:
+    return await run_sync(db.delete_image_file_id, digest)
+
+
+# --- Reads ------------------------------------------------------------------
+
+async def get_poll(poll_id: int, session: Optional[db.Session] = None) -> Optional[db.Poll]:
+    return await run_sync(db.get_poll, poll_id, session=session)
+
+
+async def get_responses(poll_id: int, session: Optional[db.Session] = None) -> List[db.Response]:
+    return await run_sync(db.get_responses, poll_id, session=session)
+
+
+async def get_participants(chat_id: int, session: Optional[db.Session] = None) -> List[db.Participant]:
+    return await run_sync(db.get_participants, chat_id, session=session)
+
+
+async def get_participant(chat_id: int, user_id: int) -> Optional[db.Participant]:
+    return await run_sync(db.get_participant, chat_id, user_id)
+
+
+async def get_poll_setting(poll_id: int, create: bool = False, session: Optional[db.Session] = None) -> Optional[db.PollSetting]:
+    return await run_sync(db.get_poll_setting, poll_id, create=create, session=session)
+
+
+async def get_poll_option(poll_id: int, option_index: int, session: Optional[db.Session] = None):
+    return await run_sync(db.get_poll_option, poll_id, option_index, session=session)
+
+
+async def get_poll_tallies(poll_id: int, session: Optional[db.Session] = None) -> Tuple[int, Dict[Tuple[int, str], int]]:
+    return await run_sync(db.get_poll_tallies, poll_id, session=session)
+
+
+async def get_poll_exclusions(poll_id: int, session: Optional[db.Session] = None) -> Set[int]:
+    return await run_sync(db.get_poll_exclusions, poll_id, session=session)
+
+
+async def get_polls_by_status(chat_id: int, status: str) -> List[db.Poll]:
+    return await run_sync(db.get_polls_by_status, chat_id, status)
+
+
+async def get_known_chats() -> List[db.KnownChat]:
+    return await run_sync(db.get_known_chats)
+
+
+async def get_group_title(chat_id: int) -> str:
+    return await run_sync(db.get_group_title, chat_id)
+
+
+async def get_image_file_id(digest: str) -> Optional[str]:
+    return await run_sync(db.get_image_file_id, digest)
@@ -0,0 +1,48 @@
+"""
+Checks the denormalized vote counters (poll_option_tallies, polls.voter_count)
+against the responses table and optionally repairs them.
+
+Usage:
+    python -m src.check_tallies               # report mismatches, exit code 1 if any
+    python -m src.check_tallies --repair      # rebuild counters of the mismatching polls
+    python -m src.check_tallies --poll 42 --repair
+"""
+import argparse
+import sys
+
+from src import database as db
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--poll', type=int, action='append', dest='poll_ids', help='check only this poll (repeatable)')
+    parser.add_argument('--repair', action='store_true', help='rebuild counters of polls with mismatches')
+    args = parser.parse_args(argv)
+
+    session = db.SessionLocal()
+    try:
+        mismatches = db.check_poll_tallies(session, args.poll_ids)
+        for m in mismatches:
+            if m.option is None:
+                what = 'voter_count'
+            else:
+                option_index, response = m.option
+                what = f'option_index={option_index}' + (f' | response={response!r}' if response else '')
+            print(f'poll_id={m.poll_id} | {what} | stored={m.stored} | actual={m.actual}')
+        if not mismatches:
+            print('Vote counters are consistent.')
+            return 0
+        if not args.repair:
+            return 1
+
+        broken = sorted({m.poll_id for m in mismatches})
+        db.rebuild_poll_tallies(session, broken)
+        db.safe_commit(session)
+        print(f'Rebuilt counters of {len(broken)} poll(s): {", ".join(map(str, broken))}')
+        return 0
+    finally:
+        session.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
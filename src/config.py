@@ -1,5 +1,6 @@
 import logging
 import os
+from typing import Optional
 from dotenv import load_dotenv
 
 # --- Helper to check if we are in a pytest run ---
@@ -35,4 +36,123 @@ WEB_URL = os.environ.get('WEB_URL')
 if not DEV_MODE and not WEB_URL and not IS_TESTING:
     logger.warning('Environment variable WEB_URL is not set while not in DEV_MODE!')
 
-DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///poll_data.db") 
\ No newline at end of file
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///poll_data.db")
+
+# Numeric knobs below: an unparsable value is logged and replaced by the default.
+def _env_number(kind, name: str, default, lo=None, hi=None):
+    """Numeric setting from the environment, clamped to [lo, hi]; an invalid value logs a warning and uses the default."""
+    raw = os.environ.get(name)
+    value = default
+    if raw is not None:
+        try:
+            value = kind(raw)
+        except ValueError:
+            logger.warning(f'Invalid {name}, using {default}')
+    if lo is not None:
+        value = max(lo, value)
+    if hi is not None:
+        value = min(hi, value)
+    return value
+
+def _env_int(name: str, default: int, lo: Optional[int] = None, hi: Optional[int] = None) -> int:
+    return _env_number(int, name, default, lo, hi)
+
+def _env_float(name: str, default: float, lo: Optional[float] = None, hi: Optional[float] = None) -> float:
+    return _env_number(float, name, default, lo, hi)
+
+# Connection pool of server databases (Postgres). Every busy DB executor thread needs a
+# connection, so DB_POOL_SIZE should not be below DB_EXECUTOR_WORKERS; up to DB_MAX_OVERFLOW
+# extra connections are opened on peaks and closed again when returned.
+DB_POOL_SIZE = _env_int('DB_POOL_SIZE', 5, 1)
+DB_MAX_OVERFLOW = _env_int('DB_MAX_OVERFLOW', 10, 0)
+# Seconds to wait for a free connection before failing.
+DB_POOL_TIMEOUT = _env_float('DB_POOL_TIMEOUT', 30.0, 0.0)
+# Connections older than this (seconds) are replaced; hosted Postgres drops idle ones. -1 disables.
+DB_POOL_RECYCLE = _env_int('DB_POOL_RECYCLE', 1800)
+# Test every connection with a cheap round-trip on checkout, replacing dead ones.
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+
+# SQLite connections: PRAGMA profile (src/database.py SQLITE_PRAGMA_PROFILES), "tuned" (WAL,
+# synchronous=NORMAL, mmap, cache) or "default" (SQLite's own settings), and how long (ms) a
+# write waits for the lock before failing with "database is locked".
+SQLITE_PRAGMA_PROFILE = os.environ.get('SQLITE_PRAGMA_PROFILE', 'tuned').strip().lower()
+if SQLITE_PRAGMA_PROFILE not in ('tuned', 'default'):
+    logger.warning(f"Unknown SQLITE_PRAGMA_PROFILE '{SQLITE_PRAGMA_PROFILE}', using 'tuned'")
+    SQLITE_PRAGMA_PROFILE = 'tuned'
+SQLITE_BUSY_TIMEOUT_MS = _env_int('SQLITE_BUSY_TIMEOUT_MS', 5000, 0)
+
+# Number of worker threads used to run blocking SQLAlchemy calls off the event loop.
+# SQLite takes one writer at a time: extra threads only queue on its lock and on the GIL,
+# which raises vote latency, so SQLite defaults to a single thread.
+DB_EXECUTOR_WORKERS = _env_int('DB_EXECUTOR_WORKERS', 1 if DATABASE_URL.startswith('sqlite') else 4, 1)
+
+# Poll message refresh: votes arriving within this window (seconds) are coalesced
+# into a single re-render and edit. The window grows up to POLL_REFRESH_MAX_WINDOW
+# when Telegram answers with flood-control errors and shrinks back afterwards.
+POLL_REFRESH_WINDOW = _env_float('POLL_REFRESH_WINDOW', 3.0, 0.0)
+POLL_REFRESH_MAX_WINDOW = _env_float('POLL_REFRESH_MAX_WINDOW', 60.0, POLL_REFRESH_WINDOW)
+
+# Webhook handling: "inline" processes the update before answering Telegram, "queue" puts it
+# into a bounded in-process queue drained by WEBHOOK_WORKERS tasks and answers right away.
+# A full queue answers 503, so Telegram delivers the update again later.
+# "sharded" routes every update by chat to one of SHARD_WORKERS worker processes (src/sharding.py).
+WEBHOOK_MODE = os.environ.get('WEBHOOK_MODE', 'inline').strip().lower()
+if WEBHOOK_MODE not in ('inline', 'queue', 'sharded'):
+    logger.warning(f"Unknown WEBHOOK_MODE '{WEBHOOK_MODE}', using 'inline'")
+    WEBHOOK_MODE = 'inline'
+WEBHOOK_WORKERS = _env_int('WEBHOOK_WORKERS', 4, 1)
+WEBHOOK_QUEUE_SIZE = _env_int('WEBHOOK_QUEUE_SIZE', 256, 1)
+# Seconds the queued updates get to be processed on shutdown.
+WEBHOOK_DRAIN_TIMEOUT = _env_float('WEBHOOK_DRAIN_TIMEOUT', 10.0, 0.0)
+# WEBHOOK_MODE=sharded: worker processes behind the webhook process and the updates each
+# of them may have waiting (a full inbox answers 503, like the queue mode).
+SHARD_WORKERS = _env_int('SHARD_WORKERS', 2, 1)
+SHARD_QUEUE_SIZE = _env_int('SHARD_QUEUE_SIZE', 256, 1)
+
+# /metrics (queue depths, pool state, counters) is served only when METRICS_TOKEN is set,
+# and only to requests sending "Authorization: Bearer <METRICS_TOKEN>".
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '').strip()
+
+# Webhook redeliveries (src/update_dedup.py): "memory" remembers the update_ids of this process,
+# "database" shares them between processes (several gunicorn workers) in processed_updates, "off".
+UPDATE_DEDUP = os.environ.get('UPDATE_DEDUP', 'memory').strip().lower()
+if UPDATE_DEDUP not in ('memory', 'database', 'off'):
+    logger.warning(f"Unknown UPDATE_DEDUP '{UPDATE_DEDUP}', using 'memory'")
+    UPDATE_DEDUP = 'memory'
+# Seconds an update_id is remembered; Telegram redelivers well within an hour.
+UPDATE_DEDUP_TTL = _env_float('UPDATE_DEDUP_TTL', 3600.0, 0.0)
+UPDATE_DEDUP_MAX_ENTRIES = _env_int('UPDATE_DEDUP_MAX_ENTRIES', 100000, 0)
+
+# Update processing (src/update_processor.py): updates of different chats run in parallel, at most
+# UPDATE_CONCURRENCY at a time; updates of one chat always run one after another, in order.
+# UPDATE_MAX_PENDING bounds the updates accepted but not yet finished.
+UPDATE_CONCURRENCY = _env_int('UPDATE_CONCURRENCY', 8, 1)
+UPDATE_MAX_PENDING = _env_int('UPDATE_MAX_PENDING', 256, 2)
+
+# Chat titles and group members seen in updates are buffered in memory and written in
+# batches every ACTIVITY_FLUSH_INTERVAL seconds (0 writes every change right away).
+# Unchanged chats/members seen within ACTIVITY_SEEN_TTL seconds are not written again.
+ACTIVITY_FLUSH_INTERVAL = _env_float('ACTIVITY_FLUSH_INTERVAL', 5.0, 0.0)
+ACTIVITY_MAX_PENDING = _env_int('ACTIVITY_MAX_PENDING', 500, 1)
+ACTIVITY_SEEN_TTL = _env_float('ACTIVITY_SEEN_TTL', 3600.0, 0.0)
+ACTIVITY_SEEN_MAX_ENTRIES = _env_int('ACTIVITY_SEEN_MAX_ENTRIES', 50000, 0)
+
+# Rendered poll content (caption + heatmap PNG) cache, keyed by (poll_id, version).
+RENDER_CACHE_MAX_ENTRIES = _env_int('RENDER_CACHE_MAX_ENTRIES', 256, 0)
+RENDER_CACHE_MAX_BYTES = _env_int('RENDER_CACHE_MAX_BYTES', 32 * 1024 * 1024, 0)
+
+# Number of polls whose drawn heatmap layout is kept for incremental repaints.
+HEATMAP_LAYER_CACHE_POLLS = _env_int('HEATMAP_LAYER_CACHE_POLLS', 16, 0)
+
+# Heatmap rendering pool: worker threads and the number of renders that may be
+# queued or running before callers have to wait. RENDER_WORKERS=0 renders inline.
+RENDER_WORKERS = _env_int('RENDER_WORKERS', 2, 0)
+RENDER_MAX_PENDING = _env_int('RENDER_MAX_PENDING', max(1, RENDER_WORKERS) * 4, 1)
+
+# Heatmap output encoding (see src/image_encoders.py): png, png-palette, webp or jpeg.
+# Only png keeps the drawn pixels exactly; the others are smaller but lossy, so they are opt-in.
+HEATMAP_IMAGE_FORMAT = os.environ.get('HEATMAP_IMAGE_FORMAT', 'png').strip().lower()
+HEATMAP_PNG_COMPRESS_LEVEL = _env_int('HEATMAP_PNG_COMPRESS_LEVEL', 6, 0, 9)
+HEATMAP_PNG_OPTIMIZE = os.environ.get('HEATMAP_PNG_OPTIMIZE', 'false').lower() in ('1', 'true', 'yes')
+HEATMAP_PALETTE_COLORS = _env_int('HEATMAP_PALETTE_COLORS', 256, 2, 256)
+HEATMAP_IMAGE_QUALITY = _env_int('HEATMAP_IMAGE_QUALITY', 90, 1, 100)
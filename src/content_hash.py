@@ -0,0 +1,69 @@
+"""
+Digests of published poll messages.
+
+``update_poll_message`` hashes the caption, keyboard and image it is about to
+send and compares it with the digest of what was last published to the same
+message. Identical output skips the Telegram call entirely instead of relying
+on "Message is not modified" errors (and instead of re-uploading the same PNG).
+"""
+import hashlib
+import io
+import json
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple, Union
+
+from telegram import InlineKeyboardMarkup
+
+# Number of (chat_id, message_id) digests kept in memory.
+MAX_TRACKED_MESSAGES = 4096
+
+
+def content_digest(text: str, reply_markup: Optional[InlineKeyboardMarkup],
+                   image: Union[io.BytesIO, bytes, None]) -> str:
+    """SHA-256 over caption, serialized keyboard and image bytes."""
+    digest = hashlib.sha256()
+    digest.update((text or '').encode('utf-8'))
+    digest.update(b'\0')
+    if reply_markup is not None:
+        digest.update(json.dumps(reply_markup.to_dict(), sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    digest.update(b'\0')
+    if image is not None:
+        digest.update(image.getvalue() if isinstance(image, io.BytesIO) else image)
+    else:
+        digest.update(b'<no image>')
+    return digest.hexdigest()
+
+
+class PublishedDigests:
+    """LRU map of (chat_id, message_id) -> digest of the last published content."""
+
+    def __init__(self, max_size: int = MAX_TRACKED_MESSAGES):
+        self.max_size = max_size
+        self._digests: "OrderedDict[Tuple[int, int], str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chat_id: int, message_id: int) -> Optional[str]:
+        with self._lock:
+            digest = self._digests.get((chat_id, message_id))
+            if digest is not None:
+                self._digests.move_to_end((chat_id, message_id))
+            return digest
+
+    def remember(self, chat_id: int, message_id: int, digest: str) -> None:
+        with self._lock:
+            self._digests[(chat_id, message_id)] = digest
+            self._digests.move_to_end((chat_id, message_id))
+            while len(self._digests) > self.max_size:
+                self._digests.popitem(last=False)
+
+    def forget(self, chat_id: int, message_id: int) -> None:
+        with self._lock:
+            self._digests.pop((chat_id, message_id), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._digests.clear()
+
+
+published_digests = PublishedDigests()
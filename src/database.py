@@ -1,11 +1,22 @@
 import os
 import logging
-from sqlalchemy import create_engine, Column, Integer, BigInteger, String, Boolean, Float, Text, PrimaryKeyConstraint, ForeignKey, inspect, text, UniqueConstraint, event, select
+import time
+from sqlalchemy import create_engine, Column, Integer, BigInteger, String, Boolean, Float, Text, PrimaryKeyConstraint, ForeignKey, Index, inspect, text, UniqueConstraint, event, select, or_, func, tuple_
+from sqlalchemy.dialects import postgresql as postgresql_dialect, sqlite as sqlite_dialect
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship, Mapped
-from typing import Union, List, Optional, Set
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from collections import defaultdict
+from contextlib import closing, contextmanager
+from typing import Dict, Iterable, Iterator, NamedTuple, Union, List, Optional, Set, Tuple
 from telegram.helpers import escape_markdown
 
+from . import metrics
+from . import unit_of_work
+from .config import (DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING, DB_EXECUTOR_WORKERS,
+                     SQLITE_PRAGMA_PROFILE, SQLITE_BUSY_TIMEOUT_MS)
+
 logger = logging.getLogger(__name__)
 
 # Определение базы для моделей
@@ -19,14 +30,224 @@ if DATABASE_URL.startswith('postgres'):
     DATABASE_URL = DATABASE_URL.replace('postgres://', 'postgresql://', 1)
 logger.info(f"Using database: {DATABASE_URL}")
 
-# Создание движка и сессии
-engine_args = {}
-if DATABASE_URL.startswith('sqlite'):
-    engine_args['connect_args'] = {"check_same_thread": False}
+# Профиль PRAGMA для SQLite, применяется к каждому новому соединению.
+# WAL: читатели не блокируют писателя, а коммит пишет в журнал без fsync самой базы;
+# synchronous=NORMAL в режиме WAL не теряет целостность, только последние коммиты при сбое питания;
+# busy_timeout: ждать блокировку вместо мгновенного "database is locked".
+# SQLITE_PRAGMA_PROFILE=default оставляет настройки SQLite по умолчанию.
+SQLITE_PRAGMA_PROFILES: Dict[str, Dict[str, Union[str, int]]] = {
+    'tuned': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,            # мс
+        'mmap_size': 256 * 1024 * 1024,  # байт
+        'cache_size': -32000,            # отрицательное значение — в КиБ (~32 МБ)
+        'temp_store': 'MEMORY',
+    },
+    'default': {},
+}
+
+
+def sqlite_pragmas(profile: str = None) -> Dict[str, Union[str, int]]:
+    """PRAGMA values of the given (or configured) profile, with the configured busy timeout."""
+    pragmas = dict(SQLITE_PRAGMA_PROFILES[profile or SQLITE_PRAGMA_PROFILE])
+    if pragmas:
+        pragmas['busy_timeout'] = SQLITE_BUSY_TIMEOUT_MS
+    return pragmas
+
+
+# Checkouts waiting at least this long (seconds) for a connection are counted as slow.
+POOL_SLOW_CHECKOUT = 0.05
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that also records how long checkouts wait for a connection."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            metrics.increment('db_pool_timeouts')
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            metrics.increment('db_pool_wait_us', int(waited * 1_000_000))
+            if waited >= POOL_SLOW_CHECKOUT:
+                metrics.increment('db_pool_slow_checkouts')
+
+
+def pool_options() -> dict:
+    """create_engine() pool arguments for server databases, from the DB_POOL_* settings."""
+    if DB_POOL_SIZE + DB_MAX_OVERFLOW < DB_EXECUTOR_WORKERS:
+        logger.warning(f"DB_POOL_SIZE + DB_MAX_OVERFLOW ({DB_POOL_SIZE + DB_MAX_OVERFLOW}) is below "
+                       f"DB_EXECUTOR_WORKERS ({DB_EXECUTOR_WORKERS}): DB threads will wait for connections")
+    return dict(
+        poolclass=MeteredQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+
+
+def instrument_pool(target_engine) -> None:
+    """
+    Counts connects, checkouts (and those served by overflow connections) and
+    invalidations of the engine's pool, and registers gauges of its current state
+    in ``metrics``. The engine's pool is looked up on every call, so the gauges
+    keep working after ``dispose()`` replaces it.
+    """
+    @event.listens_for(target_engine, 'connect')
+    def count_connect(dbapi_connection, connection_record):
+        metrics.increment('db_pool_connects')
+
+    @event.listens_for(target_engine, 'checkout')
+    def count_checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.increment('db_pool_checkouts')
+        pool = target_engine.pool
+        if isinstance(pool, QueuePool) and pool.overflow() > 0:
+            metrics.increment('db_pool_overflow_checkouts')
+
+    @event.listens_for(target_engine, 'invalidate')
+    def count_invalidate(dbapi_connection, connection_record, exception):
+        metrics.increment('db_pool_invalidations')
+
+    if isinstance(target_engine.pool, QueuePool):
+        metrics.register_gauge('db_pool_size', lambda: target_engine.pool.size())
+        metrics.register_gauge('db_pool_checked_out', lambda: target_engine.pool.checkedout())
+        metrics.register_gauge('db_pool_overflow', lambda: max(0, target_engine.pool.overflow()))
 
-engine = create_engine(DATABASE_URL, **engine_args)
+
+def make_engine(url: str = None, pragmas: Dict[str, Union[str, int]] = None, **kwargs):
+    """
+    Creates the engine for ``url`` (DATABASE_URL by default). Server databases get
+    the configured pool (see pool_options, overridable through ``kwargs``); SQLite
+    connections get ``pragmas`` (the configured profile by default) applied on connect.
+    """
+    url = url or DATABASE_URL
+    if not url.startswith('sqlite'):
+        return create_engine(url, **{**pool_options(), **kwargs})
+
+    connect_args = {"check_same_thread": False, **kwargs.pop('connect_args', {})}
+    new_engine = create_engine(url, connect_args=connect_args, **kwargs)
+    pragmas = sqlite_pragmas() if pragmas is None else pragmas
+    if pragmas:
+        @event.listens_for(new_engine, 'connect')
+        def apply_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            try:
+                for name, value in pragmas.items():
+                    # journal_mode=WAL для :memory: молча остаётся 'memory'
+                    cursor.execute(f"PRAGMA {name}={value}")
+            finally:
+                cursor.close()
+    return new_engine
+
+
+# Создание движка и сессии
+engine = make_engine(DATABASE_URL)
+instrument_pool(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+def close_database() -> None:
+    """Closes pooled connections; with WAL the last one checkpoints the journal into the database file."""
+    engine.dispose()
+
+
+# Сессии вспомогательных функций: переданная вызывающим, сессия текущей единицы работы
+# (см. unit_of_work) или собственная, которая закрывается на выходе.
+@contextmanager
+def _helper_session(session: Optional[Session] = None) -> Iterator[Session]:
+    """The given session, else the current unit of work's, else a new one closed afterwards."""
+    if session is not None:
+        yield session
+        return
+    uow = unit_of_work.current()
+    if uow is not None:
+        yield uow.session
+        return
+    session = SessionLocal()
+    session.info['helper_owned'] = True
+    try:
+        yield session
+    finally:
+        session.info.pop('helper_owned', None)
+        session.close()
+
+
+@contextmanager
+def _write_session(session: Optional[Session] = None) -> Iterator[Session]:
+    """
+    _helper_session for helpers that write. In the unit of work's session the helper
+    runs in a savepoint, so its failure (``_discard``) undoes only its own writes.
+    """
+    with _helper_session(session) as session:
+        if not _in_unit_of_work(session):
+            yield session
+            return
+        savepoint = session.begin_nested()
+        session.info.setdefault('savepoints', []).append(savepoint)
+        try:
+            yield session
+        except BaseException:
+            if savepoint.is_active:
+                savepoint.rollback()
+            raise
+        finally:
+            session.info['savepoints'].remove(savepoint)
+        if savepoint.is_active:
+            savepoint.commit()  # released; the write itself is committed by _save
+
+
+def _owns(session: Session) -> bool:
+    """True for a session a helper opened for itself (as opposed to a shared one)."""
+    return session.info.get('helper_owned', False)
+
+
+def _in_unit_of_work(session: Session) -> bool:
+    """True for the session of a unit of work (see unit_of_work.UnitOfWork.session)."""
+    return session.info.get('unit_of_work', False)
+
+
+def _save(session: Session) -> None:
+    """
+    Commits a helper's own session and the unit of work's, so no write lock outlives the
+    helper (handlers go on to talk to Telegram); a caller's session is only flushed.
+    """
+    if _owns(session) or _in_unit_of_work(session):
+        safe_commit(session)
+    else:
+        session.flush()
+
+
+def _discard(session: Session) -> None:
+    """Undoes the writes of a failed helper: its savepoint in the unit of work, else the transaction."""
+    savepoints = session.info.get('savepoints')
+    if savepoints and savepoints[-1].is_active:
+        savepoints[-1].rollback()
+    else:
+        session.rollback()
+
+
+def open_session() -> Session:
+    """
+    Session for handler code: the unit of work's while an update is being handled, else
+    a new one. Pass it to close_session when done; the unit of work's stays open.
+    """
+    uow = unit_of_work.current()
+    if uow is not None:
+        return uow.session
+    return SessionLocal()
+
+
+def close_session(session: Session) -> None:
+    """Closes a session from open_session unless it belongs to the unit of work."""
+    if not _in_unit_of_work(session):
+        session.close()
+
 # Модели таблиц
 class User(Base):
     __tablename__ = 'users'
@@ -49,7 +270,11 @@ class Participant(Base):
     first_name = Column(String)
     last_name = Column(String)
     excluded = Column(Integer, default=0)
-    __table_args__ = (PrimaryKeyConstraint('chat_id', 'user_id'),)
+    __table_args__ = (
+        PrimaryKeyConstraint('chat_id', 'user_id'),
+        # Name fallback for voters missing from users (get_users_by_ids).
+        Index('ix_participants_user_id', 'user_id'),
+    )
 
 class Poll(Base):
     __tablename__ = 'polls'
@@ -58,20 +283,84 @@ class Poll(Base):
     message_id: Mapped[Optional[int]] = Column(Integer)
     photo_file_id: Mapped[Optional[str]] = Column(String) # For storing the file_id of the heatmap image
     message: Mapped[Optional[str]] = Column(String)
-    options: Mapped[Optional[str]] = Column(String)
     status: Mapped[str] = Column(String, default='draft') # draft, active, closed
     poll_type = Column(String, default='native', nullable=False)
     web_app_id = Column(String, nullable=True)
     nudge_message_id = Column(BigInteger)
+    # Bumped on every change that affects how the poll is rendered (see _collect_version_bumps).
+    version = Column(Integer, nullable=False, default=0, server_default='0')
+    # Distinct voters, maintained together with poll_option_tallies (see _collect_tally_changes).
+    voter_count = Column(Integer, nullable=False, default=0, server_default='0')
+    # get_polls_by_status and the per-chat version bumps.
+    __table_args__ = (Index('ix_polls_chat_id_status', 'chat_id', 'status'),)
     
     # This relationship allows us to easily access responses via poll.responses
     responses = relationship("Response", backref="poll", cascade="all, delete-orphan")
+    # Answer options in index order, loaded together with the poll.
+    option_rows = relationship("PollOption", back_populates="poll", order_by="PollOption.option_index",
+                               cascade="all, delete-orphan", lazy="selectin")
+
+    @property
+    def options(self) -> List[str]:
+        """Option texts in index order."""
+        return [option.text for option in self.option_rows]
+
+    @options.setter
+    def options(self, texts: Optional[Iterable[str]]) -> None:
+        """
+        Replaces the option texts, without empty ones. Settings follow their option (see
+        _option_moves); options past the new end are removed. Votes are not touched: for a poll with votes use replace_poll_options.
+        """
+        if isinstance(texts, str):
+            raise TypeError("Poll.options takes a list of option texts")
+        # Blank lines and doubled commas are not options (Telegram rejects buttons without text).
+        texts = [text for text in (text.strip() for text in texts or ()) if text]
+        rows = self.option_rows
+        moves = _option_moves([row.text for row in rows], texts)
+        settings = {moves[index]: {attr: getattr(row, attr) for attr in _OPTION_SETTING_DEFAULTS}
+                    for index, row in enumerate(rows) if moves[index] is not None}
+        del rows[len(texts):]
+        for index, text in enumerate(texts):
+            if index >= len(rows):
+                rows.append(PollOption(option_index=index, text=text))
+            rows[index].text = text
+            for attr, value in settings.get(index, _OPTION_SETTING_DEFAULTS).items():
+                setattr(rows[index], attr, value)
+
+def _option_moves(old: List[str], new: List[str]) -> Dict[int, Optional[int]]:
+    """
+    New index of every old option: the option with the same text, else the option at the same
+    position if that one is new as well (a renamed option), else None (the option was removed).
+    """
+    free = defaultdict(list)
+    for index, text in enumerate(new):
+        free[text].append(index)
+    moves = {index: free[text].pop(0) if free[text] else None for index, text in enumerate(old)}
+    taken = set(moves.values())
+    for index in moves:
+        if moves[index] is None and index < len(new) and index not in taken:
+            moves[index] = index
+            taken.add(index)
+    return moves
+
+# Response.option_index for answers that are not one of the poll's options
+# (free-text web app answers); their text is kept in Response.response.
+FREE_TEXT_OPTION = -1
 
 class Response(Base):
+    """
+    A voter's choice. Native votes store the option index and an empty text, so
+    renaming an option does not touch responses. Free-text answers store
+    FREE_TEXT_OPTION and the text itself.
+    """
     __tablename__ = 'responses'
     poll_id = Column(Integer, ForeignKey('polls.poll_id'), primary_key=True)
     user_id = Column(BigInteger, primary_key=True)
-    response = Column(Text, primary_key=True)
+    option_index = Column(Integer, primary_key=True, default=FREE_TEXT_OPTION, server_default=str(FREE_TEXT_OPTION))
+    response = Column(Text, primary_key=True, default='', server_default='')
+    # Lookups by voter (has_user_created_poll_in_chat, version bumps on renames).
+    # (poll_id, user_id) lookups use the primary key prefix.
+    __table_args__ = (Index('ix_responses_user_id', 'user_id'),)
 
 class PollSetting(Base):
     __tablename__ = 'poll_settings'
@@ -87,10 +376,15 @@ class PollSetting(Base):
     target_sum = Column(Float, default=0)
     nudge_negative_emoji = Column(String, default='❌')
 
-class PollOptionSetting(Base):
-    __tablename__ = 'poll_option_settings'
-    poll_id = Column(Integer, primary_key=True)
+class PollOption(Base):
+    """
+    One answer option of a poll: its text and display settings.
+    Looked up by primary key (poll_id, option_index) on the vote path.
+    """
+    __tablename__ = 'poll_options'
+    poll_id = Column(Integer, ForeignKey('polls.poll_id'), primary_key=True)
     option_index = Column(Integer, primary_key=True)
+    text = Column(Text, nullable=False, default='')
     show_names = Column(Integer)
     names_style = Column(String)
     is_priority = Column(Integer, default=0)
@@ -99,6 +393,13 @@ class PollOptionSetting(Base):
     show_count = Column(Integer)
     show_contribution = Column(Integer, default=1)
 
+    poll = relationship("Poll", back_populates="option_rows")
+
+# Per-option settings and their values for a new option (see Poll.options).
+_OPTION_SETTING_DEFAULTS = {'show_names': None, 'names_style': None, 'is_priority': 0,
+                            'contribution_amount': 0, 'emoji': None, 'show_count': None,
+                            'show_contribution': 1}
+
 # --- Новая таблица: исключения участников для конкретного опроса ----------
 class PollExclusion(Base):
     """Содержит пары (poll_id, user_id) для участников, исключённых только из
@@ -108,6 +409,312 @@ class PollExclusion(Base):
     poll_id = Column(Integer, primary_key=True)
     user_id = Column(BigInteger, primary_key=True)
 
+class PollOptionTally(Base):
+    """Number of responses per (poll, option), maintained on write (see _collect_tally_changes)."""
+    __tablename__ = 'poll_option_tallies'
+    poll_id = Column(Integer, primary_key=True)
+    option_index = Column(Integer, primary_key=True)
+    response = Column(Text, primary_key=True, default='')  # free text for FREE_TEXT_OPTION, '' otherwise
+    votes = Column(Integer, nullable=False, default=0)
+
+class ImageFileId(Base):
+    """Telegram file_id of an already uploaded image, keyed by SHA-256 of its bytes (see src/photo_registry.py)."""
+    __tablename__ = 'image_file_ids'
+    digest = Column(String(64), primary_key=True)
+    file_id = Column(String, nullable=False)
+
+class ProcessedUpdate(Base):
+    """update_id of a webhook update already taken for processing, by any process (see src/update_dedup.py)."""
+    __tablename__ = 'processed_updates'
+    update_id = Column(BigInteger, primary_key=True)
+    received_at = Column(Float, nullable=False, index=True)  # unix time
+
+
+# --- Poll versioning ---
+# Every change that alters how a poll looks (votes, poll/option settings,
+# exclusions, participants of its chat, voter names) bumps polls.version.
+# Renders are cached by (poll_id, version), see src/render_cache.py.
+# ORM changes are picked up automatically at flush time; bulk Query.delete()
+# calls bypass the unit of work and must call bump_poll_versions themselves.
+
+# Poll columns that influence the rendered message.
+_POLL_RENDER_COLUMNS = ('message', 'status', 'poll_type')
+
+def bump_poll_versions(session: Session, poll_ids: Iterable[int] = (), chat_ids: Iterable[int] = (), user_ids: Iterable[int] = ()):
+    """Increments the version of the given polls, of all polls in the chats and of all polls the users voted in."""
+    poll_ids, chat_ids, user_ids = set(poll_ids), set(chat_ids), set(user_ids)
+    conditions = []
+    if poll_ids:
+        conditions.append(Poll.__table__.c.poll_id.in_(poll_ids))
+    if chat_ids:
+        conditions.append(Poll.__table__.c.chat_id.in_(chat_ids))
+    if user_ids:
+        voted = select(Response.__table__.c.poll_id).where(Response.__table__.c.user_id.in_(user_ids))
+        conditions.append(Poll.__table__.c.poll_id.in_(voted))
+    if not conditions:
+        return
+    polls = Poll.__table__
+    session.connection().execute(
+        polls.update().where(or_(*conditions)).values(version=polls.c.version + 1)
+    )
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Poll) and not inspect(obj).pending:
+            session.expire(obj, ['version'])
+
+@event.listens_for(Session, 'before_flush')
+def _collect_version_bumps(session, flush_context, instances):
+    poll_ids, chat_ids, user_ids = set(), set(), set()
+    changed = [obj for obj in session.dirty if session.is_modified(obj, include_collections=False)]
+    for obj in list(session.new) + list(session.deleted) + changed:
+        if isinstance(obj, (Response, PollSetting, PollExclusion)):
+            if obj.poll_id is not None:
+                poll_ids.add(obj.poll_id)
+        elif isinstance(obj, PollOption):
+            # Options added through Poll.options get their poll_id during the flush.
+            poll_id = obj.poll_id if obj.poll_id is not None else getattr(obj.poll, 'poll_id', None)
+            if poll_id is not None:
+                poll_ids.add(poll_id)
+        elif isinstance(obj, Participant):
+            chat_ids.add(obj.chat_id)
+        elif isinstance(obj, User) and obj not in session.new:
+            user_ids.add(obj.user_id)
+        elif isinstance(obj, Poll) and obj in changed:
+            state = inspect(obj)
+            if any(state.attrs[col].history.has_changes() for col in _POLL_RENDER_COLUMNS):
+                obj.version = Poll.version + 1
+    # Options removed from Poll.options are deleted as orphans later in the flush.
+    for obj in session.dirty:
+        if isinstance(obj, Poll) and obj.poll_id is not None and inspect(obj).attrs.option_rows.history.deleted:
+            poll_ids.add(obj.poll_id)
+    if poll_ids or chat_ids or user_ids:
+        pending = session.info.setdefault('version_bumps', (set(), set(), set()))
+        for target, ids in zip(pending, (poll_ids, chat_ids, user_ids)):
+            target.update(ids)
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _apply_version_bumps(session, flush_context):
+    pending = session.info.pop('version_bumps', None)
+    if pending:
+        bump_poll_versions(session, *pending)
+
+
+# --- Vote tallies ---
+# poll_option_tallies holds the number of responses per (poll, option) and
+# polls.voter_count the number of distinct voters, so totals are read in
+# O(options) instead of aggregating the responses table. Both are updated at flush
+# time from ORM inserts, deletes and response text changes, inside the same
+# transaction as the votes themselves. Bulk Query.delete()/bulk inserts bypass the
+# unit of work and must call rebuild_poll_tallies (see also src/check_tallies.py).
+
+class TallyMismatch(NamedTuple):
+    poll_id: int
+    option: Optional[Tuple[int, str]]   # (option_index, free text); None for polls.voter_count
+    stored: int
+    actual: int
+
+def _committed_value(obj, attr: str):
+    """Value of the attribute as it is in the database (before pending changes)."""
+    history = inspect(obj).attrs[attr].history
+    return history.deleted[0] if history.deleted else getattr(obj, attr)
+
+def _response_key(poll_id, user_id, option_index, response):
+    # Column defaults are applied at INSERT time, after before_flush.
+    return (poll_id, user_id, FREE_TEXT_OPTION if option_index is None else option_index, response or '')
+
+_RESPONSE_KEY_ATTRS = ('poll_id', 'user_id', 'option_index', 'response')
+
+@event.listens_for(Session, 'before_flush')
+def _collect_tally_changes(session, flush_context, instances):
+    votes = defaultdict(int)        # (poll_id, option_index, response) -> change in responses
+    per_voter = defaultdict(int)    # (poll_id, user_id) -> change in the voter's responses
+    deleted_polls = set()
+
+    def count(key, delta):
+        poll_id, user_id, option_index, response = key
+        votes[(poll_id, option_index, response)] += delta
+        per_voter[(poll_id, user_id)] += delta
+
+    for obj in session.new:
+        if isinstance(obj, Response):
+            count(_response_key(*(getattr(obj, attr) for attr in _RESPONSE_KEY_ATTRS)), +1)
+    for obj in session.deleted:
+        if isinstance(obj, Response):
+            count(_response_key(*(_committed_value(obj, attr) for attr in _RESPONSE_KEY_ATTRS)), -1)
+        elif isinstance(obj, Poll):
+            deleted_polls.add(obj.poll_id)
+    for obj in session.dirty:
+        if isinstance(obj, Response) and session.is_modified(obj, include_collections=False):
+            old = _response_key(*(_committed_value(obj, attr) for attr in _RESPONSE_KEY_ATTRS))
+            new = _response_key(*(getattr(obj, attr) for attr in _RESPONSE_KEY_ATTRS))
+            if old != new:
+                count(old, -1)
+                count(new, +1)
+
+    voters = defaultdict(int)
+    changed_pairs = [pair for pair, delta in per_voter.items() if delta]
+    if changed_pairs:
+        # The flush has not run yet, so the table still holds the "before" state.
+        responses = Response.__table__
+        before = dict(
+            ((poll_id, user_id), n) for poll_id, user_id, n in session.connection().execute(
+                select(responses.c.poll_id, responses.c.user_id, func.count())
+                .where(tuple_(responses.c.poll_id, responses.c.user_id).in_(changed_pairs))
+                .group_by(responses.c.poll_id, responses.c.user_id)
+            )
+        )
+        for pair in changed_pairs:
+            had_votes = before.get(pair, 0) > 0
+            has_votes = before.get(pair, 0) + per_voter[pair] > 0
+            voters[pair[0]] += int(has_votes) - int(had_votes)
+
+    if any(votes.values()) or any(voters.values()) or deleted_polls:
+        pending = session.info.setdefault('tally_changes', (defaultdict(int), defaultdict(int), set()))
+        for key, delta in votes.items():
+            pending[0][key] += delta
+        for key, delta in voters.items():
+            pending[1][key] += delta
+        pending[2].update(deleted_polls)
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _apply_tally_changes(session, flush_context):
+    pending = session.info.pop('tally_changes', None)
+    if not pending:
+        return
+    votes, voters, deleted_polls = pending
+    tallies, polls = PollOptionTally.__table__, Poll.__table__
+    conn = session.connection()
+
+    for (poll_id, option_index, response), delta in votes.items():
+        if not delta or poll_id in deleted_polls:
+            continue
+        updated = conn.execute(
+            tallies.update()
+            .where(tallies.c.poll_id == poll_id, tallies.c.option_index == option_index, tallies.c.response == response)
+            .values(votes=tallies.c.votes + delta)
+        ).rowcount
+        if not updated:
+            conn.execute(tallies.insert().values(poll_id=poll_id, option_index=option_index, response=response, votes=delta))
+    touched = {poll_id for poll_id, _, _ in votes} - deleted_polls
+    if touched:
+        conn.execute(tallies.delete().where(tallies.c.poll_id.in_(touched), tallies.c.votes <= 0))
+    if deleted_polls:
+        conn.execute(tallies.delete().where(tallies.c.poll_id.in_(deleted_polls)))
+
+    for poll_id, delta in voters.items():
+        if delta and poll_id not in deleted_polls:
+            conn.execute(polls.update().where(polls.c.poll_id == poll_id).values(voter_count=polls.c.voter_count + delta))
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Poll) and obj.poll_id in voters and not inspect(obj).pending:
+            session.expire(obj, ['voter_count'])
+
+def _actual_tallies(session: Session, poll_ids: Optional[Iterable[int]] = None):
+    """(votes by (poll_id, option_index, response), distinct voters by poll_id) aggregated from the responses table."""
+    responses = Response.__table__
+    option = (responses.c.poll_id, responses.c.option_index, responses.c.response)
+    by_option = select(*option, func.count()).group_by(*option)
+    by_poll = select(responses.c.poll_id, func.count(func.distinct(responses.c.user_id))).group_by(responses.c.poll_id)
+    if poll_ids is not None:
+        by_option = by_option.where(responses.c.poll_id.in_(poll_ids))
+        by_poll = by_poll.where(responses.c.poll_id.in_(poll_ids))
+    conn = session.connection()
+    votes = {(poll_id, option_index, response): n for poll_id, option_index, response, n in conn.execute(by_option)}
+    voters = {poll_id: n for poll_id, n in conn.execute(by_poll)}
+    return votes, voters
+
+def get_poll_tallies(poll_id: int, session: Optional[Session] = None) -> Tuple[int, Dict[Tuple[int, str], int]]:
+    """Returns (distinct voters, {(option_index, free text): votes}) from the maintained counters."""
+    with _helper_session(session) as session:
+        voters = session.query(Poll.voter_count).filter_by(poll_id=poll_id).scalar() or 0
+        rows = session.query(PollOptionTally.option_index, PollOptionTally.response, PollOptionTally.votes).filter_by(poll_id=poll_id)
+        votes = {(option_index, response): n for option_index, response, n in rows}
+        return voters, votes
+
+def check_poll_tallies(session: Session, poll_ids: Optional[Iterable[int]] = None) -> List[TallyMismatch]:
+    """Compares the maintained counters with the responses table."""
+    poll_ids = None if poll_ids is None else set(poll_ids)
+    votes, voters = _actual_tallies(session, poll_ids)
+
+    tallies_query = session.query(PollOptionTally.poll_id, PollOptionTally.option_index, PollOptionTally.response, PollOptionTally.votes)
+    polls_query = session.query(Poll.poll_id, Poll.voter_count)
+    if poll_ids is not None:
+        tallies_query = tallies_query.filter(PollOptionTally.poll_id.in_(poll_ids))
+        polls_query = polls_query.filter(Poll.poll_id.in_(poll_ids))
+    stored_votes = {(poll_id, option_index, response): n for poll_id, option_index, response, n in tallies_query.all()}
+    stored_voters = dict(polls_query.all())
+
+    mismatches = [
+        TallyMismatch(key[0], key[1:], stored_votes.get(key, 0), votes.get(key, 0))
+        for key in sorted(set(votes) | set(stored_votes))
+        if stored_votes.get(key, 0) != votes.get(key, 0)
+    ]
+    mismatches.extend(
+        TallyMismatch(poll_id, None, stored, voters.get(poll_id, 0))
+        for poll_id, stored in sorted(stored_voters.items())
+        if (stored or 0) != voters.get(poll_id, 0)
+    )
+    return mismatches
+
+def rebuild_poll_tallies(session: Session, poll_ids: Optional[Iterable[int]] = None) -> None:
+    """Recomputes the counters from the responses table (all polls if poll_ids is None). Does not commit."""
+    poll_ids = None if poll_ids is None else set(poll_ids)
+    votes, voters = _actual_tallies(session, poll_ids)
+    tallies, polls = PollOptionTally.__table__, Poll.__table__
+    conn = session.connection()
+
+    clear_tallies, reset_polls = tallies.delete(), polls.update()
+    if poll_ids is not None:
+        clear_tallies = clear_tallies.where(tallies.c.poll_id.in_(poll_ids))
+        reset_polls = reset_polls.where(polls.c.poll_id.in_(poll_ids))
+    conn.execute(clear_tallies)
+    conn.execute(reset_polls.values(voter_count=0))
+    if votes:
+        conn.execute(tallies.insert(), [
+            {'poll_id': poll_id, 'option_index': option_index, 'response': response, 'votes': n}
+            for (poll_id, option_index, response), n in votes.items()
+        ])
+    for poll_id, n in voters.items():
+        conn.execute(polls.update().where(polls.c.poll_id == poll_id).values(voter_count=n))
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Poll) and not inspect(obj).pending:
+            session.expire(obj, ['voter_count'])
+
+# Option indexes are parked here while responses move, so that swapped options never collide on
+# the primary key: option_index -> _PARKED_OPTION - new index (FREE_TEXT_OPTION stays apart).
+_PARKED_OPTION = FREE_TEXT_OPTION - 1
+
+def replace_poll_options(session: Session, poll: Poll, texts: Iterable[str]) -> None:
+    """
+    Replaces the options of a poll that may already have votes. Votes and settings follow their
+    option (see _option_moves), votes for removed options are deleted, and the counters are
+    rebuilt. Does not commit.
+    """
+    old = poll.options
+    poll.options = texts
+    moves = {index: new for index, new in _option_moves(old, poll.options).items() if new != index}
+    if not moves or poll.poll_id is None:
+        return
+
+    responses = Response.__table__
+    conn = session.connection()
+    of_poll = responses.c.poll_id == poll.poll_id
+    removed = [index for index, new in moves.items() if new is None]
+    if removed:
+        conn.execute(responses.delete().where(of_poll, responses.c.option_index.in_(removed)))
+    for index, new in moves.items():
+        if new is not None:
+            conn.execute(responses.update().where(of_poll, responses.c.option_index == index)
+                         .values(option_index=_PARKED_OPTION - new))
+    conn.execute(responses.update().where(of_poll, responses.c.option_index <= _PARKED_OPTION)
+                 .values(option_index=_PARKED_OPTION - responses.c.option_index))
+
+    # Loaded responses are keyed by their old option_index (read from the key: reloading them would fail).
+    for key, obj in list(session.identity_map.items()):
+        if key[0] is Response and key[1][0] == poll.poll_id:
+            session.expunge(obj)
+    session.expire(poll, ['responses'])
+    rebuild_poll_tallies(session, [poll.poll_id])
+    bump_poll_versions(session, [poll.poll_id])
+
 
 # --- Database migrations ---
 # The manual run_migrations() function has been removed.
@@ -134,6 +741,24 @@ def update_user(session: Session, user_id: int, first_name: str, last_name: str,
         user = User(user_id=user_id, first_name=first_name, last_name=last_name, username=username)
         session.add(user)
 
+def _resolve_option(poll_id: int, options: List[str], option_index: Optional[int], option_text: Optional[str]) -> Optional[Tuple[int, str]]:
+    """
+    Stored (option_index, response) of a vote given by option index or by option text.
+    Text matching one of the options is stored as that option's index; other text is free text.
+    """
+    if option_text is not None:
+        try:
+            return options.index(option_text.strip()), ''
+        except ValueError:
+            return FREE_TEXT_OPTION, option_text
+    if option_index is None:
+        logger.error("Either option_index or option_text must be provided.")
+        return None
+    if not 0 <= option_index < len(options):
+        logger.error(f"Invalid option index {option_index} for poll {poll_id}")
+        return None
+    return option_index, ''
+
 def add_or_update_response_ext(session: Session, poll_id: int, user_id: int, first_name: str, last_name: str, username: str, option_index: int = None, option_text: str = None):
     """
     Adds or updates a user's response to a poll using an EXISTING session.
@@ -158,396 +783,499 @@ def add_or_update_response_ext(session: Session, poll_id: int, user_id: int, fir
     # Debug logging for multiple answers setting
     logger.info(f"[DEBUG] Poll ID {poll_id} multiple answers setting: {poll_setting.allow_multiple_answers if poll_setting else 'No setting found'}")
 
-    # Determine the response text
-    response_value = None
-    if option_text is not None:
-        response_value = option_text
-    elif option_index is not None:
-        try:
-            options = poll.options.split(',')
-            response_value = options[option_index].strip()
-        except IndexError:
-            logger.error(f"Invalid option index {option_index} for poll {poll_id}")
-            return
-    else:
-        logger.error("Either option_index or option_text must be provided.")
+    # Determine the stored option
+    option = _resolve_option(poll_id, poll.options, option_index, option_text)
+    if option is None:
         return
+    stored_index, stored_text = option
 
     allow_multiple = poll_setting.allow_multiple_answers if poll_setting else False
 
     if allow_multiple:
         # For multiple choice, check if this specific response exists and toggle it
-        response = session.query(Response).filter_by(poll_id=poll_id, user_id=user_id, response=response_value).first()
+        response = session.query(Response).filter_by(poll_id=poll_id, user_id=user_id, option_index=stored_index, response=stored_text).first()
         if response:
             # User is un-voting for this option
             session.delete(response)
         else:
             # User is voting for a new option
-            new_response = Response(poll_id=poll_id, user_id=user_id, response=response_value)
+            new_response = Response(poll_id=poll_id, user_id=user_id, option_index=stored_index, response=stored_text)
             session.add(new_response)
     else:
-        # For single choice, remove all previous responses for this user in this poll
-        session.query(Response).filter_by(poll_id=poll_id, user_id=user_id).delete()
+        # For single choice, remove all previous responses for this user in this poll.
+        # Deleted through the ORM (not Query.delete) so that vote tallies follow.
+        previous = session.query(Response).filter_by(poll_id=poll_id, user_id=user_id).all()
+        for response in previous:
+            if (response.option_index, response.response) != option:
+                session.delete(response)
         # And add the new one
-        new_response = Response(poll_id=poll_id, user_id=user_id, response=response_value)
-        session.add(new_response)
+        if not any((response.option_index, response.response) == option for response in previous):
+            session.add(Response(poll_id=poll_id, user_id=user_id, option_index=stored_index, response=stored_text))
 
 def add_or_update_response(poll_id: int, user_id: int, first_name: str, last_name: str, username: str, option_index: int = None, option_text: str = None):
     """
-    Public-facing function that creates a session and calls the core logic.
+    Public-facing function that gets a session and calls the core logic.
     """
-    session = SessionLocal()
-    try:
-        add_or_update_response_ext(
-            session=session,
-            poll_id=poll_id,
-            user_id=user_id,
-            first_name=first_name,
-            last_name=last_name,
-            username=username,
-            option_index=option_index,
-            option_text=option_text
+    with _write_session() as session:
+        try:
+            add_or_update_response_ext(
+                session=session,
+                poll_id=poll_id,
+                user_id=user_id,
+                first_name=first_name,
+                last_name=last_name,
+                username=username,
+                option_index=option_index,
+                option_text=option_text
+            )
+            _save(session)
+        except Exception as e:
+            logger.error(f"Exception in add_or_update_response: {e}", exc_info=True)
+            _discard(session)
+
+# --- Fused vote write ---
+# record_vote stores the voter, their chat participant row and the response in
+# one transaction with native upserts (INSERT ... ON CONFLICT) instead of the
+# SELECT-then-write sequence of add_user_to_participants + add_or_update_response.
+# It writes through Core, so the flush listeners above do not run: poll versions
+# and vote tallies are updated here explicitly, with the same rules.
+
+_UPSERT_INSERTS = {'sqlite': sqlite_dialect.insert, 'postgresql': postgresql_dialect.insert}
+
+def record_vote_ext(session: Session, chat_id: int, poll_id: int, user_id: int, first_name: str, last_name: str, username: str,
+                    option_index: int = None, option_text: str = None) -> Optional[int]:
+    """
+    Records a vote using an EXISTING session (does not commit).
+    Returns the poll version after the vote, or None if the poll or the option does not exist.
+    """
+    upsert = _UPSERT_INSERTS.get(session.get_bind().dialect.name)
+    if upsert is None:
+        # No native upsert on this backend: same result through the ORM.
+        update_user(session, user_id, first_name, last_name, username)
+        if session.get(Participant, (chat_id, user_id)) is None:
+            session.add(Participant(chat_id=chat_id, user_id=user_id, username=username, first_name=first_name or "", last_name=last_name or ""))
+        add_or_update_response_ext(session, poll_id, user_id, first_name, last_name, username, option_index=option_index, option_text=option_text)
+        session.flush()
+        return session.query(Poll.version).filter_by(poll_id=poll_id).scalar()
+
+    conn = session.connection()
+    polls, settings, responses = Poll.__table__, PollSetting.__table__, Response.__table__
+    users, participants, tallies = User.__table__, Participant.__table__, PollOptionTally.__table__
+    poll_options = PollOption.__table__
+
+    # The voted option is checked by primary key in the same query as the poll.
+    poll = conn.execute(
+        select(polls.c.poll_id, settings.c.allow_multiple_answers, poll_options.c.option_index)
+        .select_from(
+            polls.outerjoin(settings, settings.c.poll_id == polls.c.poll_id)
+            .outerjoin(poll_options, (poll_options.c.poll_id == polls.c.poll_id) & (poll_options.c.option_index == option_index))
         )
-        safe_commit(session)
-    except Exception as e:
-        logger.error(f"Exception in add_or_update_response: {e}", exc_info=True)
-        session.rollback()
-    finally:
-        session.close()
+        .where(polls.c.poll_id == poll_id)
+    ).first()
+    if poll is None:
+        logger.error(f"Poll with ID {poll_id} not found, can't add response.")
+        return None
+    if option_text is not None:
+        texts = conn.execute(
+            select(poll_options.c.text).where(poll_options.c.poll_id == poll_id).order_by(poll_options.c.option_index)
+        ).scalars().all()
+        option = _resolve_option(poll_id, texts, None, option_text)
+    elif option_index is None:
+        logger.error("Either option_index or option_text must be provided.")
+        return None
+    elif poll.option_index is None:
+        logger.error(f"Invalid option index {option_index} for poll {poll_id}")
+        return None
+    else:
+        option = (option_index, '')
+
+    # User: insert, or update only when the name actually changed.
+    stmt = upsert(users).values(user_id=user_id, first_name=first_name, last_name=last_name, username=username)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[users.c.user_id],
+        set_={'first_name': stmt.excluded.first_name, 'last_name': stmt.excluded.last_name, 'username': stmt.excluded.username},
+        where=or_(users.c.first_name.is_distinct_from(stmt.excluded.first_name),
+                  users.c.last_name.is_distinct_from(stmt.excluded.last_name),
+                  users.c.username.is_distinct_from(stmt.excluded.username)),
+    )
+    if conn.execute(stmt).rowcount:
+        bump_poll_versions(session, user_ids=[user_id])
+
+    stmt = upsert(participants).values(chat_id=chat_id, user_id=user_id, username=username,
+                                       first_name=first_name or "", last_name=last_name or "", excluded=0)
+    if conn.execute(stmt.on_conflict_do_nothing(index_elements=[participants.c.chat_id, participants.c.user_id])).rowcount:
+        bump_poll_versions(session, chat_ids=[chat_id])
+
+    # Response: toggle for multiple choice, replace for single choice.
+    mine = (responses.c.poll_id == poll_id, responses.c.user_id == user_id)
+    existing = set(map(tuple, conn.execute(select(responses.c.option_index, responses.c.response).where(*mine))))
+    if poll.allow_multiple_answers:
+        removed, added = existing & {option}, {option} - existing
+    else:
+        removed, added = existing - {option}, {option} - existing
+    for stored_index, stored_text in removed:
+        conn.execute(responses.delete().where(*mine, responses.c.option_index == stored_index, responses.c.response == stored_text))
+    if added:
+        stmt = upsert(responses).values(poll_id=poll_id, user_id=user_id, option_index=option[0], response=option[1])
+        if not conn.execute(stmt.on_conflict_do_nothing()).rowcount:
+            added = set()  # a concurrent duplicate of this vote got there first
+
+    if removed or added:
+        for (stored_index, stored_text), delta in [(r, -1) for r in removed] + [(a, +1) for a in added]:
+            stmt = upsert(tallies).values(poll_id=poll_id, option_index=stored_index, response=stored_text, votes=delta)
+            conn.execute(stmt.on_conflict_do_update(
+                index_elements=[tallies.c.poll_id, tallies.c.option_index, tallies.c.response],
+                set_={'votes': tallies.c.votes + stmt.excluded.votes},
+            ))
+        if removed:
+            conn.execute(tallies.delete().where(tallies.c.poll_id == poll_id, tallies.c.votes <= 0))
+        voter_delta = int(bool((existing - removed) | added)) - int(bool(existing))
+        version = conn.execute(
+            polls.update().where(polls.c.poll_id == poll_id)
+            .values(version=polls.c.version + 1, voter_count=polls.c.voter_count + voter_delta)
+            .returning(polls.c.version)
+        ).scalar_one()
+    else:
+        version = conn.execute(select(polls.c.version).where(polls.c.poll_id == poll_id)).scalar_one()
+
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Poll) and obj.poll_id == poll_id and not inspect(obj).pending:
+            session.expire(obj, ['version', 'voter_count'])
+    return version
+
+def record_vote(chat_id: int, poll_id: int, user_id: int, first_name: str, last_name: str, username: str,
+                option_index: int = None, option_text: str = None) -> Optional[int]:
+    """Records a vote (user, participant, response) in one transaction and returns the new poll version."""
+    with _write_session() as session:
+        try:
+            version = record_vote_ext(session, chat_id, poll_id, user_id, first_name, last_name, username,
+                                      option_index=option_index, option_text=option_text)
+            _save(session)
+            return version
+        except Exception as e:
+            logger.error(f"Exception in record_vote: {e}", exc_info=True)
+            _discard(session)
+            return None
 
 def add_user_to_participants(chat_id: int, user_id: int, username: str, first_name: str, last_name: str):
     """Adds a user and a participant entry in a single transaction."""
-    session = SessionLocal()
-    try:
-        update_user(session, user_id, first_name, last_name, username)
-        
-        participant = session.query(Participant).filter_by(chat_id=chat_id, user_id=user_id).first()
-        if not participant:
-            participant = Participant(chat_id=chat_id, user_id=user_id, username=username, first_name=first_name, last_name=last_name)
-            session.add(participant)
-        
-        safe_commit(session)
-    except Exception as e:
-        logger.error(f"Error in add_user_to_participants: {e}")
-        session.rollback()
-    finally:
-        session.close()
+    with _write_session() as session:
+        try:
+            update_user(session, user_id, first_name, last_name, username)
+
+            participant = session.get(Participant, (chat_id, user_id))
+            if not participant:
+                participant = Participant(chat_id=chat_id, user_id=user_id, username=username, first_name=first_name, last_name=last_name)
+                session.add(participant)
+
+            _save(session)
+        except Exception as e:
+            logger.error(f"Error in add_user_to_participants: {e}")
+            _discard(session)
 
 def update_user_standalone(user_id: int, first_name: str, last_name: str, username: str = None):
     """Standalone version of update_user for contexts without an existing session."""
-    session = SessionLocal()
-    try:
-        update_user(session, user_id, first_name, last_name, username)
-        safe_commit(session)
-    except Exception as e:
-        logger.error(f"Error in update_user_standalone: {e}")
-        session.rollback()
-    finally:
-        session.close()
+    with _write_session() as session:
+        try:
+            update_user(session, user_id, first_name, last_name, username)
+            _save(session)
+        except Exception as e:
+            logger.error(f"Error in update_user_standalone: {e}")
+            _discard(session)
 
 def update_known_chats(chat_id: int, title: str, chat_type: str) -> None:
     """Обновление списка известных чатов"""
-    session = SessionLocal()
-    try:
-        chat = session.query(KnownChat).filter_by(chat_id=chat_id).first()
-        if chat:
-            chat.title = title
-            chat.type = chat_type
-        else:
-            chat = KnownChat(chat_id=chat_id, title=title, type=chat_type)
-            session.add(chat)
-        safe_commit(session)
-    except Exception as e:
-        logger.error(f"Error updating known chats: {e}")
-        session.rollback()
-    finally:
-        session.close()
+    with _write_session() as session:
+        try:
+            chat = session.get(KnownChat, chat_id)
+            if chat:
+                chat.title = title
+                chat.type = chat_type
+            else:
+                chat = KnownChat(chat_id=chat_id, title=title, type=chat_type)
+                session.add(chat)
+            _save(session)
+        except Exception as e:
+            logger.error(f"Error updating known chats: {e}")
+            _discard(session)
+
+class ChatActivity(NamedTuple):
+    chat_id: int
+    title: str
+    chat_type: str
+
+class ParticipantActivity(NamedTuple):
+    chat_id: int
+    user_id: int
+    username: Optional[str]
+    first_name: str
+    last_name: str
+
+def record_activity(chats: Iterable[ChatActivity] = (), participants: Iterable[ParticipantActivity] = ()) -> bool:
+    """
+    Batched update_known_chats + add_user_to_participants (see src/activity_buffer.py).
+    Existing rows are loaded with IN queries (participants per chat) and only rows that actually
+    change are written; everything is committed in one transaction. Returns False on error.
+    """
+    chats, participants = list(chats), list(participants)
+    # Всегда своя сессия, не сессия единицы работы: буфер считает записи сохранёнными,
+    # как только функция вернула True, даже если обновление потом откатится.
+    with closing(SessionLocal()) as session:
+        try:
+            known, users, members = {}, {}, set()
+            chat_ids = list({c.chat_id for c in chats})
+            user_ids = list({p.user_id for p in participants})
+            members_by_chat = defaultdict(set)
+            for p in participants:
+                members_by_chat[p.chat_id].add(p.user_id)
+            for i in range(0, len(chat_ids), IN_CLAUSE_CHUNK):
+                for chat in session.query(KnownChat).filter(KnownChat.chat_id.in_(chat_ids[i:i + IN_CLAUSE_CHUNK])):
+                    known[chat.chat_id] = chat
+            for i in range(0, len(user_ids), IN_CLAUSE_CHUNK):
+                for user in session.query(User).filter(User.user_id.in_(user_ids[i:i + IN_CLAUSE_CHUNK])):
+                    users[user.user_id] = user
+            # Per chat: SQLite does not search the primary key for (chat_id, user_id) IN (VALUES ...).
+            for chat_id, ids in members_by_chat.items():
+                ids = list(ids)
+                for i in range(0, len(ids), IN_CLAUSE_CHUNK):
+                    members.update(session.query(Participant.chat_id, Participant.user_id).filter(
+                        Participant.chat_id == chat_id, Participant.user_id.in_(ids[i:i + IN_CLAUSE_CHUNK])).all())
+
+            for c in chats:
+                chat = known.get(c.chat_id)
+                if chat is None:
+                    chat = known[c.chat_id] = KnownChat(chat_id=c.chat_id, title=c.title, type=c.chat_type)
+                    session.add(chat)
+                else:
+                    if chat.title != c.title:
+                        chat.title = c.title
+                    if chat.type != c.chat_type:
+                        chat.type = c.chat_type
+            for p in participants:
+                # Same rules as update_user: empty names never overwrite stored ones.
+                user = users.get(p.user_id)
+                if user is None:
+                    user = users[p.user_id] = User(user_id=p.user_id, first_name=p.first_name, last_name=p.last_name, username=p.username)
+                    session.add(user)
+                else:
+                    for attr in ('first_name', 'last_name', 'username'):
+                        value = getattr(p, attr)
+                        if value and getattr(user, attr) != value:
+                            setattr(user, attr, value)
+                if (p.chat_id, p.user_id) not in members:
+                    members.add((p.chat_id, p.user_id))
+                    session.add(Participant(chat_id=p.chat_id, user_id=p.user_id, username=p.username,
+                                            first_name=p.first_name, last_name=p.last_name))
+            safe_commit(session)
+            return True
+        except Exception as e:
+            logger.error(f"Error recording chat activity: {e}", exc_info=True)
+            session.rollback()
+            return False
 
 
 def get_group_title(chat_id: int) -> str:
     """Получение названия группы"""
-    session = SessionLocal()
-    try:
-        chat = session.query(KnownChat).filter_by(chat_id=chat_id).first()
-        return chat.title if chat and chat.title else f"Группа {chat_id}"
-    except Exception as e:
-        logger.error(f"Error getting group title: {e}")
-        return f"Группа {chat_id}"
-    finally:
-        session.close()
+    with _helper_session() as session:
+        try:
+            chat = session.get(KnownChat, chat_id)
+            return chat.title if chat and chat.title else f"Группа {chat_id}"
+        except Exception as e:
+            logger.error(f"Error getting group title: {e}")
+            return f"Группа {chat_id}"
 
 
 def get_user_name(session: Session, user_id: int, markdown_link: bool = False) -> str:
     """Gets a user's name from a given session, optionally formatted for Markdown."""
-    logger.info(f"[DEBUG_GET_USER_NAME] Attempting to find user_id '{user_id}' in table '{User.__tablename__}'.")
-    all_user_ids_in_db = [u.user_id for u in session.query(User.user_id).all()]
-    logger.info(f"[DEBUG_GET_USER_NAME] Current user_ids in '{User.__tablename__}' table: {all_user_ids_in_db}")
-    
-    user = session.query(User).filter_by(user_id=user_id).first()
+    return resolve_user_names(session, [user_id], markdown_link=markdown_link)[user_id]
 
-    # If user not found in 'users', try to find them in 'participants' and create the 'users' entry.
-    if not user:
-        logger.warning(f"User {user_id} not found in 'users' table. Checking 'participants' as a fallback.")
-        participant = session.query(Participant).filter_by(user_id=user_id).first()
-        if participant:
-            logger.info(f"User {user_id} found in 'participants'. Creating entry in 'users' to self-heal.")
-            user = User(
-                user_id=participant.user_id,
-                username=participant.username,
-                first_name=participant.first_name,
-                last_name=participant.last_name
-            )
-            session.add(user)
-            # The calling function is responsible for the commit.
-
-    # If user is not in our database, we can't create a pretty name, but we can still create a link.
-    if not user:
-        logger.info(f"[DEBUG_GET_USER_NAME] User {user_id} not found in DB.")
-        if markdown_link:
-            # Escape "User <id>" just in case, though it's safe.
-            safe_name = escape_markdown(f"User {user_id}", version=2)
-            return f"[{safe_name}](tg://user?id={user_id})"
-        return f"User {user_id}"
-    
-    logger.info(f"[DEBUG_GET_USER_NAME] User {user_id} found in DB: {user.first_name}")
+# Upper bound for the number of bound parameters in one IN (...) clause.
+IN_CLAUSE_CHUNK = 500
 
-    # Construct the name from available details.
-    name = user.first_name or ""
-    if user.last_name:
-        name = f"{name} {user.last_name}".strip()
-    
+def get_users_by_ids(session: Session, user_ids: Iterable[int]) -> Dict[int, Union[User, Participant]]:
+    """
+    Loads name sources for many users at once: one IN query on 'users' and, for ids
+    missing there, one IN query on 'participants' (any chat). Ids found in neither are absent.
+    """
+    ids = list(dict.fromkeys(user_ids))
+    found: Dict[int, Union[User, Participant]] = {}
+    for i in range(0, len(ids), IN_CLAUSE_CHUNK):
+        chunk = ids[i:i + IN_CLAUSE_CHUNK]
+        for user in session.query(User).filter(User.user_id.in_(chunk)):
+            found[user.user_id] = user
+
+    missing = [uid for uid in ids if uid not in found]
+    for i in range(0, len(missing), IN_CLAUSE_CHUNK):
+        chunk = missing[i:i + IN_CLAUSE_CHUNK]
+        for participant in session.query(Participant).filter(Participant.user_id.in_(chunk)):
+            found.setdefault(participant.user_id, participant)
+    return found
+
+def resolve_user_names(session: Optional[Session], user_ids: Iterable[int], markdown_link: bool = False) -> Dict[int, str]:
+    """
+    Returns {user_id: name} for all given ids with a fixed number of queries.
+    Names are built like get_user_name does; unknown users become 'User <id>'.
+    """
+    with _helper_session(session) as session:
+        ids = list(dict.fromkeys(user_ids))
+        sources = get_users_by_ids(session, ids)
+        names = {}
+        for uid in ids:
+            src = sources.get(uid)
+            name = compose_user_name(uid, src.first_name, src.last_name, src.username) if src else f"User {uid}"
+            names[uid] = user_link(name, uid) if markdown_link else name
+        return names
+
+def compose_user_name(user_id: int, first_name: Optional[str], last_name: Optional[str], username: Optional[str]) -> str:
+    """Builds a display name: 'First Last', then username, then 'User <id>'."""
+    name = first_name or ""
+    if last_name:
+        name = f"{name} {last_name}".strip()
     # Fallback to username if no name is available.
     if not name:
-        name = user.username or f"User {user_id}"
-
-    # Escape the name for Markdown and create the link if requested.
-    if markdown_link:
-        # Only use characters that are safe for Markdown links
-        safe_name = escape_markdown(name, version=2)
-        return f"[{safe_name}](tg://user?id={user_id})"
-    
+        name = username or f"User {user_id}"
     return name
 
+def user_link(name: str, user_id: int) -> str:
+    """Formats a name as a MarkdownV2 mention link."""
+    safe_name = escape_markdown(name, version=2)
+    return f"[{safe_name}](tg://user?id={user_id})"
+
 # Functions to fetch data for display logic
 def get_poll(poll_id: int, session: Optional[Session] = None):
-    """Fetches a poll by its ID, optionally using an existing session."""
-    manage_session = not session
-    if manage_session:
-        session = SessionLocal()
-    
-    try:
-        poll = session.query(Poll).filter_by(poll_id=poll_id).first()
-        return poll
-    finally:
-        if manage_session:
-            session.close()
+    """Fetches a poll by its ID, optionally using an existing session (identity map first)."""
+    with _helper_session(session) as session:
+        return session.get(Poll, poll_id)
 
 def get_responses(poll_id: int, session: Optional[Session] = None) -> List[Response]:
     """Fetches all responses for a poll, optionally using an existing session."""
-    manage_session = not session
-    if manage_session:
-        session = SessionLocal()
-    
-    try:
-        responses = session.query(Response).filter_by(poll_id=poll_id).all()
-        return responses
-    finally:
-        if manage_session:
-            session.close()
+    with _helper_session(session) as session:
+        return session.query(Response).filter_by(poll_id=poll_id).all()
 
 def get_poll_setting(poll_id: int, create: bool = False, session: Optional[Session] = None) -> Optional[PollSetting]:
-    """Retrieves settings for a specific poll."""
-    manage_session = not session
-    if manage_session:
-        session = SessionLocal()
-    
-    try:
-        setting = session.query(PollSetting).filter_by(poll_id=poll_id).first()
+    """Retrieves settings for a specific poll, creating them first when ``create`` is set."""
+    with _helper_session(session) as session:
+        setting = session.get(PollSetting, poll_id)
         if not setting and create:
             setting = PollSetting(poll_id=poll_id)
             session.add(setting)
-            # We need to commit here if we created it, so the calling function can use it.
-            # A flush might be sufficient, but commit is safer for cross-function use.
-            if manage_session:
-                safe_commit(session)
-            else:
-                # If we are in a managed session, just flush to get the ID
-                session.flush()
-        
-        # Если объект найден, загружаем все атрибуты, чтобы избежать DetachedInstanceError
-        if setting and manage_session:
-            # Загружаем все атрибуты объекта в рамках текущей сессии
-            session.refresh(setting)
-            # Создаем копию объекта с загруженными атрибутами
-            setting_data = {
-                'poll_id': setting.poll_id,
-                'allow_multiple_answers': setting.allow_multiple_answers,
-                'show_results_after_vote': setting.show_results_after_vote,
-                'default_show_names': setting.default_show_names,
-                'default_show_count': setting.default_show_count,
-                'show_heatmap': setting.show_heatmap,
-                'show_text_results': setting.show_text_results,
-                'default_names_style': setting.default_names_style,
-                'target_sum': setting.target_sum,
-                'nudge_negative_emoji': setting.nudge_negative_emoji
-            }
-            # Создаем новый объект с загруженными данными
-            detached_setting = PollSetting()
-            for key, value in setting_data.items():
-                setattr(detached_setting, key, value)
-            return detached_setting
-        
-        return setting
-    finally:
-        if manage_session:
-            session.close()
-
-def get_poll_option_setting(poll_id: int, option_index: int, create: bool = False, session: Optional[Session] = None) -> Union[PollOptionSetting, None]:
-    manage_session = session is None
-    if manage_session:
-        session = SessionLocal()
-    try:
-        setting = session.query(PollOptionSetting).filter_by(poll_id=poll_id, option_index=option_index).first()
-        if not setting and create:
-            setting = PollOptionSetting(poll_id=poll_id, option_index=option_index)
-            session.add(setting)
-            # Commit to persist, then refresh to make sure attributes are loaded
-            safe_commit(session)
-        if setting is not None and manage_session:
-            # Ensure attributes loaded then detach so can be used outside
-            session.refresh(setting)
+            _save(session)
+            if _owns(session):
+                # The commit expired the defaults just written; load them before detaching.
+                session.refresh(setting)
+        if setting is not None and _owns(session):
+            # Все атрибуты загружены: объект можно использовать после закрытия сессии
+            # (и сохранить через commit_session).
             session.expunge(setting)
         return setting
-    finally:
-        if manage_session:
-            session.close()
+
+def get_poll_option(poll_id: int, option_index: int, session: Optional[Session] = None) -> Union[PollOption, None]:
+    """Fetches one option (text and settings) by primary key."""
+    with _helper_session(session) as session:
+        option = session.get(PollOption, (poll_id, option_index))
+        if option is not None and _owns(session):
+            # Detach so it can be used (and passed to commit_session) outside
+            session.expunge(option)
+        return option
 
 
 def get_known_chats():
-    session = SessionLocal()
-    chats = session.query(KnownChat).all()
-    session.close()
-    return chats
+    with _helper_session() as session:
+        return session.query(KnownChat).all()
 
 def get_polls_by_status(chat_id: int, status: str):
-    session = SessionLocal()
-    polls = session.query(Poll).filter_by(chat_id=chat_id, status=status).all()
-    session.close()
-    return polls
+    with _helper_session() as session:
+        return session.query(Poll).filter_by(chat_id=chat_id, status=status).all()
 
 def get_participants(chat_id: int, session: Optional[Session] = None):
     """Fetches all participants for a given chat."""
-    manage_session = not session
-    if manage_session:
-        session = SessionLocal()
-    
-    try:
-        participants = session.query(Participant).filter_by(chat_id=chat_id).all()
-        return participants
-    finally:
-        if manage_session:
-            session.close()
+    with _helper_session(session) as session:
+        return session.query(Participant).filter_by(chat_id=chat_id).all()
 
 def get_participant(chat_id: int, user_id: int):
-    session = SessionLocal()
-    participant = session.query(Participant).filter_by(chat_id=chat_id, user_id=user_id).first()
-    session.close()
-    return participant
+    with _helper_session() as session:
+        return session.get(Participant, (chat_id, user_id))
 
 def get_response(poll_id: int, user_id: int):
-    session = SessionLocal()
-    response = session.query(Response).filter_by(poll_id=poll_id, user_id=user_id).first()
-    session.close()
-    return response
+    with _helper_session() as session:
+        return session.query(Response).filter_by(poll_id=poll_id, user_id=user_id).first()
 
 def add_poll(poll: Poll) -> int:
     """Adds a poll to the database and returns its new ID."""
-    session = SessionLocal()
-    session.add(poll)
-    safe_commit(session)
-    poll_id = poll.poll_id
-    session.close()
-    return poll_id
+    with _helper_session() as session:
+        session.add(poll)
+        _save(session)
+        return poll.poll_id
 
 def add_response(response: Response):
-    session = SessionLocal()
-    session.add(response)
-    safe_commit(session)
-    session.close()
+    with _helper_session() as session:
+        session.add(response)
+        _save(session)
 
 def add_participant(participant: Participant):
-    session = SessionLocal()
-    session.add(participant)
-    safe_commit(session)
-    session.close()
+    with _helper_session() as session:
+        session.add(participant)
+        _save(session)
 
 def add_poll_setting(setting: PollSetting):
-    session = SessionLocal()
-    session.add(setting)
-    safe_commit(session)
-    session.close()
-
-def add_poll_option_setting(setting: PollOptionSetting):
-    session = SessionLocal()
-    session.add(setting)
-    safe_commit(session)
-    session.close()
+    with _helper_session() as session:
+        session.add(setting)
+        _save(session)
 
 def delete_response(response: Response):
-    session = SessionLocal()
-    session.delete(response)
-    safe_commit(session)
-    session.close()
+    with _helper_session() as session:
+        session.delete(response)
+        _save(session)
 
 def delete_poll(poll: Poll):
-    session = SessionLocal()
-    session.delete(poll)
-    safe_commit(session)
-    session.close()
+    with _helper_session() as session:
+        session.delete(poll)
+        _save(session)
 
 def delete_participants(chat_id: int):
-    session = SessionLocal()
-    try:
-        session.query(Participant).filter_by(chat_id=chat_id).delete()
-        safe_commit(session)
-    except Exception as e:
-        logger.error(f"Error deleting participants for chat {chat_id}: {e}")
-        session.rollback()
-    finally:
-        session.close()
+    with _write_session() as session:
+        try:
+            session.query(Participant).filter_by(chat_id=chat_id).delete()
+            bump_poll_versions(session, chat_ids=[chat_id])
+            _save(session)
+        except Exception as e:
+            logger.error(f"Error deleting participants for chat {chat_id}: {e}")
+            _discard(session)
 
 def delete_responses_for_poll(poll_id: int):
-    session = SessionLocal()
-    try:
-        session.query(Response).filter_by(poll_id=poll_id).delete()
-        safe_commit(session)
-    except Exception as e:
-        logger.error(f"Error deleting responses for poll {poll_id}: {e}")
-        session.rollback()
-    finally:
-        session.close()
+    with _write_session() as session:
+        try:
+            session.query(Response).filter_by(poll_id=poll_id).delete()
+            bump_poll_versions(session, poll_ids=[poll_id])
+            rebuild_poll_tallies(session, poll_ids=[poll_id])
+            _save(session)
+        except Exception as e:
+            logger.error(f"Error deleting responses for poll {poll_id}: {e}")
+            _discard(session)
 
 def delete_poll_setting(poll_id: int):
-    session = SessionLocal()
-    try:
-        session.query(PollSetting).filter_by(poll_id=poll_id).delete()
-        safe_commit(session)
-    except Exception as e:
-        logger.error(f"Error deleting poll setting for poll {poll_id}: {e}")
-        session.rollback()
-    finally:
-        session.close()
+    with _write_session() as session:
+        try:
+            session.query(PollSetting).filter_by(poll_id=poll_id).delete()
+            bump_poll_versions(session, poll_ids=[poll_id])
+            _save(session)
+        except Exception as e:
+            logger.error(f"Error deleting poll setting for poll {poll_id}: {e}")
+            _discard(session)
 
 def delete_poll_option_settings(poll_id: int):
-    session = SessionLocal()
-    try:
-        session.query(PollOptionSetting).filter_by(poll_id=poll_id).delete()
-        safe_commit(session)
-    except Exception as e:
-        logger.error(f"Error deleting poll option settings for poll {poll_id}: {e}")
-        session.rollback()
-    finally:
-        session.close()
+    """Resets the display settings of every option of the poll (texts are kept)."""
+    with _write_session() as session:
+        try:
+            session.query(PollOption).filter_by(poll_id=poll_id).update({
+                'show_names': None, 'names_style': None, 'is_priority': 0, 'contribution_amount': 0,
+                'emoji': None, 'show_count': None, 'show_contribution': 1,
+            }, synchronize_session=False)
+            bump_poll_versions(session, poll_ids=[poll_id])
+            _save(session)
+        except Exception as e:
+            logger.error(f"Error deleting poll option settings for poll {poll_id}: {e}")
+            _discard(session)
 
 def has_user_created_poll_in_chat(session, user_id: int, chat_id: int) -> bool:
     """
@@ -626,21 +1354,35 @@ def safe_commit(session: Session):
 
 
 def commit_session(*instances):
-    """Commits changes for the given ORM instances in a fresh session.
+    """Commits changes made to the given ORM instances.
 
-    Поскольку во многих обработчиках мы получаем объекты через функции, которые
-    внутри себя уже закрывают сессию, объекты становятся "detached". Чтобы всё
-    же сохранить модификации, мы создаём новую сессию, `merge`-им переданные
-    экземпляры и фиксируем изменения.
+    Внутри единицы работы (см. unit_of_work) объекты, полученные через функции
+    этого модуля, принадлежат её сессии: она просто фиксируется, без `merge`.
+    Вне её объекты "detached" — тогда мы создаём новую сессию, `merge`-им
+    переданные экземпляры и фиксируем изменения.
 
     Использование:
 
         poll.nudge_message_id = 123
         db.commit_session(poll)
 
-    Если объекты не переданы, функция просто делает `commit()` пустой сессии –
-    это безопасно, но ни на что не влияет.
+    Без объектов функция фиксирует текущую единицу работы, а вне её ничего не делает.
     """
+    uow = unit_of_work.current()
+    if uow is not None:
+        session = uow.session
+        try:
+            for obj in instances:
+                if obj is not None and obj not in session:
+                    session.merge(obj)
+            safe_commit(session)
+        except Exception as e:
+            logger.error(f"Error in commit_session: {e}")
+            raise
+        return
+    if not any(obj is not None for obj in instances):
+        return
+
     session = SessionLocal()
     try:
         for obj in instances:
@@ -656,32 +1398,73 @@ def commit_session(*instances):
 
 def get_poll_exclusions(poll_id: int, session: Optional[Session] = None) -> Set[int]:
     """Возвращает набор user_id, исключённых из данного опроса."""
-    manage_session = session is None
-    if manage_session:
-        session = SessionLocal()
-    try:
+    with _helper_session(session) as session:
         rows = session.query(PollExclusion.user_id).filter_by(poll_id=poll_id).all()
         return {r.user_id for r in rows}
-    finally:
-        if manage_session:
-            session.close()
 
 def toggle_poll_exclusion(poll_id: int, user_id: int):
     """Переключает статус исключения пользователя для опроса."""
-    session = SessionLocal()
-    try:
-        row = session.query(PollExclusion).filter_by(poll_id=poll_id, user_id=user_id).first()
-        if row:
-            session.delete(row)
-            excluded = False
+    with _write_session() as session:
+        try:
+            row = session.query(PollExclusion).filter_by(poll_id=poll_id, user_id=user_id).first()
+            if row:
+                session.delete(row)
+                excluded = False
+            else:
+                session.add(PollExclusion(poll_id=poll_id, user_id=user_id))
+                excluded = True
+            _save(session)
+            return excluded
+        except Exception as e:
+            logger.error(f"Error toggling poll exclusion: {e}")
+            _discard(session)
+            raise
+
+# --- Uploaded image registry ---
+
+def get_image_file_id(digest: str) -> Optional[str]:
+    """Returns the Telegram file_id stored for an image digest, if any."""
+    with _helper_session() as session:
+        row = session.get(ImageFileId, digest)
+        return row.file_id if row is not None else None
+
+def save_image_file_id(digest: str, file_id: str) -> None:
+    """Stores (or replaces) the Telegram file_id of an uploaded image."""
+    with _helper_session() as session:
+        session.merge(ImageFileId(digest=digest, file_id=file_id))
+        _save(session)
+
+def delete_image_file_id(digest: str) -> None:
+    """Forgets a file_id that Telegram no longer accepts."""
+    with _helper_session() as session:
+        session.query(ImageFileId).filter_by(digest=digest).delete()
+        _save(session)
+
+# --- Webhook update deduplication (shared by all worker processes) ---
+
+def claim_update(update_id: int, received_at: float) -> bool:
+    """Marks the update as taken for processing. False if some process has taken it already."""
+    with _helper_session() as session:
+        upsert = _UPSERT_INSERTS.get(session.get_bind().dialect.name)
+        if upsert is not None:
+            stmt = upsert(ProcessedUpdate.__table__).values(update_id=update_id, received_at=received_at)
+            claimed = bool(session.connection().execute(stmt.on_conflict_do_nothing()).rowcount)
         else:
-            session.add(PollExclusion(poll_id=poll_id, user_id=user_id))
-            excluded = True
-        safe_commit(session)
-        return excluded
-    except Exception as e:
-        logger.error(f"Error toggling poll exclusion: {e}")
-        session.rollback()
-        raise
-    finally:
-        session.close() 
\ No newline at end of file
+            claimed = session.get(ProcessedUpdate, update_id) is None
+            if claimed:
+                session.add(ProcessedUpdate(update_id=update_id, received_at=received_at))
+        _save(session)
+        return claimed
+
+def release_update(update_id: int) -> None:
+    """Forgets a claimed update that was not processed, so its redelivery is."""
+    with _helper_session() as session:
+        session.query(ProcessedUpdate).filter_by(update_id=update_id).delete()
+        _save(session)
+
+def prune_processed_updates(before: float) -> int:
+    """Deletes claims older than ``before`` (unix time); returns how many."""
+    with _helper_session() as session:
+        deleted = session.query(ProcessedUpdate).filter(ProcessedUpdate.received_at < before).delete()
+        _save(session)
+        return deleted
@@ -2,9 +2,14 @@ import re
 import io
 from telegram.helpers import escape_markdown
 from . import database as db
+from . import async_database as adb
 from .config import logger
 from .drawing import generate_results_heatmap_image
+from .snapshot import PollSnapshot, load_poll_snapshot
+from .render_cache import render_cache
+from .render_pool import render_pool
 from typing import Optional, Tuple
+from sqlalchemy import inspect
 from sqlalchemy.orm import Session
 
 def get_progress_bar(progress, total, length=40):
@@ -19,229 +24,284 @@ def get_progress_bar(progress, total, length=40):
     percent_display = int(percent * 100)
     return f"\\[{bar_escaped}\\] {percent_display}%", percent * 100
 
-def generate_poll_content(poll_id: int = None, poll: Optional[db.Poll] = None, session: Optional[Session] = None) -> Tuple[str, Optional[io.BytesIO]]:
+def generate_poll_content(poll_id: int = None, poll: Optional[db.Poll] = None, session: Optional[Session] = None,
+                          snapshot: Optional[PollSnapshot] = None) -> Tuple[str, Optional[io.BytesIO]]:
     """
     Generates the text caption and heatmap image for a poll.
+    Results are cached by (poll_id, version), so an unchanged poll is rendered only once.
+    Pass a snapshot to render exactly that state.
     Returns a tuple: (text, image_bytes)
     """
-    manage_session = session is None
-    image_bytes = None
+    content, snapshot, version = load_render_input(poll_id, poll=poll, session=session, snapshot=snapshot)
+    if content is not None:
+        return content
+    return _render_and_cache(snapshot, version)
 
-    try:
-        if manage_session:
-            session = db.SessionLocal()
+async def generate_poll_content_async(poll_id: int = None, poll: Optional[db.Poll] = None, session: Optional[Session] = None,
+                                      snapshot: Optional[PollSnapshot] = None) -> Tuple[str, Optional[io.BytesIO]]:
+    """
+    Async twin of generate_poll_content for handlers.
+    The snapshot is loaded in the DB executor and drawn in the render pool, so a
+    slow render never holds a DB worker.
+    """
+    if snapshot is None:
+        content, snapshot, version = await adb.run_sync(load_render_input, poll_id, poll=poll, session=session)
+    else:
+        content, snapshot, version = load_render_input(poll_id, snapshot=snapshot)
+    if content is not None:
+        return content
+    return await render_pool.run(_render_and_cache, snapshot, version)
+
+def load_render_input(poll_id: int = None, poll: Optional[db.Poll] = None, session: Optional[Session] = None,
+                      snapshot: Optional[PollSnapshot] = None):
+    """
+    Does the DB part of generate_poll_content.
+    Returns (content, snapshot, version): ``content`` is set when the answer is already
+    known (cached render or missing poll), otherwise ``snapshot`` holds the data to draw.
+    """
+    manage_session = session is None and snapshot is None
+    if manage_session:
+        session = db.SessionLocal()
 
-        if not poll and poll_id is not None:
-            # If we have a session, we should use it for the query.
+    try:
+        if snapshot is None and poll is None and poll_id is not None:
             poll = session.query(db.Poll).filter_by(poll_id=poll_id).first()
-        elif poll and not manage_session:
-            # If the poll object was passed from another session, merge it into ours
-            # to avoid the "already attached" error.
-            poll = session.merge(poll)
-        
-        if not poll:
+        source = snapshot if snapshot is not None else poll
+        if source is None:
             logger.error(f"generate_poll_content: Poll with ID {poll_id} not found.")
-            return "Опрос не найден.", None
-        
-        # Ensure poll_id is set for other functions that might need it.
-        if poll_id is None:
-            poll_id = poll.poll_id
-
-        message = poll.message
-        responses = db.get_responses(poll_id)
-        
-        # --- Determine the options to display ---
-        # Start with the options defined in the poll.
-        display_options = []
-        if poll.options and poll.options != 'Web App Poll': # Avoid the old placeholder
-             display_options = [opt.strip() for opt in poll.options.split(',')]
-        
-        # For any poll type, dynamically add options found in responses
-        # that aren't already in our list. This makes it robust.
-        if responses:
-            voted_options = list(dict.fromkeys(r.response.strip() for r in responses))
-            for opt in voted_options:
-                if opt not in display_options:
-                    display_options.append(opt)
-
-        votes_by_option = {opt: [] for opt in display_options}
-        # This now stores a list of responses for each user.
-        user_votes = {r.user_id: [] for r in responses}
-
-        for r in responses:
-            # Normalize the response from DB to match a clean option from the poll
-            cleaned_response = r.response.strip()
-            if cleaned_response in votes_by_option:
-                votes_by_option[cleaned_response].append(r.user_id)
-            user_votes[r.user_id].append(cleaned_response)
-
-        counts = {opt: 0 for opt in display_options}
-        for resp in responses:
-            if resp.response in counts: counts[resp.response] += 1
-            
-        poll_setting = db.get_poll_setting(poll_id)
-        # For webapp polls, we don't have per-option settings from the DB,
-        # so we rely only on the poll-wide defaults.
-        default_show_names = poll_setting.default_show_names if poll_setting and poll_setting.default_show_names is not None else 1
-        default_show_count = poll_setting.default_show_count if poll_setting and poll_setting.default_show_count is not None else 1
-
-        # In multiple choice polls, the number of voters is unique users, not total responses.
-        total_voters = len(user_votes)
-        text_parts = [escape_markdown(message, version=2), ""]
-
-        # Add a clear 'closed' status if applicable
-        if poll.status == 'closed':
-            text_parts.insert(0, "*ОПРОС ЗАВЕРШЕН*")
-            text_parts.insert(1, "\\-\\-\\-") # Separator
-
-        # For webapp polls, if there are no votes yet, don't show the options list.
-        # This avoids a Telegram API conflict on the initial message send.
-        if poll.poll_type == 'webapp' and not user_votes:
-            # The text will just be the title and the total votes (0).
-            pass
-        # For webapp polls WITH votes, or for all native polls:
-        elif poll.poll_type == 'webapp':
-            for i, option_text in enumerate(display_options):
-                count = counts.get(option_text, 0)
-                escaped_option_text = escape_markdown(option_text, version=2)
-                line = f"{escaped_option_text}: *{count}*"
-                text_parts.append(line)
-
-                if default_show_names and count > 0:
-                    # Retrieve emoji from option settings if set
-                    opt_setting = db.get_poll_option_setting(poll_id, i, session=session)
-                    prefix = (opt_setting.emoji + ' ') if opt_setting and opt_setting.emoji else "▫️ "
-                    user_ids_for_option = votes_by_option.get(option_text, [])
-                    user_names = [db.get_user_name(session, uid, markdown_link=True) for uid in user_ids_for_option]
-                    names_list = [f"{prefix}{name}" for name in user_names]
-                    text_parts.append("\n".join(f"    {name}" for name in names_list))
-                text_parts.append("")
-
-        else: # Native poll display logic
-            options_with_settings = []
-            original_options = [opt.strip() for opt in poll.options.split(',')]
-            for i, option_text in enumerate(original_options):
-                opt_setting = db.get_poll_option_setting(poll_id, i, session=session)
-                options_with_settings.append({
-                    'text': option_text,
-                    'show_names': opt_setting.show_names if opt_setting and opt_setting.show_names is not None else default_show_names,
-                    'names_style': opt_setting.names_style if opt_setting and opt_setting.names_style else 'list',
-                    'is_priority': opt_setting.is_priority if opt_setting else 0,
-                    'contribution_amount': opt_setting.contribution_amount if opt_setting else 0,
-                    'emoji': (opt_setting.emoji + ' ') if opt_setting and opt_setting.emoji else "▫️ ",
-                    'show_count': opt_setting.show_count if opt_setting and opt_setting.show_count is not None else default_show_count,
-                    'show_contribution': opt_setting.show_contribution if opt_setting and opt_setting.show_contribution is not None else 1,
-                })
-
-            options_with_settings.sort(key=lambda x: x['is_priority'], reverse=True)
-
-            total_collected = 0 # Specific to native polls with contributions
-            target_sum = poll_setting.target_sum if poll_setting and poll_setting.target_sum is not None else 0
-
-            for option_data in options_with_settings:
-                option_text = option_data['text']
-                count = counts.get(option_text, 0)
-                contribution = option_data['contribution_amount']
-                if contribution > 0: total_collected += count * contribution
-                    
-                marker = "⭐ " if option_data['is_priority'] else ""
-                escaped_option_text = escape_markdown(option_text, version=2)
-                formatted_text = f"*{escaped_option_text}*" if option_data['is_priority'] else escaped_option_text
-                line = f"{marker}{formatted_text}"
-                if contribution > 0 and option_data['show_contribution']:
-                    line += f" \\(по {int(contribution)}\\)"
-                if option_data['show_count']:
-                    line += f": *{count}*"
-                text_parts.append(line)
-
-                if option_data['show_names'] and count > 0:
-                    user_ids_for_option = votes_by_option.get(option_text, [])
-                    user_names = [db.get_user_name(session, uid, markdown_link=True) for uid in user_ids_for_option]
-                    logger.info(f"[DEBUG] User names for option '{option_text}' in poll {poll_id}: {user_names}")
-                    names_list = [f"{option_data['emoji']}{name}" for name in user_names]
-                    indent = "    "
-                    if option_data['names_style'] == 'list': text_parts.append("\n".join(f"{indent}{name}" for name in names_list))
-                    elif option_data['names_style'] == 'inline': text_parts.append(f'{indent}{", ".join(names_list)}')
-                    elif option_data['names_style'] == 'numbered': text_parts.append("\n".join(f"{indent}{i}\\. {name}" for i, name in enumerate(names_list, 1)))
-                text_parts.append("")
-
-            if target_sum > 0:
-                bar, percent = get_progress_bar(total_collected, target_sum)
-                text_parts.append(f"💰 Собрано: *{int(total_collected)} из {int(target_sum)}*\n{bar}")
-            elif total_collected > 0:
-                text_parts.append(f"💰 Собрано: *{int(total_collected)}*")
-        
-        while text_parts and text_parts[-1] == "": text_parts.pop()
-        
-        # Display the number of unique voters.
-        text_parts.append(f"\nВсего проголосовало: *{total_voters}*")
-        final_text = "\n".join(text_parts)
-        
-        # --- Image Generation ---
-        show_heatmap = poll_setting.show_heatmap if poll_setting is not None else True
-        show_text_results = poll_setting.show_text_results if poll_setting is not None else True
-        image_bytes = None
-        # Генерируем тепловую карту, даже если пока нет голосов —
-        # это позволит сразу отправлять опрос фотографией и затем
-        # обновлять изображение «на месте», без удаления сообщения.
-        if show_heatmap:
-            image_bytes = generate_results_heatmap_image(
-                poll_id=poll_id,
-                session=session
-            )
-        
-        # We only commit if we created the session inside this function.
-        # The calling function is responsible for committing if it passed its own session.
-        if manage_session:
-            db.safe_commit(session)
-        
-        logger.info(f"[DEBUG] Final poll text for poll {poll_id}:\n{final_text}")
-        # If text results are disabled while heatmap is shown, keep only title and voters count.
-        if show_heatmap and not show_text_results:
-            safe_title = escape_markdown(message, version=2)
-            final_text = f"{safe_title}\n\nВсего проголосовало: *{total_voters}*"
-        return final_text, image_bytes
+            return ("Опрос не найден.", None), None, None
+
+        # The version is read before the content, so a cached render is never older than its key.
+        poll_id, version = source.poll_id, source.version
+        state = inspect(poll, raiseerr=False) if poll is not None else None
+        if state is not None and state.modified:
+            # Uncommitted changes are not in the version yet: draw them without the cache.
+            version = None
+        if version is not None:
+            cached = render_cache.get(poll_id, version)
+            if cached is not None:
+                text, image = cached
+                return (text, io.BytesIO(image) if image is not None else None), None, version
+
+        if snapshot is None:
+            snapshot = load_poll_snapshot(poll_id, session=session, poll=poll, allow_counts_only=True)
+        return None, snapshot, version
     finally:
-        # Only close the session if we created it here.
-        if manage_session and session:
+        if manage_session:
             session.close()
 
-async def generate_nudge_text(poll_id: int) -> str:
-    """Generates the text to nudge non-voters."""
-    session = db.SessionLocal()
-    try:
-        poll = db.get_poll(poll_id)
-        if not poll: return "Опрос не найден."
-        
-        participants = db.get_participants(poll.chat_id, session=session)
-        # Исключения на уровне опроса
-        poll_excl = db.get_poll_exclusions(poll_id, session=session)
-
-        participant_ids = {p.user_id for p in participants if (not p.excluded) and (p.user_id not in poll_excl)}
-
-        respondents = db.get_responses(poll_id)
-        respondent_ids = {r.user_id for r in respondents}
-        
-        non_voters = participant_ids - respondent_ids
-
-        poll_setting = db.get_poll_setting(poll_id)
-        neg_emoji = poll_setting.nudge_negative_emoji if poll_setting and poll_setting.nudge_negative_emoji else '❌'
-
-        text_parts = ["📢 *Ждем вашего голоса:*"]
-        
-        if not non_voters:
-            text_parts.append("\n_Все участники проголосовали!_ 🎉")
+def _render_and_cache(snapshot: PollSnapshot, version: Optional[int]) -> Tuple[str, Optional[io.BytesIO]]:
+    text, image_bytes = render_poll_content(snapshot)
+    if version is not None:
+        render_cache.put(snapshot.poll_id, version, text, image_bytes.getvalue() if image_bytes is not None else None)
+    return text, image_bytes
+
+def _counts_from_tallies(snapshot: PollSnapshot) -> Tuple[list, list]:
+    """Options to display and their vote counts from a counts-only snapshot, like the responses path."""
+    display_options = list(snapshot.options)
+    counts = [0] * len(display_options)
+    extra_slots = {}
+    for (option_index, response), votes in sorted(snapshot.tallies.items()):
+        if 0 <= option_index < len(snapshot.options):
+            slot = option_index
+        elif option_index != db.FREE_TEXT_OPTION:
+            continue  # votes for removed options
+        elif response.strip() in snapshot.options:
+            slot = snapshot.options.index(response.strip())
+        else:
+            text = response.strip()
+            if text not in extra_slots:
+                extra_slots[text] = len(display_options)
+                display_options.append(text)
+                counts.append(0)
+            slot = extra_slots[text]
+        counts[slot] += votes
+    return display_options, counts
+
+def render_poll_content(snapshot: PollSnapshot) -> Tuple[str, Optional[io.BytesIO]]:
+    """Renders caption text and heatmap for a snapshot, without caching."""
+    poll_id = snapshot.poll_id
+    message = snapshot.message
+    responses = snapshot.responses
+
+    # --- Determine the options to display ---
+    # Start with the options defined in the poll.
+    display_options = list(snapshot.options)
+
+    # For any poll type, dynamically add free-text answers found in responses
+    # after the poll's own options. Votes are aggregated by slot index.
+    slots = []
+    extra_slots = {}
+    for r in responses:
+        if r.option_index is not None and r.option_index < len(display_options):
+            slots.append(r.option_index)
         else:
+            if r.response not in extra_slots:
+                extra_slots[r.response] = len(display_options)
+                display_options.append(r.response)
+            slots.append(extra_slots[r.response])
+
+    votes_by_option = [[] for _ in display_options]
+    counts = [0] * len(display_options)
+    for r, slot in zip(responses, slots):
+        votes_by_option[slot].append(r.user_id)
+        counts[slot] += 1
+    # In multiple choice polls, the number of voters is unique users, not total responses.
+    total_voters = len({r.user_id for r in responses})
+    if snapshot.tallies is not None:
+        # Counts-only snapshot (no names, no heatmap): the maintained counters instead of the votes.
+        display_options, counts = _counts_from_tallies(snapshot)
+        votes_by_option = [[] for _ in display_options]
+        total_voters = snapshot.voter_count
+
+    poll_setting = snapshot.settings
+    # For webapp polls, we don't have per-option settings from the DB,
+    # so we rely only on the poll-wide defaults.
+    default_show_names = poll_setting.default_show_names if poll_setting and poll_setting.default_show_names is not None else 1
+    default_show_count = poll_setting.default_show_count if poll_setting and poll_setting.default_show_count is not None else 1
+
+    text_parts = [escape_markdown(message, version=2), ""]
+
+    # Add a clear 'closed' status if applicable
+    if snapshot.status == 'closed':
+        text_parts.insert(0, "*ОПРОС ЗАВЕРШЕН*")
+        text_parts.insert(1, "\\-\\-\\-") # Separator
+
+    # For webapp polls, if there are no votes yet, don't show the options list.
+    # This avoids a Telegram API conflict on the initial message send.
+    if snapshot.poll_type == 'webapp' and not total_voters:
+        # The text will just be the title and the total votes (0).
+        pass
+    # For webapp polls WITH votes, or for all native polls:
+    elif snapshot.poll_type == 'webapp':
+        for i, option_text in enumerate(display_options):
+            count = counts[i]
+            escaped_option_text = escape_markdown(option_text, version=2)
+            line = f"{escaped_option_text}: *{count}*"
+            text_parts.append(line)
+
+            if default_show_names and count > 0:
+                # Retrieve emoji from option settings if set
+                opt_setting = snapshot.option_setting(i)
+                prefix = (opt_setting.emoji + ' ') if opt_setting and opt_setting.emoji else "▫️ "
+                user_ids_for_option = votes_by_option[i]
+                user_names = [snapshot.user_name(uid, markdown_link=True) for uid in user_ids_for_option]
+                names_list = [f"{prefix}{name}" for name in user_names]
+                text_parts.append("\n".join(f"    {name}" for name in names_list))
             text_parts.append("")
-            # Sorting by name requires fetching all names, which can be slow.
-            # For simplicity, we sort by user_id. For real applications, consider sorting after fetching names.
-            sorted_non_voters = sorted(list(non_voters))
-            for user_id in sorted_non_voters:
-                user_mention = db.get_user_name(session, user_id, markdown_link=True)
-                text_parts.append(f"{neg_emoji} {user_mention}")
-
-        final_text = "\n".join(text_parts)
-        session.commit()
-        return final_text
-    finally:
-        session.close() 
\ No newline at end of file
+
+    else: # Native poll display logic
+        options_with_settings = []
+        for i, option_text in enumerate(snapshot.options):
+            opt_setting = snapshot.option_setting(i)
+            options_with_settings.append({
+                'index': i,
+                'text': option_text,
+                'show_names': opt_setting.show_names if opt_setting and opt_setting.show_names is not None else default_show_names,
+                'names_style': opt_setting.names_style if opt_setting and opt_setting.names_style else 'list',
+                'is_priority': opt_setting.is_priority if opt_setting else 0,
+                'contribution_amount': opt_setting.contribution_amount if opt_setting else 0,
+                'emoji': (opt_setting.emoji + ' ') if opt_setting and opt_setting.emoji else "▫️ ",
+                'show_count': opt_setting.show_count if opt_setting and opt_setting.show_count is not None else default_show_count,
+                'show_contribution': opt_setting.show_contribution if opt_setting and opt_setting.show_contribution is not None else 1,
+            })
+
+        options_with_settings.sort(key=lambda x: x['is_priority'], reverse=True)
+
+        total_collected = 0 # Specific to native polls with contributions
+        target_sum = poll_setting.target_sum if poll_setting and poll_setting.target_sum is not None else 0
+
+        for option_data in options_with_settings:
+            option_text = option_data['text']
+            count = counts[option_data['index']]
+            contribution = option_data['contribution_amount']
+            if contribution > 0: total_collected += count * contribution
+                
+            marker = "⭐ " if option_data['is_priority'] else ""
+            escaped_option_text = escape_markdown(option_text, version=2)
+            formatted_text = f"*{escaped_option_text}*" if option_data['is_priority'] else escaped_option_text
+            line = f"{marker}{formatted_text}"
+            if contribution > 0 and option_data['show_contribution']:
+                line += f" \\(по {int(contribution)}\\)"
+            if option_data['show_count']:
+                line += f": *{count}*"
+            text_parts.append(line)
+
+            if option_data['show_names'] and count > 0:
+                user_ids_for_option = votes_by_option[option_data['index']]
+                user_names = [snapshot.user_name(uid, markdown_link=True) for uid in user_ids_for_option]
+                logger.info(f"[DEBUG] User names for option '{option_text}' in poll {poll_id}: {user_names}")
+                names_list = [f"{option_data['emoji']}{name}" for name in user_names]
+                indent = "    "
+                if option_data['names_style'] == 'list': text_parts.append("\n".join(f"{indent}{name}" for name in names_list))
+                elif option_data['names_style'] == 'inline': text_parts.append(f'{indent}{", ".join(names_list)}')
+                elif option_data['names_style'] == 'numbered': text_parts.append("\n".join(f"{indent}{i}\\. {name}" for i, name in enumerate(names_list, 1)))
+            text_parts.append("")
+
+        if target_sum > 0:
+            bar, percent = get_progress_bar(total_collected, target_sum)
+            text_parts.append(f"💰 Собрано: *{int(total_collected)} из {int(target_sum)}*\n{bar}")
+        elif total_collected > 0:
+            text_parts.append(f"💰 Собрано: *{int(total_collected)}*")
+    
+    while text_parts and text_parts[-1] == "": text_parts.pop()
+    
+    # Display the number of unique voters.
+    text_parts.append(f"\nВсего проголосовало: *{total_voters}*")
+    final_text = "\n".join(text_parts)
+    
+    # --- Image Generation ---
+    show_heatmap = poll_setting.show_heatmap if poll_setting is not None else True
+    show_text_results = poll_setting.show_text_results if poll_setting is not None else True
+    image_bytes = None
+    # Генерируем тепловую карту, даже если пока нет голосов —
+    # это позволит сразу отправлять опрос фотографией и затем
+    # обновлять изображение «на месте», без удаления сообщения.
+    if show_heatmap:
+        image_bytes = generate_results_heatmap_image(
+            poll_id=poll_id,
+            snapshot=snapshot
+        )
+
+    logger.info(f"[DEBUG] Final poll text for poll {poll_id}:\n{final_text}")
+    # If text results are disabled while heatmap is shown, keep only title and voters count.
+    if show_heatmap and not show_text_results:
+        safe_title = escape_markdown(message, version=2)
+        final_text = f"{safe_title}\n\nВсего проголосовало: *{total_voters}*"
+    return final_text, image_bytes
+
+async def generate_nudge_text(poll_id: int) -> str:
+    """Generates the text to nudge non-voters."""
+    return await adb.run_sync(build_nudge_text, poll_id)
+
+def build_nudge_text(poll_id: int, snapshot: Optional[PollSnapshot] = None) -> str:
+    """Blocking part of generate_nudge_text: builds the text from a PollSnapshot."""
+    if snapshot is None:
+        snapshot = load_poll_snapshot(poll_id)
+    if not snapshot: return "Опрос не найден."
+
+    # Исключения на уровне опроса
+    poll_excl = snapshot.exclusions
+    participant_ids = {p.user_id for p in snapshot.participants if (not p.excluded) and (p.user_id not in poll_excl)}
+
+    respondent_ids = {r.user_id for r in snapshot.responses}
+
+    non_voters = participant_ids - respondent_ids
+
+    poll_setting = snapshot.settings
+    neg_emoji = poll_setting.nudge_negative_emoji if poll_setting and poll_setting.nudge_negative_emoji else '❌'
+
+    text_parts = ["📢 *Ждем вашего голоса:*"]
+
+    if not non_voters:
+        text_parts.append("\n_Все участники проголосовали!_ 🎉")
+    else:
+        text_parts.append("")
+        # Sorting by name requires fetching all names, which can be slow.
+        # For simplicity, we sort by user_id. For real applications, consider sorting after fetching names.
+        sorted_non_voters = sorted(list(non_voters))
+        for user_id in sorted_non_voters:
+            user_mention = snapshot.user_name(user_id, markdown_link=True)
+            text_parts.append(f"{neg_emoji} {user_mention}")
+
+    return "\n".join(text_parts)
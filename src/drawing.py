@@ -1,15 +1,25 @@
+import functools
 import io
+import threading
+from collections import OrderedDict
 from PIL import Image, ImageDraw, ImageFont
-from typing import Optional
+from typing import Dict, List, NamedTuple, Optional, Tuple
 import os
 import math
 
-from . import database as db
-from .config import logger
+try:
+    import numpy as np
+except ImportError:  # optional: without numpy the vote cells are drawn one by one with Pillow
+    np = None
 
-from collections import namedtuple
+from . import database as db
+from . import metrics
+from .image_encoders import encode_image
+from .config import logger, HEATMAP_LAYER_CACHE_POLLS
+from .snapshot import ParticipantView, PollSnapshot, load_poll_snapshot
 
 # --- Constants ---
+@functools.lru_cache(maxsize=None)
 def _load_font(name_candidates, size):
     """Пробует последовательно список имён/путей к TTF-файлам и возвращает первый найденный."""
     for cand in name_candidates:
@@ -19,30 +29,34 @@ def _load_font(name_candidates, size):
             continue
     return None
 
-# Попытка загрузить шрифт с поддержкой кириллицы.
-FONT_REGULAR = _load_font([
+REGULAR_FONT_CANDIDATES = (
     "/System/Library/Fonts/Supplemental/Arial.ttf",  # macOS
     "arial.ttf",  # Windows / пользователь может установить
     "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
     "DejaVuSans.ttf",
-], 15)
-
-FONT_BOLD = _load_font([
+)
+BOLD_FONT_CANDIDATES = (
     "/System/Library/Fonts/Supplemental/Arial Bold.ttf",  # macOS (если есть)
     "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
     "DejaVuSans-Bold.ttf",
     "arialbd.ttf",
-], 16)
+)
+
+# Попытка загрузить шрифт с поддержкой кириллицы.
+FONT_REGULAR = _load_font(REGULAR_FONT_CANDIDATES, 15)
+FONT_BOLD = _load_font(BOLD_FONT_CANDIDATES, 16)
 
 if FONT_REGULAR is None or FONT_BOLD is None:
     logger.warning("Fallback to default PIL font; Cyrillic glyphs may look poor.")
     FONT_REGULAR = FONT_REGULAR or ImageFont.load_default()
     FONT_BOLD = FONT_BOLD or ImageFont.load_default()
 
+@functools.lru_cache(maxsize=None)
 def get_system_font(size=20):
     """
     Возвращает объект ImageFont с поддержкой кириллицы для Mac, Windows и Linux.
     Если подходящий ttf-шрифт не найден — возвращает стандартный PIL-шрифт.
+    Шрифты кэшируются по размеру: файловая система проверяется один раз.
     """
     possible_paths = [
         "/System/Library/Fonts/Supplemental/Arial.ttf",  # macOS
@@ -59,6 +73,74 @@ def get_system_font(size=20):
     print("WARNING: Не найден подходящий ttf-шрифт, используем стандартный PIL-шрифт (кириллица будет отображаться некорректно)")
     return ImageFont.load_default()
 
+class GlyphMetrics:
+    """
+    Caches glyph advances and pair kerning of one font.
+
+    In Pillow's basic layout the length of a string is the sum of its glyph
+    advances plus the kerning of every adjacent pair, so widths of prefixes and
+    concatenations can be computed from cached values instead of asking FreeType
+    to lay out the whole string again. Results equal ``font.getlength`` exactly.
+    """
+
+    def __init__(self, font):
+        self.font = font
+        self._advance: Dict[str, float] = {}
+        self._kerning: Dict[Tuple[str, str], float] = {}
+
+    def advance(self, char: str) -> float:
+        width = self._advance.get(char)
+        if width is None:
+            width = self._advance[char] = self.font.getlength(char)
+        return width
+
+    def kerning(self, left: str, right: str) -> float:
+        pair = (left, right)
+        delta = self._kerning.get(pair)
+        if delta is None:
+            delta = self._kerning[pair] = self.font.getlength(left + right) - self.advance(left) - self.advance(right)
+        return delta
+
+    def prefix_widths(self, text: str) -> List[float]:
+        """``result[k]`` is the width of ``text[:k]``."""
+        widths = [0.0]
+        prev = None
+        for char in text:
+            width = widths[-1] + self.advance(char)
+            if prev is not None:
+                width += self.kerning(prev, char)
+            widths.append(width)
+            prev = char
+        return widths
+
+    def width(self, text: str) -> float:
+        return self.prefix_widths(text)[-1]
+
+    def join_width(self, left_width: float, left_last: Optional[str], right_width: float, right_first: Optional[str]) -> float:
+        """Width of ``left + right`` from the parts' widths and their boundary characters (None for empty parts)."""
+        if left_last is None or right_first is None:
+            return left_width + right_width
+        return left_width + right_width + self.kerning(left_last, right_first)
+
+@functools.lru_cache(maxsize=32)
+def glyph_metrics(font) -> GlyphMetrics:
+    return GlyphMetrics(font)
+
+def truncate_text(text: str, font, max_width: float, ellipsis: str = '…') -> str:
+    """
+    Shortens ``text`` so that ``text + ellipsis`` fits into ``max_width``.
+    Text that already fits is returned unchanged; at least one character is kept.
+    """
+    gm = glyph_metrics(font)
+    widths = gm.prefix_widths(text)
+    if widths[-1] <= max_width:
+        return text
+    ellipsis_width = gm.width(ellipsis)
+    keep = len(text)
+    while keep > 1 and gm.join_width(widths[keep], text[keep - 1], ellipsis_width, ellipsis[:1] or None) > max_width:
+        keep -= 1
+    return text[:keep] + ellipsis
+
 # Colors
 COLOR_BG = (255, 255, 255)
 # Чуть более выразительный дизайн
@@ -71,6 +153,7 @@ COLOR_VOTE_YES = (99, 201, 115)        # более мягкий зелёный
 COLOR_VOTE_NO = (245, 245, 245)        # Light Grey
 COLOR_EXCLUDED_ROW = (255, 235, 238)   # Light Red for the entire row of an excluded user
 COLOR_VOTE_EXCLUDED = (255, 183, 74)   # Orange highlight for votes cast by excluded users
+COLOR_LEADER_OUTLINE = (99, 201, 115, 255)  # Outline of votes for the leading option
 
 # Layout
 CELL_HEIGHT = 38
@@ -79,53 +162,75 @@ NAME_COLUMN_WIDTH = 240
 NUMBER_COL_WIDTH = 32  # width reserved for row numbers
 PADDING = 18
 
+# Paint the vote grid with numpy when it is installed.
+VECTOR_CELLS = np is not None
+
 def _wrap_text(text, font, max_width):
-    """Wraps text to fit into a given width."""
-    if font.getlength(text) <= max_width:
+    """
+    Wraps text to fit into a given width.
+    Widths come from cached glyph metrics: every word is measured once and
+    line/substring widths are derived from its prefix sums.
+    """
+    gm = glyph_metrics(font)
+    if gm.width(text) <= max_width:
         return [text]
-    
-    lines = []
+
     words = text.split(' ')
-    while words:
-        line = ''
-        while words:
-            word = words[0]
-            # Проверяем, помещается ли слово в текущую строку
-            test_line = line + word + ' ' if line else word + ' '
-            if font.getlength(test_line) <= max_width:
-                line += words.pop(0) + ' '
-            else:
-                # Если строка пустая и слово не помещается, принудительно обрезаем слово
-                if not line:
-                    # Находим максимальную длину символов, которая помещается в max_width
-                    word_chars = list(word)
-                    truncated_word = ''
-                    for char in word_chars:
-                        test_char = truncated_word + char
-                        if font.getlength(test_char) <= max_width:
-                            truncated_word += char
-                        else:
-                            break
-                    
-                    if truncated_word:
-                        lines.append(truncated_word)
-                        # Обновляем слово, убирая уже добавленную часть
-                        remaining_word = word[len(truncated_word):]
-                        if remaining_word:
-                            words[0] = remaining_word
-                        else:
-                            words.pop(0)
-                    else:
-                        # Если даже один символ не помещается, добавляем пустую строку и пропускаем символ
-                        lines.append('')
-                        words.pop(0)
+    prefixes = {}
+
+    def sub_width(i, a, b):
+        """Width of words[i][a:b]."""
+        word = words[i]
+        if i not in prefixes:
+            prefixes[i] = gm.prefix_widths(word)
+        widths = prefixes[i]
+        if b <= a:
+            return 0.0
+        width = widths[b] - widths[a]
+        if a > 0:
+            width -= gm.kerning(word[a - 1], word[a])
+        return width
+
+    space_width = gm.advance(' ')
+    lines = []
+    i, start = 0, 0  # current word and the offset of its not yet placed part
+    while i < len(words):
+        line_parts = []
+        line_width, line_last = 0.0, None
+        while i < len(words):
+            word = words[i]
+            # Проверяем, помещается ли слово (с пробелом) в текущую строку
+            rest_width = sub_width(i, start, len(word))
+            rest_last = word[-1] if start < len(word) else None
+            piece_width = gm.join_width(rest_width, rest_last, space_width, ' ')
+            piece_first = word[start] if start < len(word) else ' '
+            test_width = gm.join_width(line_width, line_last, piece_width, piece_first)
+            if test_width <= max_width:
+                line_parts.append(word[start:] + ' ')
+                line_width, line_last = test_width, ' '
+                i, start = i + 1, 0
+            elif not line_parts:
+                # Если строка пустая и слово не помещается, принудительно обрезаем слово:
+                # берём максимальное число символов, которое помещается в max_width
+                keep = 0
+                while start + keep < len(word) and sub_width(i, start, start + keep + 1) <= max_width:
+                    keep += 1
+                if keep:
+                    lines.append(word[start:start + keep])
+                    start += keep
+                    if start == len(word):
+                        i, start = i + 1, 0
                 else:
-                    # Строка не пустая, завершаем её
-                    break
-        
-        if line:
-            lines.append(line.strip())
-    
+                    # Если даже один символ не помещается, добавляем пустую строку и пропускаем слово
+                    lines.append('')
+                    i, start = i + 1, 0
+            else:
+                # Строка не пустая, завершаем её
+                break
+
+        if line_parts:
+            lines.append(''.join(line_parts).strip())
+
     return lines
 
 def _draw_rounded_rectangle(draw, xy, radius, fill=None, outline=None, width=1, shadow=False):
@@ -138,240 +243,525 @@ def _draw_rounded_rectangle(draw, xy, radius, fill=None, outline=None, width=1,
             draw.rounded_rectangle([x1+offset, y1+offset, x2+offset, y2+offset], radius=radius+offset, fill=shadow_color)
     draw.rounded_rectangle(xy, radius=radius, fill=fill, outline=outline, width=width)
 
-def generate_results_heatmap_image(poll_id: int, session: Optional[db.Session] = None) -> io.BytesIO:
+
+# --- Heatmap model ---
+# The heatmap splits into a layout (title, option headers, participant rows) that only
+# changes when the poll text, options or participant list change, and a grid of cells
+# whose colour depends on the votes. HeatmapRenderer keeps the drawn layout per poll
+# and repaints only the cells whose state changed since the previous render.
+
+class HeatmapRow(NamedTuple):
+    label: str        # row caption, already truncated to the name column
+    excluded: bool
+
+class HeatmapLayout(NamedTuple):
+    question_text: str
+    options: Tuple[str, ...]
+    rows: Tuple[HeatmapRow, ...]
+
+class CellState(NamedTuple):
+    fill: Tuple[int, int, int, int]
+    leader: bool      # the cell gets the leader outline
+
+class _Geometry(NamedTuple):
+    title_lines: List[str]
+    line_height: int
+    title_block_height: int
+    wrapped_options: List[List[str]]
+    header_height: int
+    width: int
+    height: int
+
+def _row_label(snapshot: PollSnapshot, participant: ParticipantView) -> str:
+    user_name = snapshot.user_name(participant.user_id)
+    if participant.username and f"@{participant.username}" not in user_name:
+        user_name = f"{user_name} (@{participant.username})"
+    return truncate_text(user_name, FONT_REGULAR, NAME_COLUMN_WIDTH - NUMBER_COL_WIDTH - 10)
+
+def build_heatmap_model(poll_id: int, snapshot: PollSnapshot) -> Optional[Tuple[HeatmapLayout, Tuple[Tuple[CellState, ...], ...]]]:
     """
-    Generates a heatmap-style image for poll results.
-    Returns an in-memory image file (BytesIO) or None on failure.
+    Turns a snapshot into the heatmap layout and the per-cell states.
+    Returns None when there is nothing to draw.
     """
-    manage_session = not session
-    if manage_session:
-        session = db.SessionLocal()
+    participants = list(snapshot.participants)
+    responses = snapshot.responses
+
+    # --- Ensure we have participant rows ---------------------------------
+    # В случае, если в таблице participants нет записей (или нет тех, кто
+    # уже проголосовал), добавим «виртуальных» участников только для
+    # отрисовки карты.
+
+    if not participants:
+        logger.info(f"No participants stored for chat {snapshot.chat_id}; building list from responders for heatmap")
+
+    participant_ids_present = {p.user_id for p in participants}
+    for r in responses:
+        if r.user_id not in participant_ids_present:
+            user = snapshot.users.get(r.user_id)
+            participants.append(ParticipantView(user_id=r.user_id, username=user.username if user else None, excluded=0))
+            participant_ids_present.add(r.user_id)
+
+    # Determine poll options, dynamically for web apps, and the column of every vote.
+    if snapshot.poll_type == 'native' and snapshot.options:
+        options = list(snapshot.options)
+        columns = [r.option_index for r in responses]
+    else:
+        options = sorted(list(set(r.response for r in responses)))
+        column_of = {option_text: i for i, option_text in enumerate(options)}
+        columns = [column_of[r.response] for r in responses]
+
+    if not participants or not options:
+        logger.warning(f"Not enough data for heatmap poll {poll_id}")
+        return None
 
-    try:
-        poll = db.get_poll(poll_id)
-        if not poll:
-            raise ValueError("Poll not found")
+    # Проставляем флаги excluded для poll-specific исключений
+    participants = [
+        p._replace(excluded=1) if p.user_id in snapshot.exclusions else p
+        for p in participants
+    ]
 
-        participants = db.get_participants(poll.chat_id, session=session)
-        responses = db.get_responses(poll_id)
-        
-        # --- Ensure we have participant rows ---------------------------------
-        # В случае, если в таблице participants нет записей (или нет тех, кто
-        # уже проголосовал), добавим «виртуальных» участников только для
-        # отрисовки карты.
-
-        if not participants:
-            logger.info(f"No participants stored for chat {poll.chat_id}; building list from responders for heatmap")
-
-        participant_ids_present = {p.user_id for p in participants}
-        dummy_needed_ids = [r.user_id for r in responses if r.user_id not in participant_ids_present]
-
-        if dummy_needed_ids:
-            DummyParticipant = namedtuple('Participant', ['user_id', 'chat_id', 'username', 'first_name', 'last_name', 'excluded'])
-            for uid in dummy_needed_ids:
-                user = session.query(db.User).filter_by(user_id=uid).first()
-                participants.append(
-                    DummyParticipant(
-                        user_id=uid,
-                        chat_id=poll.chat_id,
-                        username=getattr(user, 'username', None) if user else None,
-                        first_name=getattr(user, 'first_name', None) if user else None,
-                        last_name=getattr(user, 'last_name', None) if user else None,
-                        excluded=0,
-                    )
-                )
-
-        # Determine poll options, dynamically for web apps.
-        if poll.poll_type == 'native' and poll.options:
-            options = [opt.strip() for opt in poll.options.split(',')]
+    # --- Build final participant list ---
+    # 1. Добавляем все не-исключённые.
+    # 2. Добавляем исключённых только если они голосовали.
+    respondent_ids = {r.user_id for r in responses}
+    participants = [
+        p for p in participants
+        if (not p.excluded) or (p.user_id in respondent_ids)
+    ]
+    visible_user_ids = {p.user_id for p in participants}
+
+    # Re-build the votes map so that only rows present on the heatmap are considered
+    votes = {
+        (r.user_id, column) for r, column in zip(responses, columns)
+        if column is not None and r.user_id in visible_user_ids
+    }
+
+    # --- Определяем лидирующий вариант ---
+    # Пересчитываем количество голосов по оставшимся (неисключённым) участникам
+    option_counts = [0] * len(options)
+    for _, column in votes:
+        option_counts[column] += 1
+    max_votes = max(option_counts) if option_counts else 0
+    leaders = {column for column, cnt in enumerate(option_counts) if cnt == max_votes and max_votes > 0}
+
+    # Градиент по количеству голосов за вариант
+    intensities = []
+    for votes_for_option in option_counts:
+        if max_votes > 0:
+            norm = votes_for_option / max_votes
+            intensities.append(int(40 + 215 * (norm ** 1.7)))  # Квадратичная шкала для контраста
         else:
-            options = sorted(list(set(r.response.strip() for r in responses)))
+            intensities.append(40)
+
+    cells = []
+    for participant in participants:
+        row = []
+        for column in range(len(options)):
+            voted = (participant.user_id, column) in votes
+            if voted:
+                if participant.excluded:
+                    # Постоянный оранжевый цвет для голосов исключённых участников
+                    fill = (*COLOR_VOTE_EXCLUDED, 220)
+                else:
+                    fill = (99, 201, 115, intensities[column])
+            else:
+                fill = (245, 245, 245, 180)
+            # Акцент для лидирующего варианта
+            row.append(CellState(fill=fill, leader=voted and column in leaders))
+        cells.append(tuple(row))
+
+    layout = HeatmapLayout(
+        question_text=(snapshot.message or "").strip(),
+        options=tuple(options),
+        rows=tuple(HeatmapRow(label=_row_label(snapshot, p), excluded=bool(p.excluded)) for p in participants),
+    )
+    return layout, tuple(cells)
+
+# --- Drawing primitives ---
+
+def _geometry(layout: HeatmapLayout) -> _Geometry:
+    question_text = layout.question_text
+    options = layout.options
+    title_lines = _wrap_text(question_text, FONT_BOLD, NAME_COLUMN_WIDTH + len(options)*MIN_CELL_WIDTH)
+    # Calculate exact line height of the bold font to avoid overlaps
+    line_height = FONT_BOLD.getbbox("Ag")[3] - FONT_BOLD.getbbox("Ag")[1]
+    TITLE_MARGIN = 18  # extra spacing below title to separate from option headers
+    title_height = (len(title_lines) * (line_height + 2)) if title_lines and question_text else 0
+    title_block_height = title_height + (TITLE_MARGIN if question_text else 0)
+
+    wrapped_options = [_wrap_text(opt, FONT_REGULAR, MIN_CELL_WIDTH - 10) for opt in options]
+    max_option_lines = max(len(w) for w in wrapped_options) if wrapped_options else 1
+    header_height = title_block_height + (max_option_lines * 18) + 14
+
+    image_width = NAME_COLUMN_WIDTH + (len(options) * MIN_CELL_WIDTH) + 2 * PADDING
+    image_height = header_height + (len(layout.rows) * CELL_HEIGHT) + 2 * PADDING
+    return _Geometry(title_lines, line_height, title_block_height, wrapped_options, header_height, image_width, image_height)
+
+def _cell_origin(geom: _Geometry, p_idx: int, o_idx: int) -> Tuple[int, int]:
+    return PADDING + NAME_COLUMN_WIDTH + (o_idx * MIN_CELL_WIDTH), PADDING + geom.header_height + (p_idx * CELL_HEIGHT)
+
+def _cell_box(geom: _Geometry, p_idx: int, o_idx: int) -> Tuple[int, int, int, int]:
+    """Pixel box (crop coordinates, right/bottom exclusive) that a cell may paint."""
+    x, y = _cell_origin(geom, p_idx, o_idx)
+    return x + 4, y + 4, x + MIN_CELL_WIDTH - 5, y + CELL_HEIGHT - 5
+
+def _cell_radius(layout: HeatmapLayout, p_idx: int, o_idx: int) -> int:
+    # Скругление только у первой/последней строки и первой/последней колонки
+    return 10 if (p_idx in (0, len(layout.rows)-1) or o_idx in (0, len(layout.options)-1)) else 0
+
+def _row_background(layout: HeatmapLayout, p_idx: int) -> Tuple[int, int, int, int]:
+    # Цвет строки
+    if layout.rows[p_idx].excluded:
+        return (255, 235, 238, 220)
+    if p_idx % 2 == 1:
+        return (250, 250, 250, 180)
+    return (255,255,255,0)
+
+def _is_edge_row(layout: HeatmapLayout, p_idx: int) -> bool:
+    return p_idx in (0, len(layout.rows)-1)
+
+def _draw_layout(draw, layout: HeatmapLayout, geom: _Geometry) -> None:
+    """Draws everything below the vote cells: card, header, title, option headers and rows."""
+    image_width, image_height = geom.width, geom.height
+    # Тень под таблицей
+    _draw_rounded_rectangle(draw, (8, 8, image_width-8, image_height-8), radius=24, fill=(200,200,220,60), shadow=True)
+    # Основная карточка
+    _draw_rounded_rectangle(draw, (0, 0, image_width, image_height), radius=24, fill=(255,255,255,220), outline=(220,220,240,255), width=3)
+
+    # --- Header ---
+    header_rect_top = PADDING
+    header_rect_bottom = PADDING + geom.header_height
+    _draw_rounded_rectangle(draw, (PADDING, header_rect_top, image_width - PADDING, header_rect_bottom), radius=16, fill=(240,245,255,220))
+
+    # --- Draw poll question text ---
+    if layout.question_text:
+        cur_y = PADDING + 6
+        for line in geom.title_lines:
+            text_width = glyph_metrics(FONT_BOLD).width(line)
+            x_pos = PADDING + (image_width - 2*PADDING - text_width)/2  # center align
+            draw.text((x_pos, cur_y), line, font=FONT_BOLD, fill=COLOR_TEXT)
+            cur_y += geom.line_height + 2
+
+    # --- Draw Option Headers ---
+    for i, option_text_lines in enumerate(geom.wrapped_options):
+        x = PADDING + NAME_COLUMN_WIDTH + (i * MIN_CELL_WIDTH)
+        line_y = PADDING + 6 + geom.title_block_height
+        for line in option_text_lines:
+            draw.text((x + 8, line_y), line, font=FONT_BOLD, fill=COLOR_TEXT)
+            line_y += 18
+
+    # --- Draw Participant Rows ---
+    # Ячейки голосов рисуются отдельно (_draw_cell): они не пересекаются с фоном
+    # следующей строки и с колонкой имён, поэтому порядок не влияет на результат.
+    for p_idx, row in enumerate(layout.rows):
+        y = PADDING + geom.header_height + (p_idx * CELL_HEIGHT)
+        # Скругление только у первой и последней строки
+        radius = 14 if _is_edge_row(layout, p_idx) else 0
+        _draw_rounded_rectangle(draw, (PADDING, y, image_width - PADDING, y + CELL_HEIGHT), radius=radius, fill=_row_background(layout, p_idx))
+        # Draw row number
+        draw.text((PADDING + 5, y + (CELL_HEIGHT // 2) - 8), str(p_idx + 1), font=FONT_REGULAR, fill=COLOR_TEXT)
+        # User name shifted right to leave space for number
+        draw.text((PADDING + 5 + NUMBER_COL_WIDTH, y + (CELL_HEIGHT // 2) - 8), row.label, font=FONT_REGULAR, fill=COLOR_TEXT)
+        # Иконка исключённого
+        if row.excluded:
+            draw.text((PADDING + 5, y + (CELL_HEIGHT // 2) - 8), "🚫", font=FONT_BOLD, fill=(220,0,0,255))
+
+def _draw_cell(draw, x: int, y: int, radius: int, state: CellState) -> None:
+    _draw_rounded_rectangle(draw, (x+4, y+4, x + MIN_CELL_WIDTH-6, y + CELL_HEIGHT-6), radius=radius, fill=state.fill)
+    if state.leader:
+        draw.rounded_rectangle([(x+8, y+8), (x+MIN_CELL_WIDTH-10, y+CELL_HEIGHT-10)], radius=radius, outline=COLOR_LEADER_OUTLINE, width=3)
+
+# --- Vectorized cell rasterizer ---
+# Cells overwrite the canvas (ImageDraw on an RGBA image does not blend), so every
+# cell slot is "the layout, with the cell's fill and outline pixels replaced".
+# With numpy the whole grid is painted at once: the pixels one cell covers are
+# rasterized by Pillow once per corner radius (a stamp) and copied into every slot
+# through boolean masks. The result is identical to drawing cell by cell.
+
+class _CellStamp(NamedTuple):
+    holes: Tuple[object, object]     # slot pixels inside CELL_FILL_BOX the fill leaves alone (rounded corners)
+    outline: Tuple[object, object]   # slot pixels of the leader outline
+
+# Bounding box of a cell's fill within its CELL_HEIGHT x MIN_CELL_WIDTH slot: (top, bottom, left, right).
+# A rounded rectangle always touches the edges of its box, whatever the radius.
+CELL_FILL_BOX = (4, CELL_HEIGHT - 5, 4, MIN_CELL_WIDTH - 5)
+
+@functools.lru_cache(maxsize=8)
+def _cell_stamp(radius: int) -> _CellStamp:
+    """Pixels one cell covers in its slot, rasterized once by Pillow."""
+    stamp = Image.new('RGBA', (MIN_CELL_WIDTH, CELL_HEIGHT), (0, 0, 0, 0))
+    _draw_cell(ImageDraw.Draw(stamp, 'RGBA'), 0, 0, radius, CellState(fill=(0, 0, 0, 255), leader=True))
+    pixels = np.asarray(stamp)
+    top, bottom, left, right = CELL_FILL_BOX
+    uncovered = np.ones(pixels.shape[:2], dtype=bool)
+    uncovered[top:bottom, left:right] = pixels[top:bottom, left:right, 3] == 0
+    in_box = np.zeros_like(uncovered)
+    in_box[top:bottom, left:right] = True
+    return _CellStamp(
+        holes=np.nonzero(uncovered & in_box),
+        outline=np.nonzero((pixels == COLOR_LEADER_OUTLINE).all(axis=-1)),
+    )
+
+def _paint_cells_vectorized(image: Image.Image, layout: HeatmapLayout, geom: _Geometry, cells):
+    """
+    Paints the vote cells with numpy and returns the layout tiles under them (see _layout_tiles).
+
+    Reading the layout back from Pillow costs more than drawing the cells, so the
+    grid region is rebuilt instead: below a middle row every pixel of the region
+    is that row's background (_draw_layout paints a plain full-width rectangle and
+    nothing else there). Only the first and last rows, whose rounded corners reach
+    into the last column, are read back. The rebuilt region with the cells on top
+    replaces the region in one paste.
+    """
+    rows, cols = len(layout.rows), len(layout.options)
+    x0, y0 = _cell_origin(geom, 0, 0)
+    height, width = rows * CELL_HEIGHT, cols * MIN_CELL_WIDTH
+    # RGBA pixels packed into uint32, as (row, slot y, column, slot x)
+    region = np.empty((rows, CELL_HEIGHT, cols, MIN_CELL_WIDTH), dtype=np.uint32)
+
+    def packed(color):
+        return np.array(color, dtype=np.uint8).view(np.uint32)[0]
+
+    edge_rows = sorted({0, rows - 1})
+    for p_idx in range(rows):
+        if p_idx in edge_rows:
+            band = image.crop((x0, y0 + p_idx * CELL_HEIGHT, x0 + width, y0 + (p_idx + 1) * CELL_HEIGHT))
+            region[p_idx] = np.asarray(band).view(np.uint32)[..., 0].reshape(CELL_HEIGHT, cols, MIN_CELL_WIDTH)
+        else:
+            region[p_idx] = packed(_row_background(layout, p_idx))
+
+    # Layout tiles under the cell boxes: one per background colour, plus the edge rows' own.
+    top, bottom, left, right = CELL_FILL_BOX
+    tiles, tile_ids, under = [], {}, {}
+    for p_idx in range(rows):
+        for o_idx in range(cols):
+            if p_idx in edge_rows:
+                tile = Image.fromarray(np.ascontiguousarray(region[p_idx, top:bottom, o_idx, left:right]).view(np.uint8).reshape(bottom - top, right - left, 4))
+                key = tile.tobytes()
+            else:
+                key = _row_background(layout, p_idx)
+                tile = None
+            if key not in tile_ids:
+                tile_ids[key] = len(tiles)
+                tiles.append(tile if tile is not None else Image.new('RGBA', (right - left, bottom - top), key))
+            under[(p_idx, o_idx)] = tile_ids[key]
+
+    fills = np.array([[packed(state.fill) for state in row] for row in cells], dtype=np.uint32)
+    leaders = np.array([[state.leader for state in row] for row in cells], dtype=bool)
+    radii = np.array([[_cell_radius(layout, p_idx, o_idx) for o_idx in range(cols)] for p_idx in range(rows)])
+
+    # Rounded corners: remember the layout pixels the fill must not cover.
+    kept = []
+    for radius in np.unique(radii):
+        hole_ys, hole_xs = _cell_stamp(int(radius)).holes
+        if len(hole_ys):
+            p_idx, o_idx = np.nonzero(radii == radius)
+            index = (p_idx[:, None], hole_ys, o_idx[:, None], hole_xs)
+            kept.append((index, region[index]))
+    # One broadcast assignment fills the box of every cell.
+    region[:, top:bottom, :, left:right] = fills[:, None, :, None]
+    for index, pixels in kept:
+        region[index] = pixels
+    outline = packed(COLOR_LEADER_OUTLINE)
+    for radius in np.unique(radii[leaders]):
+        outline_ys, outline_xs = _cell_stamp(int(radius)).outline
+        p_idx, o_idx = np.nonzero(leaders & (radii == radius))
+        region[p_idx[:, None], outline_ys, o_idx[:, None], outline_xs] = outline
+
+    image.paste(Image.fromarray(region.reshape(height, width).view(np.uint8).reshape(height, width, 4)), (x0, y0))
+    return tiles, under
+
+def _layout_tiles(image: Image.Image, layout: HeatmapLayout, geom: _Geometry):
+    """
+    Crops the layout under every cell box, before the cells are drawn.
+    Returns (distinct tiles, {(p_idx, o_idx): tile index}); most boxes share one of a few row backgrounds.
+    """
+    tiles, tile_ids, under = [], {}, {}
+    for p_idx in range(len(layout.rows)):
+        for o_idx in range(len(layout.options)):
+            tile = image.crop(_cell_box(geom, p_idx, o_idx))
+            key = tile.tobytes()
+            if key not in tile_ids:
+                tile_ids[key] = len(tiles)
+                tiles.append(tile)
+            under[(p_idx, o_idx)] = tile_ids[key]
+    return tiles, under
+
+def _cells_under_grid(mask: Image.Image, layout: HeatmapLayout, geom: _Geometry) -> List[Tuple[int, int]]:
+    """Cells whose box contains grid or border pixels of ``mask``."""
+    rows, cols = len(layout.rows), len(layout.options)
+    if np is None:
+        return [
+            (p_idx, o_idx)
+            for p_idx in range(rows)
+            for o_idx in range(cols)
+            if mask.crop(_cell_box(geom, p_idx, o_idx)).getbbox() is not None
+        ]
+    x0, y0 = _cell_origin(geom, 0, 0)
+    region = np.asarray(mask.crop((x0, y0, x0 + cols * MIN_CELL_WIDTH, y0 + rows * CELL_HEIGHT)))
+    top, bottom, left, right = CELL_FILL_BOX
+    hits = region.reshape(rows, CELL_HEIGHT, cols, MIN_CELL_WIDTH)[:, top:bottom, :, left:right].any(axis=(1, 3))
+    return list(zip(*(idx.tolist() for idx in np.nonzero(hits))))
+
+def _draw_grid(draw, layout: HeatmapLayout, geom: _Geometry, ink=None) -> None:
+    """Gridlines, separators and the outer border; ``ink`` replaces every colour (used for masks)."""
+    image_width, image_height = geom.width, geom.height
+    # --- Gridlines (мягкие) ---
+    for i in range(len(layout.options) + 2):
+        x_pos = PADDING + NAME_COLUMN_WIDTH + (i * MIN_CELL_WIDTH) if i > 0 else PADDING
+        draw.line([(x_pos, PADDING), (x_pos, image_height - PADDING)], fill=ink or (220,220,220,120))
+    for i in range(len(layout.rows) + 1):
+        y_pos = PADDING + geom.header_height + (i * CELL_HEIGHT)
+        draw.line([(PADDING, y_pos), (image_width - PADDING, y_pos)], fill=ink or (220,220,220,120))
+    # Vertical separator after number+name column
+    draw.line([(PADDING + NAME_COLUMN_WIDTH, PADDING), (PADDING + NAME_COLUMN_WIDTH, image_height - PADDING)], fill=ink or (190,190,190,180), width=2)
+    # Optional thinner separator between number and name
+    draw.line([(PADDING + NUMBER_COL_WIDTH, PADDING + geom.header_height), (PADDING + NUMBER_COL_WIDTH, image_height - PADDING)], fill=ink or (220,220,220,120))
+    # Outer border
+    _draw_rounded_rectangle(draw, (PADDING, PADDING, image_width - PADDING, image_height - PADDING), radius=18, outline=ink or (190,190,190,200), width=3)
+
+# --- Incremental renderer ---
+
+class _HeatmapLayers:
+    """Cached drawing of one poll's heatmap."""
+    __slots__ = ('layout', 'geom', 'cells', 'image', 'under', 'tiles', 'overlays')
+
+    def __init__(self, layout, geom, cells, image, under, tiles, overlays):
+        self.layout = layout
+        self.geom = geom
+        self.cells = cells          # CellState grid currently painted on ``image``
+        self.image = image          # final RGB image
+        self.under = under          # (p_idx, o_idx) -> index into ``tiles``
+        self.tiles = tiles          # distinct RGBA crops of the layout under a cell box
+        self.overlays = overlays    # (p_idx, o_idx) -> (RGBA crop, L mask) of the grid drawn over a cell box
+
+class HeatmapRenderer:
+    """
+    Renders heatmaps and keeps the last drawing of recently rendered polls.
 
-        if not participants or not options:
-            logger.warning(f"Not enough data for heatmap poll {poll_id}")
-            return None
+    A render whose layout equals the cached one only repaints cells whose state
+    changed: the cell box is restored from the cached layout tile, the cell is
+    drawn again, gridlines crossing the box are put back and the box is
+    composited onto white. The result is pixel-identical to a full render.
+    """
 
-        # votes dict already built above based on visible participants
-        
-        # Проставляем флаги excluded для poll-specific исключений
-        poll_excl_ids = db.get_poll_exclusions(poll_id, session=session)
-        for idx, p in enumerate(participants):
-            if p.user_id in poll_excl_ids:
-                # namedtuple – неизменяем, поэтому создаём новый DummyParticipant либо дополняем
-                try:
-                    participants[idx] = p._replace(excluded=1)
-                except AttributeError:
-                    # ORM-объект Participant – у него атрибут изменяемый
-                    setattr(p, 'excluded', 1)
-
-        # --- Build final participant list ---
-        # 1. Добавляем все не-исключённые.
-        # 2. Добавляем исключённых только если они голосовали.
-        respondent_ids = {r.user_id for r in responses}
-        participants = [
-            p for p in participants
-            if (not getattr(p, 'excluded', False)) or (p.user_id in respondent_ids)
-        ]
-        visible_user_ids = {p.user_id for p in participants}
-
-        # Re-build the votes map so that only rows present on the heatmap are considered
-        votes = {(r.user_id, r.response.strip()): True for r in responses if r.user_id in visible_user_ids}
-
-        # --- Calculate Dimensions & Prepare Canvas ---
-        # --- Prepare question text (poll title) ---
-        question_text = (poll.message or "").strip()
-        title_lines = _wrap_text(question_text, FONT_BOLD, NAME_COLUMN_WIDTH + len(options)*MIN_CELL_WIDTH)
-        # Calculate exact line height of the bold font to avoid overlaps
-        line_height = FONT_BOLD.getbbox("Ag")[3] - FONT_BOLD.getbbox("Ag")[1]
-        TITLE_MARGIN = 18  # extra spacing below title to separate from option headers
-        title_height = (len(title_lines) * (line_height + 2)) if title_lines and question_text else 0
-        title_block_height = title_height + (TITLE_MARGIN if question_text else 0)
-
-        wrapped_options = [_wrap_text(opt, FONT_REGULAR, MIN_CELL_WIDTH - 10) for opt in options]
-        max_option_lines = max(len(w) for w in wrapped_options) if wrapped_options else 1
-        header_height = title_block_height + (max_option_lines * 18) + 14
-
-        image_width = NAME_COLUMN_WIDTH + (len(options) * MIN_CELL_WIDTH) + 2 * PADDING
-        image_height = header_height + (len(participants) * CELL_HEIGHT) + 2 * PADDING
-        
+    def __init__(self, max_polls: int = HEATMAP_LAYER_CACHE_POLLS):
+        self.max_polls = max_polls
+        self._layers: "OrderedDict[int, _HeatmapLayers]" = OrderedDict()
+        # Renders run in the DB executor threads, so access must be serialised.
+        self._lock = threading.Lock()
+
+    def render(self, poll_id: int, layout: HeatmapLayout, cells: Tuple[Tuple[CellState, ...], ...]) -> io.BytesIO:
+        # The cached drawing is taken out while it is being updated, so a concurrent
+        # render of the same poll simply draws from scratch.
+        with self._lock:
+            layers = self._layers.pop(poll_id, None)
+
+        changed = None
+        if layers is not None and layers.layout == layout:
+            changed = [
+                (p_idx, o_idx)
+                for p_idx, (old_row, new_row) in enumerate(zip(layers.cells, cells))
+                for o_idx, (old, new) in enumerate(zip(old_row, new_row))
+                if old != new
+            ]
+        # Repainting cell by cell only pays off while a minority of cells change.
+        if changed is None or len(changed) * 2 > len(layout.rows) * len(layout.options):
+            layers = self._draw_full(layout, cells)
+            metrics.increment('heatmap_full_renders')
+        else:
+            self._repaint(layers, cells, changed)
+            metrics.increment('heatmap_incremental_renders')
+            metrics.increment('heatmap_cells_repainted', len(changed))
+
+        image_buffer = encode_image(layers.image)
+
+        if self.max_polls > 0:
+            with self._lock:
+                self._layers[poll_id] = layers
+                self._layers.move_to_end(poll_id)
+                while len(self._layers) > self.max_polls:
+                    self._layers.popitem(last=False)
+        return image_buffer
+
+    def _draw_full(self, layout: HeatmapLayout, cells) -> _HeatmapLayers:
+        geom = _geometry(layout)
         # --- Glassmorphism: полупрозрачный белый фон ---
-        image = Image.new('RGBA', (image_width, image_height), (255,255,255,0))
+        image = Image.new('RGBA', (geom.width, geom.height), (255,255,255,0))
         draw = ImageDraw.Draw(image, 'RGBA')
-        # Тень под таблицей
-        _draw_rounded_rectangle(draw, (8, 8, image_width-8, image_height-8), radius=24, fill=(200,200,220,60), shadow=True)
-        # Основная карточка
-        _draw_rounded_rectangle(draw, (0, 0, image_width, image_height), radius=24, fill=(255,255,255,220), outline=(220,220,240,255), width=3)
-
-        # --- Header ---
-        header_rect_top = PADDING
-        header_rect_bottom = PADDING + header_height
-        _draw_rounded_rectangle(draw, (PADDING, header_rect_top, image_width - PADDING, header_rect_bottom), radius=16, fill=(240,245,255,220))
-
-        # --- Draw poll question text ---
-        if question_text:
-            cur_y = PADDING + 6
-            for line in title_lines:
-                text_width = FONT_BOLD.getlength(line)
-                x_pos = PADDING + (image_width - 2*PADDING - text_width)/2  # center align
-                draw.text((x_pos, cur_y), line, font=FONT_BOLD, fill=COLOR_TEXT)
-                cur_y += line_height + 2
-
-        # --- Определяем лидирующий вариант ---
-        # Пересчитываем количество голосов по оставшимся (неисключённым) участникам
-        option_counts = {opt: 0 for opt in options}
-        for r in responses:
-            if r.user_id not in visible_user_ids:
-                continue
-            resp = r.response.strip()
-            if resp in option_counts:
-                option_counts[resp] += 1
-        max_votes = max(option_counts.values()) if option_counts else 0
-        leaders = [opt for opt, cnt in option_counts.items() if cnt == max_votes and max_votes > 0]
-
-        # --- Draw Option Headers ---
-        for i, option_text_lines in enumerate(wrapped_options):
-            x = PADDING + NAME_COLUMN_WIDTH + (i * MIN_CELL_WIDTH)
-            line_y = PADDING + 6 + title_block_height
-            # Если есть эмодзи для варианта — показываем крупно
-            emoji = None
-            if hasattr(poll, 'option_settings'):
-                try:
-                    emoji = poll.option_settings[i].emoji
-                except Exception:
-                    emoji = None
-            if emoji:
-                draw.text((x + 40, line_y), emoji, font=get_system_font(28), fill=(0,0,0,255))
-                line_y += 32
-            for line in option_text_lines:
-                draw.text((x + 8, line_y), line, font=FONT_BOLD, fill=COLOR_TEXT)
-                line_y += 18
-            # Лидирующий вариант — можно выделить другим способом (например, жирным текстом).
-            # Убираем обводку, чтобы шапки колонок были без рамок.
-            # if options[i] in leaders:
-            #     draw.rounded_rectangle([(x+2, header_rect_top+2), (x+MIN_CELL_WIDTH-4, header_rect_bottom-2)], radius=12, outline=(99,201,115,255), width=4)
-
-        # --- Draw Participant Rows ---
-        for p_idx, participant in enumerate(participants):
-            y = PADDING + header_height + (p_idx * CELL_HEIGHT)
-            # Цвет строки
-            if participant.excluded:
-                row_bg = (255, 235, 238, 220)
-            elif p_idx % 2 == 1:
-                row_bg = (250, 250, 250, 180)
-            else:
-                row_bg = (255,255,255,0)
-            # Скругление только у первой и последней строки
-            radius = 14 if p_idx in (0, len(participants)-1) else 0
-            _draw_rounded_rectangle(draw, (PADDING, y, image_width - PADDING, y + CELL_HEIGHT), radius=radius, fill=row_bg)
-            # Имя
-            # Draw row number
-            row_number_text = str(p_idx + 1)
-            draw.text((PADDING + 5, y + (CELL_HEIGHT // 2) - 8), row_number_text, font=FONT_REGULAR, fill=COLOR_TEXT)
-
-            # Prepare and draw user name shifted right to leave space for number
-            user_name = db.get_user_name(session, participant.user_id)
-            if participant.username and f"@{participant.username}" not in user_name:
-                user_name = f"{user_name} (@{participant.username})"
-            max_name_width = NAME_COLUMN_WIDTH - NUMBER_COL_WIDTH - 10
-            if FONT_REGULAR.getlength(user_name) > max_name_width:
-                while FONT_REGULAR.getlength(user_name + '…') > max_name_width and len(user_name) > 1:
-                    user_name = user_name[:-1]
-                user_name += '…'
-            draw.text((PADDING + 5 + NUMBER_COL_WIDTH, y + (CELL_HEIGHT // 2) - 8), user_name, font=FONT_REGULAR, fill=COLOR_TEXT)
-            # Ячейки голосов
-            for o_idx, option_text in enumerate(options):
-                x = PADDING + NAME_COLUMN_WIDTH + (o_idx * MIN_CELL_WIDTH)
-                voted = (participant.user_id, option_text) in votes
-                # Градиент по количеству голосов за вариант
-                votes_for_option = option_counts[option_text]
-                if max_votes > 0:
-                    norm = votes_for_option / max_votes
-                    intensity = int(40 + 215 * (norm ** 1.7))  # Квадратичная шкала для контраста
-                else:
-                    intensity = 40
-                if voted:
-                    if participant.excluded:
-                        # Постоянный оранжевый цвет для голосов исключённых участников
-                        cell_color = (*COLOR_VOTE_EXCLUDED, 220)
-                    else:
-                        cell_color = (99, 201, 115, intensity)  # Вернул прежний зелёный цвет
-                else:
-                    cell_color = (245, 245, 245, 180)
-                # Скругление только у первой/последней строки и первой/последней колонки
-                cell_radius = 10 if (p_idx in (0, len(participants)-1) or o_idx in (0, len(options)-1)) else 0
-                _draw_rounded_rectangle(draw, (x+4, y+4, x + MIN_CELL_WIDTH-6, y + CELL_HEIGHT-6), radius=cell_radius, fill=cell_color)
-                # Акцент для лидирующего варианта
-                if option_text in leaders and voted:
-                    draw.rounded_rectangle([(x+8, y+8), (x+MIN_CELL_WIDTH-10, y+CELL_HEIGHT-10)], radius=cell_radius, outline=(99,201,115,255), width=3)
-            # Иконка исключённого
-            if participant.excluded:
-                draw.text((PADDING + 5, y + (CELL_HEIGHT // 2) - 8), "🚫", font=FONT_BOLD, fill=(220,0,0,255))
-        # --- Gridlines (мягкие) ---
-        for i in range(len(options) + 2):
-            x_pos = PADDING + NAME_COLUMN_WIDTH + (i * MIN_CELL_WIDTH) if i > 0 else PADDING
-            draw.line([(x_pos, PADDING), (x_pos, image_height - PADDING)], fill=(220,220,220,120))
-        for i in range(len(participants) + 1):
-            y_pos = PADDING + header_height + (i * CELL_HEIGHT)
-            draw.line([(PADDING, y_pos), (image_width - PADDING, y_pos)], fill=(220,220,220,120))
-        # Bolder separator for names
-        # Vertical separator after number+name column
-        draw.line([(PADDING + NAME_COLUMN_WIDTH, PADDING), (PADDING + NAME_COLUMN_WIDTH, image_height - PADDING)], fill=(190,190,190,180), width=2)
-        # Optional thinner separator between number and name
-        draw.line([(PADDING + NUMBER_COL_WIDTH, PADDING + header_height), (PADDING + NUMBER_COL_WIDTH, image_height - PADDING)], fill=(220,220,220,120))
-        # Outer border
-        _draw_rounded_rectangle(draw, (PADDING, PADDING, image_width - PADDING, image_height - PADDING), radius=18, outline=(190,190,190,200), width=3)
+        _draw_layout(draw, layout, geom)
+
+        if VECTOR_CELLS:
+            tiles, under = _paint_cells_vectorized(image, layout, geom, cells)
+        else:
+            tiles, under = _layout_tiles(image, layout, geom)
+            for p_idx, row in enumerate(cells):
+                for o_idx, state in enumerate(row):
+                    x, y = _cell_origin(geom, p_idx, o_idx)
+                    _draw_cell(draw, x, y, _cell_radius(layout, p_idx, o_idx), state)
+        _draw_grid(draw, layout, geom)
+
+        # Remember the grid pixels that land inside cell boxes (rounded corners, border).
+        mask = Image.new('L', image.size, 0)
+        _draw_grid(ImageDraw.Draw(mask), layout, geom, ink=255)
+        overlays = {}
+        for cell in _cells_under_grid(mask, layout, geom):
+            box = _cell_box(geom, *cell)
+            overlays[cell] = (image.crop(box), mask.crop(box))
+
         # --- Finalize ---
-        out = Image.new('RGB', (image_width, image_height), (255,255,255))
+        out = Image.new('RGB', image.size, (255,255,255))
         out.paste(image, (0,0), image)
-        image_buffer = io.BytesIO()
-        out.save(image_buffer, format='PNG')
-        image_buffer.seek(0)
-        
-        return image_buffer
+        return _HeatmapLayers(layout, geom, cells, out, under, tiles, overlays)
+
+    def _repaint(self, layers: _HeatmapLayers, cells, changed) -> None:
+        geom = layers.geom
+        for p_idx, o_idx in changed:
+            box = _cell_box(geom, p_idx, o_idx)
+            tile = layers.tiles[layers.under[(p_idx, o_idx)]].copy()
+            x, y = _cell_origin(geom, p_idx, o_idx)
+            # Draw in tile coordinates: the box starts at (x+4, y+4).
+            _draw_cell(ImageDraw.Draw(tile, 'RGBA'), -4, -4, _cell_radius(layers.layout, p_idx, o_idx), cells[p_idx][o_idx])
+            overlay = layers.overlays.get((p_idx, o_idx))
+            if overlay is not None:
+                tile.paste(overlay[0], (0, 0), overlay[1])
+            region = Image.new('RGB', tile.size, (255,255,255))
+            region.paste(tile, (0, 0), tile)
+            layers.image.paste(region, box[:2])
+        layers.cells = cells
+
+    def forget(self, poll_id: int) -> None:
+        with self._lock:
+            self._layers.pop(poll_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._layers.clear()
+
+    def __len__(self) -> int:
+        return len(self._layers)
+
+
+heatmap_renderer = HeatmapRenderer()
+
+def generate_results_heatmap_image(poll_id: int, session: Optional[db.Session] = None, snapshot: Optional[PollSnapshot] = None) -> io.BytesIO:
+    """
+    Generates a heatmap-style image for poll results.
+    Data comes from a PollSnapshot; it is loaded (with ``session`` if given) when not passed in.
+    Returns an in-memory image file (BytesIO) or None on failure.
+    """
+    try:
+        if snapshot is None:
+            snapshot = load_poll_snapshot(poll_id, session=session)
+        if not snapshot:
+            raise ValueError("Poll not found")
+
+        model = build_heatmap_model(poll_id, snapshot)
+        if model is None:
+            return None
+        layout, cells = model
+        return heatmap_renderer.render(poll_id, layout, cells)
 
     except Exception as e:
         logger.error(f"Failed to generate heatmap for poll {poll_id}: {e}", exc_info=True)
         return None
-    finally:
-        if manage_session:
-            session.close() 
\ No newline at end of file
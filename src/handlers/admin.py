@@ -9,6 +9,8 @@ from sqlalchemy.orm import class_mapper
 from src.config import logger
 from src.decorators import admin_only
 from src import database as db
+from src.render_cache import render_cache
+from src.activity_buffer import activity_buffer
 
 
 def model_to_dict(obj):
@@ -25,7 +27,7 @@ async def export_json(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     await update.message.reply_text("Starting data export... This may take a moment.")
     await update.message.reply_chat_action(ChatAction.UPLOAD_DOCUMENT)
 
-    session = db.SessionLocal()
+    session = db.open_session()
     try:
         # Fetch all data from all tables
         full_data = {
@@ -35,7 +37,7 @@ async def export_json(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             "polls": [model_to_dict(p) for p in session.query(db.Poll).all()],
             "responses": [model_to_dict(r) for r in session.query(db.Response).all()],
             "poll_settings": [model_to_dict(ps) for ps in session.query(db.PollSetting).all()],
-            "poll_option_settings": [model_to_dict(pos) for pos in session.query(db.PollOptionSetting).all()],
+            "poll_options": [model_to_dict(po) for po in session.query(db.PollOption).all()],
         }
 
         # Convert data to JSON string
@@ -56,7 +58,25 @@ async def export_json(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await update.message.reply_text(f"An error occurred during export: {e}")
         logger.error(f"Export failed: {e}", exc_info=True)
     finally:
-        session.close()
+        db.close_session(session)
+
+
+def _options_from_legacy_export(data: dict) -> list:
+    """
+    poll_options rows for exports made before options had their own table:
+    comma-joined polls.options texts merged with poll_option_settings.
+    """
+    settings = {(s['poll_id'], s['option_index']): s for s in data.get('poll_option_settings') or []}
+    rows = []
+    for poll in data['polls']:
+        texts = poll.pop('options', None)
+        if not texts or texts == 'Web App Poll':
+            continue
+        for index, text in enumerate(texts.split(',')):
+            row = dict(settings.get((poll['poll_id'], index), {}), poll_id=poll['poll_id'], option_index=index)
+            row['text'] = text.strip()
+            rows.append(row)
+    return rows
 
 
 @admin_only
@@ -86,18 +106,22 @@ async def import_json(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
         
     await update.message.reply_text("⚠️ **WARNING!** The entire database will be wiped before import. This cannot be undone.")
+    await update.message.reply_text("Wiping the database and importing...")
 
+    # Wipe and import are one transaction of their own, outside the update's unit of work:
+    # a failed import leaves the old data in place. No Telegram calls until it is committed.
     session = db.SessionLocal()
     MODELS_IN_ORDER = [
-        db.User, db.KnownChat, db.Participant, db.Poll,
-        db.Response, db.PollSetting, db.PollOptionSetting
+        db.User, db.KnownChat, db.Participant, db.Poll, db.PollOption,
+        db.Response, db.PollSetting
     ]
+    if 'poll_options' not in data_to_import:
+        data_to_import['poll_options'] = _options_from_legacy_export(data_to_import)
 
     try:
         # 1. Wipe data in reverse order of dependencies
         for model in reversed(MODELS_IN_ORDER):
             session.query(model).delete(synchronize_session=False)
-        await update.message.reply_text("Database wiped. Starting import...")
 
         # 2. Import data in order of dependencies
         for model in MODELS_IN_ORDER:
@@ -106,7 +130,13 @@ async def import_json(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                 # Using bulk_insert_mappings for efficiency
                 session.bulk_insert_mappings(model, data_to_import[table_name])
 
+        # Bulk inserts bypass the flush-time vote counters.
+        db.rebuild_poll_tallies(session)
         session.commit()
+        # Imported polls may reuse (poll_id, version) pairs of cached renders.
+        render_cache.clear()
+        # Chats and members cached as already written may be gone now.
+        activity_buffer.forget_all()
         await update.message.reply_text("✅ Data imported successfully! It's recommended to restart the bot.")
 
     except Exception as e:
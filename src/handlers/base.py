@@ -6,6 +6,9 @@ from functools import wraps
 from telegram.helpers import escape_markdown
 
 from src import database as db
+from src import async_database as adb
+from src import unit_of_work
+from src.activity_buffer import activity_buffer
 from src.config import BOT_OWNER_ID, logger
 from src.handlers import dashboard
 from src.decorators import admin_only
@@ -51,11 +54,26 @@ async def toggle_debug(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     else:
         await update.message.reply_text("Подробное логирование всех событий ВЫКЛЮЧЕНО.")
 
+async def begin_unit_of_work(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Pre-handler: opens the unit of work (one DB session) shared by all handlers of this update."""
+    context.unit_of_work = unit_of_work.begin()
+
+async def finish_unit_of_work(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Runs after every other handler: commits what the update left uncommitted and closes its unit of work."""
+    uow = getattr(context, 'unit_of_work', None)
+    if uow is None:
+        return
+    try:
+        if uow.has_session:
+            await adb.run_sync(uow.commit)
+    finally:
+        unit_of_work.end(uow)
+
 async def track_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Tracks every chat the bot is in. Called by the TypeHandler."""
     if update.effective_chat:
-        # This will add the chat to the DB if it's not there, or update its title if it changed.
-        db.update_known_chats(
+        # Buffered: the chat is added or its title updated with the next batch, unchanged chats are skipped.
+        await activity_buffer.note_chat(
             chat_id=update.effective_chat.id, 
             title=update.effective_chat.title or "Unknown Title", 
             chat_type=update.effective_chat.type
@@ -69,6 +87,10 @@ async def log_all_updates(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log Errors caused by Updates."""
     logger.error(f"Update {update} caused error: {context.error}", exc_info=context.error)
+    # Changes of the failed handler are not committed with the rest of the update.
+    uow = unit_of_work.current()
+    if uow is not None and uow.has_session:
+        await adb.run_sync(uow.rollback)
     if isinstance(context.error, ChatMigrated):
         old_chat_id = context.error.chat_id
         new_chat_id = context.error.new_chat_id
@@ -96,12 +118,12 @@ async def register_user_activity(update: Update, context: ContextTypes.DEFAULT_T
     chat_id = update.message.chat.id
     user_name = update.message.from_user.full_name
     
-    # Сохраняем пользователя и участника (если их ещё нет) в БД
+    # Сохраняем пользователя и участника (если их ещё нет) в БД — пакетом, см. activity_buffer
     username = update.message.from_user.username
     first_name = update.message.from_user.first_name or ""
     last_name = update.message.from_user.last_name or ""
 
-    db.add_user_to_participants(
+    await activity_buffer.note_participant(
         chat_id=chat_id,
         user_id=user_id,
         username=username,
@@ -124,7 +146,7 @@ async def register_new_chat_members(update: Update, context: ContextTypes.DEFAUL
         if member.is_bot:
             continue
 
-        db.add_user_to_participants(
+        await adb.add_user_to_participants(
             chat_id=chat_id,
             user_id=member.id,
             username=member.username,
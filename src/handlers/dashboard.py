@@ -1,4 +1,4 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, WebAppInfo, InputMediaPhoto
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, WebAppInfo
 from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
 from telegram.helpers import escape_markdown
@@ -8,8 +8,11 @@ import time
 from telegram.error import BadRequest
 
 from src import database as db
+from src import async_database as adb
 from src.config import logger, WEB_URL, BOT_OWNER_ID
-from src.display import generate_poll_content
+from src.display import generate_poll_content_async
+from src.photo_registry import send_photo, edit_photo
+from src.activity_buffer import activity_buffer
 from src.handlers import admin
 from src.poll_modules import get_poll_modules
 
@@ -114,9 +117,9 @@ async def wizard_select_webapp(query: CallbackQuery, context: ContextTypes.DEFAU
 async def start_poll(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, poll_id: int):
     """Activates a draft poll and sends it to the group as a photo with a caption."""
     logger.info(f"Attempting to start poll_id: {poll_id}")
-    session = db.SessionLocal()
+    session = db.open_session()
     try:
-        poll = session.query(db.Poll).filter_by(poll_id=poll_id).first()
+        poll = await adb.get_poll(poll_id, session=session)
         
         if not poll:
             logger.error(f"start_poll: Poll {poll_id} not found in database.")
@@ -140,22 +143,20 @@ async def start_poll(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, p
             await query.answer('Текст (заголовок) опроса не задан. Отредактируйте его в настройках.', show_alert=True)
             return
 
-        caption, image_bytes = generate_poll_content(poll=poll, session=session)
+        caption, image_bytes = await generate_poll_content_async(poll=poll, session=session)
         
         # Determine keyboard
         kb = []
         if poll.poll_type == 'native':
             # Validation for native poll options.
-            if not poll.options or any(not opt.strip() for opt in poll.options.split(',')):
+            if not poll.options or any(not opt for opt in poll.options):
                 await query.answer('Ошибка: опрос содержит пустые или некорректные варианты ответов. Пожалуйста, отредактируйте их в настройках.', show_alert=True)
                 return
-            options = poll.options.split(',')
-            options = poll.options.split(',')
             kb = []
             row = []
-            for i, opt in enumerate(options):
+            for i, opt in enumerate(poll.options):
                 row.append(
-                    InlineKeyboardButton(opt.strip(),
+                    InlineKeyboardButton(opt,
                                          callback_data=f'vote:{poll.poll_id}:{i}')
                 )
                 # группируем по 3 кнопки в строке
@@ -180,9 +181,10 @@ async def start_poll(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, p
             msg = None
             # If we have an image, send a photo.
             if image_bytes:
-                msg = await context.bot.send_photo(
-                    chat_id=poll.chat_id,
-                    photo=image_bytes,
+                msg = await send_photo(
+                    context.bot,
+                    poll.chat_id,
+                    image_bytes,
                     caption=caption,
                     reply_markup=InlineKeyboardMarkup(kb),
                     parse_mode=ParseMode.MARKDOWN_V2
@@ -200,20 +202,20 @@ async def start_poll(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, p
 
             poll.status = 'active'
             poll.message_id = msg.message_id
-            session.commit()
+            await adb.run_sync(session.commit)
             await query.answer(f'Опрос {poll.poll_id} запущен.', show_alert=True)
             await show_poll_list(query, poll.chat_id, 'draft')
         except Exception as e:
             logger.error(f"Ошибка запуска опроса {poll_id}: {e}", exc_info=True)
             await query.answer(f'Ошибка: {e}', show_alert=True)
     finally:
-        session.close()
+        db.close_session(session)
 
 async def close_poll(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, poll_id: int):
     """Closes an active poll, updating the photo and caption."""
-    session = db.SessionLocal()
+    session = db.open_session()
     try:
-        poll = session.query(db.Poll).filter_by(poll_id=poll_id).first()
+        poll = await adb.get_poll(poll_id, session=session)
         
         if not poll or poll.status != 'active':
             await query.answer("Опрос не активен.", show_alert=True)
@@ -221,9 +223,9 @@ async def close_poll(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, p
 
         poll.status = 'closed'
         chat_id_for_refresh = poll.chat_id
-        session.commit() # Commit status change first
+        await adb.run_sync(session.commit) # Commit status change first
         
-        final_caption, final_image = generate_poll_content(poll=poll, session=session)
+        final_caption, final_image = await generate_poll_content_async(poll=poll, session=session)
         
         try:
             # If we have a final image (and a message to edit), update the media.
@@ -231,11 +233,10 @@ async def close_poll(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, p
                 # We need a file_id to edit media. If we don't have one (e.g., poll started as text),
                 # we must delete the old message and send a new photo.
                 if poll.photo_file_id:
-                    media = InputMediaPhoto(media=final_image, caption=final_caption, parse_mode=ParseMode.MARKDOWN_V2)
-                    await context.bot.edit_message_media(chat_id=poll.chat_id, message_id=poll.message_id, media=media, reply_markup=None)
+                    await edit_photo(context.bot, poll.chat_id, poll.message_id, final_image, final_caption, reply_markup=None)
                 else:
                     await context.bot.delete_message(chat_id=poll.chat_id, message_id=poll.message_id)
-                    new_msg = await context.bot.send_photo(chat_id=poll.chat_id, photo=final_image, caption=final_caption, parse_mode=ParseMode.MARKDOWN_V2)
+                    new_msg = await send_photo(context.bot, poll.chat_id, final_image, caption=final_caption, parse_mode=ParseMode.MARKDOWN_V2)
                     poll.message_id = new_msg.message_id
                     if new_msg.photo:
                         poll.photo_file_id = new_msg.photo[-1].file_id
@@ -255,7 +256,7 @@ async def close_poll(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, p
             if "Message is not modified" not in str(e):
                 logger.error(f"Could not edit final message for poll {poll_id}: {e}")
         
-        session.commit()
+        await adb.run_sync(session.commit)
         await query.answer("Опрос завершён.", show_alert=True)
         await show_poll_list(query, chat_id_for_refresh, 'active')
 
@@ -264,30 +265,29 @@ async def close_poll(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, p
         session.rollback()
         await query.answer("Произошла неожиданная ошибка при завершении опроса.", show_alert=True)
     finally:
-        session.close()
+        db.close_session(session)
 
 async def reopen_poll(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, poll_id: int):
     """Reopens a closed poll, updating the photo, caption, and keyboard."""
-    session = db.SessionLocal()
+    session = db.open_session()
     try:
-        poll = session.query(db.Poll).filter_by(poll_id=poll_id).first()
+        poll = await adb.get_poll(poll_id, session=session)
         if not poll or poll.status != 'closed':
             await query.answer("Этот опрос нельзя открыть заново.", show_alert=True)
             return
 
         poll.status = 'active'
-        # No need to commit here, it will be committed after the message is successfully sent/edited
+        await adb.run_sync(session.commit) # Commit status change first: the new version keys the render
 
-        new_caption, new_image = generate_poll_content(poll=poll, session=session)
+        new_caption, new_image = await generate_poll_content_async(poll=poll, session=session)
         
         kb = []
         if poll.poll_type == 'native':
-            options = poll.options.split(',')
             kb = []
             row = []
-            for i, opt in enumerate(options):
+            for i, opt in enumerate(poll.options):
                 row.append(
-                    InlineKeyboardButton(opt.strip(), callback_data=f'vote:{poll.poll_id}:{i}')
+                    InlineKeyboardButton(opt, callback_data=f'vote:{poll.poll_id}:{i}')
                 )
                 # group buttons by 3 per row
                 if len(row) == 3:
@@ -298,7 +298,7 @@ async def reopen_poll(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE,
         elif poll.poll_type == 'webapp':
             if not poll.web_app_id:
                 await query.answer('Ошибка: для этого опроса не задан ID веб-приложения.', show_alert=True)
-                session.close()
+                db.close_session(session)
                 return
             url = f"{WEB_URL}/web_apps/{poll.web_app_id}/?poll_id={poll.poll_id}"
             kb = [[InlineKeyboardButton("⚜️ Голосовать в приложении", web_app=WebAppInfo(url=url))]]
@@ -314,12 +314,11 @@ async def reopen_poll(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE,
             elif new_image:
                 # If it was already a photo, edit it
                 if poll.photo_file_id:
-                    media = InputMediaPhoto(media=new_image, caption=new_caption, parse_mode=ParseMode.MARKDOWN_V2)
-                    await context.bot.edit_message_media(chat_id=poll.chat_id, message_id=poll.message_id, media=media, reply_markup=reply_markup)
+                    await edit_photo(context.bot, poll.chat_id, poll.message_id, new_image, new_caption, reply_markup=reply_markup)
                 # If it was text, delete and send a new photo
                 else:
                     await context.bot.delete_message(chat_id=poll.chat_id, message_id=poll.message_id)
-                    new_msg = await context.bot.send_photo(chat_id=poll.chat_id, photo=new_image, caption=new_caption, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
+                    new_msg = await send_photo(context.bot, poll.chat_id, new_image, caption=new_caption, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
                     poll.message_id = new_msg.message_id
                     if new_msg.photo:
                         poll.photo_file_id = new_msg.photo[-1].file_id
@@ -335,7 +334,7 @@ async def reopen_poll(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE,
                 else:
                     await context.bot.edit_message_text(chat_id=poll.chat_id, message_id=poll.message_id, text=new_caption, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
 
-            session.commit()
+            await adb.run_sync(session.commit)
             await query.answer("Опрос снова открыт.", show_alert=True)
             await show_poll_list(query, poll.chat_id, 'closed')
         except Exception as e:
@@ -349,24 +348,24 @@ async def reopen_poll(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE,
         session.rollback()
         await query.answer("Произошла неожиданная ошибка при открытии опроса.", show_alert=True)
     finally:
-        session.close()
+        db.close_session(session)
 
 async def delete_poll(query: CallbackQuery, poll_id: int):
     """Deletes a poll and all associated data."""
-    session = db.SessionLocal()
+    session = db.open_session()
     try:
-        poll = session.query(db.Poll).filter_by(poll_id=poll_id).first()
+        poll = await adb.get_poll(poll_id, session=session)
         if poll:
             chat_id, status = poll.chat_id, poll.status
             # Cascade delete is configured in the model, so this should be enough
-            session.delete(poll)
-            session.commit()
+            await adb.run_sync(session.delete, poll)
+            await adb.run_sync(session.commit)
             await query.answer(f"Опрос {poll_id} удален.", show_alert=True)
             await show_poll_list(query, chat_id, status)
         else:
             await query.answer("Опрос не найден.", show_alert=True)
     finally:
-        session.close()
+        db.close_session(session)
 
 
 async def check_admin_in_chat(user_id: int, chat: db.KnownChat, context: ContextTypes.DEFAULT_TYPE, semaphore: asyncio.Semaphore):
@@ -392,13 +391,13 @@ async def check_admin_in_chat(user_id: int, chat: db.KnownChat, context: Context
                     return {'id': chat.chat_id, 'title': chat.title}
 
                 # --- Fallback Check: Has the user created any polls in this chat? ---
-                session = db.SessionLocal()
+                session = db.open_session()
                 try:
-                    if db.has_user_created_poll_in_chat(session, user_id, chat.chat_id):
+                    if await adb.run_sync(db.has_user_created_poll_in_chat, session, user_id, chat.chat_id):
                         logger.info(f"SUCCESS (Creator): User {user_id} is not an admin but created a poll in chat {chat.chat_id}.")
                         return {'id': chat.chat_id, 'title': chat.title}
                 finally:
-                    session.close()
+                    db.close_session(session)
 
                 # If neither check passes, log for diagnostics.
                 logger.warning(
@@ -425,7 +424,7 @@ async def private_chat_entry_point(update: Update, context: ContextTypes.DEFAULT
     # Immediately send a "loading" message to give user feedback.
     loading_message = await update.effective_message.reply_text("🔎 Ищу чаты, где вы админ...")
 
-    known_chats = db.get_known_chats()
+    known_chats = await adb.get_known_chats()
     
     admin_chats = []
     if known_chats:
@@ -460,7 +459,7 @@ async def private_chat_entry_point(update: Update, context: ContextTypes.DEFAULT
 
 
 async def show_group_dashboard(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, chat_id: int):
-    chat_title = db.get_group_title(chat_id)
+    chat_title = await adb.get_group_title(chat_id)
     text = f"Панель управления для чата *{escape_markdown(chat_title, 2)}*:"
 
     keyboard = [
@@ -474,9 +473,9 @@ async def show_group_dashboard(query: CallbackQuery, context: ContextTypes.DEFAU
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN_V2)
 
 async def show_poll_list(query: CallbackQuery, chat_id: int, status: str):
-    session = db.SessionLocal()
+    session = db.open_session()
     try:
-        polls = db.get_polls_by_status(chat_id, status)
+        polls = await adb.get_polls_by_status(chat_id, status)
         status_text_map = {'active': 'активных опросов', 'draft': 'черновиков', 'closed': 'завершённых опросов'}
         text_part = status_text_map.get(status, f'{status} опросов')
 
@@ -494,8 +493,10 @@ async def show_poll_list(query: CallbackQuery, chat_id: int, status: str):
             # Common delete button for closed and draft polls
             delete_button = InlineKeyboardButton("🗑", callback_data=f"dash:delete_poll_confirm:{poll.poll_id}")
             
+            # Число проголосовавших берётся из счётчика в polls, без подсчёта ответов.
+            voters = f" · 👥 {poll.voter_count or 0}"
             if status == 'active': 
-                kb.append([InlineKeyboardButton(msg, callback_data=f"results:show:{poll.poll_id}")])
+                kb.append([InlineKeyboardButton(f"{msg}{voters}", callback_data=f"results:show:{poll.poll_id}")])
             elif status == 'draft': 
                 kb.append([
                     InlineKeyboardButton(f"✏️ {msg}", callback_data=f"settings:poll_menu:{poll.poll_id}"), 
@@ -504,7 +505,7 @@ async def show_poll_list(query: CallbackQuery, chat_id: int, status: str):
                 ])
             elif status == 'closed': 
                 kb.append([
-                    InlineKeyboardButton(f"📊 {msg}", callback_data=f"results:show:{poll.poll_id}"), 
+                    InlineKeyboardButton(f"📊 {msg}{voters}", callback_data=f"results:show:{poll.poll_id}"), 
                     delete_button
                 ])
         kb.append([InlineKeyboardButton("↩️ Назад", callback_data=f"dash:group:{chat_id}")])
@@ -534,10 +535,10 @@ async def show_poll_list(query: CallbackQuery, chat_id: int, status: str):
             else:
                 raise
     finally:
-        session.close()
+        db.close_session(session)
 
 async def show_participants_menu(query: CallbackQuery, chat_id: int):
-    title = escape_markdown(db.get_group_title(chat_id), 2)
+    title = escape_markdown(await adb.get_group_title(chat_id), 2)
     text = f"👥 *Управление участниками в* `{title}`"
     kb = [
         [InlineKeyboardButton("📄 Показать список", callback_data=f"dash:participants_list:{chat_id}:0")],
@@ -550,10 +551,10 @@ async def show_participants_menu(query: CallbackQuery, chat_id: int):
 
 async def show_participants_list(query: CallbackQuery, chat_id: int, page: int = 0):
     """Displays a paginated list of group participants."""
-    session = db.SessionLocal()
+    session = db.open_session()
     try:
-        participants = db.get_participants(chat_id, session=session)
-        title = escape_markdown(db.get_group_title(chat_id), 2)
+        participants = await adb.get_participants(chat_id, session=session)
+        title = escape_markdown(await adb.get_group_title(chat_id), 2)
 
         if not participants:
             text = f"В чате «{title}» нет зарегистрированных участников."
@@ -568,9 +569,10 @@ async def show_participants_list(query: CallbackQuery, chat_id: int, page: int =
         total_pages = -(-len(participants) // items_per_page)
 
         text_parts = [f'👥 *Список участников \\(«{title}»\\)* \\(Стр\\. {page + 1}/{total_pages}\\):\n']
+        names = await adb.run_sync(db.resolve_user_names, session, [p.user_id for p in paginated_participants])
         
         for i, p in enumerate(paginated_participants, start=start_index + 1):
-            name = escape_markdown(db.get_user_name(session, p.user_id), 2)
+            name = escape_markdown(names[p.user_id], 2)
             status = " \\(🚫\\)" if p.excluded else ""
             text_parts.append(f"{i}\\. {name}{status}")
         
@@ -588,14 +590,14 @@ async def show_participants_list(query: CallbackQuery, chat_id: int, page: int =
         
         await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb_rows), parse_mode=ParseMode.MARKDOWN_V2)
     finally:
-        session.close()
+        db.close_session(session)
 
 async def show_exclude_menu(query: CallbackQuery, chat_id: int, page: int = 0):
     """Displays a paginated menu to exclude/include participants."""
-    session = db.SessionLocal()
+    session = db.open_session()
     try:
-        participants = db.get_participants(chat_id, session=session)
-        title = escape_markdown(db.get_group_title(chat_id), 2)
+        participants = await adb.get_participants(chat_id, session=session)
+        title = escape_markdown(await adb.get_group_title(chat_id), 2)
 
         if not participants:
             await query.answer("Нет участников для управления.", show_alert=True)
@@ -613,8 +615,9 @@ async def show_exclude_menu(query: CallbackQuery, chat_id: int, page: int = 0):
         current_row = []
         MAX_PER_ROW = 3  # up to 3 short buttons per row
         SHORT_LEN = 15   # threshold to treat button as short
+        names = await adb.run_sync(db.resolve_user_names, session, [p.user_id for p in paginated_participants])
         for p in paginated_participants:
-            name = db.get_user_name(session, p.user_id)
+            name = names[p.user_id]
             status_icon = "🚫" if p.excluded else "✅"
             username_part = f" (@{p.username})" if p.username else ""
             button_text = f"{status_icon} {name}{username_part}"
@@ -642,21 +645,21 @@ async def show_exclude_menu(query: CallbackQuery, chat_id: int, page: int = 0):
         
         await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN_V2)
     finally:
-        session.close()
+        db.close_session(session)
 
 async def toggle_exclude_participant(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, page: int):
     """Toggles the 'excluded' status for a participant."""
-    session = db.SessionLocal()
+    session = db.open_session()
     try:
-        participant = session.query(db.Participant).filter_by(chat_id=chat_id, user_id=user_id).first()
+        participant = await adb.run_sync(session.get, db.Participant, (chat_id, user_id))
         if participant:
             participant.excluded = not participant.excluded
-            session.commit()
+            await adb.run_sync(session.commit)
             await show_exclude_menu(query, chat_id, page)
 
             # --- Refresh nudge messages for active polls in this chat ---
             from src.display import generate_nudge_text
-            polls = session.query(db.Poll).filter_by(chat_id=chat_id, status='active').all()
+            polls = await adb.run_sync(session.query(db.Poll).filter_by(chat_id=chat_id, status='active').all)
             for poll in polls:
                 nudge_text = await generate_nudge_text(poll.poll_id)
                 try:
@@ -677,25 +680,24 @@ async def toggle_exclude_participant(query: CallbackQuery, context: ContextTypes
                                 parse_mode=ParseMode.MARKDOWN_V2,
                             )
                             poll.nudge_message_id = new_msg.message_id
-                    session.commit()
+                    await adb.run_sync(session.commit)
                 except BadRequest as e:
                     if "Message is not modified" not in str(e):
                         logger.warning(f"Failed to update nudge for poll {poll.poll_id}: {e}")
         else:
             await query.answer("Участник не найден.", show_alert=True)
     finally:
-        session.close()
+        db.close_session(session)
 
 async def clean_participants(query: CallbackQuery, chat_id: int):
     """Deletes all participants from a chat."""
-    session = db.SessionLocal()
-    try:
-        db.delete_participants(session, chat_id)
-        session.commit()
-        await query.answer(f'Список участников для "{db.get_group_title(chat_id)}" очищен.', show_alert=True)
-        await show_participants_menu(query, chat_id)
-    finally:
-        session.close()
+    # Committed by the helper before the answer goes out.
+    await adb.run_sync(db.delete_participants, chat_id)
+    # Members who write again must be registered again, not skipped as recently seen.
+    activity_buffer.forget_chat(chat_id)
+    chat_title = await adb.get_group_title(chat_id)
+    await query.answer(f'Список участников для "{chat_title}" очищен.', show_alert=True)
+    await show_participants_menu(query, chat_id)
 
 async def add_user_via_forward_start(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     """Puts the bot in a state to wait for a forwarded message."""
@@ -708,9 +710,9 @@ async def add_user_via_forward_start(query: CallbackQuery, context: ContextTypes
 
 async def delete_poll_confirm(query: CallbackQuery, poll_id: int):
     """Asks for confirmation before deleting a poll."""
-    session = db.SessionLocal()
+    session = db.open_session()
     try:
-        poll = session.query(db.Poll).filter_by(poll_id=poll_id).first()
+        poll = await adb.get_poll(poll_id, session=session)
         if not poll:
             await query.answer("Опрос уже удален.", show_alert=True)
             return
@@ -721,7 +723,7 @@ async def delete_poll_confirm(query: CallbackQuery, poll_id: int):
         ]]
         await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN_V2)
     finally:
-        session.close()
+        db.close_session(session)
 
 async def delete_poll_execute(query: CallbackQuery, poll_id: int):
     """Deletes a poll after confirmation."""
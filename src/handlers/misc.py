@@ -3,8 +3,9 @@ from telegram.ext import ContextTypes
 import json
 
 from src import database as db
+from src import async_database as adb
 from src.config import logger
-from src.handlers.voting import update_poll_message
+from src.handlers.voting import schedule_poll_update
 
 async def forwarded_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles a forwarded message to add a user to the participants list."""
@@ -21,11 +22,11 @@ async def forwarded_message_handler(update: Update, context: ContextTypes.DEFAUL
         return
 
     # Check if participant already exists
-    existing_participant = db.get_participant(chat_id_to_add, fwd_from.id)
+    existing_participant = await adb.get_participant(chat_id_to_add, fwd_from.id)
     if existing_participant:
         await original_message.reply_text(f"Пользователь {fwd_from.full_name} уже в списке участников.")
     else:
-        db.add_user_to_participants(
+        await adb.add_user_to_participants(
             chat_id=chat_id_to_add,
             user_id=fwd_from.id,
             username=fwd_from.username,
@@ -51,7 +52,7 @@ async def web_app_data_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     response_text = data['response']
 
     # We reuse the same logic as regular voting for consistency
-    db.add_or_update_response(
+    await adb.add_or_update_response(
         poll_id=poll_id,
         user_id=user.id,
         first_name=user.first_name,
@@ -63,4 +64,4 @@ async def web_app_data_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     )
 
     # Update the visual representation of the poll
-    await update_poll_message(poll_id, context) 
\ No newline at end of file
+    await schedule_poll_update(poll_id, context) 
\ No newline at end of file
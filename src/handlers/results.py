@@ -5,20 +5,22 @@ import telegram
 import asyncio
 
 from src import database as db
+from src import async_database as adb
 from src.config import logger, WEB_URL
-from src.display import generate_poll_content, generate_nudge_text
+from src.display import generate_poll_content_async, generate_nudge_text
 from src.drawing import generate_results_heatmap_image
+from src.photo_registry import send_photo
 
 async def show_draft_poll_menu(context: ContextTypes.DEFAULT_TYPE, poll_id: int, chat_id: int, message_id: int):
     """Displays the management menu for a newly created draft poll with heatmap preview."""
-    poll = db.get_poll(poll_id)
+    poll = await adb.get_poll(poll_id)
     if not poll:
         # This should not happen in the normal flow
         await context.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text="Ошибка: созданный опрос не найден.")
         return
 
     # Generate both text and heatmap image
-    text, image_bytes = generate_poll_content(poll_id)
+    text, image_bytes = await generate_poll_content_async(poll_id)
     kb_rows = [
         [
             InlineKeyboardButton("▶️ Запустить", callback_data=f"dash:start_poll:{poll_id}"),
@@ -84,12 +86,12 @@ async def show_draft_poll_menu(context: ContextTypes.DEFAULT_TYPE, poll_id: int,
 async def show_results(update: Update, context: ContextTypes.DEFAULT_TYPE, poll_id: int):
     """Displays the results of a poll with action buttons."""
     query = update.callback_query
-    poll = db.get_poll(poll_id)
+    poll = await adb.get_poll(poll_id)
     if not poll:
         await query.edit_message_text("Опрос не найден.")
         return
 
-    text, image_bytes = generate_poll_content(poll_id)
+    text, image_bytes = await generate_poll_content_async(poll_id)
     kb_rows = []
     if poll.status == 'active':
         kb_rows.append([
@@ -153,7 +155,7 @@ async def show_results(update: Update, context: ContextTypes.DEFAULT_TYPE, poll_
 async def nudge_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, poll_id: int):
     """Handles the nudge button, creating or updating the nudge message."""
     query = update.callback_query
-    poll = db.get_poll(poll_id)
+    poll = await adb.get_poll(poll_id)
     if not poll or poll.status != 'active':
         await query.answer("Опрос не активен.", show_alert=True)
         return
@@ -162,7 +164,7 @@ async def nudge_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, poll
     try:
         msg = await context.bot.send_message(chat_id=poll.chat_id, text=nudge_text, reply_to_message_id=poll.message_id, parse_mode=ParseMode.MARKDOWN_V2)
         poll.nudge_message_id = msg.message_id
-        db.commit_session(poll)
+        await adb.commit_session(poll)
         await query.answer("Оповещение отправлено!", show_alert=False)
     except Exception as e:
         logger.error(f"Failed to send nudge message for poll {poll_id}: {e}")
@@ -173,7 +175,7 @@ async def nudge_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, poll
 async def del_nudge_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, poll_id: int):
     """Deletes the nudge message and handles cases where it's already gone."""
     query = update.callback_query
-    poll = db.get_poll(poll_id)
+    poll = await adb.get_poll(poll_id)
     
     # If poll is gone for some reason, just stop.
     if not poll:
@@ -185,7 +187,7 @@ async def del_nudge_handler(update: Update, context: ContextTypes.DEFAULT_TYPE,
     # Always clear the nudge message ID from the database first.
     # This ensures our state is corrected even if the deletion fails.
     poll.nudge_message_id = None
-    db.commit_session(poll)
+    await adb.commit_session(poll)
 
     if nudge_id_to_delete:
         try:
@@ -209,9 +211,9 @@ async def del_nudge_handler(update: Update, context: ContextTypes.DEFAULT_TYPE,
 async def move_to_bottom_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, poll_id: int):
     """Reposts the poll to the bottom of the chat, ensuring data is saved."""
     query = update.callback_query
-    session = db.SessionLocal()
+    session = db.open_session()
     try:
-        poll = session.query(db.Poll).filter_by(poll_id=poll_id).first()
+        poll = await adb.get_poll(poll_id, session=session)
         if not poll or poll.status != 'active':
             await query.answer("Опрос не активен.", show_alert=True)
             return
@@ -223,25 +225,25 @@ async def move_to_bottom_handler(update: Update, context: ContextTypes.DEFAULT_T
             logger.warning(f"Couldn't delete old poll message {poll.message_id}: {e}")
 
         # Сгенерируем контент опроса (текст + возможная тепловая карта)
-        new_text, image_bytes = generate_poll_content(poll=poll, session=session)
+        new_text, image_bytes = await generate_poll_content_async(poll=poll, session=session)
         kb = []
         if poll.poll_type == 'native':
-            options = poll.options.split(',')
-            kb = [[InlineKeyboardButton(opt.strip(), callback_data=f'vote:{poll.poll_id}:{i}')] for i, opt in enumerate(options)]
+            kb = [[InlineKeyboardButton(opt, callback_data=f'vote:{poll.poll_id}:{i}')] for i, opt in enumerate(poll.options)]
         elif poll.poll_type == 'webapp':
             if not poll.web_app_id:
                 # We can't easily alert the user here, but we can log it.
                 logger.error(f"Cannot move poll {poll_id} to bottom, associated web app id not found.")
-                session.close()
+                db.close_session(session)
                 return
             url = f"{WEB_URL}/web_apps/{poll.web_app_id}/?poll_id={poll.poll_id}"
             kb = [[InlineKeyboardButton("⚜️ Голосовать в приложении", web_app=WebAppInfo(url=url))]]
         
         try:
             if image_bytes:
-                new_message = await context.bot.send_photo(
-                    chat_id=poll.chat_id,
-                    photo=image_bytes,
+                new_message = await send_photo(
+                    context.bot,
+                    poll.chat_id,
+                    image_bytes,
                     caption=new_text,
                     reply_markup=InlineKeyboardMarkup(kb),
                     parse_mode=ParseMode.MARKDOWN_V2
@@ -254,14 +256,14 @@ async def move_to_bottom_handler(update: Update, context: ContextTypes.DEFAULT_T
                     parse_mode=ParseMode.MARKDOWN_V2
                 )
             poll.message_id = new_message.message_id
-            session.commit()
+            await adb.run_sync(session.commit)
         except Exception as e:
             # We don't have a message to edit here if this fails, so we can't show the error easily.
             # Logging is the most important part.
             logger.error(f"Failed to resend poll {poll_id} on move_to_bottom: {e}")
             await context.bot.send_message(query.message.chat_id, f"Ошибка при перемещении: {e}")
     finally:
-        session.close()
+        db.close_session(session)
 
 async def results_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Routes all callbacks starting with 'results:'."""
@@ -8,6 +8,7 @@ import asyncio
 import math
 
 from src import database as db
+from src import async_database as adb
 from src.config import logger
 
 async def _edit_message_safely(
@@ -60,7 +61,7 @@ async def _edit_message_safely(
             if query: await query.answer("Произошла ошибка при обновлении сообщения.", show_alert=True)
 
 async def show_nudge_emoji_menu(query: Union[CallbackQuery, None], context: ContextTypes.DEFAULT_TYPE, poll_id: int, message_id: int = None, chat_id: int = None):
-    poll_setting = db.get_poll_setting(poll_id)
+    poll_setting = await adb.get_poll_setting(poll_id)
     neg_emoji = (poll_setting.nudge_negative_emoji if poll_setting and poll_setting.nudge_negative_emoji else '❌')
     text = f"⚙️ Настройка эмодзи для оповещения\n\nТекущий негативный эмодзи: {neg_emoji}"
     kb = [[InlineKeyboardButton("📝 Изменить", callback_data=f"settings:set_nudge_neg_emoji:{poll_id}")],
@@ -69,13 +70,14 @@ async def show_nudge_emoji_menu(query: Union[CallbackQuery, None], context: Cont
     await _edit_message_safely(context, text, query=query, chat_id=chat_id, message_id=message_id, reply_markup=InlineKeyboardMarkup(kb))
 
 async def show_option_settings_menu(query: Union[CallbackQuery, None], context: ContextTypes.DEFAULT_TYPE, poll_id: int, option_index: int, message_id: int = None, chat_id: int = None):
-    poll = db.get_poll(poll_id)
-    option_text = poll.options.split(',')[option_index].strip()
-    poll_setting = db.get_poll_setting(poll_id)
+    opt_setting = await adb.get_poll_option(poll_id, option_index)
+    if not opt_setting:
+        if query: await query.answer("Вариант не найден.", show_alert=True)
+        return
+    option_text = opt_setting.text
+    poll_setting = await adb.get_poll_setting(poll_id)
     default_show_names, default_show_count = (1, 1) if not poll_setting else (poll_setting.default_show_names, poll_setting.default_show_count)
     
-    opt_setting = db.get_poll_option_setting(poll_id, option_index)
-    
     show_names = default_show_names if not opt_setting or opt_setting.show_names is None else opt_setting.show_names
     names_style = (poll_setting.default_names_style if not opt_setting or not opt_setting.names_style else opt_setting.names_style) or 'list'
     is_priority = opt_setting.is_priority if opt_setting else 0
@@ -109,12 +111,12 @@ async def show_option_settings_menu(query: Union[CallbackQuery, None], context:
 async def show_poll_settings_menu(query: Union[CallbackQuery, None], context: ContextTypes.DEFAULT_TYPE, poll_id: int, message_id: int = None, chat_id: int = None):
     """Shows the main settings menu for a specific poll."""
     logger.info(f"show_poll_settings_menu: poll_id={poll_id}")
-    poll = db.get_poll(poll_id)
+    poll = await adb.get_poll(poll_id)
     if not poll:
         if query: await query.answer("Опрос не найден.", show_alert=True)
         return
 
-    poll_setting = db.get_poll_setting(poll_id, create=True)
+    poll_setting = await adb.get_poll_setting(poll_id, create=True)
     multiple_answers = poll_setting.allow_multiple_answers
     target_sum = poll_setting.target_sum if poll_setting and poll_setting.target_sum is not None else 0
 
@@ -144,7 +146,7 @@ async def show_poll_settings_menu(query: Union[CallbackQuery, None], context: Co
 
 async def show_poll_options_settings_menu(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, poll_id: int):
     """Shows the settings menu for poll options."""
-    poll = db.get_poll(poll_id)
+    poll = await adb.get_poll(poll_id)
     if not poll:
         await query.answer("Опрос не найден.", show_alert=True)
         return
@@ -152,10 +154,9 @@ async def show_poll_options_settings_menu(query: CallbackQuery, context: Context
     title = poll.message or f"Опрос {poll.poll_id}"
     text = f"⚙️ *Настройки вариантов для «{title}»*:\nВыберите вариант для настройки."
     
-    options = poll.options.split(',')
     kb = []
-    for i, option_text in enumerate(options):
-        button_text = f"✏️ {option_text.strip()[:30]}"
+    for i, option_text in enumerate(poll.options):
+        button_text = f"✏️ {option_text[:30]}"
         kb.append([InlineKeyboardButton(button_text, callback_data=f"settings:option_menu:{poll_id}:{i}")])
     kb.append([InlineKeyboardButton("↩️ К настройкам опроса", callback_data=f"settings:poll_menu:{poll_id}")])
 
@@ -163,14 +164,17 @@ async def show_poll_options_settings_menu(query: CallbackQuery, context: Context
 
 async def show_single_option_settings_menu(query: Union[CallbackQuery, None], context: ContextTypes.DEFAULT_TYPE, poll_id: int, option_index: int, message_id: int = None, chat_id: int = None):
     """Shows the detailed settings menu for a single poll option."""
-    poll = db.get_poll(poll_id)
+    poll = await adb.get_poll(poll_id)
     if not poll:
         if query: await query.answer("Опрос не найден.", show_alert=True)
         return
     
-    option_text = poll.options.split(',')[option_index].strip()
-    opt_setting = db.get_poll_option_setting(poll_id, option_index, create=True)
-    poll_setting = db.get_poll_setting(poll_id, create=True)
+    opt_setting = await adb.get_poll_option(poll_id, option_index)
+    if not opt_setting:
+        if query: await query.answer("Вариант не найден.", show_alert=True)
+        return
+    option_text = opt_setting.text
+    poll_setting = await adb.get_poll_setting(poll_id, create=True)
 
     show_names = opt_setting.show_names if opt_setting.show_names is not None else poll_setting.default_show_names
     show_count = opt_setting.show_count if opt_setting.show_count is not None else poll_setting.default_show_count
@@ -276,7 +280,7 @@ async def settings_callback_handler(update: Update, context: ContextTypes.DEFAUL
         await text_input_for_option_setting(query, context, poll_id, int(parts[3]), parts[4])
     elif command == "toggle_setting":
         setting_key = parts[3]
-        toggle_boolean_setting(poll_id, setting_key)
+        await adb.run_sync(toggle_boolean_setting, poll_id, setting_key)
         await show_poll_settings_menu(query, context, poll_id)
     elif command == "excl_menu":
         page = int(parts[3])
@@ -288,7 +292,7 @@ async def settings_callback_handler(update: Update, context: ContextTypes.DEFAUL
     elif command == "toggle_option_setting":
         option_index = int(parts[3])
         setting_key = parts[4]
-        toggle_boolean_option_setting(poll_id, option_index, setting_key)
+        await adb.run_sync(toggle_boolean_option_setting, poll_id, option_index, setting_key)
         await show_single_option_settings_menu(query, context, poll_id, option_index)
 
 def toggle_boolean_setting(poll_id: int, setting_key: str):
@@ -303,8 +307,11 @@ def toggle_boolean_setting(poll_id: int, setting_key: str):
 
 def toggle_boolean_option_setting(poll_id: int, option_index: int, setting_key: str):
     """Toggles a boolean setting for a specific poll option."""
-    option_setting = db.get_poll_option_setting(poll_id, option_index, create=True)
-    
+    option_setting = db.get_poll_option(poll_id, option_index)
+    if option_setting is None:
+        logger.warning(f"Attempted to toggle '{setting_key}' of non-existent option {option_index} of poll {poll_id}")
+        return
+
     if setting_key == 'names_style':
         # Get default from main settings if not set
         poll_setting = db.get_poll_setting(poll_id, create=True)
@@ -323,18 +330,19 @@ async def show_poll_exclusion_menu(query: CallbackQuery, context: ContextTypes.D
     """Показывает список участников чата с возможностью исключения из опроса."""
     PAGE_SIZE = 20
 
-    poll = db.get_poll(poll_id)
+    poll = await adb.get_poll(poll_id)
     if not poll:
         await query.answer("Опрос не найден.", show_alert=True)
         return
 
-    session = db.SessionLocal()
+    session = db.open_session()
     try:
-        participants = db.get_participants(poll.chat_id, session=session)
-        excluded_ids = db.get_poll_exclusions(poll_id, session=session)
+        participants = await adb.get_participants(poll.chat_id, session=session)
+        excluded_ids = await adb.get_poll_exclusions(poll_id, session=session)
 
         # Сначала показываем исключённых, затем остальных (по алфавиту внутри групп)
-        participants.sort(key=lambda p: (p.user_id not in excluded_ids, db.get_user_name(session, p.user_id).lower()))
+        names = await adb.run_sync(db.resolve_user_names, session, [p.user_id for p in participants])
+        participants.sort(key=lambda p: (p.user_id not in excluded_ids, names[p.user_id].lower()))
 
         total_pages = max(1, math.ceil(len(participants) / PAGE_SIZE))
         page = max(0, min(page, total_pages - 1))
@@ -346,12 +354,12 @@ async def show_poll_exclusion_menu(query: CallbackQuery, context: ContextTypes.D
         text_lines = ["*Исключение участников из опроса:*", f"Стр. {page+1}/{total_pages}", ""]
         kb_rows = []
         for p in page_participants:
-            name = db.get_user_name(session, p.user_id, markdown_link=True)
+            name = db.user_link(names[p.user_id], p.user_id)
             is_exc = p.user_id in excluded_ids
             icon = "🚫" if is_exc else "✅"
             text_lines.append(f"{icon} {name}")
                         # Кнопка показывает значок и имя участника
-            name_plain = db.get_user_name(session, p.user_id, markdown_link=False)
+            name_plain = names[p.user_id]
             uname_part = f" (@{p.username})" if p.username else ""
             label_name = f"{name_plain}{uname_part}"
             # Ограничиваем длину, чтобы кнопка оставалась компактной
@@ -373,14 +381,15 @@ async def show_poll_exclusion_menu(query: CallbackQuery, context: ContextTypes.D
 
         await _edit_message_safely(context, "\n".join(text_lines), query=query, reply_markup=InlineKeyboardMarkup(kb_rows))
     finally:
-        session.close()
+        db.close_session(session)
 
 from src.display import generate_nudge_text
 
 async def toggle_exclude_in_poll(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, poll_id: int, user_id: int, page: int):
     """Переключает исключение участника и возвращает в меню."""
-    excluded = db.toggle_poll_exclusion(poll_id, user_id)
-    user_name = db.get_user_name(None, user_id)
+    excluded = await adb.toggle_poll_exclusion(poll_id, user_id)
+    user_name = (await adb.run_sync(db.resolve_user_names, None, [user_id]))[user_id]
+    poll = await adb.get_poll(poll_id)
     await query.answer(f"Исключён {user_name}" if excluded else f"Включён {user_name}", show_alert=False)
     # Обновляем меню той же страницы
     await show_poll_exclusion_menu(query, context, poll_id, page)
@@ -394,7 +403,6 @@ async def toggle_exclude_in_poll(query: CallbackQuery, context: ContextTypes.DEF
             await results_handlers.show_draft_poll_menu(context, poll_id, user_chat_id, preview_id)
 
     # --- Refresh nudge message, if any ---
-    poll = db.get_poll(poll_id)
     if poll:
         try:
             nudge_text = await generate_nudge_text(poll_id)
@@ -407,7 +415,7 @@ async def toggle_exclude_in_poll(query: CallbackQuery, context: ContextTypes.DEF
             # if nobody pending -> clear id
             if "Все участники проголосовали" in nudge_text:
                 poll.nudge_message_id = None
-                db.commit_session(poll)
+                await adb.commit_session(poll)
         except BadRequest as e:
             if "Message is not modified" not in str(e):
                 logger.warning(f"Failed to edit nudge message after exclusion change: {e}")
@@ -422,4 +430,4 @@ async def toggle_exclude_in_poll(query: CallbackQuery, context: ContextTypes.DEF
                     parse_mode=ParseMode.MARKDOWN_V2,
                 )
                 poll.nudge_message_id = new_msg.message_id
-                db.commit_session(poll)
\ No newline at end of file
+                await adb.commit_session(poll)
\ No newline at end of file
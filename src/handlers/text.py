@@ -4,6 +4,7 @@ from telegram.helpers import escape_markdown
 import asyncio
 
 from src import database as db
+from src import async_database as adb
 from src.config import logger
 from src.handlers import dashboard, settings, results
 
@@ -94,22 +95,20 @@ async def _handle_poll_creation(update: Update, context: ContextTypes.DEFAULT_TY
             app_manifest = context.bot_data.get('BUNDLED_WEB_APPS', {}).get(web_app_id, {})
             predefined_options = app_manifest.get('options')
 
-            options_str = None
+            options = []
             if predefined_options and isinstance(predefined_options, list):
-                options_str = ','.join(predefined_options)
-            else:
-                # Fallback for simple web apps without predefined options
-                options_str = 'Web App Poll'
+                options = [str(option) for option in predefined_options]
+            # Simple web apps without predefined options collect free-text answers.
 
             new_poll = db.Poll(
                 chat_id=chat_id,
                 message=title,
                 status='draft',
-                options=options_str,
+                options=options,
                 poll_type='webapp',
                 web_app_id=web_app_id
             )
-            new_poll_id = db.add_poll(new_poll)
+            new_poll_id = await adb.add_poll(new_poll)
             
             await results.show_draft_poll_menu(
                 context=context,
@@ -163,7 +162,7 @@ async def _handle_settings_update(update: Update, context: ContextTypes.DEFAULT_
         _clean_wizard_context(context)
         return
 
-    session = db.SessionLocal()
+    session = db.open_session()
     try:
         # --- Option-specific settings ---
         if context.user_data['wizard_state'] == 'waiting_for_option_setting':
@@ -172,21 +171,17 @@ async def _handle_settings_update(update: Update, context: ContextTypes.DEFAULT_
                 raise ValueError("State is for option setting but 'wizard_option_index' is missing.")
 
             if setting_key == 'text':
-                poll = session.query(db.Poll).filter_by(poll_id=poll_id).first()
-                if poll:
-                    options_list = poll.options.split(',')
-                    if option_index < len(options_list):
-                        old_text = options_list[option_index].strip()
-                        for resp in poll.responses:
-                            if resp.response == old_text:
-                                resp.response = text_input
-                        options_list[option_index] = text_input
-                        poll.options = ','.join(options_list)
-                    else:
-                        logger.error(f"Option index {option_index} out of bounds for poll {poll_id}")
+                option = await adb.get_poll_option(poll_id, option_index, session=session)
+                if option:
+                    # Responses store the option index, so they follow the new text as is.
+                    option.text = text_input.strip()
+                else:
+                    logger.error(f"Option index {option_index} out of bounds for poll {poll_id}")
             else:
-                setting = db.get_poll_option_setting(poll_id, option_index, create=True, session=session)
-                if setting_key == 'emoji':
+                setting = await adb.get_poll_option(poll_id, option_index, session=session)
+                if setting is None:
+                    logger.error(f"Option index {option_index} out of bounds for poll {poll_id}")
+                elif setting_key == 'emoji':
                     setting.emoji = text_input
                 elif setting_key == 'contribution_amount':
                     try:
@@ -195,19 +190,25 @@ async def _handle_settings_update(update: Update, context: ContextTypes.DEFAULT_
                          logger.warning(f"Invalid contribution amount: {text_input}")
                          # Should we notify the user? For now, we don't.
             
-            session.commit()
+            await adb.run_sync(session.commit)
             await settings.show_single_option_settings_menu(None, context, poll_id, option_index, chat_id=chat_id, message_id=message_id)
 
         # --- Poll-level settings ---
         elif context.user_data['wizard_state'] == 'waiting_for_poll_setting':
-            poll = session.query(db.Poll).filter_by(poll_id=poll_id).first()
+            poll = await adb.get_poll(poll_id, session=session)
             if poll:
-                poll_setting = db.get_poll_setting(poll_id, create=True, session=session)
+                poll_setting = await adb.get_poll_setting(poll_id, create=True, session=session)
                 logger.info(f"[DEBUG] BEFORE: poll_id={poll_id} target_sum={getattr(poll_setting, 'target_sum', None)} session_id={id(session)} poll_setting_obj={poll_setting}")
                 if setting_key == 'message':
                     poll.message = text_input
                 elif setting_key == 'options':
-                    poll.options = text_input.replace('\n', ',')
+                    # One option per line; a single line may list them separated by commas.
+                    # Votes move with their options (by text), votes for removed options are dropped.
+                    options = text_input.split('\n') if '\n' in text_input else text_input.split(',')
+                    if any(option.strip() for option in options):
+                        await adb.run_sync(db.replace_poll_options, session, poll, options)
+                    else:
+                        logger.warning(f"Ignoring an options list without options for poll {poll_id}")
                 elif setting_key == 'nudge_negative_emoji':
                     poll_setting.nudge_negative_emoji = text_input
                 elif setting_key == 'target_sum':
@@ -218,16 +219,16 @@ async def _handle_settings_update(update: Update, context: ContextTypes.DEFAULT_
                     except ValueError:
                         poll_setting.target_sum = 0
                         logger.warning(f"Invalid target_sum: {text_input}")
-            db.safe_commit(session)
-            session.refresh(poll_setting)
+            await adb.run_sync(db.safe_commit, session)
+            await adb.run_sync(session.refresh, poll_setting)
             logger.info(f"[AFTER COMMIT] poll_id={poll_id} target_sum in DB: {poll_setting.target_sum} session_id={id(session)} poll_setting_obj={poll_setting}")
             await settings.show_poll_settings_menu(None, context, poll_id, chat_id=chat_id, message_id=message_id)
 
     except Exception as e:
         logger.error(f"Error updating setting: {e}", exc_info=True)
-        session.rollback()
+        await adb.run_sync(session.rollback)
     finally:
-        session.close()
+        db.close_session(session)
         _clean_wizard_context(context)
 
 # --- Utility Functions ---
@@ -293,11 +294,11 @@ async def done_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id=chat_id, 
         message=title, 
         status='draft', 
-        options=','.join(options), 
+        options=options, 
         poll_type=poll_type,
         web_app_id=app_user_data.get('wizard_web_app_id') # Will be None, which is fine
     )
-    new_poll_id = db.add_poll(new_poll)
+    new_poll_id = await adb.add_poll(new_poll)
     
     # Instead of showing text, show the management menu
     await results.show_draft_poll_menu(
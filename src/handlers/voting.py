@@ -1,16 +1,20 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, User, WebAppInfo, InputMediaPhoto
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, User, WebAppInfo
 from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
 
 import telegram
-import os
 
 from src.database import safe_commit
 
 from src import database as db
+from src import async_database as adb
 from src.config import logger, WEB_URL
-from src.display import generate_poll_content, generate_nudge_text
+from src.display import generate_poll_content_async, generate_nudge_text
+from src.poll_refresher import PollRefresher
+from src.content_hash import content_digest, published_digests
+from src.photo_registry import send_photo, edit_photo, empty_image
+from src import metrics
 
 
 # Текст ошибки Telegram при невозможности удаления сообщения.
@@ -22,27 +26,25 @@ async def update_poll_message(poll_id: int, context: ContextTypes.DEFAULT_TYPE):
     Refreshes the poll message after a vote, handling text and photo updates.
     This function can now handle transitions between text-only and photo messages.
     """
+    # Runs in the refresher's own task, never inside an update's unit of work: a session of its own.
     session = db.SessionLocal()
     try:
         # Use session to query to ensure data is fresh
-        poll = session.query(db.Poll).filter_by(poll_id=poll_id).first()
+        poll = await adb.run_sync(db.get_poll, poll_id, session=session)
         if not poll or not poll.message_id:
             logger.warning(f"update_poll_message: Poll {poll_id} or its message_id not found.")
             return
 
-        # Generate new content, which may include an image
-        new_caption, new_image = generate_poll_content(poll=poll, session=session)
+        # Generate new content, which may include an image.
+        # DB reads run in the DB executor, drawing in the render pool — not on the event loop.
+        new_caption, new_image = await generate_poll_content_async(poll=poll, session=session)
 
         # Regenerate keyboard
         kb = []
         # --- Модульные кнопки ---
         poll_type = getattr(poll, 'poll_type', 'native')
         extra_buttons = []
-        # Импортируем модули registry из bot.py
-        from bot import discover_and_register_modules
-        # Собираем все poll-модули (PollModuleBase)
-        # Для простоты — повторно вызываем discover_and_register_modules, но лучше вынести реестр в bot.py
-        # Здесь для примера:
+        # Собираем все poll-модули (PollModuleBase) один раз и кешируем на объекте бота
         modules = {}
         def collect_modules():
             import os, glob, importlib
@@ -77,13 +79,11 @@ async def update_poll_message(poll_id: int, context: ContextTypes.DEFAULT_TYPE):
             bot_username = (await context.bot.get_me()).username
             extra_buttons = module.get_extra_buttons(poll.poll_id, bot_username)
         if poll.poll_type == 'native' and poll.options:
-            options = poll.options.split(',')
             kb = []
             current_row = []
             MAX_PER_ROW = 3
             SHORT_LEN = 15
-            for i, opt in enumerate(options):
-                text = opt.strip()
+            for i, text in enumerate(poll.options):
                 btn = InlineKeyboardButton(text, callback_data=f'vote:{poll.poll_id}:{i}')
                 if len(text) <= SHORT_LEN:
                     current_row.append(btn)
@@ -103,12 +103,20 @@ async def update_poll_message(poll_id: int, context: ContextTypes.DEFAULT_TYPE):
         
         reply_markup = InlineKeyboardMarkup(kb) if kb else None
 
+        # Skip the network round-trip entirely if this exact output is already published.
+        digest = content_digest(new_caption, reply_markup, new_image)
+        if published_digests.get(poll.chat_id, poll.message_id) == digest:
+            metrics.increment('poll_edits_skipped')
+            logger.debug(f"update_poll_message: poll {poll_id} unchanged, edit skipped")
+            return
+
         try:
             if new_image and not poll.photo_file_id:
                 # Раньше было текстовое сообщение, теперь хотим добавить изображение
-                new_msg = await context.bot.send_photo(
-                    chat_id=poll.chat_id,
-                    photo=new_image,
+                new_msg = await send_photo(
+                    context.bot,
+                    poll.chat_id,
+                    new_image,
                     caption=new_caption,
                     reply_markup=reply_markup,
                     parse_mode=ParseMode.MARKDOWN_V2,
@@ -124,33 +132,24 @@ async def update_poll_message(poll_id: int, context: ContextTypes.DEFAULT_TYPE):
                 poll.message_id = new_msg.message_id
                 poll.photo_file_id = new_msg.photo[-1].file_id if new_msg.photo else None
             elif poll.photo_file_id:
-                # Сообщение уже содержит фото. Если сгенерировано новое изображение —
-                # заменяем медиаконтент, иначе обновляем только подпись или убираем картинку.
-                if new_image:
-                    media = InputMediaPhoto(media=new_image, caption=new_caption, parse_mode=ParseMode.MARKDOWN_V2)
-                    await context.bot.edit_message_media(
-                        chat_id=poll.chat_id,
-                        message_id=poll.message_id,
-                        media=media,
-                        reply_markup=reply_markup,
-                    )
-                else:
-                    # Если image_bytes отсутствует, а раньше была картинка — отправляем пустую картинку
-                    empty_path = os.path.join(os.path.dirname(__file__), '../static/empty.png')
-                    with open(empty_path, 'rb') as f:
-                        empty_image = f.read()
-                    media = InputMediaPhoto(media=empty_image, caption=new_caption, parse_mode=ParseMode.MARKDOWN_V2)
-                    await context.bot.edit_message_media(
-                        chat_id=poll.chat_id,
-                        message_id=poll.message_id,
-                        media=media,
-                        reply_markup=reply_markup,
-                    )
+                # Сообщение уже содержит фото. Заменяем медиаконтент новым изображением,
+                # а если его нет — пустой картинкой. Изображения, которые Telegram уже видел,
+                # отправляются по file_id без повторной загрузки (см. photo_registry).
+                await edit_photo(
+                    context.bot,
+                    poll.chat_id,
+                    poll.message_id,
+                    new_image or empty_image(),
+                    new_caption,
+                    reply_markup=reply_markup,
+                )
             else:
                 # обычное текстовое сообщение
                 await context.bot.edit_message_text(text=new_caption, chat_id=poll.chat_id, message_id=poll.message_id, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
 
-            safe_commit(session)
+            await adb.run_sync(safe_commit, session)
+            published_digests.remember(poll.chat_id, poll.message_id, digest)
+            metrics.increment('poll_edits_sent')
 
             # --- Update nudge message if exists ---
             if poll.nudge_message_id:
@@ -165,13 +164,18 @@ async def update_poll_message(poll_id: int, context: ContextTypes.DEFAULT_TYPE):
                     # If everyone has voted, optionally clear the nudge id
                     if "Все участники проголосовали" in nudge_text:
                         poll.nudge_message_id = None
-                        safe_commit(session)
+                        await adb.run_sync(safe_commit, session)
                 except BadRequest as e:
                     if "Message is not modified" not in str(e):
                         logger.warning(f"Failed to edit nudge message {poll.nudge_message_id}: {e}")
 
+        except RetryAfter:
+            # Flood control: let the refresher back off and retry.
+            raise
         except BadRequest as e:
-            if "Message is not modified" not in str(e):
+            if "Message is not modified" in str(e):
+                published_digests.remember(poll.chat_id, poll.message_id, digest)
+            else:
                 logger.error(f"Failed to edit message for poll {poll_id}: {e}", exc_info=True)
         except Exception as e:
             logger.error(f"Unexpected failure in update_poll_message for poll {poll_id}: {e}", exc_info=True)
@@ -180,6 +184,15 @@ async def update_poll_message(poll_id: int, context: ContextTypes.DEFAULT_TYPE):
         session.close()
 
 
+# Coalesces vote bursts into one re-render and edit per poll and window.
+poll_refresher = PollRefresher(update_poll_message)
+
+
+async def schedule_poll_update(poll_id: int, context: ContextTypes.DEFAULT_TYPE):
+    """Requests a (debounced) refresh of the poll message. Use this after votes."""
+    await poll_refresher.request(poll_id, context)
+
+
 async def legacy_vote_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the old vote callback format (e.g., 'poll_22_1')."""
     query = update.callback_query
@@ -191,23 +204,17 @@ async def legacy_vote_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         option_index = int(parts[2])
         user = update.effective_user
         
-        db.add_user_to_participants(
+        await adb.record_vote(
             chat_id=update.effective_chat.id,
-            user_id=user.id,
-            username=user.username,
-            first_name=user.first_name or "",
-            last_name=user.last_name or "",
-        )
-        db.add_or_update_response(
             poll_id=poll_id,
             user_id=user.id,
             first_name=user.first_name,
             last_name=user.last_name,
             username=user.username,
-            option_index=option_index
+            option_index=option_index,
         )
         await query.answer("Спасибо, ваш голос учтён!")
-        await update_poll_message(poll_id, context)
+        await schedule_poll_update(poll_id, context)
 
     except (IndexError, ValueError) as e:
         logger.error(f"Error parsing legacy_vote_handler data '{query.data}': {e}")
@@ -229,25 +236,20 @@ async def vote_callback_handler(update: Update, context: ContextTypes.DEFAULT_TY
 
     user = query.from_user
     
-    # Register the vote first
-    db.add_user_to_participants(
+    # Register the vote first: user, participant and response in one transaction, committed
+    # by record_vote itself, so no write lock is held across the Telegram round-trip.
+    await adb.record_vote(
         chat_id=update.effective_chat.id,
-        user_id=user.id,
-        username=user.username,
-        first_name=user.first_name or "",
-        last_name=user.last_name or "",
-    )
-    db.add_or_update_response(
         poll_id=poll_id,
         user_id=user.id,
         first_name=user.first_name,
         last_name=user.last_name,
         username=user.username,
-        option_index=option_index
+        option_index=option_index,
     )
-    
+
     # Acknowledge the vote immediately
     await query.answer("Спасибо, ваш голос учтён!")
     
-    # Trigger the message update logic
-    await update_poll_message(poll_id, context) 
\ No newline at end of file
+    # Trigger the message update logic (coalesced with other votes on this poll)
+    await schedule_poll_update(poll_id, context) 
\ No newline at end of file
@@ -0,0 +1,56 @@
+"""
+Process-wide counters for operational metrics.
+
+Counters are plain monotonically increasing integers identified by name.
+They are cheap to bump from any thread and are exposed as JSON on the
+``/metrics`` endpoint of the web server (only with ``METRICS_TOKEN``, see
+``is_authorized``). Gauges are current values (pool
+connections in use, ...) read through a callback when the snapshot is taken.
+"""
+import hmac
+import threading
+from collections import Counter
+from typing import Callable, Dict
+
+_counters: Counter = Counter()
+_gauges: Dict[str, Callable[[], int]] = {}
+_lock = threading.Lock()
+
+
+def is_authorized(authorization: str, token: str) -> bool:
+    """Whether an Authorization header carries the metrics token; never without a token."""
+    if not token:
+        return False
+    return hmac.compare_digest((authorization or '').encode(), f'Bearer {token}'.encode())
+
+
+def increment(name: str, value: int = 1) -> None:
+    with _lock:
+        _counters[name] += value
+
+
+def get(name: str) -> int:
+    with _lock:
+        return _counters[name]
+
+
+def register_gauge(name: str, read: Callable[[], int]) -> None:
+    """Registers (or replaces) a gauge read by ``read()`` on every snapshot."""
+    with _lock:
+        _gauges[name] = read
+
+
+def snapshot() -> Dict[str, int]:
+    """Returns a copy of all counters together with the current gauge values."""
+    with _lock:
+        values = dict(_counters)
+        gauges = list(_gauges.items())
+    for name, read in gauges:
+        values[name] = read()
+    return values
+
+
+def reset() -> None:
+    """Clears the counters; gauges stay registered."""
+    with _lock:
+        _counters.clear()
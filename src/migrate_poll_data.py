@@ -10,7 +10,7 @@ def migrate_poll_data(old_poll_id, new_poll_id):
         responses = session.query(db.Response).filter_by(poll_id=old_poll_id).all()
         for r in responses:
             # Проверка на дубли
-            exists = session.query(db.Response).filter_by(poll_id=new_poll_id, user_id=r.user_id, response=r.response).first()
+            exists = session.query(db.Response).filter_by(poll_id=new_poll_id, user_id=r.user_id, option_index=r.option_index, response=r.response).first()
             if not exists:
                 r.poll_id = new_poll_id
         # Poll exclusions
@@ -25,10 +25,10 @@ def migrate_poll_data(old_poll_id, new_poll_id):
             exists = session.query(db.PollSetting).filter_by(poll_id=new_poll_id).first()
             if not exists:
                 old_setting.poll_id = new_poll_id
-        # Poll option settings
-        option_settings = session.query(db.PollOptionSetting).filter_by(poll_id=old_poll_id).all()
-        for s in option_settings:
-            exists = session.query(db.PollOptionSetting).filter_by(poll_id=new_poll_id, option_index=s.option_index).first()
+        # Poll options (text and settings)
+        options = session.query(db.PollOption).filter_by(poll_id=old_poll_id).all()
+        for s in options:
+            exists = session.get(db.PollOption, (new_poll_id, s.option_index))
             if not exists:
                 s.poll_id = new_poll_id
         session.commit()
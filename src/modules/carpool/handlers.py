@@ -2,7 +2,7 @@ import logging
 from telegram.ext import CommandHandler, ContextTypes, ConversationHandler, MessageHandler, filters
 from telegram import Update, InlineKeyboardButton
 from src.modules.carpool.models import Car
-from src.database import SessionLocal
+from src.database import open_session, close_session
 
 # Состояния диалога
 ASK_SEATS, ASK_TIME, ASK_AREA, CONFIRM = range(4)
@@ -52,7 +52,7 @@ async def save_car(update: Update, context: ContextTypes.DEFAULT_TYPE):
     depart_time = context.user_data['depart_time']
     depart_area = context.user_data['depart_area']
     # Сохраняем машину в БД
-    session = SessionLocal()
+    session = open_session()
     try:
         car = Car(driver_id=user.id, seats=seats, depart_time=depart_time, depart_area=depart_area)
         session.add(car)
@@ -62,7 +62,7 @@ async def save_car(update: Update, context: ContextTypes.DEFAULT_TYPE):
         session.rollback()
         await update.message.reply_text(f"Ошибка при сохранении: {e}")
     finally:
-        session.close()
+        close_session(session)
     return ConversationHandler.END
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
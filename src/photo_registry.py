@@ -0,0 +1,152 @@
+"""
+Content-addressed registry of photos already uploaded to Telegram.
+
+Telegram answers every photo upload with a ``file_id``; sending that id again
+re-uses the stored file instead of uploading the bytes. Heatmaps are rendered
+deterministically (the render cache returns the same bytes for the same poll
+version), so closing, reopening, moving or re-editing a poll very often sends
+an image Telegram has already seen, and ``static/empty.png`` is always the same.
+
+The registry maps the SHA-256 of the image bytes to its ``file_id``. It is
+persisted in the ``image_file_ids`` table, so it survives restarts and is
+shared between instances, with a small in-memory LRU in front of it. A
+``file_id`` Telegram rejects is forgotten and the bytes are uploaded instead.
+"""
+import functools
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional, Union
+
+from telegram import InputMediaPhoto
+from telegram.constants import ParseMode
+from telegram.error import BadRequest
+
+from . import async_database as adb
+from . import metrics
+from .config import logger
+
+# Number of digest -> file_id pairs kept in memory.
+MAX_CACHED_FILE_IDS = 2048
+
+EMPTY_IMAGE_PATH = os.path.join(os.path.dirname(__file__), 'static', 'empty.png')
+
+ImageData = Union[io.BytesIO, bytes]
+
+
+def image_digest(image: ImageData) -> str:
+    return hashlib.sha256(image.getvalue() if isinstance(image, io.BytesIO) else image).hexdigest()
+
+
+@functools.lru_cache(maxsize=1)
+def empty_image() -> bytes:
+    """Placeholder shown when a photo message no longer has a heatmap; read from disk once."""
+    with open(EMPTY_IMAGE_PATH, 'rb') as f:
+        return f.read()
+
+
+class PhotoRegistry:
+    """digest -> file_id, backed by the image_file_ids table."""
+
+    def __init__(self, max_size: int = MAX_CACHED_FILE_IDS):
+        self.max_size = max_size
+        self._file_ids: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember_locally(self, digest: str, file_id: str) -> None:
+        with self._lock:
+            self._file_ids[digest] = file_id
+            self._file_ids.move_to_end(digest)
+            while len(self._file_ids) > self.max_size:
+                self._file_ids.popitem(last=False)
+
+    async def lookup(self, digest: str) -> Optional[str]:
+        with self._lock:
+            file_id = self._file_ids.get(digest)
+            if file_id is not None:
+                self._file_ids.move_to_end(digest)
+                return file_id
+        try:
+            file_id = await adb.get_image_file_id(digest)
+        except Exception as e:
+            # The registry is an optimisation: without it the image is simply uploaded.
+            logger.warning(f"Image file_id lookup failed: {e}")
+            return None
+        if file_id:
+            self._remember_locally(digest, file_id)
+        return file_id
+
+    async def remember(self, digest: str, file_id: str) -> None:
+        self._remember_locally(digest, file_id)
+        try:
+            await adb.save_image_file_id(digest, file_id)
+        except Exception as e:
+            logger.warning(f"Couldn't store image file_id: {e}")
+
+    async def forget(self, digest: str) -> None:
+        with self._lock:
+            self._file_ids.pop(digest, None)
+        try:
+            await adb.delete_image_file_id(digest)
+        except Exception as e:
+            logger.warning(f"Couldn't delete image file_id: {e}")
+
+    def clear(self) -> None:
+        """Clears the in-memory part only."""
+        with self._lock:
+            self._file_ids.clear()
+
+
+photo_registry = PhotoRegistry()
+
+
+def _photo_file_id(message) -> Optional[str]:
+    photos = getattr(message, 'photo', None)
+    if not photos:
+        return None
+    file_id = photos[-1].file_id
+    return file_id if isinstance(file_id, str) else None
+
+
+async def _with_registered_photo(image: ImageData, request: Callable[[Union[str, ImageData]], Awaitable]):
+    """Runs ``request`` with the known file_id of ``image``, or with its bytes, and records the resulting file_id."""
+    digest = image_digest(image)
+    file_id = await photo_registry.lookup(digest)
+    if file_id:
+        try:
+            result = await request(file_id)
+            metrics.increment('photo_file_id_hits')
+            return result
+        except BadRequest as e:
+            if "Message is not modified" in str(e):
+                raise
+            logger.warning(f"Telegram rejected cached file_id for image {digest[:12]}, uploading it again: {e}")
+            await photo_registry.forget(digest)
+
+    result = await request(image)
+    metrics.increment('photo_uploads')
+    file_id = _photo_file_id(result)
+    if file_id:
+        await photo_registry.remember(digest, file_id)
+    return result
+
+
+async def send_photo(bot, chat_id: int, image: ImageData, **kwargs):
+    """``bot.send_photo`` that sends a known image by file_id instead of uploading it."""
+    return await _with_registered_photo(
+        image, lambda photo: bot.send_photo(chat_id=chat_id, photo=photo, **kwargs))
+
+
+async def edit_photo(bot, chat_id: int, message_id: int, image: ImageData, caption: str,
+                     reply_markup=None, parse_mode: str = ParseMode.MARKDOWN_V2):
+    """``bot.edit_message_media`` with a photo, sending a known image by file_id instead of uploading it."""
+    return await _with_registered_photo(
+        image,
+        lambda media: bot.edit_message_media(
+            chat_id=chat_id,
+            message_id=message_id,
+            media=InputMediaPhoto(media=media, caption=caption, parse_mode=parse_mode),
+            reply_markup=reply_markup,
+        ))
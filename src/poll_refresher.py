@@ -0,0 +1,134 @@
+"""
+Per-poll coalescing refresher for poll messages.
+
+Every vote used to re-render the poll and edit the Telegram message right away,
+so a burst of votes produced a burst of renders and edits that ran into flood
+control. ``PollRefresher.request`` marks a poll as dirty instead:
+
+* an idle poll is refreshed immediately (a single vote shows up without delay),
+  in a task of its own: the caller (a vote handler) does not wait for the
+  render and the Telegram edit, nor keep its chat's slot and its unit of work
+  open meanwhile (``inline=True`` refreshes in the caller's task instead, for
+  the serverless entry point, whose instance may be frozen after the response);
+* requests that arrive while a refresh is running or while the window is still
+  open are merged into one trailing refresh at the end of the window;
+* the trailing refresh reads the database when it runs, so it always publishes
+  the latest state;
+* when Telegram answers with ``RetryAfter`` the poll's window grows (at least to
+  the requested delay, at most to ``max_window``) and the refresh is retried;
+  every successful edit shrinks the window back towards ``base_window``.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from telegram.error import RetryAfter
+
+from .config import logger, POLL_REFRESH_WINDOW, POLL_REFRESH_MAX_WINDOW
+
+# Window multiplier applied after each successful refresh.
+WINDOW_DECAY = 0.75
+# Idle poll states are pruned once the table grows beyond this size.
+MAX_IDLE_STATES = 256
+
+
+class _PollState:
+    __slots__ = ('dirty', 'flushing', 'task', 'context', 'window', 'not_before')
+
+    def __init__(self, window: float):
+        self.dirty = False
+        self.flushing = False
+        self.task: Optional[asyncio.Task] = None
+        self.context: Any = None
+        self.window = window
+        self.not_before = 0.0
+
+    @property
+    def busy(self) -> bool:
+        return self.dirty or self.flushing or self.task is not None
+
+
+class PollRefresher:
+    """Collapses refresh requests for the same poll into at most one refresh per window."""
+
+    def __init__(self, refresh: Callable[[int, Any], Awaitable[None]],
+                 base_window: float = POLL_REFRESH_WINDOW, max_window: float = POLL_REFRESH_MAX_WINDOW,
+                 inline: bool = False):
+        self._refresh = refresh
+        self.inline = inline
+        self.base_window = base_window
+        self.max_window = max(base_window, max_window)
+        self._polls: Dict[int, _PollState] = {}
+
+    def window(self, poll_id: int) -> float:
+        """Current flush window of a poll, in seconds."""
+        state = self._polls.get(poll_id)
+        return state.window if state else self.base_window
+
+    async def request(self, poll_id: int, context: Any) -> None:
+        """
+        Asks for the poll message to be refreshed and returns without waiting for it (unless inline).
+        An idle poll is refreshed right away, otherwise the request joins the trailing refresh.
+        """
+        state = self._polls.get(poll_id)
+        if state is None:
+            self._prune()
+            state = self._polls[poll_id] = _PollState(self.base_window)
+
+        state.dirty = True
+        state.context = context
+        if state.flushing or state.task is not None:
+            return  # the running refresh will pick the change up
+        if self.inline and asyncio.get_running_loop().time() >= state.not_before:
+            await self._flush(poll_id, state)
+            if not state.dirty:
+                return
+        state.task = asyncio.create_task(self._run(poll_id, state))
+
+    async def _run(self, poll_id: int, state: _PollState) -> None:
+        # Refreshes until no request is left; waits out the window (or flood control) in between.
+        loop = asyncio.get_running_loop()
+        try:
+            while state.dirty:
+                delay = state.not_before - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await self._flush(poll_id, state)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"PollRefresher: refresh of poll {poll_id} failed: {e}", exc_info=True)
+        finally:
+            state.task = None
+
+    async def _flush(self, poll_id: int, state: _PollState) -> None:
+        loop = asyncio.get_running_loop()
+        state.dirty = False
+        state.flushing = True
+        try:
+            await self._refresh(poll_id, state.context)
+        except RetryAfter as e:
+            retry_after = float(e.retry_after)
+            state.window = min(self.max_window, max(state.window * 2, retry_after))
+            state.not_before = loop.time() + max(retry_after, state.window)
+            state.dirty = True  # the edit did not go through, publish again
+            logger.warning(f"PollRefresher: flood control for poll {poll_id}, retry in {retry_after}s, window now {state.window:.1f}s")
+        else:
+            state.window = max(self.base_window, state.window * WINDOW_DECAY)
+            state.not_before = loop.time() + state.window
+        finally:
+            state.flushing = False
+
+    def _prune(self) -> None:
+        if len(self._polls) < MAX_IDLE_STATES:
+            return
+        now = asyncio.get_running_loop().time()
+        for poll_id in [pid for pid, s in self._polls.items() if not s.busy and s.not_before <= now]:
+            del self._polls[poll_id]
+
+    async def shutdown(self) -> None:
+        """Cancels pending trailing refreshes. Votes are already stored, so nothing is lost."""
+        tasks = [s.task for s in self._polls.values() if s.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._polls.clear()
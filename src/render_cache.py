@@ -0,0 +1,73 @@
+"""
+LRU cache of rendered poll content.
+
+Entries are keyed by ``(poll_id, version)``. ``polls.version`` is bumped on every
+change that affects rendering (see ``database.bump_poll_versions``), so a cached
+entry never needs invalidation: a new version simply misses and older versions
+age out. The cache is bounded both by entry count and by total size in bytes.
+"""
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from . import metrics
+from .config import RENDER_CACHE_MAX_BYTES, RENDER_CACHE_MAX_ENTRIES
+
+# (caption text, PNG bytes or None)
+RenderedContent = Tuple[str, Optional[bytes]]
+
+
+class RenderCache:
+    def __init__(self, max_entries: int = RENDER_CACHE_MAX_ENTRIES, max_bytes: int = RENDER_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[int, int], RenderedContent]" = OrderedDict()
+        self._size = 0
+        # Renders run in the DB executor threads, so access must be serialised.
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _entry_size(content: RenderedContent) -> int:
+        text, image = content
+        return len(text.encode('utf-8')) + (len(image) if image else 0)
+
+    def get(self, poll_id: int, version: int) -> Optional[RenderedContent]:
+        with self._lock:
+            content = self._entries.get((poll_id, version))
+            if content is None:
+                metrics.increment('render_cache_misses')
+                return None
+            self._entries.move_to_end((poll_id, version))
+            metrics.increment('render_cache_hits')
+            return content
+
+    def put(self, poll_id: int, version: int, text: str, image: Optional[bytes]) -> None:
+        content = (text, image)
+        size = self._entry_size(content)
+        if size > self.max_bytes or self.max_entries == 0:
+            return
+        with self._lock:
+            key = (poll_id, version)
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= self._entry_size(old)
+            self._entries[key] = content
+            self._size += size
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= self._entry_size(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._size
+
+
+render_cache = RenderCache()
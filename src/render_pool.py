@@ -0,0 +1,79 @@
+"""
+Bounded worker pool for heatmap rendering.
+
+Drawing and PNG encoding take tens to hundreds of milliseconds on large polls.
+They used to run in the DB executor, so a few big renders could occupy every DB
+worker and stall unrelated reads and writes. Renders now work from a
+``PollSnapshot`` (plain data, no ORM session) and run in their own threads:
+
+* at most ``RENDER_WORKERS`` renders run at once;
+* at most ``RENDER_MAX_PENDING`` renders are queued or running; further callers
+  wait for a free slot instead of piling up work (backpressure);
+* ``RENDER_WORKERS=0`` renders inline in the calling coroutine, which is what
+  the test suite uses.
+
+Threads rather than processes: Pillow releases the GIL while drawing and
+encoding, and the incremental heatmap renderer keeps its layer cache in memory,
+which worker processes could not share.
+"""
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, TypeVar
+
+from . import metrics
+from .config import logger, RENDER_WORKERS, RENDER_MAX_PENDING
+
+T = TypeVar('T')
+
+
+class RenderPool:
+    def __init__(self, workers: int = RENDER_WORKERS, max_pending: int = RENDER_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max(workers, max_pending)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._slots_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def inline(self) -> bool:
+        return self.workers <= 0
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='render')
+        return self._executor
+
+    def _get_slots(self) -> asyncio.Semaphore:
+        # A semaphore belongs to one event loop; tests run each case in a fresh loop.
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._slots_loop is not loop:
+            self._slots = asyncio.Semaphore(self.max_pending)
+            self._slots_loop = loop
+        return self._slots
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Runs a render callable in the pool and returns its result."""
+        metrics.increment('render_jobs')
+        if self.inline:
+            return func(*args, **kwargs)
+
+        slots = self._get_slots()
+        if slots.locked():
+            metrics.increment('render_backpressure_waits')
+        async with slots:
+            loop = asyncio.get_running_loop()
+            ctx = contextvars.copy_context()
+            call = functools.partial(ctx.run, func, *args, **kwargs)
+            return await loop.run_in_executor(self._get_executor(), call)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stops the render threads. Called on application shutdown."""
+        if self._executor is not None:
+            logger.info("Shutting down render pool...")
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+render_pool = RenderPool()
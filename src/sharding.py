@@ -0,0 +1,167 @@
+"""
+Sharded webhook: the updates of a chat always go to the same worker process.
+
+Several gunicorn workers each receive arbitrary updates, but part of the bot's
+state lives in the process: wizard state in ``user_data``, the poll modules
+cached on the bot, render and heatmap caches, the activity buffer. With
+``WEBHOOK_MODE=sharded`` the web server runs as one process (the front) that
+only checks the payload, drops redeliveries and routes the raw update to one of
+``SHARD_WORKERS`` worker processes; each worker runs the PTB application with
+its own keyed update processor. A chat is always routed to the same worker, so
+its state and caches stay in one process and its updates stay in order.
+
+``shard_of`` hashes the ordering key of src/update_processor.py (chat, else
+poll, else user) with crc32: ``hash()`` of a str differs between processes.
+A private chat has the id of its user, so a user's dashboard wizard stays in
+one worker as well; a button pressed in a group goes to the group's worker.
+
+Transport: one bounded ``multiprocessing`` queue per worker (spawn context).
+``ShardRouter.route`` puts the payload without waiting and refuses it when the
+worker's inbox is full, so the endpoint can answer 503 as in the queue mode.
+A worker that died is started again on the next update routed to it, with a
+new inbox: the old one may still be locked by the dead reader.
+
+Workers stop when they take ``None`` from their inbox, or by themselves once
+the front process is gone. Counters of the workers stay in the workers; /metrics
+of the front shows the routing: ``shard_updates_routed``,
+``shard_updates_rejected``, ``shard_worker_restarts``.
+"""
+import asyncio
+import multiprocessing
+import os
+import queue
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, List, Optional
+
+from telegram import Update
+
+from . import metrics
+from .config import logger, SHARD_WORKERS, SHARD_QUEUE_SIZE, WEBHOOK_DRAIN_TIMEOUT
+from .update_processor import update_key
+
+# A worker checks every this many seconds whether the front process is still there.
+PARENT_CHECK_INTERVAL = 1.0
+
+
+def shard_of(update: Update, shards: int) -> int:
+    """Index of the worker for an update: the same for every update of a chat, in every process."""
+    key = update_key(update)
+    if key is None:
+        key = update.update_id
+    return zlib.crc32(repr(key).encode()) % shards
+
+
+class ShardRouter:
+    """Starts the worker processes and hands each update over to the worker of its chat."""
+
+    def __init__(self, target: Callable[[int, Any], None], workers: int = SHARD_WORKERS,
+                 queue_size: int = SHARD_QUEUE_SIZE, context: Optional[str] = 'spawn'):
+        # target(index, inbox) runs in the worker process; with "spawn" it must be importable by name.
+        self._target = target
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self._context = multiprocessing.get_context(context)
+        self._inboxes: List[Any] = []
+        self._processes: List[Any] = []
+
+    @property
+    def running(self) -> bool:
+        return bool(self._processes)
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._inboxes = [None] * self.workers
+        self._processes = [None] * self.workers
+        for index in range(self.workers):
+            self._spawn(index)
+        logger.info(f"Started {self.workers} shard workers")
+
+    def _spawn(self, index: int) -> None:
+        inbox = self._context.Queue(self.queue_size)
+        process = self._context.Process(target=self._target, args=(index, inbox), name=f'shard-{index}')
+        process.start()
+        self._inboxes[index], self._processes[index] = inbox, process
+
+    def route(self, update: Update, payload: dict) -> bool:
+        """Puts the raw update into the inbox of its worker; False if that inbox is full or the router is stopped."""
+        if not self.running:
+            metrics.increment('shard_updates_rejected')
+            return False
+        index = shard_of(update, self.workers)
+        if not self._processes[index].is_alive():
+            logger.error(f"Shard worker {index} exited with code {self._processes[index].exitcode}, starting it again")
+            self._inboxes[index].close()
+            self._inboxes[index].cancel_join_thread()
+            self._spawn(index)
+            metrics.increment('shard_worker_restarts')
+        try:
+            self._inboxes[index].put_nowait(payload)
+        except queue.Full:
+            metrics.increment('shard_updates_rejected')
+            return False
+        metrics.increment('shard_updates_routed')
+        return True
+
+    def depth(self) -> int:
+        """Updates waiting in the inboxes (0 where the platform cannot tell)."""
+        total = 0
+        for inbox in self._inboxes:
+            try:
+                total += inbox.qsize()
+            except NotImplementedError:  # macOS
+                pass
+        return total
+
+    def alive(self) -> int:
+        """Number of worker processes running."""
+        return sum(process.is_alive() for process in self._processes)
+
+    async def stop(self, drain_timeout: float = WEBHOOK_DRAIN_TIMEOUT) -> None:
+        """Lets the workers finish what they were given for up to drain_timeout seconds, then terminates them."""
+        if not self.running:
+            return
+        processes, inboxes = self._processes, self._inboxes
+        self._processes, self._inboxes = [], []
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + drain_timeout
+        for inbox in inboxes:
+            try:
+                inbox.put_nowait(None)
+            except queue.Full:
+                pass  # terminated below if it does not get through its inbox in time
+        for index, process in enumerate(processes):
+            await asyncio.to_thread(process.join, max(0.0, deadline - loop.time()))
+            if process.is_alive():
+                logger.warning(f"Shard worker {index} did not finish in {drain_timeout:g}s, terminating it")
+                process.terminate()
+                await asyncio.to_thread(process.join)
+        for inbox in inboxes:
+            inbox.close()
+            inbox.cancel_join_thread()
+
+
+async def consume(inbox, handle: Callable[[dict], Awaitable[None]]) -> None:
+    """
+    Worker side: awaits handle(payload) for every update taken from the inbox, in order,
+    until it takes None or the front process is gone.
+    """
+    loop = asyncio.get_running_loop()
+    parent = os.getppid()
+    # The blocking get runs in a thread of its own, not in the DB executor.
+    with ThreadPoolExecutor(1, thread_name_prefix='shard-inbox') as reader:
+        while True:
+            try:
+                payload = await loop.run_in_executor(reader, inbox.get, True, PARENT_CHECK_INTERVAL)
+            except queue.Empty:
+                if os.getppid() != parent:
+                    logger.warning("Shard worker: the front process is gone, stopping")
+                    return
+                continue
+            if payload is None:
+                return
+            try:
+                await handle(payload)
+            except Exception as e:
+                logger.error(f"Shard worker: update {payload.get('update_id')} failed: {e}", exc_info=True)
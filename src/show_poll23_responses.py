@@ -6,5 +6,5 @@ if __name__ == '__main__':
     print(f'poll.options: {poll.options if poll else None}')
     print('responses:')
     for r in session.query(db.Response).filter_by(poll_id=23).all():
-        print(f'user_id={r.user_id} | response={repr(r.response)}')
+        print(f'user_id={r.user_id} | option_index={r.option_index} | response={repr(r.response)}')
     session.close() 
\ No newline at end of file
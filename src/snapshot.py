@@ -0,0 +1,210 @@
+"""
+Immutable read model of a poll for the renderers.
+
+``generate_poll_content``, ``generate_nudge_text`` and
+``generate_results_heatmap_image`` used to fetch the poll, its settings, every
+option and every voter name one query at a time. ``load_poll_snapshot``
+reads everything they need in a fixed number of queries (independent of the
+number of options and voters) and packs it into plain named tuples that are
+safe to pass between threads and sessions. A poll that shows only vote counts
+is rendered from the maintained tallies (``allow_counts_only``).
+"""
+from types import MappingProxyType
+from typing import FrozenSet, Iterable, Mapping, NamedTuple, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from . import database as db
+
+
+class SettingsView(NamedTuple):
+    """Poll-wide settings. Values are stored as-is, None means "not set"."""
+    allow_multiple_answers: Optional[bool]
+    show_results_after_vote: Optional[bool]
+    default_show_names: Optional[bool]
+    default_show_count: Optional[bool]
+    show_heatmap: Optional[bool]
+    show_text_results: Optional[bool]
+    default_names_style: Optional[str]
+    target_sum: Optional[float]
+    nudge_negative_emoji: Optional[str]
+
+
+class OptionSettingsView(NamedTuple):
+    option_index: int
+    show_names: Optional[int]
+    names_style: Optional[str]
+    is_priority: Optional[int]
+    contribution_amount: Optional[float]
+    emoji: Optional[str]
+    show_count: Optional[int]
+    show_contribution: Optional[int]
+
+
+class ParticipantView(NamedTuple):
+    user_id: int
+    username: Optional[str]
+    excluded: int
+
+
+class UserView(NamedTuple):
+    user_id: int
+    name: str
+    username: Optional[str]
+
+
+class VoteView(NamedTuple):
+    user_id: int
+    option_index: Optional[int]     # None for free-text answers
+    response: str                   # option text, or the free text
+
+
+class PollSnapshot(NamedTuple):
+    poll_id: int
+    chat_id: int
+    message: Optional[str]
+    status: Optional[str]
+    poll_type: Optional[str]
+    message_id: Optional[int]
+    nudge_message_id: Optional[int]
+    version: Optional[int]
+    options: Tuple[str, ...]
+    settings: Optional[SettingsView]
+    option_settings: Mapping[int, OptionSettingsView]
+    responses: Tuple[VoteView, ...]
+    participants: Tuple[ParticipantView, ...]
+    exclusions: FrozenSet[int]
+    users: Mapping[int, UserView]
+    # Counts-only snapshots (see load_poll_snapshot): votes by (option_index, free text) from
+    # poll_option_tallies and polls.voter_count; ``responses`` is empty then.
+    tallies: Optional[Mapping[Tuple[int, str], int]] = None
+    voter_count: Optional[int] = None
+
+    def option_setting(self, option_index: int) -> Optional[OptionSettingsView]:
+        return self.option_settings.get(option_index)
+
+    def user_name(self, user_id: int, markdown_link: bool = False) -> str:
+        """Same output as ``database.get_user_name`` but without touching the DB."""
+        user = self.users.get(user_id)
+        name = user.name if user else f"User {user_id}"
+        return db.user_link(name, user_id) if markdown_link else name
+
+
+def _vote_view(response, options: Tuple[str, ...]) -> Optional[VoteView]:
+    """Resolves a stored response to (option_index, option text); None for votes for removed options."""
+    option_index = getattr(response, 'option_index', None)
+    if option_index is not None and 0 <= option_index < len(options):
+        return VoteView(response.user_id, option_index, options[option_index])
+    if option_index is not None and option_index != db.FREE_TEXT_OPTION:
+        return None
+    # Free text; rows written before option indices were stored may still carry an option's text.
+    text = (response.response or '').strip()
+    return VoteView(response.user_id, options.index(text) if text in options else None, text)
+
+
+def _option_settings_view(option) -> OptionSettingsView:
+    view = OptionSettingsView(*(getattr(option, field) for field in OptionSettingsView._fields))
+    # Column defaults are applied on INSERT only; options that were never flushed have None here.
+    return view._replace(is_priority=view.is_priority or 0, contribution_amount=view.contribution_amount or 0)
+
+
+def build_snapshot(poll, setting=None, options: Optional[Iterable] = None, responses: Iterable = (),
+                   participants: Iterable = (), exclusions: Iterable[int] = (), users: Iterable = (),
+                   tallies: Optional[Tuple[int, Mapping[Tuple[int, str], int]]] = None) -> PollSnapshot:
+    """
+    Packs already loaded rows into a PollSnapshot.
+    ``options`` are PollOption rows (``poll.option_rows`` by default).
+    ``users`` may contain User or Participant rows; the first row seen for a user_id wins.
+    ``tallies`` is the (voters, votes) pair of ``database.get_poll_tallies`` for counts-only snapshots.
+    """
+    options = sorted(poll.option_rows if options is None else options, key=lambda o: o.option_index)
+    option_texts = tuple(o.text for o in options)
+
+    user_views = {}
+    for u in users:
+        if u.user_id not in user_views:
+            user_views[u.user_id] = UserView(
+                user_id=u.user_id,
+                name=db.compose_user_name(u.user_id, u.first_name, u.last_name, u.username),
+                username=u.username,
+            )
+
+    settings_view = None
+    if setting is not None:
+        settings_view = SettingsView(*(getattr(setting, field) for field in SettingsView._fields))
+
+    return PollSnapshot(
+        poll_id=poll.poll_id,
+        chat_id=poll.chat_id,
+        message=poll.message,
+        status=poll.status,
+        poll_type=poll.poll_type,
+        message_id=poll.message_id,
+        nudge_message_id=poll.nudge_message_id,
+        version=poll.version,
+        options=option_texts,
+        settings=settings_view,
+        option_settings=MappingProxyType({o.option_index: _option_settings_view(o) for o in options}),
+        responses=tuple(v for v in (_vote_view(r, option_texts) for r in responses) if v is not None),
+        participants=tuple(ParticipantView(p.user_id, p.username, p.excluded) for p in participants),
+        exclusions=frozenset(exclusions),
+        users=MappingProxyType(user_views),
+        tallies=MappingProxyType(dict(tallies[1])) if tallies is not None else None,
+        voter_count=tallies[0] if tallies is not None else None,
+    )
+
+
+def shows_voters(poll, setting) -> bool:
+    """
+    True if the poll is drawn from its individual votes: the heatmap, or voter names under
+    at least one option (same defaults as display.render_poll_content). Otherwise the
+    caption needs the vote counts only.
+    """
+    if setting is None or setting.show_heatmap:
+        return True
+    default_show_names = setting.default_show_names if setting.default_show_names is not None else 1
+    if poll.poll_type == 'webapp':
+        return bool(default_show_names)
+    return any(o.show_names if o.show_names is not None else default_show_names for o in poll.option_rows)
+
+
+def load_poll_snapshot(poll_id: int = None, session: Optional[Session] = None, poll: Optional[db.Poll] = None,
+                       allow_counts_only: bool = False) -> Optional[PollSnapshot]:
+    """
+    Loads a poll and everything needed to render it. Returns None if the poll does not exist.
+    The options come with the poll (Poll.option_rows is loaded eagerly).
+    Issues at most 8 queries regardless of the number of options, voters or participants
+    (up to 500 users per IN query, see database.IN_CLAUSE_CHUNK).
+    With ``allow_counts_only`` a poll that shows neither names nor the heatmap (see
+    shows_voters) gets a counts-only snapshot: the maintained tallies instead of the
+    responses, participants and users, in O(options).
+    """
+    manage_session = session is None
+    if manage_session:
+        session = db.SessionLocal()
+
+    try:
+        if poll is None:
+            poll = session.query(db.Poll).filter_by(poll_id=poll_id).first()
+            if not poll:
+                return None
+        poll_id = poll.poll_id
+
+        setting = session.query(db.PollSetting).filter_by(poll_id=poll_id).first()
+        if allow_counts_only and not shows_voters(poll, setting):
+            return build_snapshot(poll, setting, poll.option_rows, tallies=db.get_poll_tallies(poll_id, session=session))
+
+        responses = (
+            session.query(db.Response.user_id, db.Response.option_index, db.Response.response)
+            .filter_by(poll_id=poll_id).all()
+        )
+        participants = session.query(db.Participant).filter_by(chat_id=poll.chat_id).all()
+        exclusions = [uid for (uid,) in session.query(db.PollExclusion.user_id).filter_by(poll_id=poll_id)]
+
+        user_ids = {p.user_id for p in participants} | {r.user_id for r in responses}
+        users = db.get_users_by_ids(session, user_ids)
+
+        return build_snapshot(poll, setting, poll.option_rows, responses, participants, exclusions, users.values())
+    finally:
+        if manage_session:
+            session.close()
@@ -0,0 +1,119 @@
+"""
+Request-scoped unit of work.
+
+Every Telegram update gets one ``UnitOfWork``: a pre-handler opens it and
+attaches it to the PTB context, and every ``database`` helper called while the
+update is being handled uses its session instead of opening one of its own;
+handler code gets it from ``database.open_session``. A handler that calls five
+helpers therefore checks out one connection, objects stay attached (no
+detached copies, no ``merge``), and objects already loaded come from the
+session's identity map without another SELECT.
+
+Writing helpers commit as soon as they are done (``database._save``): handlers
+go on to talk to Telegram, and no write lock (SQLite) or open transaction
+(Postgres) may be held across those round-trips. A failing helper rolls back
+only its own savepoint, not the writes made before it. Whatever handler code
+changed itself is committed with ``database.commit_session`` (or by the handler's
+own ``session.commit()``), and the rest once the update has been handled. The
+session does not expire objects on commit, so the objects of an update stay
+loaded; helpers that write with Core statements expire the attributes they touch.
+
+The unit of work belongs to the asyncio task that opened it. Tasks spawned
+while handling the update (background answers, debounced message refreshes)
+inherit the context variable but not the unit of work: they keep opening
+their own sessions, so a session is never used by two tasks at once.
+"""
+import asyncio
+import contextvars
+from typing import Optional
+
+from sqlalchemy.orm import Session
+
+_current: contextvars.ContextVar[Optional["UnitOfWork"]] = contextvars.ContextVar('unit_of_work', default=None)
+
+
+def _running_task() -> Optional[asyncio.Task]:
+    try:
+        return asyncio.current_task()
+    except RuntimeError:
+        # No event loop in this thread: a DB executor thread, see async_database.run_sync.
+        return None
+
+
+class UnitOfWork:
+    """One session shared by everything that handles one update; what is left uncommitted is committed at the end."""
+
+    def __init__(self, task: Optional[asyncio.Task] = None):
+        self.task = task
+        self.closed = False
+        self._session: Optional[Session] = None
+
+    @property
+    def session(self) -> Session:
+        """The shared session, opened on first use."""
+        if self.closed:
+            raise RuntimeError("Unit of work is already closed")
+        if self._session is None:
+            from . import database as db
+            self._session = db.SessionLocal(expire_on_commit=False)
+            self._session.info['unit_of_work'] = True
+        return self._session
+
+    @property
+    def has_session(self) -> bool:
+        return self._session is not None
+
+    def commit(self) -> None:
+        if self._session is not None:
+            from . import database as db
+            db.safe_commit(self._session)
+
+    def rollback(self) -> None:
+        if self._session is not None:
+            self._session.rollback()
+
+    def close(self) -> None:
+        """Closes the session; changes that were not committed are rolled back."""
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        self.closed = True
+
+
+def begin() -> UnitOfWork:
+    """Opens a unit of work owned by the current task (closing one left over in this context)."""
+    previous = _current.get()
+    if previous is not None and not previous.closed:
+        previous.close()
+    uow = UnitOfWork(task=_running_task())
+    _current.set(uow)
+    return uow
+
+
+def end(uow: Optional[UnitOfWork]) -> None:
+    """Closes ``uow`` and detaches it from the current context."""
+    if uow is not None:
+        uow.close()
+    if _current.get() is uow:
+        _current.set(None)
+
+
+def current() -> Optional[UnitOfWork]:
+    """
+    The unit of work of the update being handled, or None outside of one.
+
+    On the event loop only the task that opened it gets it; in DB executor
+    threads ``bind`` has already decided.
+    """
+    uow = _current.get()
+    if uow is None or uow.closed:
+        return None
+    task = _running_task()
+    if task is not None and task is not uow.task:
+        return None
+    return uow
+
+
+def bind(uow: Optional[UnitOfWork]) -> None:
+    """Makes ``uow`` current in this context; used for the copied context of executor calls."""
+    _current.set(uow)
@@ -0,0 +1,131 @@
+"""
+Suppression of webhook redeliveries.
+
+When an update is not acknowledged in time Telegram delivers it again, and the
+webhook used to process every delivery. For most updates that only costs work,
+but a redelivered vote in a multiple-choice poll toggles the option back off
+(``add_or_update_response_ext``). The webhook endpoints therefore ``claim``
+every update_id before processing it; a claim for an update_id seen within
+``ttl`` seconds fails, and the endpoint acknowledges the delivery without
+processing it. If the update could not be handed over (update queue or shard
+inbox full, answered with 503) the endpoint ``release``s it, so the next
+delivery is processed. A claim is not released when a handler fails: handler
+errors go to the error handler, the delivery is acknowledged all the same and
+Telegram does not send it again.
+
+* ``UpdateDeduplicator`` remembers the update_ids of this process: at most
+  ``max_entries``, the oldest are dropped first (LRU + TTL).
+* ``DatabaseUpdateDeduplicator`` claims them in the ``processed_updates`` table
+  as well, so several worker processes (gunicorn) share them; repeats of
+  updates this process claimed itself are still answered from memory.
+
+Counters: ``update_dedup_hits`` (duplicates dropped), ``update_dedup_misses``.
+"""
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from . import async_database as adb
+from . import database as db
+from . import metrics
+from .config import logger, UPDATE_DEDUP, UPDATE_DEDUP_TTL, UPDATE_DEDUP_MAX_ENTRIES
+
+# The database variant prunes expired claims every this many claims.
+PRUNE_EVERY = 1000
+
+
+class UpdateDeduplicator:
+    """update_ids claimed by this process within ``ttl`` seconds, at most ``max_entries`` of them."""
+
+    def __init__(self, ttl: float = UPDATE_DEDUP_TTL, max_entries: int = UPDATE_DEDUP_MAX_ENTRIES,
+                 clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._seen: "OrderedDict[int, float]" = OrderedDict()  # update_id -> expiry
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def _seen_recently(self, update_id: int) -> bool:
+        expires = self._seen.get(update_id)
+        if expires is None:
+            return False
+        if expires <= self._clock():
+            del self._seen[update_id]
+            return False
+        return True
+
+    def _remember(self, update_id: int) -> None:
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        now = self._clock()
+        self._seen[update_id] = now + self.ttl
+        self._seen.move_to_end(update_id)
+        # Expired entries sit at the front (same ttl for all): drop them, then the oldest over the limit.
+        while self._seen and (len(self._seen) > self.max_entries or next(iter(self._seen.values())) <= now):
+            self._seen.popitem(last=False)
+
+    async def claim(self, update_id: int) -> bool:
+        """True if the update should be processed, False for a redelivery of one already taken."""
+        if self._seen_recently(update_id):
+            metrics.increment('update_dedup_hits')
+            return False
+        self._remember(update_id)
+        metrics.increment('update_dedup_misses')
+        return True
+
+    async def release(self, update_id: int) -> None:
+        """Forgets a claimed update that was not processed."""
+        self._seen.pop(update_id, None)
+
+
+class DatabaseUpdateDeduplicator(UpdateDeduplicator):
+    """Claims update_ids in the processed_updates table, shared by all processes of the bot."""
+
+    def __init__(self, *args, wall_clock: Callable[[], float] = time.time, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wall_clock = wall_clock
+        self._claims = 0
+
+    async def claim(self, update_id: int) -> bool:
+        if self._seen_recently(update_id):
+            metrics.increment('update_dedup_hits')
+            return False
+        try:
+            claimed = await adb.run_sync(db.claim_update, update_id, self._wall_clock())
+        except Exception as e:
+            # Better a rare double vote than dropping updates while the database is unavailable.
+            logger.error(f"Update dedup: claiming update {update_id} failed, processing it anyway: {e}")
+            claimed = True
+        if claimed:
+            # Only own claims: an update claimed by another process may still be released there.
+            self._remember(update_id)
+        metrics.increment('update_dedup_misses' if claimed else 'update_dedup_hits')
+        self._claims += 1
+        if self._claims % PRUNE_EVERY == 0:
+            await self._prune()
+        return claimed
+
+    async def release(self, update_id: int) -> None:
+        await super().release(update_id)
+        try:
+            await adb.run_sync(db.release_update, update_id)
+        except Exception as e:
+            logger.error(f"Update dedup: releasing update {update_id} failed: {e}")
+
+    async def _prune(self) -> None:
+        try:
+            await adb.run_sync(db.prune_processed_updates, self._wall_clock() - self.ttl)
+        except Exception as e:
+            logger.error(f"Update dedup: pruning processed_updates failed: {e}")
+
+
+def make_deduplicator(mode: Optional[str] = None) -> UpdateDeduplicator:
+    """The deduplicator configured by UPDATE_DEDUP; "off" gives one that never finds a duplicate."""
+    mode = mode or UPDATE_DEDUP
+    if mode == 'database':
+        return DatabaseUpdateDeduplicator()
+    if mode == 'off':
+        return UpdateDeduplicator(max_entries=0)
+    return UpdateDeduplicator()
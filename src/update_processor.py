@@ -0,0 +1,194 @@
+"""
+Keyed update processor: parallel across chats, strictly ordered within a chat.
+
+Without ``concurrent_updates`` PTB handles one update at a time, so a group in
+the middle of a vote storm (DB writes, answers, photo edits) stalls every other
+chat. ``KeyedUpdateProcessor`` gives every update a key (``update_key``: the
+chat, else the native poll, else the user) and keeps one FIFO queue per key:
+
+* updates with the same key run one after another, in the order they were
+  submitted, so votes, commands and text input of a chat never overtake each
+  other;
+* queues of different keys are drained in parallel, at most
+  ``max_concurrent_updates`` updates run at the same time. An update waiting
+  behind its own chat does not hold one of these slots, so a busy chat takes at
+  most one of them;
+* at most ``max_pending`` updates are accepted and not yet finished; ``submit``
+  waits for a free place beyond that, first come first served, so the order of
+  submission is kept even under backpressure.
+
+It is passed to ``Application.builder().concurrent_updates(...)`` (polling
+goes through it) and the webhook endpoints hand their updates to it too.
+"""
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional, Set, Tuple
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from . import metrics
+from .config import logger, UPDATE_CONCURRENCY, UPDATE_MAX_PENDING
+
+
+def update_key(update: object) -> Optional[Hashable]:
+    """Ordering key of an update; updates without a chat, poll or user (None) are not ordered."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return ('chat', update.effective_chat.id)
+    if update.poll_answer is not None:
+        return ('poll', update.poll_answer.poll_id)
+    if update.poll is not None:
+        return ('poll', update.poll.id)
+    if update.effective_user is not None:
+        return ('user', update.effective_user.id)
+    return None
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """PTB update processor with one FIFO queue per chat and a global limit of running updates."""
+
+    def __init__(self, max_concurrent_updates: int = UPDATE_CONCURRENCY, max_pending: int = UPDATE_MAX_PENDING,
+                 key: Callable[[object], Optional[Hashable]] = update_key):
+        # PTB's own semaphore bounds the updates it hands over (and must be > 1 for polling to hand
+        # them over concurrently); the running ones are bounded by self._active.
+        super().__init__(max(2, max_pending))
+        self.concurrency = max(1, max_concurrent_updates)
+        self.max_pending = max(2, max_pending)
+        self._key = key
+        self._queues: Dict[Hashable, Deque[Tuple[Awaitable[Any], asyncio.Future, float]]] = {}
+        self._drainers: Set[asyncio.Task] = set()
+        self._active: Optional[asyncio.Semaphore] = None
+        self._admission: Deque[asyncio.Future] = deque()
+        self._loop = None
+        self._running = 0
+        self._accepted = 0
+
+    def running(self) -> int:
+        """Updates being processed right now."""
+        return self._running
+
+    def pending(self) -> int:
+        """Updates accepted and not finished yet (running or waiting)."""
+        return self._accepted
+
+    def busy_keys(self) -> int:
+        """Chats (keys) with updates running or waiting."""
+        return len(self._queues)
+
+    def _bind_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._active = asyncio.Semaphore(self.concurrency)
+            self._admission.clear()
+            self._queues.clear()
+            self._drainers.clear()
+            self._accepted = 0
+
+    async def initialize(self) -> None:
+        self._bind_loop()
+
+    async def shutdown(self) -> None:
+        """Waits for the accepted updates to finish."""
+        if self._drainers:
+            logger.info(f"Update processor: waiting for {self._accepted} updates in {len(self._queues)} chats...")
+            await asyncio.gather(*list(self._drainers), return_exceptions=True)
+
+    async def submit(self, update: object, coroutine: Awaitable[Any]) -> asyncio.Future:
+        """
+        Queues ``coroutine`` (processing ``update``) behind the earlier updates of its key.
+        Returns once the update is accepted, with a future that is done when it has been processed.
+        """
+        self._bind_loop()
+        await self._admit()
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        key = self._key(update)
+        if key is None:
+            key = object()  # a queue of its own
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            queue.append((coroutine, done, loop.time()))
+            task = asyncio.create_task(self._drain(key, queue))
+            self._drainers.add(task)
+            task.add_done_callback(self._drainers.discard)
+        else:
+            queue.append((coroutine, done, loop.time()))
+            metrics.increment('updates_queued_behind_chat')
+        return done
+
+    async def _admit(self) -> None:
+        # asyncio.Semaphore lets a newcomer take a released place before earlier waiters on
+        # some Python versions, which would reorder the updates of a chat; this queue does not.
+        if self._accepted < self.max_pending and not self._admission:
+            self._accepted += 1
+            return
+        metrics.increment('update_admission_waits')
+        waiter = asyncio.get_running_loop().create_future()
+        self._admission.append(waiter)
+        try:
+            await waiter  # _release hands its place over
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            elif waiter in self._admission:
+                self._admission.remove(waiter)
+            raise
+
+    def _release(self) -> None:
+        while self._admission:
+            waiter = self._admission.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._accepted -= 1
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        """Called by PTB (polling) with its semaphore held: returns when the update has been processed."""
+        done = await self.submit(update, coroutine)
+        try:
+            await done
+        except Exception:
+            pass  # already logged by _drain; PTB's process_update reports handler errors itself
+
+    async def _drain(self, key: Hashable, queue: Deque) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while queue:
+                coroutine, done, accepted_at = queue[0]
+                try:
+                    async with self._active:
+                        metrics.increment('update_wait_us', int((loop.time() - accepted_at) * 1_000_000))
+                        self._running += 1
+                        try:
+                            await coroutine
+                        finally:
+                            self._running -= 1
+                    metrics.increment('updates_processed')
+                    if not done.done():
+                        done.set_result(None)
+                except asyncio.CancelledError:
+                    done.cancel()
+                    raise
+                except Exception as e:
+                    metrics.increment('update_failures')
+                    logger.error(f"Update processor: processing an update of {key} failed: {e}", exc_info=True)
+                    if not done.done():
+                        done.set_exception(e)
+                        done.exception()  # retrieved: nobody has to await it
+                finally:
+                    queue.popleft()
+                    self._release()
+        finally:
+            if self._queues.get(key) is queue:
+                del self._queues[key]
+            for coroutine, done, _ in queue:
+                # Cancelled while updates were still waiting: they will not run.
+                if hasattr(coroutine, 'close'):
+                    coroutine.close()
+                done.cancel()
+                self._release()
+            queue.clear()
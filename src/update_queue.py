@@ -0,0 +1,115 @@
+"""
+Fast-ack webhook: a bounded in-process queue of Telegram updates.
+
+In the default (inline) mode the webhook endpoint awaits
+``application.process_update`` before answering, so Telegram's delivery waits
+for our database work and photo uploads, and a slow handler makes Telegram
+deliver the update again. With ``WEBHOOK_MODE=queue`` the endpoint only checks
+the payload (``parse_update``), puts the update into ``UpdateQueue`` and answers
+at once; ``workers`` tasks take updates from the queue and process them.
+
+The queue holds at most ``max_size`` updates. When it is full ``enqueue``
+refuses the update and the endpoint answers 503, so Telegram keeps it and
+delivers it again later instead of the bot buffering without bound.
+
+Updates are taken in arrival order. In bot.py the workers only hand them over
+to the keyed update processor (src/update_processor.py), which runs different
+chats in parallel and keeps the order within a chat.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, List, Optional
+
+from telegram import Update
+
+from . import metrics
+from .config import logger, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_DRAIN_TIMEOUT
+
+
+def parse_update(payload: Any, bot) -> Optional[Update]:
+    """The Update of a webhook payload, or None if the payload is not a Telegram update."""
+    if not isinstance(payload, dict) or not isinstance(payload.get('update_id'), int):
+        return None
+    try:
+        return Update.de_json(data=payload, bot=bot)
+    except Exception as e:
+        logger.warning(f"Malformed update {payload.get('update_id')}: {e}")
+        return None
+
+
+class UpdateQueue:
+    """Bounded queue of updates drained by a fixed number of worker tasks."""
+
+    def __init__(self, process: Callable[[Update], Awaitable[None]], workers: int = WEBHOOK_WORKERS,
+                 max_size: int = WEBHOOK_QUEUE_SIZE):
+        self._process = process
+        self.workers = max(1, workers)
+        self.max_size = max(1, max_size)
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._busy = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def depth(self) -> int:
+        """Number of updates waiting for a worker."""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def busy(self) -> int:
+        """Number of workers processing an update right now."""
+        return self._busy
+
+    def start(self) -> None:
+        """Starts the workers (on the running event loop)."""
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._tasks = [asyncio.create_task(self._work(), name=f'update-worker-{n}') for n in range(self.workers)]
+        logger.info(f"Update queue started: {self.workers} workers, up to {self.max_size} queued updates")
+
+    def enqueue(self, update: Update) -> bool:
+        """Queues the update. Returns False if the queue is full (or not running)."""
+        if not self.running:
+            return False
+        try:
+            self._queue.put_nowait((asyncio.get_running_loop().time(), update))
+        except asyncio.QueueFull:
+            metrics.increment('webhook_updates_rejected')
+            return False
+        metrics.increment('webhook_updates_enqueued')
+        return True
+
+    async def _work(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            queued_at, update = await self._queue.get()
+            self._busy += 1
+            try:
+                metrics.increment('webhook_queue_wait_us', int((loop.time() - queued_at) * 1_000_000))
+                await self._process(update)
+                metrics.increment('webhook_updates_processed')
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # process_update hands handler errors to the error handler; this is a failure around it.
+                metrics.increment('webhook_update_failures')
+                logger.error(f"Processing update {update.update_id} failed: {e}", exc_info=True)
+            finally:
+                self._busy -= 1
+                self._queue.task_done()
+
+    async def stop(self, drain_timeout: float = WEBHOOK_DRAIN_TIMEOUT) -> None:
+        """Waits up to ``drain_timeout`` seconds for the queued updates, then stops the workers."""
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            # Telegram got 200 for these: they are lost.
+            logger.warning(f"Update queue: {self.depth()} queued updates dropped on shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
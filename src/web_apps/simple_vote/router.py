@@ -20,7 +20,7 @@ async def view_page(request: Request):
     if not poll:
         return templates.TemplateResponse("error.html", {"request": request, "error_message": "Poll not found."})
     
-    options = [opt.strip() for opt in poll.options.split(',')]
+    options = poll.options
     
     context = {
         "request": request,
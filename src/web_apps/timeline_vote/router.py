@@ -27,7 +27,11 @@ async def get_poll_data(request: Request):
     try:
         response_obj = get_response(poll_id, user_id)
         if response_obj:
-            user_response = response_obj.response
+            options = poll.options
+            if 0 <= response_obj.option_index < len(options):
+                user_response = options[response_obj.option_index]
+            else:
+                user_response = response_obj.response
     finally:
         session.close()
 
@@ -0,0 +1,168 @@
+import asyncio
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from src import database as db
+from src.activity_buffer import ActivityBuffer
+from src.database import Base, ChatActivity, KnownChat, Participant, ParticipantActivity, Poll, User
+
+
+class FakeWriter:
+    """Records written batches; fails the first ``failures`` writes."""
+
+    def __init__(self, failures=0):
+        self.batches = []
+        self.failures = failures
+
+    async def __call__(self, chats, participants):
+        await asyncio.sleep(0)
+        if self.failures:
+            self.failures -= 1
+            return False
+        self.batches.append((chats, participants))
+        return True
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+# --- Buffer ---
+
+@pytest.mark.asyncio
+async def test_burst_is_written_as_one_batch_with_latest_values():
+    writer = FakeWriter()
+    buffer = ActivityBuffer(writer, interval=0.05)
+
+    for n in range(20):
+        await buffer.note_chat(-1001, "Чат" if n < 19 else "Новое название", "supergroup")
+        await buffer.note_participant(-1001, 10 + n % 2, None, f"Имя{n % 2}", "")
+    assert writer.batches == []
+    await asyncio.sleep(0.1)
+
+    assert len(writer.batches) == 1
+    chats, participants = writer.batches[0]
+    assert chats == [ChatActivity(-1001, "Новое название", "supergroup")]
+    assert sorted(p.user_id for p in participants) == [10, 11]
+    assert buffer.pending() == 0
+
+@pytest.mark.asyncio
+async def test_seen_entries_are_not_written_again_until_they_change_or_expire():
+    writer, clock = FakeWriter(), FakeClock()
+    buffer = ActivityBuffer(writer, interval=0, seen_ttl=60, clock=clock)
+
+    await buffer.note_participant(-1001, 10, "ann", "Ann", "")
+    await buffer.note_participant(-1001, 10, "ann", "Ann", "")
+    await buffer.note_chat(-1001, "Чат", "group")
+    await buffer.note_chat(-1001, "Чат", "group")
+    assert len(writer.batches) == 2
+
+    await buffer.note_participant(-1001, 10, "ann", "Anna", "")   # renamed
+    assert len(writer.batches) == 3
+    clock.now = 61
+    await buffer.note_chat(-1001, "Чат", "group")                  # expired
+    assert len(writer.batches) == 4
+
+@pytest.mark.asyncio
+async def test_forget_chat_registers_members_again():
+    writer = FakeWriter()
+    buffer = ActivityBuffer(writer, interval=0)
+
+    await buffer.note_participant(-1001, 10, None, "Ann", "")
+    await buffer.note_participant(-1002, 10, None, "Ann", "")
+    buffer.forget_chat(-1001)
+    await buffer.note_participant(-1001, 10, None, "Ann", "")
+    await buffer.note_participant(-1002, 10, None, "Ann", "")
+
+    assert [p[0].chat_id for _, p in writer.batches] == [-1001, -1002, -1001]
+
+@pytest.mark.asyncio
+async def test_failed_write_keeps_entries_for_the_next_flush():
+    writer = FakeWriter(failures=1)
+    buffer = ActivityBuffer(writer, interval=60)
+
+    await buffer.note_chat(-1001, "Чат", "group")
+    assert await buffer.flush() is False
+    assert buffer.pending() == 1
+    await buffer.note_chat(-1001, "Новый чат", "group")   # newer value wins over the failed one
+    assert await buffer.flush() is True
+
+    assert writer.batches == [([ChatActivity(-1001, "Новый чат", "group")], [])]
+    await buffer.shutdown()
+
+@pytest.mark.asyncio
+async def test_full_buffer_is_flushed_before_the_interval():
+    writer = FakeWriter()
+    buffer = ActivityBuffer(writer, interval=60, max_pending=3)
+
+    for user_id in range(3):
+        await buffer.note_participant(-1001, user_id, None, "Имя", "")
+    await asyncio.sleep(0.01)
+
+    assert len(writer.batches) == 1 and len(writer.batches[0][1]) == 3
+    await buffer.shutdown()
+
+@pytest.mark.asyncio
+async def test_shutdown_writes_what_is_buffered():
+    writer = FakeWriter()
+    buffer = ActivityBuffer(writer, interval=60)
+
+    await buffer.note_chat(-1001, "Чат", "group")
+    await buffer.shutdown()
+
+    assert writer.batches == [([ChatActivity(-1001, "Чат", "group")], [])]
+    assert buffer.pending() == 0
+
+# --- Batched write ---
+
+@pytest.fixture
+def engine(monkeypatch, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'activity.db'}")
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+    monkeypatch.setattr(db, "SessionLocal", factory)
+    session = factory()
+    session.add_all([
+        User(user_id=10, first_name="Ann", last_name="Lee", username="ann"),
+        Participant(chat_id=-1001, user_id=10, first_name="Ann", last_name="Lee"),
+        KnownChat(chat_id=-1001, title="Чат", type="group"),
+        Poll(poll_id=1, chat_id=-1002, message="Опрос", options=["A"], status='active'),
+    ])
+    session.commit()
+    session.close()
+    yield engine
+    Base.metadata.drop_all(engine)
+
+def test_record_activity_writes_only_changes(engine):
+    writes = []
+    event.listen(engine, "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: writes.append(statement.split()[0])
+                 if statement.startswith(("INSERT", "UPDATE")) else None)
+
+    assert db.record_activity(
+        [ChatActivity(-1001, "Чат", "group")],
+        [ParticipantActivity(-1001, 10, "ann", "Ann", ""), ParticipantActivity(-1002, 10, "ann", "Ann", "")],
+    )
+    # Only the new participant of -1002, plus the version bump of that chat's poll.
+    assert writes == ["INSERT", "UPDATE"]
+
+    assert db.record_activity(
+        [ChatActivity(-1001, "Переименован", "supergroup"), ChatActivity(-1003, "Новый", "group")],
+        [ParticipantActivity(-1003, 20, None, "Bob", ""), ParticipantActivity(-1002, 20, None, "Bob", "")],
+    )
+    session = db.SessionLocal()
+    try:
+        assert session.get(KnownChat, -1001).title == "Переименован"
+        assert session.get(KnownChat, -1003).type == "group"
+        assert session.get(User, 10).last_name == "Lee"   # empty names do not overwrite stored ones
+        assert session.get(User, 20).first_name == "Bob"
+        assert {(p.chat_id, p.user_id) for p in session.query(Participant)} == {(-1001, 10), (-1002, 10), (-1003, 20), (-1002, 20)}
+        assert session.get(Poll, 1).version > 1
+    finally:
+        session.close()
@@ -4,7 +4,7 @@ from sqlalchemy.orm import sessionmaker
 
 # Import the models and function to be tested
 from src.database import (
-    Base, Poll, Participant, Response, PollSetting, User, add_or_update_response
+    Base, Poll, Participant, Response, PollSetting, User, FREE_TEXT_OPTION, add_or_update_response
 )
 
 # --- Fixtures ---
@@ -43,7 +43,7 @@ def user_2():
 @pytest.fixture
 def single_choice_poll(db_session):
     """Creates a single-choice poll and adds it to the database."""
-    poll = Poll(poll_id=1, chat_id=-1001, options="A,B,C", status='active')
+    poll = Poll(poll_id=1, chat_id=-1001, options=["A", "B", "C"], status='active')
     poll_setting = PollSetting(poll_id=1, allow_multiple_answers=False)
     db_session.add_all([poll, poll_setting])
     db_session.commit()
@@ -52,7 +52,7 @@ def single_choice_poll(db_session):
 @pytest.fixture
 def multiple_choice_poll(db_session):
     """Creates a multiple-choice poll and adds it to the database."""
-    poll = Poll(poll_id=2, chat_id=-1002, options="X,Y,Z", status='active')
+    poll = Poll(poll_id=2, chat_id=-1002, options=["X", "Y", "Z"], status='active')
     poll_setting = PollSetting(poll_id=2, allow_multiple_answers=True)
     db_session.add_all([poll, poll_setting])
     db_session.commit()
@@ -70,12 +70,12 @@ def test_single_choice_first_vote(db_session, single_choice_poll, user_1):
     # Assert
     responses = db_session.query(Response).filter_by(poll_id=poll_id, user_id=user_1['user_id']).all()
     assert len(responses) == 1
-    assert responses[0].response == "A"
+    assert (responses[0].option_index, responses[0].response) == (0, "")
 
 def test_single_choice_change_vote(db_session, single_choice_poll, user_1):
     # Arrange
     poll_id = single_choice_poll.poll_id
-    initial_response = Response(poll_id=poll_id, user_id=user_1['user_id'], response="A")
+    initial_response = Response(poll_id=poll_id, user_id=user_1['user_id'], option_index=0)
     db_session.add(initial_response)
     db_session.commit()
 
@@ -85,7 +85,7 @@ def test_single_choice_change_vote(db_session, single_choice_poll, user_1):
     # Assert
     responses = db_session.query(Response).filter_by(poll_id=poll_id, user_id=user_1['user_id']).all()
     assert len(responses) == 1
-    assert responses[0].response == "B"
+    assert responses[0].option_index == 1
 
 def test_multiple_choice_first_vote(db_session, multiple_choice_poll, user_1):
     # Arrange
@@ -97,12 +97,12 @@ def test_multiple_choice_first_vote(db_session, multiple_choice_poll, user_1):
     # Assert
     responses = db_session.query(Response).filter_by(poll_id=poll_id, user_id=user_1['user_id']).all()
     assert len(responses) == 1
-    assert responses[0].response == "X"
+    assert responses[0].option_index == 0
 
 def test_multiple_choice_second_vote(db_session, multiple_choice_poll, user_1):
     # Arrange
     poll_id = multiple_choice_poll.poll_id
-    initial_response = Response(poll_id=poll_id, user_id=user_1['user_id'], response="X")
+    initial_response = Response(poll_id=poll_id, user_id=user_1['user_id'], option_index=0)
     db_session.add(initial_response)
     db_session.commit()
     
@@ -112,15 +112,14 @@ def test_multiple_choice_second_vote(db_session, multiple_choice_poll, user_1):
     # Assert: User should now have two responses (X and Z)
     responses = db_session.query(Response).filter_by(poll_id=poll_id, user_id=user_1['user_id']).all()
     assert len(responses) == 2
-    response_texts = {r.response for r in responses}
-    assert response_texts == {"X", "Z"}
+    assert {r.option_index for r in responses} == {0, 2}
 
 def test_multiple_choice_unvote(db_session, multiple_choice_poll, user_1):
     # Arrange
     poll_id = multiple_choice_poll.poll_id
     initial_responses = [
-        Response(poll_id=poll_id, user_id=user_1['user_id'], response="X"),
-        Response(poll_id=poll_id, user_id=user_1['user_id'], response="Z")
+        Response(poll_id=poll_id, user_id=user_1['user_id'], option_index=0),
+        Response(poll_id=poll_id, user_id=user_1['user_id'], option_index=2)
     ]
     db_session.add_all(initial_responses)
     db_session.commit()
@@ -131,7 +130,7 @@ def test_multiple_choice_unvote(db_session, multiple_choice_poll, user_1):
     # Assert: User should now only have one response (Z)
     responses = db_session.query(Response).filter_by(poll_id=poll_id, user_id=user_1['user_id']).all()
     assert len(responses) == 1
-    assert responses[0].response == "Z"
+    assert responses[0].option_index == 2
 
 def test_user_data_is_created_and_updated(db_session, single_choice_poll, user_1):
     # Arrange
@@ -154,11 +153,86 @@ def test_user_data_is_created_and_updated(db_session, single_choice_poll, user_1
     user_in_db = db_session.query(User).filter_by(user_id=user_1['user_id']).first()
     assert user_in_db.first_name == "\u0410\u043b\u0438\u0441\u0430-\u043d\u043e\u0432\u043e\u0435-\u0438\u043c\u044f"
 
+def test_option_text_vote_is_stored_by_index(db_session, single_choice_poll, user_1, user_2):
+    """Text matching an option (web app answers) is stored as its index, other text as free text."""
+    add_or_update_response(poll_id=1, option_text=" B ", **user_1)
+    add_or_update_response(poll_id=1, option_text="Другое", **user_2)
+
+    stored = {(r.user_id, r.option_index, r.response) for r in db_session.query(Response)}
+    assert stored == {(101, 1, ""), (102, FREE_TEXT_OPTION, "Другое")}
+
+def test_option_rename_keeps_responses(db_session, single_choice_poll, user_1, user_2):
+    """Renaming an option changes its poll_options row only; the votes follow it."""
+    from src import database as db
+    from src.snapshot import load_poll_snapshot
+    add_or_update_response(poll_id=1, option_index=0, **user_1)
+    add_or_update_response(poll_id=1, option_index=0, **user_2)
+    before = sorted((r.user_id, r.option_index, r.response) for r in db_session.query(Response))
+
+    db.get_poll_option(1, 0, session=db_session).text = "A+"
+    db_session.commit()
+
+    assert sorted((r.user_id, r.option_index, r.response) for r in db_session.query(Response)) == before
+    snapshot = load_poll_snapshot(1, session=db_session)
+    assert {(v.option_index, v.response) for v in snapshot.responses} == {(0, "A+")}
+
+def test_options_keep_commas_and_settings(db_session, user_1):
+    """Options are rows, not a comma-joined string; replacing the texts keeps settings by index."""
+    from src import database as db
+    db_session.add(Poll(poll_id=3, chat_id=-1003, options=["1,5 часа", "2 часа", "3 часа"], status='active'))
+    db_session.commit()
+    db.get_poll_option(3, 1, session=db_session).emoji = "⭐"
+    db_session.commit()
+
+    add_or_update_response(poll_id=3, option_text="1,5 часа", **user_1)
+    assert db_session.query(Response.option_index).filter_by(poll_id=3).scalar() == 0
+
+    db_session.query(Poll).filter_by(poll_id=3).one().options = ["1,5 часа", "2 часа!"]
+    db_session.commit()
+    rows = db_session.query(db.PollOption).filter_by(poll_id=3).order_by(db.PollOption.option_index).all()
+    assert [(o.text, o.emoji) for o in rows] == [("1,5 часа", None), ("2 часа!", "⭐")]
+
+def test_blank_options_are_dropped(db_session):
+    """Blank lines and doubled or trailing commas of the options wizard do not become options."""
+    poll = Poll(poll_id=4, chat_id=-1004, options=["A", "", "  ", "B", ""], status='active')
+    db_session.add(poll)
+    db_session.commit()
+    assert poll.options == ["A", "B"]
+
+    poll.options = "A,,C,".split(',')
+    db_session.commit()
+    assert db_session.query(Poll).filter_by(poll_id=4).one().options == ["A", "C"]
+
+def test_editing_options_moves_votes_with_their_options(db_session, multiple_choice_poll, user_1, user_2):
+    """Reordered options keep their votes and settings, removed ones lose them, the counters follow."""
+    from src import database as db
+    add_or_update_response(poll_id=2, option_index=0, **user_1)
+    add_or_update_response(poll_id=2, option_index=1, **user_1)
+    add_or_update_response(poll_id=2, option_index=2, **user_2)
+    db.get_poll_option(2, 2, session=db_session).emoji = "⭐"
+    db_session.commit()
+    votes = {(r.user_id, r.option_index) for r in db_session.query(Response).filter_by(poll_id=2)}
+
+    poll = db_session.query(Poll).filter_by(poll_id=2).one()
+    db.replace_poll_options(db_session, poll, ["Новый", "Z", "X"])   # Y removed, X and Z swapped
+    db_session.commit()
+
+    assert votes == {(101, 0), (101, 1), (102, 2)}
+    assert {(r.user_id, r.option_index) for r in db_session.query(Response).filter_by(poll_id=2)} == {(101, 2), (102, 1)}
+    rows = db_session.query(db.PollOption).filter_by(poll_id=2).order_by(db.PollOption.option_index).all()
+    assert [(o.text, o.emoji) for o in rows] == [("Новый", None), ("Z", "⭐"), ("X", None)]
+    assert get_poll_tallies(2, session=db_session) == (2, {(1, ""): 1, (2, ""): 1})
+    assert check_poll_tallies(db_session) == []
+
+    # Y is gone for good: voting for the option now at its place is a new vote.
+    add_or_update_response(poll_id=2, option_index=0, **user_1)
+    assert get_poll_tallies(2, session=db_session) == (2, {(0, ""): 1, (1, ""): 1, (2, ""): 1})
+
 # --- Тесты для исключений участников внутри опроса -------------------------
 
 def test_toggle_poll_exclusion(db_session):
     # Arrange: создать опрос и участника
-    poll = Poll(poll_id=99, chat_id=-200, options="A,B", status='active')
+    poll = Poll(poll_id=99, chat_id=-200, options=["A", "B"], status='active')
     participant = Participant(chat_id=-200, user_id=555)
     db_session.add_all([poll, participant])
     db_session.commit()
@@ -178,4 +252,206 @@ def test_toggle_poll_exclusion(db_session):
 
     excl_ids = db.get_poll_exclusions(99, session=db_session)
     assert 555 not in excl_ids
- 
\ No newline at end of file
+ 
+# --- Тесты для пакетного получения имён ------------------------------------
+
+@pytest.mark.parametrize("table_size", [10, 1000])
+def test_resolve_user_names_query_count_is_constant(db_session, table_size):
+    """The number of queries does not depend on how many users the table holds."""
+    from sqlalchemy import event
+    from src import database as db
+
+    db_session.add_all(User(user_id=i, first_name=f"Имя{i}") for i in range(table_size))
+    db_session.add(Participant(chat_id=-300, user_id=5000, first_name="Гость"))
+    db_session.commit()
+
+    statements = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    engine = db_session.get_bind()
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        names = db.resolve_user_names(db_session, [1, 2, 3, 5000, 6000])
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+    # One IN query on users plus one fallback IN query on participants.
+    assert len(statements) == 2
+    assert names == {1: "Имя1", 2: "Имя2", 3: "Имя3", 5000: "Гость", 6000: "User 6000"}
+
+def test_resolve_user_names_markdown_link(db_session):
+    from src import database as db
+
+    db_session.add(User(user_id=7, first_name="Ann", last_name="Lee"))
+    db_session.commit()
+
+    names = db.resolve_user_names(db_session, [7], markdown_link=True)
+
+    assert names[7] == "[Ann Lee](tg://user?id=7)"
+    assert db.get_user_name(db_session, 7, markdown_link=True) == names[7]
+
+# --- Vote tallies ---
+
+from src.database import PollOptionTally, get_poll_tallies, check_poll_tallies, rebuild_poll_tallies
+
+def test_tallies_follow_votes(db_session, single_choice_poll, multiple_choice_poll, user_1, user_2):
+    """Counters are maintained for votes, vote changes, re-votes and unvotes."""
+    add_or_update_response(poll_id=1, **user_1, option_index=0)
+    add_or_update_response(poll_id=1, **user_2, option_index=0)
+    add_or_update_response(poll_id=1, **user_1, option_index=1)   # change
+    add_or_update_response(poll_id=1, **user_2, option_index=0)   # same option again
+    add_or_update_response(poll_id=2, **user_1, option_index=0)
+    add_or_update_response(poll_id=2, **user_1, option_index=2)
+    add_or_update_response(poll_id=2, **user_2, option_index=2)
+    add_or_update_response(poll_id=2, **user_2, option_index=2)   # unvote
+
+    assert get_poll_tallies(1, session=db_session) == (2, {(0, ""): 1, (1, ""): 1})
+    assert get_poll_tallies(2, session=db_session) == (1, {(0, ""): 1, (2, ""): 1})
+    assert check_poll_tallies(db_session) == []
+
+def test_tallies_follow_orm_edits_and_poll_deletion(db_session, single_choice_poll, user_1, user_2):
+    add_or_update_response(poll_id=1, **user_1, option_index=0)
+    add_or_update_response(poll_id=1, **user_2, option_index=0)
+
+    # Moving votes to another option through the ORM.
+    for response in db_session.query(Response).filter_by(poll_id=1, option_index=0):
+        response.option_index = 2
+    db_session.commit()
+    assert get_poll_tallies(1, session=db_session) == (2, {(2, ""): 2})
+
+    db_session.delete(db_session.query(Poll).filter_by(poll_id=1).one())
+    db_session.commit()
+    assert db_session.query(PollOptionTally).count() == 0
+
+def test_check_and_rebuild_tallies(db_session, single_choice_poll, user_1):
+    add_or_update_response(poll_id=1, **user_1, option_index=0)
+    db_session.query(PollOptionTally).filter_by(poll_id=1).update({"votes": 5})
+    db_session.query(Poll).filter_by(poll_id=1).update({"voter_count": 0})
+    db_session.commit()
+
+    mismatches = check_poll_tallies(db_session)
+    assert {(m.option, m.stored, m.actual) for m in mismatches} == {((0, ""), 5, 1), (None, 0, 1)}
+
+    rebuild_poll_tallies(db_session, [1])
+    db_session.commit()
+    assert check_poll_tallies(db_session) == []
+    assert get_poll_tallies(1, session=db_session) == (1, {(0, ""): 1})
+
+# --- Fused vote write ---
+
+from src.database import record_vote, add_user_to_participants
+
+VOTES = [(1, "user_1", 0), (1, "user_2", 0), (1, "user_1", 1), (1, "user_2", 0),
+         (2, "user_1", 0), (2, "user_1", 2), (2, "user_2", 2), (2, "user_2", 2)]
+
+def _state(session):
+    return (
+        sorted((r.poll_id, r.user_id, r.option_index, r.response) for r in session.query(Response)),
+        sorted((t.poll_id, t.option_index, t.response, t.votes) for t in session.query(PollOptionTally)),
+        sorted((p.chat_id, p.user_id, p.first_name, p.excluded) for p in session.query(Participant)),
+        sorted((u.user_id, u.first_name, u.username) for u in session.query(User)),
+        sorted((p.poll_id, p.voter_count) for p in session.query(Poll)),
+    )
+
+def test_record_vote_matches_orm_path(db_session, single_choice_poll, multiple_choice_poll, user_1, user_2):
+    users = {"user_1": user_1, "user_2": user_2}
+    for poll_id, user, option_index in VOTES:
+        version = record_vote(chat_id=-1001, poll_id=poll_id, **users[user], option_index=option_index)
+        assert version == db_session.query(Poll.version).filter_by(poll_id=poll_id).scalar()
+    fused = _state(db_session)
+
+    db_session.query(Response).delete()
+    db_session.query(PollOptionTally).delete()
+    db_session.query(Participant).delete()
+    db_session.query(User).delete()
+    db_session.query(Poll).update({"voter_count": 0})
+    db_session.commit()
+    for poll_id, user, option_index in VOTES:
+        data = users[user]
+        add_user_to_participants(chat_id=-1001, user_id=data["user_id"], username=data["username"],
+                                 first_name=data["first_name"] or "", last_name=data["last_name"] or "")
+        add_or_update_response(poll_id=poll_id, **data, option_index=option_index)
+
+    assert fused == _state(db_session)
+    assert check_poll_tallies(db_session) == []
+
+def test_record_vote_versions(db_session, single_choice_poll, user_1):
+    v1 = record_vote(chat_id=-1001, poll_id=1, **user_1, option_index=0)
+    # Same vote again changes nothing.
+    assert record_vote(chat_id=-1001, poll_id=1, **user_1, option_index=0) == v1
+    v2 = record_vote(chat_id=-1001, poll_id=1, **user_1, option_index=1)
+    assert v2 > v1
+    # A renamed voter re-renders the poll even without a vote change.
+    renamed = dict(user_1, first_name="Алиса Н.")
+    assert record_vote(chat_id=-1001, poll_id=1, **renamed, option_index=1) > v2
+    assert db_session.query(User).filter_by(user_id=101).one().first_name == "Алиса Н."
+
+def test_record_vote_unknown_poll_or_option(db_session, single_choice_poll, user_1):
+    assert record_vote(chat_id=-1001, poll_id=999, **user_1, option_index=0) is None
+    assert record_vote(chat_id=-1001, poll_id=1, **user_1, option_index=7) is None
+    assert db_session.query(Response).count() == 0
+
+# --- SQLite pragma profile ---
+
+from src.database import make_engine, sqlite_pragmas
+
+def _pragma(engine, name):
+    with engine.connect() as conn:
+        return conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+
+def test_make_engine_applies_tuned_pragmas(tmp_path):
+    engine = make_engine(f"sqlite:///{tmp_path / 'tuned.db'}", pragmas=sqlite_pragmas('tuned'))
+    try:
+        assert _pragma(engine, "journal_mode") == "wal"
+        assert _pragma(engine, "synchronous") == 1  # NORMAL
+        assert _pragma(engine, "busy_timeout") == sqlite_pragmas('tuned')['busy_timeout']
+        assert _pragma(engine, "temp_store") == 2  # MEMORY
+        assert _pragma(engine, "cache_size") == -32000
+    finally:
+        engine.dispose()
+
+def test_make_engine_default_profile_keeps_sqlite_defaults(tmp_path):
+    engine = make_engine(f"sqlite:///{tmp_path / 'default.db'}", pragmas=sqlite_pragmas('default'))
+    try:
+        assert _pragma(engine, "journal_mode") == "delete"
+        assert _pragma(engine, "synchronous") == 2  # FULL
+    finally:
+        engine.dispose()
+
+# --- Connection pool metrics ---
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from src import metrics
+from src.database import MeteredQueuePool, instrument_pool, pool_options
+
+def test_pool_options_use_metered_pool():
+    options = pool_options()
+    assert options["poolclass"] is MeteredQueuePool
+    assert {"pool_size", "max_overflow", "pool_timeout", "pool_recycle", "pool_pre_ping"} <= set(options)
+
+def test_pool_metrics(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "_gauges", {})
+    engine = create_engine(f"sqlite:///{tmp_path / 'pool.db'}", poolclass=MeteredQueuePool,
+                           pool_size=1, max_overflow=1, pool_timeout=0.05)
+    instrument_pool(engine)
+    before = metrics.snapshot()
+    delta = lambda name: metrics.snapshot().get(name, 0) - before.get(name, 0)
+    try:
+        first = engine.connect()
+        second = engine.connect()  # overflow connection
+        assert metrics.snapshot()["db_pool_checked_out"] == 2
+        assert metrics.snapshot()["db_pool_overflow"] == 1
+        assert delta("db_pool_checkouts") == 2
+        assert delta("db_pool_overflow_checkouts") == 1
+
+        with pytest.raises(PoolTimeoutError):
+            engine.connect()
+        assert delta("db_pool_timeouts") == 1
+        assert delta("db_pool_slow_checkouts") >= 1
+
+        second.close()
+        first.close()
+        assert metrics.snapshot()["db_pool_checked_out"] == 0
+        assert delta("db_pool_connects") == 2
+    finally:
+        engine.dispose()
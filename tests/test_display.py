@@ -6,6 +6,7 @@ from unittest.mock import patch
 # Import the models and function to be tested
 from src.database import Poll, Response, PollSetting, User
 from src.display import generate_poll_content
+from src.snapshot import build_snapshot
 
 # --- Test Data Fixtures ---
 
@@ -16,7 +17,7 @@ def mock_poll():
         poll_id=1,
         chat_id=-1001,
         message="Какой твой любимый цвет?",
-        options="Красный,Синий,Зеленый",
+        options=["Красный", "Синий", "Зеленый"],
         status='active',
         poll_type='native'
     )
@@ -31,28 +32,34 @@ def mock_session(mock_poll):
     return session
 
 @pytest.fixture
-def mock_poll_with_votes(mock_poll):
-    """A fixture for a poll object that simulates having votes."""
-    # This is a bit of a hack, but it allows us to reuse the mock_poll
-    # and just add responses for tests that need them.
-    responses = [
+def use_snapshot(mocker):
+    """
+    Makes generate_poll_content read a snapshot built from the given rows
+    instead of loading it from the database.
+    """
+    def _use(poll, responses=(), setting=None, users=()):
+        snapshot = build_snapshot(poll, setting, responses=responses, users=users)
+        mocker.patch('src.display.load_poll_snapshot', return_value=snapshot)
+        return snapshot
+    return _use
+
+@pytest.fixture
+def mock_votes():
+    """Responses for tests that need a poll with votes."""
+    return [
         Response(user_id=101, response="Красный"),
         Response(user_id=102, response="Синий"),
         Response(user_id=103, response="Красный"),
     ]
-    with patch('src.database.get_responses', return_value=responses):
-        yield mock_poll
 
 # --- Unit Tests for generate_poll_text ---
 
-def test_generate_poll_text_no_votes(mocker, mock_poll, mock_session):
+def test_generate_poll_text_no_votes(mocker, mock_poll, mock_session, use_snapshot):
     """
     Tests poll text generation when there are no votes.
     """
     # Arrange: Mock DB calls
-    mocker.patch('src.database.get_responses', return_value=[])
-    mocker.patch('src.database.get_poll_setting', return_value=PollSetting(default_show_names=True, default_show_count=True))
-    mocker.patch('src.database.get_poll_option_setting', return_value=None)
+    use_snapshot(mock_poll, setting=PollSetting(default_show_names=True, default_show_count=True))
     # Mock the image generation to test the text part in isolation
     mocker.patch('src.display.generate_results_heatmap_image', return_value=b'fake_image')
     
@@ -65,55 +72,39 @@ def test_generate_poll_text_no_votes(mocker, mock_poll, mock_session):
     # Image should be None because there are no votes
     assert image is None
 
-def test_generate_poll_content_with_votes_and_image(mocker, mock_poll_with_votes, mock_session):
+def test_generate_poll_content_with_votes_and_image(mocker, mock_poll, mock_votes, mock_session, use_snapshot):
     """
     Tests poll content generation with votes, expecting an image by default.
     """
-    mocker.patch('src.database.get_poll_setting', return_value=PollSetting(show_heatmap=True))
-    mocker.patch('src.database.get_poll_option_setting', return_value=None)
+    use_snapshot(mock_poll, mock_votes, setting=PollSetting(show_heatmap=True))
     mocker.patch('src.display.generate_results_heatmap_image', return_value=b'fake_image_bytes')
     
-    text, image = generate_poll_content(poll=mock_poll_with_votes, session=mock_session)
+    text, image = generate_poll_content(poll=mock_poll, session=mock_session)
     
     assert "Всего проголосовало: *3*" in text
     assert image == b'fake_image_bytes'
 
-def test_generate_poll_content_with_votes_no_image(mocker, mock_poll_with_votes, mock_session):
+def test_generate_poll_content_with_votes_no_image(mocker, mock_poll, mock_votes, mock_session, use_snapshot):
     """
     Tests poll content generation with votes but with the heatmap setting disabled.
     """
     # Arrange: Disable the heatmap
-    mocker.patch('src.database.get_poll_setting', return_value=PollSetting(show_heatmap=False))
-    mocker.patch('src.database.get_poll_option_setting', return_value=None)
+    use_snapshot(mock_poll, mock_votes, setting=PollSetting(show_heatmap=False))
     # We don't need to mock the image generator as it shouldn't be called.
     
-    text, image = generate_poll_content(poll=mock_poll_with_votes, session=mock_session)
+    text, image = generate_poll_content(poll=mock_poll, session=mock_session)
     
     assert "Всего проголосовало: *3*" in text
     assert image is None
 
-def test_generate_poll_text_with_votes_and_names(mocker, mock_poll, mock_session):
+def test_generate_poll_text_with_votes_and_names(mocker, mock_poll, mock_votes, mock_session, use_snapshot):
     """
     Tests poll text generation with votes and displayed voter names.
     """
-    # Arrange: Mock DB calls
-    responses = [
-        Response(user_id=101, response="Красный"),
-        Response(user_id=102, response="Синий"),
-        Response(user_id=103, response="Красный"),
-    ]
-    mocker.patch('src.database.get_responses', return_value=responses)
-    mocker.patch('src.database.get_poll_setting', return_value=PollSetting(default_show_names=True, default_show_count=True, show_heatmap=True))
-    mocker.patch('src.database.get_poll_option_setting', return_value=None)
+    # Arrange: voter names come from the users table
+    users = [User(user_id=101, first_name="Алиса"), User(user_id=102, first_name="Боб"), User(user_id=103, first_name="Вася")]
+    use_snapshot(mock_poll, mock_votes, setting=PollSetting(default_show_names=True, default_show_count=True, show_heatmap=True), users=users)
     mocker.patch('src.display.generate_results_heatmap_image', return_value=b'fake_image')
-    
-    # Mock user name fetching
-    def get_user_name_mock(session, user_id, markdown_link=False):
-        names = {101: "Алиса", 102: "Боб", 103: "Вася"}
-        name = names.get(user_id, "Unknown")
-        return f'[{name}](tg://user?id={user_id})' if markdown_link else name
-    
-    mocker.patch('src.database.get_user_name', side_effect=get_user_name_mock)
 
     # Act
     text, image = generate_poll_content(poll=mock_poll, session=mock_session)
@@ -127,16 +118,14 @@ def test_generate_poll_text_with_votes_and_names(mocker, mock_poll, mock_session
     assert "Вася" in text
     assert image is not None
 
-def test_generate_poll_text_votes_no_names(mocker, mock_poll, mock_session):
+def test_generate_poll_text_votes_no_names(mocker, mock_poll, mock_session, use_snapshot):
     """
     Tests poll text generation with votes but without displaying voter names.
     """
     # Arrange: Mock DB calls
     responses = [Response(user_id=101, response="Красный")]
-    mocker.patch('src.database.get_responses', return_value=responses)
-    mocker.patch('src.database.get_poll_setting', return_value=PollSetting(default_show_names=False, show_heatmap=True)) # Names are turned OFF
-    mocker.patch('src.database.get_poll_option_setting', return_value=None)
-    mocker.patch('src.database.get_user_name', return_value="Алиса")
+    setting = PollSetting(default_show_names=False, show_heatmap=True) # Names are turned OFF
+    use_snapshot(mock_poll, responses, setting=setting, users=[User(user_id=101, first_name="Алиса")])
     mocker.patch('src.display.generate_results_heatmap_image', return_value=b'fake_image')
 
     # Act
@@ -147,15 +136,13 @@ def test_generate_poll_text_votes_no_names(mocker, mock_poll, mock_session):
     assert "Алиса" not in text # Name should not be in the text
     assert image is not None
 
-def test_generate_poll_text_closed_poll(mocker, mock_poll, mock_session):
+def test_generate_poll_text_closed_poll(mocker, mock_poll, mock_session, use_snapshot):
     """
     Tests that a closed poll includes the 'ОПРОС ЗАВЕРШЕН' header.
     """
     # Arrange
     mock_poll.status = 'closed'
-    mocker.patch('src.database.get_responses', return_value=[])
-    mocker.patch('src.database.get_poll_setting', return_value=PollSetting())
-    mocker.patch('src.database.get_poll_option_setting', return_value=None)
+    use_snapshot(mock_poll, setting=PollSetting())
     mocker.patch('src.display.generate_results_heatmap_image', return_value=b'fake_image')
 
     # Act
@@ -165,7 +152,7 @@ def test_generate_poll_text_closed_poll(mocker, mock_poll, mock_session):
     assert text.startswith("*ОПРОС ЗАВЕРШЕН*")
     assert image is None # No votes, no image
 
-def test_generate_poll_text_multiple_choice(mocker, mock_poll, mock_session):
+def test_generate_poll_text_multiple_choice(mocker, mock_poll, mock_session, use_snapshot):
     """
     Tests correct calculation of total voters in a multiple-choice poll.
     """
@@ -175,9 +162,7 @@ def test_generate_poll_text_multiple_choice(mocker, mock_poll, mock_session):
         Response(user_id=101, response="Синий"), # Same user, different choice
         Response(user_id=102, response="Зеленый"),
     ]
-    mocker.patch('src.database.get_responses', return_value=responses)
-    mocker.patch('src.database.get_poll_setting', return_value=PollSetting(show_heatmap=True))
-    mocker.patch('src.database.get_poll_option_setting', return_value=None)
+    use_snapshot(mock_poll, responses, setting=PollSetting(show_heatmap=True))
     mocker.patch('src.display.generate_results_heatmap_image', return_value=b'fake_image')
     
     # Act
@@ -199,7 +184,7 @@ def test_generate_poll_text_for_webapp_no_votes(mocker, mock_poll, mock_session)
     # Arrange
     mock_poll.poll_type = 'webapp'
 
-def test_generate_poll_text_with_voter_emojis(mocker, mock_poll, mock_session):
+def test_generate_poll_text_with_voter_emojis(mocker, mock_poll, mock_session, use_snapshot):
     """
     Tests that voter emojis are correctly displayed next to their names.
     """
@@ -208,39 +193,14 @@ def test_generate_poll_text_with_voter_emojis(mocker, mock_poll, mock_session):
         Response(user_id=101, response="Красный"),
         Response(user_id=102, response="Синий"),
     ]
-    mocker.patch('src.database.get_responses', return_value=responses)
+    users = [User(user_id=101, first_name="Алиса"), User(user_id=102, first_name="Боб")]
+
+    # Emoji per option index. In mock_poll: 0 -> Красный, 1 -> Синий
+    for option, emoji in zip(mock_poll.option_rows, ("❤️", "💙")):
+        option.emoji, option.show_names, option.names_style, option.show_count = emoji, 1, 'list', 1
     # Disable heatmap to simplify test assertion by not needing to check the image
-    mocker.patch('src.database.get_poll_setting', return_value=PollSetting(default_show_names=True, show_heatmap=False))
-
-    # Mock user name fetching
-    def get_user_name_mock(session, user_id, markdown_link=False):
-        names = {101: "Алиса", 102: "Боб"}
-        name = names.get(user_id, "Unknown")
-        return f'[{name}](tg://user?id={user_id})' if markdown_link else name
-    mocker.patch('src.database.get_user_name', side_effect=get_user_name_mock)
-
-    # Mock emoji fetching for each option based on its index
-    def get_poll_option_setting_mock(poll_id, option_index):
-        # In mock_poll: 0 -> Красный, 1 -> Синий
-        emojis = {
-            0: "❤️",
-            1: "💙",
-        }
-        emoji = emojis.get(option_index)
-        
-        # The real function returns a PollOptionSetting object.
-        # We need to mock all attributes that are accessed in display.py to avoid AttributeErrors
-        mock_setting = MagicMock()
-        mock_setting.show_names = True
-        mock_setting.names_style = 'list'
-        mock_setting.is_priority = 0
-        mock_setting.contribution_amount = 0
-        mock_setting.emoji = emoji # Assign the correct emoji or None
-        mock_setting.show_count = True
-        mock_setting.show_contribution = True
-        return mock_setting
-
-    mocker.patch('src.database.get_poll_option_setting', side_effect=get_poll_option_setting_mock)
+    use_snapshot(mock_poll, responses, setting=PollSetting(default_show_names=True, show_heatmap=False),
+                 users=users)
 
     # Act
     text, image = generate_poll_content(poll=mock_poll, session=mock_session)
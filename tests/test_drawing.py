@@ -3,8 +3,10 @@ import io
 from unittest.mock import MagicMock, patch, call
 from PIL import Image
 
+from src import drawing
 from src.drawing import generate_results_heatmap_image
-from src.database import Poll, Participant, Response
+from src.database import Poll, Participant, Response, User
+from src.snapshot import build_snapshot
 
 @pytest.fixture
 def mock_db_session():
@@ -14,31 +16,18 @@ def mock_db_session():
     session.query.return_value.all.return_value = []
     return session
 
-@patch('src.drawing.db.SessionLocal')
-@patch('src.drawing.db')
-def test_heatmap_generation_with_internal_session(mock_db, mock_session_local):
+@patch('src.drawing.load_poll_snapshot')
+def test_heatmap_generation_with_internal_session(mock_load_snapshot):
     """
-    Tests successful heatmap generation when no session is passed,
-    ensuring internal session management works as expected.
-    This test covers the scenario that was previously failing.
+    Tests successful heatmap generation when no session or snapshot is passed:
+    the snapshot is loaded once and the image is drawn from it.
     """
     # Arrange
-    # This mock session will be returned by SessionLocal() inside the function
-    mock_internal_session = MagicMock()
-    mock_session_local.return_value = mock_internal_session
-
-    poll = Poll(poll_id=1, chat_id=-100, poll_type='native', options="Да,Нет")
-    participants = [Participant(user_id=101), Participant(user_id=102, excluded=True)]
+    poll = Poll(poll_id=1, chat_id=-100, poll_type='native', options=["Да", "Нет"])
+    participants = [Participant(user_id=101, username=None, excluded=0), Participant(user_id=102, username=None, excluded=1)]
     responses = [Response(user_id=101, response="Да")]
-
-    # Mock DB functions. 
-    # get_poll and get_responses are now called without session.
-    mock_db.get_poll.return_value = poll
-    mock_db.get_responses.return_value = responses
-    
-    # These functions are called with the internally created session.
-    mock_db.get_participants.return_value = participants
-    mock_db.get_user_name.side_effect = lambda s, uid: f"User {uid}"
+    users = [User(user_id=101, first_name="User 101"), User(user_id=102, first_name="User 102")]
+    mock_load_snapshot.return_value = build_snapshot(poll, responses=responses, participants=participants, users=users)
 
     # Act
     image_buffer = generate_results_heatmap_image(poll_id=1)
@@ -50,62 +39,212 @@ def test_heatmap_generation_with_internal_session(mock_db, mock_session_local):
     assert img.format == 'PNG'
     assert img.width > 100 and img.height > 50
 
-    # Verify that the functions were called correctly.
-    # get_poll and get_responses should be called without the session argument.
-    mock_db.get_poll.assert_called_once_with(1)
-    mock_db.get_responses.assert_called_once_with(1)
-    
-    # get_participants and get_user_name should be called with the session
-    # that was created inside generate_results_heatmap_image.
-    mock_db.get_participants.assert_called_once_with(-100, session=mock_internal_session)
-    
-    # Assert that get_user_name was called for both the active and the excluded participant
-    expected_calls = [
-        call(mock_internal_session, 101),
-        call(mock_internal_session, 102)
-    ]
-    mock_db.get_user_name.assert_has_calls(expected_calls, any_order=True)
-    
-    # Check that the internal session was closed.
-    mock_internal_session.close.assert_called_once()
+    # The snapshot is the only DB access and is loaded without an external session.
+    mock_load_snapshot.assert_called_once_with(1, session=None)
 
-@patch('src.drawing.db')
-def test_heatmap_generation_no_participants(mock_db):
+def test_heatmap_generation_uses_given_snapshot():
+    """A snapshot passed by the caller is drawn as-is, without touching the DB."""
+    poll = Poll(poll_id=4, chat_id=-103, poll_type='native', options=["Да", "Нет"])
+    snapshot = build_snapshot(poll, responses=[Response(user_id=101, response="Нет")],
+                              users=[User(user_id=101, first_name="Алиса")])
+
+    with patch('src.drawing.load_poll_snapshot') as mock_load_snapshot:
+        image_buffer = generate_results_heatmap_image(poll_id=4, snapshot=snapshot)
+
+    assert isinstance(image_buffer, io.BytesIO)
+    mock_load_snapshot.assert_not_called()
+
+@patch('src.drawing.load_poll_snapshot')
+def test_heatmap_generation_no_participants(mock_load_snapshot):
     """
     Tests that heatmap generation returns None if there are no participants.
     """
     # Arrange
-    poll = Poll(poll_id=2, chat_id=-101, poll_type='native', options="A,B")
-    mock_db.get_poll.return_value = poll
-    mock_db.get_participants.return_value = [] # No participants
-    mock_db.get_responses.return_value = [] # To truly test no participants, there should be no responses either
+    poll = Poll(poll_id=2, chat_id=-101, poll_type='native', options=["A", "B"])
+    # To truly test no participants, there should be no responses either
+    mock_load_snapshot.return_value = build_snapshot(poll)
 
     # Act
     image_buffer = generate_results_heatmap_image(poll_id=2)
 
     # Assert
     assert image_buffer is None
-    mock_db.get_poll.assert_called_once_with(2)
-    mock_db.get_participants.assert_called_once() # We don't care about args here as much
+    mock_load_snapshot.assert_called_once()
     
-@patch('src.drawing.db')
-def test_heatmap_generation_no_options(mock_db):
+@patch('src.drawing.load_poll_snapshot')
+def test_heatmap_generation_no_options(mock_load_snapshot):
     """
     Tests that heatmap generation for a webapp poll with no responses (and thus no options) returns None.
     """
     # Arrange
     poll = Poll(poll_id=3, chat_id=-102, poll_type='webapp')
-    participants = [Participant(user_id=101)]
-    
-    mock_db.get_poll.return_value = poll
-    mock_db.get_participants.return_value = participants
-    mock_db.get_responses.return_value = [] # No responses -> no options
+    participants = [Participant(user_id=101, username=None, excluded=0)]
+    mock_load_snapshot.return_value = build_snapshot(poll, participants=participants)  # No responses -> no options
 
     # Act
     image_buffer = generate_results_heatmap_image(poll_id=3)
 
     # Assert
     assert image_buffer is None
-    mock_db.get_poll.assert_called_once_with(3)
-    mock_db.get_responses.assert_called_once_with(3)
-    mock_db.get_participants.assert_called_once() 
\ No newline at end of file
+    mock_load_snapshot.assert_called_once()
+
+# --- Incremental renderer ---
+
+from PIL import ImageChops
+from src.drawing import HeatmapRenderer, build_heatmap_model
+
+def _votes_snapshot(votes, options=("Пн", "Вт", "Ср"), voters=12, exclusions=()):
+    poll = Poll(poll_id=7, chat_id=-107, poll_type='native', options=list(options), message="Когда?")
+    participants = [Participant(user_id=uid, username=None, excluded=0) for uid in range(voters)]
+    users = [User(user_id=uid, first_name=f"Имя{uid}") for uid in range(voters)]
+    responses = [Response(user_id=uid, response=opt) for uid, opt in votes]
+    return build_snapshot(poll, responses=responses, participants=participants, users=users, exclusions=exclusions)
+
+def _render(renderer, snapshot):
+    return Image.open(renderer.render(7, *build_heatmap_model(7, snapshot))).convert('RGB')
+
+@pytest.mark.parametrize("change", [
+    [(0, "Пн"), (1, "Пн"), (2, "Вт"), (11, "Вт")],            # new vote, leader tie
+    [(0, "Пн"), (1, "Пн")],                                    # vote removed, column intensity changes
+    [(0, "Пн"), (1, "Пн"), (2, "Вт"), (3, "Ср"), (4, "Ср")],   # leader moves
+])
+def test_incremental_render_matches_full_render(change):
+    renderer = HeatmapRenderer()
+    _render(renderer, _votes_snapshot([(0, "Пн"), (1, "Пн"), (2, "Вт")]))
+
+    incremental = _render(renderer, _votes_snapshot(change))
+    full = _render(HeatmapRenderer(), _votes_snapshot(change))
+
+    assert ImageChops.difference(incremental, full).getbbox() is None
+
+def test_incremental_render_repaints_only_changed_cells(mocker):
+    renderer = HeatmapRenderer()
+    _render(renderer, _votes_snapshot([(0, "Пн"), (1, "Вт")]))
+    draw_cell = mocker.spy(drawing, "_draw_cell")
+    draw_layout = mocker.spy(drawing, "_draw_layout")
+
+    # A second vote for "Пн": the new cell plus the "Вт" cell that loses the lead.
+    _render(renderer, _votes_snapshot([(0, "Пн"), (1, "Вт"), (2, "Пн")]))
+
+    draw_layout.assert_not_called()
+    assert draw_cell.call_count == 2
+
+def test_layout_change_triggers_full_render(mocker):
+    renderer = HeatmapRenderer()
+    _render(renderer, _votes_snapshot([(0, "Пн")]))
+    draw_layout = mocker.spy(drawing, "_draw_layout")
+
+    _render(renderer, _votes_snapshot([(0, "Пн")], exclusions=[5]))
+
+    draw_layout.assert_called_once()
+
+# --- Font and glyph-metric cache ---
+
+from src.drawing import FONT_BOLD, FONT_REGULAR, get_system_font, glyph_metrics, truncate_text, _wrap_text
+
+CYRILLIC_SAMPLES = [
+    "Александр Преображенский (@alexander_preobrazhensky)",
+    "Голенищева-Кутузова Маргарита",
+    "Ёж",
+    "AVATAR Татьяна WAVE",
+    "  пробелы  по  краям  ",
+]
+
+def test_system_font_is_loaded_once():
+    assert get_system_font(28) is get_system_font(28)
+
+@pytest.mark.parametrize("font", [FONT_REGULAR, FONT_BOLD])
+@pytest.mark.parametrize("text", CYRILLIC_SAMPLES)
+def test_glyph_metrics_match_getlength(font, text):
+    widths = glyph_metrics(font).prefix_widths(text)
+    assert widths == [font.getlength(text[:k]) for k in range(len(text) + 1)]
+
+@pytest.mark.parametrize("text", CYRILLIC_SAMPLES)
+@pytest.mark.parametrize("max_width", [5, 60, 198])
+def test_truncate_text_matches_getlength_loop(text, max_width):
+    expected = text
+    if FONT_REGULAR.getlength(expected) > max_width:
+        while FONT_REGULAR.getlength(expected + '…') > max_width and len(expected) > 1:
+            expected = expected[:-1]
+        expected += '…'
+
+    assert truncate_text(text, FONT_REGULAR, max_width) == expected
+
+@pytest.mark.parametrize("text", CYRILLIC_SAMPLES)
+@pytest.mark.parametrize("max_width", [40, 120])
+def test_wrap_text_lines_fit(text, max_width):
+    lines = _wrap_text(text, FONT_REGULAR, max_width)
+
+    assert all(FONT_REGULAR.getlength(line) <= max_width for line in lines)
+    # Wrapping only drops the spaces it breaks on.
+    assert "".join(lines).replace(" ", "") == text.replace(" ", "")
+
+# --- Vectorized cell rasterizer ---
+
+@pytest.mark.parametrize("voters, votes, exclusions", [
+    (1, [(0, "Пн")], []),
+    (2, [(0, "Пн"), (1, "Вт")], []),
+    (7, [(0, "Пн"), (1, "Пн"), (2, "Ср"), (3, "Вт"), (6, "Пн")], [3]),
+])
+def test_vectorized_cells_match_pillow(monkeypatch, voters, votes, exclusions):
+    pytest.importorskip("numpy")
+    snapshot = _votes_snapshot(votes, voters=voters, exclusions=exclusions)
+
+    monkeypatch.setattr(drawing, "VECTOR_CELLS", False)
+    pillow = _render(HeatmapRenderer(), snapshot)
+    monkeypatch.setattr(drawing, "VECTOR_CELLS", True)
+    renderer = HeatmapRenderer()
+    vectorized = _render(renderer, snapshot)
+
+    assert ImageChops.difference(pillow, vectorized).getbbox() is None
+    # The layout tiles it keeps support incremental repaints as well.
+    changed = votes + [(voters - 1, "Ср")]
+    assert ImageChops.difference(_render(renderer, _votes_snapshot(changed, voters=voters, exclusions=exclusions)),
+                                 _render(HeatmapRenderer(), _votes_snapshot(changed, voters=voters, exclusions=exclusions))).getbbox() is None
+
+# --- Output encoders ---
+
+from src import image_encoders
+
+def _drawn_heatmap():
+    layout, cells = build_heatmap_model(7, _votes_snapshot([(0, "Пн"), (1, "Пн"), (2, "Вт")]))
+    return HeatmapRenderer(max_polls=0)._draw_full(layout, cells).image
+
+@pytest.mark.parametrize("fmt, pil_format", [
+    ("png", "PNG"), ("png-palette", "PNG"), ("webp", "WEBP"), ("jpeg", "JPEG"),
+])
+def test_encoders_produce_requested_format(fmt, pil_format):
+    image = _drawn_heatmap()
+    decoded = Image.open(image_encoders.encode_image(image, fmt))
+    assert decoded.format == pil_format
+    assert decoded.size == image.size
+
+def test_default_encoder_keeps_pixels_exactly():
+    image = _drawn_heatmap()
+    decoded = Image.open(image_encoders.encode_image(image))
+    assert decoded.format == "PNG"
+    assert ImageChops.difference(image, decoded.convert('RGB')).getbbox() is None
+
+def test_palette_png_is_smaller_and_keeps_colours_close():
+    image = _drawn_heatmap()
+    full = image_encoders.encode_image(image, "png").getvalue()
+    palette = image_encoders.encode_image(image, "png-palette")
+
+    assert len(palette.getvalue()) < len(full) * 0.7
+    decoded = Image.open(palette)
+    assert decoded.mode == "P"
+    # Most frequent colours (backgrounds, cell fills) survive within a few levels.
+    assert max(band_max for _, band_max in ImageChops.difference(image, decoded.convert('RGB')).getextrema()) <= 8
+
+def test_unknown_encoder_falls_back_to_png():
+    assert Image.open(image_encoders.encode_image(_drawn_heatmap(), "gif")).format == "PNG"
+
+def test_custom_encoder_can_be_registered(monkeypatch):
+    monkeypatch.setattr(image_encoders, "_encoders", dict(image_encoders._encoders))
+
+    @image_encoders.register_encoder("bmp")
+    def encode_bmp(image, buffer):
+        image.save(buffer, format="BMP")
+
+    assert "bmp" in image_encoders.available_encoders()
+    assert Image.open(image_encoders.encode_image(_drawn_heatmap(), "bmp")).format == "BMP"
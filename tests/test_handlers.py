@@ -7,7 +7,8 @@ from telegram import Update, User, Chat, Message, CallbackQuery, InlineKeyboardM
 from telegram.ext import ContextTypes
 
 from src.handlers import base, dashboard, voting, results
-from src.database import Participant, Poll, PollSetting
+from src.activity_buffer import ActivityBuffer
+from src.database import Participant, ParticipantActivity, Poll, PollSetting
 
 @pytest.fixture
 def mock_context():
@@ -23,7 +24,8 @@ async def test_register_user_activity_in_group(mocker):
     Tests that a user sending a message in a group gets registered.
     """
     # Arrange
-    mocker.patch('src.database.add_user_to_participants')
+    mocker.patch('src.database.record_activity', return_value=True)
+    buffer = mocker.patch('src.handlers.base.activity_buffer', ActivityBuffer(interval=60))
     from src import database as db
 
     mock_update = MagicMock(spec=Update)
@@ -41,15 +43,13 @@ async def test_register_user_activity_in_group(mocker):
     
     # Act
     await base.register_user_activity(mock_update, MagicMock())
+    await base.register_user_activity(mock_update, MagicMock())
+    await buffer.shutdown()
 
-    # Assert
-    db.add_user_to_participants.assert_called_once_with(
-        chat_id=-1001,
-        user_id=123,
-        username="testuser",
-        first_name="Test",
-        last_name="User",
-    )
+    # Assert: both messages are written as one participant entry
+    db.record_activity.assert_called_once_with([], [
+        ParticipantActivity(chat_id=-1001, user_id=123, username="testuser", first_name="Test", last_name="User"),
+    ])
 
 @pytest.mark.asyncio
 async def test_register_user_activity_ignored_in_private(mocker):
@@ -57,7 +57,8 @@ async def test_register_user_activity_ignored_in_private(mocker):
     Tests that user activity in a private chat is ignored for participant registration.
     """
     # Arrange
-    mocker.patch('src.database.add_user_to_participants')
+    mocker.patch('src.database.record_activity', return_value=True)
+    buffer = mocker.patch('src.handlers.base.activity_buffer', ActivityBuffer(interval=0))
     from src import database as db
 
     mock_update = MagicMock(spec=Update)
@@ -77,7 +78,8 @@ async def test_register_user_activity_ignored_in_private(mocker):
     await base.register_user_activity(mock_update, MagicMock())
 
     # Assert
-    db.add_user_to_participants.assert_not_called()
+    assert buffer.pending() == 0
+    db.record_activity.assert_not_called()
 
 @pytest.mark.asyncio
 async def test_show_participants_list_empty(mocker):
@@ -108,7 +110,7 @@ async def test_show_participants_list_with_data_and_pagination(mocker):
     participants = [Participant(user_id=i, chat_id=-1001) for i in range(55)]
     mocker.patch('src.database.get_participants', return_value=participants)
     mocker.patch('src.database.get_group_title', return_value="Test Group")
-    mocker.patch('src.database.get_user_name', side_effect=lambda session, user_id, markdown_link=False: f"User {user_id}")
+    mocker.patch('src.database.resolve_user_names', side_effect=lambda session, user_ids, markdown_link=False: {uid: f"User {uid}" for uid in user_ids})
     mock_query = AsyncMock(spec=CallbackQuery)
 
     # Act (Page 0)
@@ -134,13 +136,13 @@ async def test_show_participants_list_with_data_and_pagination(mocker):
 
 @pytest.mark.asyncio
 @patch('src.handlers.dashboard.db.SessionLocal')
-@patch('src.handlers.dashboard.generate_poll_content', return_value=("Сгенерированный текст", io.BytesIO(b"fake_image_bytes")))
+@patch('src.handlers.dashboard.generate_poll_content_async', new_callable=AsyncMock, return_value=("Сгенерированный текст", io.BytesIO(b"fake_image_bytes")))
 @patch('src.handlers.dashboard.show_poll_list', new_callable=AsyncMock)
 async def test_start_poll_success_native_with_image(mock_show_list, mock_gen_content, mock_session_local, mock_context):
     mock_session = MagicMock()
     mock_session_local.return_value = mock_session
-    mock_poll = Poll(poll_id=22, chat_id=-1001, message="Заголовок", options="A,B", status='draft', poll_type='native')
-    mock_session.query.return_value.filter_by.return_value.first.return_value = mock_poll
+    mock_poll = Poll(poll_id=22, chat_id=-1001, message="Заголовок", options=["A", "B"], status='draft', poll_type='native')
+    mock_session.get.return_value = mock_poll
     mock_context.bot.send_photo.return_value.photo = [MagicMock(file_id="dummy_file_id")]
     mock_query = AsyncMock(spec=CallbackQuery)
     await dashboard.start_poll(mock_query, mock_context, poll_id=22)
@@ -150,13 +152,13 @@ async def test_start_poll_success_native_with_image(mock_show_list, mock_gen_con
 
 @pytest.mark.asyncio
 @patch('src.handlers.dashboard.db.SessionLocal')
-@patch('src.handlers.dashboard.generate_poll_content')
+@patch('src.handlers.dashboard.generate_poll_content_async', new_callable=AsyncMock)
 @patch('src.handlers.dashboard.show_poll_list', new_callable=AsyncMock)
 async def test_start_poll_success_native(mock_show_list, mock_generate_content, mock_session_local, mock_context):
     mock_session = MagicMock()
     mock_session_local.return_value = mock_session
-    mock_poll = Poll(poll_id=1, chat_id=-1001, message="Native Poll Title", options="Opt1,Opt2", status='draft', poll_type='native')
-    mock_session.query.return_value.filter_by.return_value.first.return_value = mock_poll
+    mock_poll = Poll(poll_id=1, chat_id=-1001, message="Native Poll Title", options=["Opt1", "Opt2"], status='draft', poll_type='native')
+    mock_session.get.return_value = mock_poll
     mock_generate_content.return_value = ("Final Caption", b"new_image_bytes")
     mock_query = AsyncMock(spec=CallbackQuery)
     mock_context.bot.send_photo = AsyncMock()
@@ -167,23 +169,24 @@ async def test_start_poll_success_native(mock_show_list, mock_generate_content,
 
 @pytest.mark.asyncio
 @patch('src.handlers.dashboard.db')
-async def test_show_draft_poll_list(mock_db, mock_context):
+@patch('src.database.get_polls_by_status')
+async def test_show_draft_poll_list(mock_get_polls_by_status, mock_db, mock_context):
     """
     Tests that the list of draft polls is displayed correctly.
-    This test mocks the entire db module inside dashboard.py to bypass issues.
+    The poll list is read through the async twin, which resolves src.database at call time.
     """
     chat_id = -1001
     draft_polls = [
         Poll(poll_id=10, chat_id=chat_id, status='draft', message="Draft Poll 1"),
         Poll(poll_id=11, chat_id=chat_id, status='draft', message="Draft Poll 2"),
     ]
-    mock_db.get_polls_by_status.return_value = draft_polls
+    mock_get_polls_by_status.return_value = draft_polls
     mock_query = AsyncMock(spec=CallbackQuery)
 
     await dashboard.show_poll_list(mock_query, chat_id=chat_id, status='draft')
 
     # Assert db call is correct
-    mock_db.get_polls_by_status.assert_called_once_with(chat_id, 'draft')
+    mock_get_polls_by_status.assert_called_once_with(chat_id, 'draft')
 
     # Assert message is edited correctly
     mock_query.edit_message_text.assert_called_once()
@@ -202,7 +205,7 @@ async def test_start_poll_fail_not_a_draft(mock_show_list, mock_session_local, m
     mock_session = MagicMock()
     mock_session_local.return_value = mock_session
     mock_poll = Poll(poll_id=23, status='active')
-    mock_session.query.return_value.filter_by.return_value.first.return_value = mock_poll
+    mock_session.get.return_value = mock_poll
     mock_query = AsyncMock(spec=CallbackQuery)
     await dashboard.start_poll(mock_query, mock_context, poll_id=23)
     mock_context.bot.send_photo.assert_not_called()
@@ -216,7 +219,7 @@ async def test_start_poll_fail_no_title(mock_session_local, mock_context):
     mock_session = MagicMock()
     mock_session_local.return_value = mock_session
     mock_poll = Poll(poll_id=24, status='draft', message=None)
-    mock_session.query.return_value.filter_by.return_value.first.return_value = mock_poll
+    mock_session.get.return_value = mock_poll
     mock_query = AsyncMock(spec=CallbackQuery)
     await dashboard.start_poll(mock_query, mock_context, poll_id=24)
     mock_query.answer.assert_called_once_with('Текст (заголовок) опроса не задан. Отредактируйте его в настройках.', show_alert=True)
@@ -227,19 +230,18 @@ async def test_start_poll_fail_no_native_options(mock_session_local, mock_contex
     mock_session = MagicMock()
     mock_session_local.return_value = mock_session
     mock_poll = Poll(poll_id=25, status='draft', message='title', poll_type='native', options=None)
-    mock_session.query.return_value.filter_by.return_value.first.return_value = mock_poll
+    mock_session.get.return_value = mock_poll
     mock_query = AsyncMock(spec=CallbackQuery)
-    with patch('src.handlers.dashboard.generate_poll_content', return_value=("", None)):
+    with patch('src.handlers.dashboard.generate_poll_content_async', new_callable=AsyncMock, return_value=("", None)):
         await dashboard.start_poll(mock_query, mock_context, poll_id=25)
     mock_query.answer.assert_called_once_with('Ошибка: опрос содержит пустые или некорректные варианты ответов. Пожалуйста, отредактируйте их в настройках.', show_alert=True)
 
 @pytest.mark.asyncio
-@patch('src.handlers.voting.db.add_user_to_participants')
 @patch('src.handlers.voting.db.SessionLocal')
-@patch('src.handlers.voting.db.add_or_update_response')
-@patch('src.handlers.voting.generate_poll_content')
+@patch('src.handlers.voting.db.record_vote')
+@patch('src.handlers.voting.generate_poll_content_async', new_callable=AsyncMock)
 async def test_vote_callback_handler_calls_db_correctly(
-    mock_generate_content, mock_add_response, mock_session_local, mock_add_participant
+    mock_generate_content, mock_record_vote, mock_session_local
 ):
     """
     Tests that the vote handler correctly processes a vote, fetches poll settings,
@@ -251,10 +253,10 @@ async def test_vote_callback_handler_calls_db_correctly(
     mock_session = MagicMock()
     mock_session_local.return_value = mock_session
     
-    mock_poll = Poll(poll_id=42, chat_id=-1001, message_id=999, status='active', options="Да,Нет")
+    mock_poll = Poll(poll_id=42, chat_id=-1001, message_id=999, status='active', options=["Да", "Нет"])
     
-    # Configure the mock query to return the poll object.
-    mock_session.query.return_value.filter_by.return_value.first.return_value = mock_poll
+    # Configure the mock session to return the poll object.
+    mock_session.get.return_value = mock_poll
 
     # 2. Mock the Telegram Update object
     mock_user = User(id=123, first_name="Тест", is_bot=False, last_name="Тестов", username="test_user")
@@ -276,19 +278,13 @@ async def test_vote_callback_handler_calls_db_correctly(
 
     # --- Act ---
     await voting.vote_callback_handler(mock_update, mock_context)
+    await asyncio.sleep(0.05)  # the leading refresh runs in a task of its own
+    await voting.poll_refresher.shutdown()
 
     # --- Assert ---
-    # 1. Check that participant was added
-    mock_add_participant.assert_called_once_with(
+    # 1-2. Check that user, participant and response were recorded in one call
+    mock_record_vote.assert_called_once_with(
         chat_id=-1001,
-        user_id=123,
-        username="test_user",
-        first_name="Тест",
-        last_name="Тестов",
-    )
-
-    # 2. Check that the response was added/updated
-    mock_add_response.assert_called_once_with(
         poll_id=42,
         user_id=123,
         first_name="Тест",
@@ -306,10 +302,37 @@ async def test_vote_callback_handler_calls_db_correctly(
     # 5. Check that the poll message is updated
     mock_context.bot.edit_message_text.assert_called_once()
 
+@pytest.mark.asyncio
+@patch('src.handlers.voting.db.SessionLocal')
+@patch('src.handlers.voting.generate_poll_content_async', new_callable=AsyncMock, return_value=("Same caption", None))
+async def test_update_poll_message_skips_identical_output(mock_generate_content, mock_session_local, mock_context):
+    """A second refresh that renders exactly the same output must not call Telegram."""
+    from src import metrics
+    from src.content_hash import published_digests
+
+    published_digests.clear()
+    mock_session = MagicMock()
+    mock_session_local.return_value = mock_session
+    mock_session.get.return_value = Poll(
+        poll_id=43, chat_id=-1001, message_id=1000, status='active', options=["Да", "Нет"], poll_type='native'
+    )
+    skipped_before = metrics.get('poll_edits_skipped')
+
+    await voting.update_poll_message(43, mock_context)
+    await voting.update_poll_message(43, mock_context)
+
+    mock_context.bot.edit_message_text.assert_called_once()
+    assert metrics.get('poll_edits_skipped') == skipped_before + 1
+
+    # A different rendering is published again.
+    mock_generate_content.return_value = ("New caption", None)
+    await voting.update_poll_message(43, mock_context)
+    assert mock_context.bot.edit_message_text.call_count == 2
+
 # --- NEW TESTS FOR HEATMAP DISPLAY IN show_results ---
 
 @pytest.mark.asyncio
-@patch('src.handlers.results.generate_poll_content', return_value=("Caption", io.BytesIO(b"imgbytes")))
+@patch('src.handlers.results.generate_poll_content_async', new_callable=AsyncMock, return_value=("Caption", io.BytesIO(b"imgbytes")))
 async def test_show_results_edits_existing_photo(mock_generate_content, mocker, mock_context):
     """Если сообщение уже содержит фото, show_results должен редактировать медиа."""
     from src.handlers import results
@@ -345,7 +368,7 @@ async def test_show_results_edits_existing_photo(mock_generate_content, mocker,
     context.bot.send_photo.assert_not_called()
 
 @pytest.mark.asyncio
-@patch('src.handlers.results.generate_poll_content', return_value=("Caption", io.BytesIO(b"imgbytes")))
+@patch('src.handlers.results.generate_poll_content_async', new_callable=AsyncMock, return_value=("Caption", io.BytesIO(b"imgbytes")))
 async def test_show_results_sends_photo_when_text(mock_generate_content, mocker, mock_context):
     """Если сообщение было текстовым, show_results должен удалить его и отправить новое фото."""
     from src.handlers import results
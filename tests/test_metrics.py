@@ -0,0 +1,12 @@
+from src import metrics
+
+
+def test_metrics_need_the_configured_token():
+    assert metrics.is_authorized('Bearer s3cret', 's3cret')
+    assert not metrics.is_authorized('Bearer wrong', 's3cret')
+    assert not metrics.is_authorized(None, 's3cret')
+    assert not metrics.is_authorized('s3cret', 's3cret')
+
+def test_metrics_are_closed_without_a_token():
+    assert not metrics.is_authorized('Bearer ', '')
+    assert not metrics.is_authorized('', '')
@@ -0,0 +1,85 @@
+import io
+
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from telegram.error import BadRequest
+
+from src import database as db
+from src import photo_registry as registry
+from src.database import Base, ImageFileId
+
+# --- Fixtures ---
+
+@pytest.fixture
+def session_factory(monkeypatch):
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    monkeypatch.setattr(db, "SessionLocal", factory)
+    registry.photo_registry.clear()
+    yield factory
+    registry.photo_registry.clear()
+    Base.metadata.drop_all(engine)
+
+@pytest.fixture
+def bot():
+    bot = AsyncMock()
+    bot.send_photo.return_value = MagicMock(photo=[MagicMock(file_id="small"), MagicMock(file_id="FILE-1")])
+    bot.edit_message_media.return_value = MagicMock(photo=[MagicMock(file_id="FILE-2")])
+    return bot
+
+# --- Tests ---
+
+async def test_identical_image_is_sent_by_file_id(session_factory, bot):
+    await registry.send_photo(bot, -1001, io.BytesIO(b"heatmap"), caption="a")
+    # Restart: only the table remembers the upload.
+    registry.photo_registry.clear()
+    await registry.send_photo(bot, -1001, io.BytesIO(b"heatmap"), caption="b")
+    await registry.send_photo(bot, -1001, io.BytesIO(b"other"), caption="c")
+
+    photos = [call.kwargs["photo"] for call in bot.send_photo.call_args_list]
+    assert isinstance(photos[0], io.BytesIO)
+    assert photos[1] == "FILE-1"
+    assert isinstance(photos[2], io.BytesIO)
+    session = session_factory()
+    assert session.get(ImageFileId, registry.image_digest(b"heatmap")).file_id == "FILE-1"
+    session.close()
+
+async def test_edit_records_file_id_of_edited_message(session_factory, bot):
+    await registry.edit_photo(bot, -1001, 5, b"heatmap", "caption")
+    await registry.edit_photo(bot, -1001, 5, b"heatmap", "caption")
+
+    first, second = (call.kwargs["media"] for call in bot.edit_message_media.call_args_list)
+    assert first.media.input_file_content == b"heatmap"
+    assert second.media == "FILE-2"
+
+async def test_rejected_file_id_is_forgotten_and_uploaded_again(session_factory, bot):
+    digest = registry.image_digest(b"heatmap")
+    await registry.photo_registry.remember(digest, "STALE")
+    bot.send_photo.side_effect = [BadRequest("Wrong file identifier/http url specified"), bot.send_photo.return_value]
+
+    await registry.send_photo(bot, -1001, b"heatmap")
+
+    assert bot.send_photo.call_count == 2
+    assert bot.send_photo.call_args.kwargs["photo"] == b"heatmap"
+    assert await registry.photo_registry.lookup(digest) == "FILE-1"
+
+async def test_not_modified_is_not_treated_as_stale_file_id(session_factory, bot):
+    digest = registry.image_digest(b"heatmap")
+    await registry.photo_registry.remember(digest, "FILE-2")
+    bot.edit_message_media.side_effect = BadRequest("Message is not modified")
+
+    with pytest.raises(BadRequest):
+        await registry.edit_photo(bot, -1001, 5, b"heatmap", "caption")
+    assert bot.edit_message_media.call_count == 1
+    assert await registry.photo_registry.lookup(digest) == "FILE-2"
+
+def test_empty_placeholder_is_read_once():
+    registry.empty_image.cache_clear()
+    first = registry.empty_image()
+    assert registry.empty_image() is first
+    assert registry.empty_image.cache_info().misses == 1
+    assert first.startswith(b"\x89PNG")
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+from telegram.error import RetryAfter
+
+from src.poll_refresher import PollRefresher
+
+
+class FakeRenderer:
+    """Records refreshes and the 'database state' each one saw."""
+
+    def __init__(self, fail_with=None):
+        self.state = 0
+        self.published = []
+        self.fail_with = list(fail_with or [])
+
+    async def __call__(self, poll_id, context):
+        await asyncio.sleep(0)  # yield like a real edit would
+        if self.fail_with:
+            raise self.fail_with.pop(0)
+        self.published.append((poll_id, self.state, context))
+
+
+@pytest.mark.asyncio
+async def test_single_request_refreshes_immediately():
+    renderer = FakeRenderer()
+    refresher = PollRefresher(renderer, base_window=0.05, max_window=1)
+
+    await refresher.request(1, "ctx")
+    await asyncio.sleep(0.01)
+
+    assert renderer.published == [(1, 0, "ctx")]
+
+@pytest.mark.asyncio
+async def test_request_does_not_wait_for_the_refresh():
+    """The vote handler returns while the leading refresh is still talking to Telegram."""
+    edit = asyncio.Event()
+
+    async def slow_refresh(poll_id, context):
+        await edit.wait()
+
+    refresher = PollRefresher(slow_refresh, base_window=0.05, max_window=1)
+    await asyncio.wait_for(refresher.request(1, None), timeout=1)
+    edit.set()
+    await refresher.shutdown()
+
+@pytest.mark.asyncio
+async def test_inline_refresher_refreshes_in_the_callers_task():
+    renderer = FakeRenderer()
+    refresher = PollRefresher(renderer, base_window=0.05, max_window=1, inline=True)
+
+    await refresher.request(1, "ctx")
+
+    assert renderer.published == [(1, 0, "ctx")]
+
+@pytest.mark.asyncio
+async def test_burst_is_coalesced_and_publishes_latest_state():
+    renderer = FakeRenderer()
+    refresher = PollRefresher(renderer, base_window=0.05, max_window=1)
+
+    # Twenty votes in quick succession.
+    for vote in range(20):
+        renderer.state = vote
+        await refresher.request(1, f"ctx{vote}")
+        await asyncio.sleep(0.001)
+    await asyncio.sleep(0.15)
+
+    # One leading refresh plus one trailing refresh with the final state.
+    assert len(renderer.published) == 2
+    assert renderer.published[-1] == (1, 19, "ctx19")
+
+@pytest.mark.asyncio
+async def test_polls_are_refreshed_independently():
+    renderer = FakeRenderer()
+    refresher = PollRefresher(renderer, base_window=0.05, max_window=1)
+
+    await refresher.request(1, None)
+    await refresher.request(2, None)
+    await asyncio.sleep(0.01)
+
+    assert [poll_id for poll_id, _, _ in renderer.published] == [1, 2]
+
+@pytest.mark.asyncio
+async def test_retry_after_grows_window_and_retries():
+    renderer = FakeRenderer(fail_with=[RetryAfter(0)])
+    refresher = PollRefresher(renderer, base_window=0.02, max_window=1)
+
+    await refresher.request(1, None)
+    await asyncio.sleep(0.01)
+    assert renderer.published == []
+    assert refresher.window(1) == pytest.approx(0.04)
+
+    await asyncio.sleep(0.1)
+    # The failed edit is retried, and success shrinks the window again.
+    assert len(renderer.published) == 1
+    assert refresher.window(1) < 0.04
+
+@pytest.mark.asyncio
+async def test_window_is_capped_and_shutdown_cancels_pending():
+    renderer = FakeRenderer(fail_with=[RetryAfter(30)])
+    refresher = PollRefresher(renderer, base_window=0.01, max_window=0.5)
+
+    await refresher.request(1, None)
+    await asyncio.sleep(0.01)
+
+    assert refresher.window(1) == 0.5
+    await refresher.shutdown()
+    assert renderer.published == []
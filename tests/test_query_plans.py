@@ -0,0 +1,145 @@
+"""
+Index advisor: runs the per-poll / per-chat / per-user data-access functions
+against a seeded SQLite database, records every statement they issue and fails
+if the plan of any of them scans a whole table (``EXPLAIN QUERY PLAN`` reports
+``SCAN <table>`` instead of ``SEARCH <table> USING ...``).
+
+Functions that are meant to read whole tables (exports, repairs without a poll
+filter) are not listed here.
+"""
+import re
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from src import database as db
+from src.database import Base, Participant, Poll, PollExclusion, PollSetting, Response, User
+from src.snapshot import load_poll_snapshot
+
+CHATS = (-1001, -1002, -1003)
+POLLS_PER_CHAT = 10
+USERS = 60
+
+# --- Fixtures ---
+
+@pytest.fixture
+def engine(monkeypatch):
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    monkeypatch.setattr(db, "SessionLocal", factory)
+
+    session = factory()
+    session.add_all(User(user_id=u, first_name=f"Имя{u}") for u in range(1, USERS + 1))
+    poll_id = 0
+    for chat_id in CHATS:
+        session.add_all(Participant(chat_id=chat_id, user_id=u, first_name=f"Имя{u}", excluded=0) for u in range(1, USERS + 1))
+        for n in range(POLLS_PER_CHAT):
+            poll_id += 1
+            session.add_all([
+                Poll(poll_id=poll_id, chat_id=chat_id, message=f"Опрос {poll_id}", options=["A", "B", "C"],
+                     status=('active', 'closed', 'draft')[n % 3], poll_type='native'),
+                PollSetting(poll_id=poll_id, allow_multiple_answers=bool(n % 2)),
+                PollExclusion(poll_id=poll_id, user_id=USERS),
+            ])
+            session.add_all(Response(poll_id=poll_id, user_id=u, option_index=(u + n) % 3) for u in range(1, USERS, 2))
+    session.commit()
+    session.close()
+    yield engine
+    Base.metadata.drop_all(engine)
+
+def _full_scans(engine, call):
+    """Runs call() and returns the plan lines of its statements that scan a whole table."""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and re.match(r"\s*(SELECT|UPDATE|DELETE|WITH)\b", statement, re.IGNORECASE):
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        call()
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert statements, "the call issued no queries"
+
+    tables = set(Base.metadata.tables)
+    scans = []
+    with engine.connect() as conn:
+        for statement, parameters in statements:
+            for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters):
+                detail = row[-1]
+                match = re.match(r"SCAN (\w+)", detail)
+                if match and match.group(1) in tables:
+                    scans.append(f"{detail}  <-  {' '.join(statement.split())}")
+    return scans
+
+def _session_call(func):
+    """Runs func(session) in a throwaway session (for functions that take one)."""
+    def call():
+        session = db.SessionLocal()
+        try:
+            func(session)
+            session.commit()
+        finally:
+            session.close()
+    return call
+
+VOTER = dict(first_name="Имя3", last_name=None, username=None)
+
+CALLS = {
+    "get_poll": lambda: db.get_poll(5),
+    "get_responses": lambda: db.get_responses(5),
+    "get_response": lambda: db.get_response(5, 3),
+    "get_poll_setting": lambda: db.get_poll_setting(5),
+    "get_poll_option": lambda: db.get_poll_option(5, 1),
+    "get_polls_by_status": lambda: db.get_polls_by_status(-1002, 'active'),
+    "get_participants": lambda: db.get_participants(-1002),
+    "get_participant": lambda: db.get_participant(-1002, 3),
+    "get_poll_exclusions": lambda: db.get_poll_exclusions(5),
+    "toggle_poll_exclusion": lambda: db.toggle_poll_exclusion(5, 7),
+    "get_poll_tallies": lambda: db.get_poll_tallies(5),
+    "check_poll_tallies": _session_call(lambda s: db.check_poll_tallies(s, [5])),
+    "rebuild_poll_tallies": _session_call(lambda s: db.rebuild_poll_tallies(s, [5])),
+    "get_user_name": _session_call(lambda s: db.get_user_name(s, 3)),
+    "resolve_user_names": lambda: db.resolve_user_names(None, [3, 5, 10_000]),
+    "has_user_created_poll_in_chat": lambda: db.has_user_created_poll_in_chat(db.SessionLocal(), 3, -1002),
+    "single_choice_vote": lambda: db.add_or_update_response(4, 3, option_index=2, **VOTER),
+    "multiple_choice_vote": lambda: db.add_or_update_response(5, 3, option_index=2, **VOTER),
+    "record_vote": lambda: db.record_vote(-1001, 5, 3, option_index=2, **VOTER),
+    "record_vote_text": lambda: db.record_vote(-1001, 5, 3, option_text="B", **VOTER),
+    "record_vote_renamed_voter": lambda: db.record_vote(-1001, 5, 3, option_index=2, **dict(VOTER, first_name="Новое имя")),
+    "add_user_to_participants": lambda: db.add_user_to_participants(-1003, 3, None, "Имя3", None),
+    "update_known_chats": lambda: db.update_known_chats(-1003, "Чат", "group"),
+    "get_group_title": lambda: db.get_group_title(-1003),
+    "record_activity": lambda: db.record_activity([db.ChatActivity(-1003, "Чат", "group")],
+                                                  [db.ParticipantActivity(-1003, 3, None, "Имя3", ""),
+                                                   db.ParticipantActivity(-1003, USERS + 1, None, "Новый", "")]),
+    "delete_responses_for_poll": lambda: db.delete_responses_for_poll(6),
+    "delete_participants": lambda: db.delete_participants(-1003),
+    "load_poll_snapshot": lambda: load_poll_snapshot(5),
+    "release_update": lambda: (db.claim_update(42, 1.0), db.release_update(42)),
+    "prune_processed_updates": lambda: db.prune_processed_updates(before=100.0),
+    "image_file_ids": lambda: (db.save_image_file_id("ab" * 32, "file"), db.get_image_file_id("ab" * 32),
+                               db.delete_image_file_id("ab" * 32)),
+}
+
+# --- Tests ---
+
+@pytest.mark.parametrize("name", sorted(CALLS))
+def test_no_full_table_scans(engine, name):
+    scans = _full_scans(engine, CALLS[name])
+    assert not scans, f"{name} scans whole tables:\n" + "\n".join(scans)
+
+def test_advisor_detects_full_scan(engine):
+    """The harness itself: an unindexed filter is reported."""
+    def unindexed():
+        session = db.SessionLocal()
+        try:
+            session.query(User).filter(User.first_name == "Имя3").all()
+        finally:
+            session.close()
+
+    assert _full_scans(engine, unindexed)
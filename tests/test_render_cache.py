@@ -0,0 +1,193 @@
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from telegram import CallbackQuery
+
+from src import database as db
+from src import display
+from src.database import Base, Poll, PollSetting, Participant
+from src.render_cache import RenderCache, render_cache
+from src.render_pool import RenderPool
+from src.handlers import dashboard
+
+# --- Fixtures ---
+
+@pytest.fixture
+def session_factory(monkeypatch):
+    """In-memory SQLite shared by every session the code under test opens."""
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    monkeypatch.setattr(db, "SessionLocal", factory)
+    render_cache.clear()
+    yield factory
+    render_cache.clear()
+    Base.metadata.drop_all(engine)
+
+@pytest.fixture
+def poll(session_factory):
+    session = session_factory()
+    session.add_all([
+        Poll(poll_id=1, chat_id=-1001, message="Q", options=["A", "B"], status='active', poll_type='native'),
+        PollSetting(poll_id=1, show_heatmap=True, show_text_results=True),
+        Participant(chat_id=-1001, user_id=10, first_name="Ann", excluded=0),
+    ])
+    session.commit()
+    session.close()
+
+def _version(factory, poll_id=1):
+    session = factory()
+    try:
+        return session.query(Poll.version).filter_by(poll_id=poll_id).scalar()
+    finally:
+        session.close()
+
+def _vote(user_id=10, option_index=0):
+    db.add_or_update_response(poll_id=1, user_id=user_id, first_name="Ann", last_name=None, username=None, option_index=option_index)
+
+# --- Version bumps ---
+
+def test_vote_bumps_version(session_factory, poll):
+    before = _version(session_factory)
+    _vote()
+    assert _version(session_factory) > before
+
+def test_settings_and_exclusions_bump_version(session_factory, poll):
+    v0 = _version(session_factory)
+
+    setting = db.get_poll_setting(1)
+    setting.default_show_names = False
+    db.commit_session(setting)
+    v1 = _version(session_factory)
+
+    db.toggle_poll_exclusion(1, 10)
+    v2 = _version(session_factory)
+
+    session = session_factory()
+    session.query(Participant).filter_by(chat_id=-1001, user_id=10).one().excluded = 1
+    session.commit()
+    session.close()
+    v3 = _version(session_factory)
+
+    assert v0 < v1 < v2 < v3
+
+def test_non_render_changes_keep_version(session_factory, poll):
+    before = _version(session_factory)
+
+    session = session_factory()
+    p = session.query(Poll).filter_by(poll_id=1).one()
+    p.message_id = 555
+    session.commit()
+    session.close()
+    # Re-registering a known participant with the same data changes nothing.
+    db.add_user_to_participants(chat_id=-1001, user_id=10, username=None, first_name="Ann", last_name=None)
+
+    assert _version(session_factory) == before
+
+def test_status_change_bumps_version(session_factory, poll):
+    before = _version(session_factory)
+    session = session_factory()
+    session.query(Poll).filter_by(poll_id=1).one().status = 'closed'
+    session.commit()
+    session.close()
+    assert _version(session_factory) == before + 1
+
+# --- Render cache ---
+
+def test_repeat_view_costs_zero_renders(session_factory, poll, mocker):
+    _vote()
+    render = mocker.spy(display, "render_poll_content")
+
+    first = display.generate_poll_content(poll_id=1)
+    second = display.generate_poll_content(poll_id=1)
+
+    assert render.call_count == 1
+    assert first[0] == second[0]
+    assert first[1].getvalue() == second[1].getvalue()
+
+    # A new vote produces a new version and a fresh render.
+    _vote(option_index=1)
+    third = display.generate_poll_content(poll_id=1)
+    assert render.call_count == 2
+    assert "B: *1*" in third[0]
+
+@pytest.mark.asyncio
+async def test_reopened_poll_is_not_shown_as_closed(session_factory, poll, mocker):
+    mocker.patch('src.handlers.dashboard.show_poll_list', new_callable=AsyncMock)
+    query, context = AsyncMock(spec=CallbackQuery), MagicMock()
+    context.bot.send_message = AsyncMock(return_value=MagicMock(message_id=5))
+
+    await dashboard.close_poll(query, context, 1)  # renders and caches the closed poll
+    await dashboard.reopen_poll(query, context, 1)
+
+    text = context.bot.send_message.call_args.kwargs['text']
+    assert "ОПРОС ЗАВЕРШЕН" not in text
+    session = session_factory()
+    try:
+        assert session.get(Poll, 1).status == 'active'
+    finally:
+        session.close()
+
+def test_lru_evicts_by_entries_and_bytes():
+    cache = RenderCache(max_entries=2, max_bytes=100)
+    cache.put(1, 1, "a", b"x" * 10)
+    cache.put(2, 1, "b", b"x" * 10)
+    assert cache.get(1, 1) is not None  # 1 becomes most recently used
+    cache.put(3, 1, "c", b"x" * 10)
+
+    assert cache.get(2, 1) is None
+    assert cache.get(1, 1) is not None
+
+    cache.put(4, 1, "d", b"x" * 95)
+    assert len(cache) == 1
+    assert cache.size_bytes <= 100
+
+    # Entries larger than the whole cache are not stored at all.
+    cache.put(5, 1, "e", b"x" * 200)
+    assert cache.get(5, 1) is None
+
+@pytest.mark.asyncio
+async def test_async_generation_draws_in_render_pool_once(session_factory, poll, mocker):
+    _vote()
+    run = mocker.spy(display.render_pool, "run")
+
+    first = await display.generate_poll_content_async(poll_id=1)
+    second = await display.generate_poll_content_async(poll_id=1)
+
+    # The second call is answered from the cache without a render job.
+    assert run.call_count == 1
+    assert first[0] == second[0]
+    assert "A: *1*" in first[0]
+
+@pytest.mark.asyncio
+async def test_suite_renders_inline(session_factory, poll, mocker):
+    # pytest.ini sets RENDER_WORKERS=0 for the handler tests.
+    assert display.render_pool.inline
+    render = mocker.spy(display, "render_poll_content")
+    await display.generate_poll_content_async(poll_id=1)
+    assert render.call_count == 1
+
+@pytest.mark.asyncio
+async def test_pooled_generation_draws_in_a_render_thread(session_factory, poll, monkeypatch):
+    import threading
+    pool = RenderPool(workers=1, max_pending=2)
+    monkeypatch.setattr(display, "render_pool", pool)
+    threads = []
+    original = display.render_poll_content
+
+    def render(snapshot):
+        threads.append(threading.current_thread().name)
+        return original(snapshot)
+
+    monkeypatch.setattr(display, "render_poll_content", render)
+    _vote()
+    try:
+        text, _ = await display.generate_poll_content_async(poll_id=1)
+    finally:
+        pool.shutdown()
+
+    assert "A: *1*" in text
+    assert len(threads) == 1 and threads[0].startswith('render')
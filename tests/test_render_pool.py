@@ -0,0 +1,55 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from src import metrics
+from src.render_pool import RenderPool
+
+
+@pytest.mark.asyncio
+async def test_render_runs_off_the_event_loop_thread():
+    pool = RenderPool(workers=2, max_pending=4)
+    try:
+        name = await pool.run(lambda: threading.current_thread().name)
+    finally:
+        pool.shutdown()
+
+    assert name.startswith('render')
+
+@pytest.mark.asyncio
+async def test_inline_mode_renders_in_the_caller():
+    pool = RenderPool(workers=0)
+
+    name = await pool.run(lambda: threading.current_thread().name)
+
+    assert pool.inline
+    assert name == threading.current_thread().name
+
+@pytest.mark.asyncio
+async def test_pending_renders_are_bounded():
+    pool = RenderPool(workers=1, max_pending=2)
+    running, peak = 0, 0
+    lock = threading.Lock()
+
+    def render():
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.02)
+        with lock:
+            running -= 1
+        return True
+
+    waits_before = metrics.get('render_backpressure_waits')
+    try:
+        results = await asyncio.gather(*(pool.run(render) for _ in range(6)))
+    finally:
+        pool.shutdown()
+
+    assert all(results)
+    assert peak == 1
+    # Only two renders may be queued or running; the other callers had to wait.
+    assert metrics.get('render_backpressure_waits') - waits_before >= 4
@@ -0,0 +1,130 @@
+import asyncio
+import functools
+import multiprocessing
+import time
+
+import pytest
+from telegram import Update
+
+from src import metrics
+from src.sharding import ShardRouter, consume, shard_of
+
+
+def message(update_id, chat_id, user_id=1):
+    return {
+        'update_id': update_id,
+        'message': {'message_id': update_id, 'date': 0, 'text': 'hi',
+                    'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'},
+                    'from': {'id': user_id, 'is_bot': False, 'first_name': 'Участник'}},
+    }
+
+def button(update_id, chat_id, user_id):
+    return {
+        'update_id': update_id,
+        'callback_query': {'id': str(update_id), 'chat_instance': 'x', 'data': 'dash:1',
+                           'from': {'id': user_id, 'is_bot': False, 'first_name': 'Участник'},
+                           'message': {'message_id': 1, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}}},
+    }
+
+def update(data):
+    return Update.de_json(data, None)
+
+
+# Worker processes (spawned: they must be importable by name).
+
+def echo_worker(results, index, inbox):
+    async def handle(payload):
+        results.put((index, payload['message']['chat']['id'], payload['update_id']))
+    asyncio.run(consume(inbox, handle))
+
+def crashing_worker(results, index, inbox):
+    async def handle(payload):
+        if payload['message']['text'] == 'crash':
+            raise SystemExit(3)
+        results.put((index, payload['update_id']))
+    asyncio.run(consume(inbox, handle))
+
+def stuck_worker(index, inbox):
+    time.sleep(60)
+
+
+def collect(results, count, timeout=30):
+    got = []
+    deadline = time.monotonic() + timeout
+    while len(got) < count:
+        got.append(results.get(timeout=max(0.1, deadline - time.monotonic())))
+    return got
+
+
+def test_shard_of_keeps_a_chat_and_its_user_together():
+    assert shard_of(update(message(1, -1001)), 4) == shard_of(update(message(2, -1001, user_id=7)), 4)
+    # Text typed into the dashboard wizard and its buttons: the user's private chat.
+    assert shard_of(update(message(3, 42, user_id=42)), 4) == shard_of(update(button(4, 42, 42)), 4)
+    spread = {shard_of(update(message(n, -100 - n)), 4) for n in range(100)}
+    assert spread == {0, 1, 2, 3}
+
+@pytest.mark.asyncio
+async def test_each_chat_is_handled_by_one_worker_in_order():
+    metrics.reset()
+    results = multiprocessing.get_context('spawn').Queue()
+    router = ShardRouter(functools.partial(echo_worker, results), workers=3, queue_size=100)
+    router.start()
+    try:
+        traffic = [message(update_id, -100 - update_id % 10) for update_id in range(60)]
+        for data in traffic:
+            assert router.route(update(data), data)
+        got = await asyncio.to_thread(collect, results, len(traffic))
+    finally:
+        await router.stop(drain_timeout=10)
+
+    per_chat = {}
+    for index, chat_id, update_id in got:
+        per_chat.setdefault(chat_id, []).append((index, update_id))
+    assert len(per_chat) == 10
+    for handled in per_chat.values():
+        assert len({index for index, _ in handled}) == 1
+        assert [update_id for _, update_id in handled] == sorted(update_id for _, update_id in handled)
+    assert metrics.get('shard_updates_routed') == 60
+    assert not router.running and router.alive() == 0
+
+@pytest.mark.asyncio
+async def test_full_inbox_is_refused_and_stuck_worker_terminated():
+    metrics.reset()
+    router = ShardRouter(stuck_worker, workers=1, queue_size=1)
+    router.start()
+    try:
+        first, second = message(1, -1), message(2, -1)
+        assert router.route(update(first), first)
+        await asyncio.sleep(0.2)  # the feeder thread moves it into the pipe, the semaphore stays taken
+        assert not router.route(update(second), second)
+        assert metrics.get('shard_updates_rejected') == 1
+        process = router._processes[0]
+    finally:
+        started = time.monotonic()
+        await router.stop(drain_timeout=0.5)
+    assert time.monotonic() - started < 10
+    assert not process.is_alive()
+
+@pytest.mark.asyncio
+async def test_dead_worker_is_started_again():
+    metrics.reset()
+    results = multiprocessing.get_context('spawn').Queue()
+    router = ShardRouter(functools.partial(crashing_worker, results), workers=1, queue_size=10)
+    router.start()
+    try:
+        crash = message(1, -1)
+        crash['message']['text'] = 'crash'
+        assert router.route(update(crash), crash)
+        await asyncio.to_thread(router._processes[0].join, 30)
+
+        after = message(2, -1)
+        assert router.route(update(after), after)
+        assert await asyncio.to_thread(collect, results, 1) == [(0, 2)]
+        assert metrics.get('shard_worker_restarts') == 1
+    finally:
+        await router.stop(drain_timeout=10)
+
+def test_route_refuses_when_not_started():
+    router = ShardRouter(stuck_worker, workers=1)
+    data = message(1, -1)
+    assert router.route(update(data), data) is False
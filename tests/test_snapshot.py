@@ -0,0 +1,157 @@
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from src.database import (
+    Base, Poll, Participant, Response, PollSetting, PollExclusion, User, FREE_TEXT_OPTION
+)
+from src.display import generate_poll_content, build_nudge_text, render_poll_content
+from src.snapshot import load_poll_snapshot
+from src.render_cache import render_cache
+
+OPTIONS = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб"]
+
+# --- Fixtures ---
+
+@pytest.fixture(autouse=True)
+def empty_render_cache():
+    render_cache.clear()
+    yield
+    render_cache.clear()
+
+@pytest.fixture(scope="function")
+def engine():
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    yield engine
+    Base.metadata.drop_all(engine)
+
+@pytest.fixture
+def db_session(engine):
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+@pytest.fixture
+def query_counter(engine):
+    """Counts SELECT statements sent to the engine."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    yield statements
+    event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+def _make_poll(session, voters: int) -> Poll:
+    poll = Poll(poll_id=1, chat_id=-1001, message="Когда встречаемся?", options=list(OPTIONS), status='active', poll_type='native')
+    session.add_all([
+        poll,
+        PollSetting(poll_id=1, default_show_names=True, show_heatmap=True, show_text_results=True),
+    ])
+    for option in poll.option_rows:
+        option.emoji = "✅"
+    for i in range(voters):
+        uid = 1000 + i
+        session.add(User(user_id=uid, first_name=f"Имя{i}"))
+        session.add(Participant(chat_id=-1001, user_id=uid, first_name=f"Имя{i}", excluded=0))
+        session.add(Response(poll_id=1, user_id=uid, response=OPTIONS[i % len(OPTIONS)]))
+    session.commit()
+    return poll
+
+# --- Tests ---
+
+@pytest.mark.parametrize("voters", [1, 40])
+def test_snapshot_query_count_is_constant(db_session, query_counter, voters):
+    """The number of queries does not grow with voters or options."""
+    _make_poll(db_session, voters)
+    db_session.expunge_all()
+    query_counter.clear()
+
+    snapshot = load_poll_snapshot(1, session=db_session)
+
+    assert len(query_counter) <= 8
+    assert len(snapshot.responses) == voters
+    assert len(snapshot.option_settings) == len(OPTIONS)
+    assert snapshot.user_name(1000) == "Имя0"
+
+def test_generate_poll_content_uses_snapshot_only(db_session, query_counter, mocker):
+    """Rendering text and heatmap for a 40-voter, 6-option poll stays within the snapshot queries."""
+    _make_poll(db_session, 40)
+    db_session.expunge_all()
+    query_counter.clear()
+
+    text, image = generate_poll_content(poll_id=1, session=db_session)
+
+    assert len(query_counter) <= 8
+    assert "Всего проголосовало: *40*" in text
+    assert "✅ [Имя0](tg://user?id=1000)" in text
+    assert image is not None
+
+def test_snapshot_name_falls_back_to_participant(db_session):
+    """Voters missing from the users table are named from their participant row."""
+    db_session.add_all([
+        Poll(poll_id=5, chat_id=-2002, message="Q", options=["A", "B"], status='active'),
+        Participant(chat_id=-9999, user_id=77, first_name="Гость", excluded=0),
+        Response(poll_id=5, user_id=77, response="A"),
+        Response(poll_id=5, user_id=78, response="B"),
+    ])
+    db_session.commit()
+
+    snapshot = load_poll_snapshot(5, session=db_session)
+
+    assert snapshot.user_name(77) == "Гость"
+    assert snapshot.user_name(78) == "User 78"
+
+def test_snapshot_is_immutable(db_session):
+    _make_poll(db_session, 2)
+    snapshot = load_poll_snapshot(1, session=db_session)
+
+    with pytest.raises(AttributeError):
+        snapshot.status = 'closed'
+    with pytest.raises(TypeError):
+        snapshot.users[1000] = None
+
+def test_nudge_text_skips_voters_and_exclusions(db_session):
+    _make_poll(db_session, 2)
+    db_session.add_all([
+        Participant(chat_id=-1001, user_id=5, first_name="Молчун", excluded=0),
+        Participant(chat_id=-1001, user_id=6, first_name="Исключён", excluded=0),
+        PollExclusion(poll_id=1, user_id=6),
+    ])
+    db_session.commit()
+
+    snapshot = load_poll_snapshot(1, session=db_session)
+    text = build_nudge_text(1, snapshot=snapshot)
+
+    assert "Молчун" in text
+    assert "Исключён" not in text
+    assert "Имя0" not in text
+
+def test_counts_only_caption_reads_the_tallies(db_session, query_counter):
+    """Without names and heatmap the caption comes from poll_option_tallies, not from the responses."""
+    _make_poll(db_session, 40)
+    setting = db_session.get(PollSetting, 1)
+    setting.default_show_names, setting.show_heatmap = False, False
+    db_session.add(Response(poll_id=1, user_id=1000, option_index=FREE_TEXT_OPTION, response="Никогда"))
+    db_session.commit()
+    db_session.expunge_all()
+    query_counter.clear()
+
+    snapshot = load_poll_snapshot(1, session=db_session, allow_counts_only=True)
+
+    assert snapshot.responses == () and snapshot.users == {}
+    assert not any("FROM responses" in statement for statement in query_counter)
+    assert snapshot.voter_count == 40
+    full = load_poll_snapshot(1, session=db_session)
+    assert full.tallies is None
+    caption, image = render_poll_content(snapshot)
+    assert "Пн: *7*" in caption and "Всего проголосовало: *40*" in caption and image is None
+    assert (caption, image) == render_poll_content(full)
+
+    # Names shown under one option: the votes are needed again.
+    db_session.query(Poll).one().option_rows[0].show_names = 1
+    db_session.commit()
+    assert load_poll_snapshot(1, session=db_session, allow_counts_only=True).tallies is None
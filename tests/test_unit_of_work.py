@@ -0,0 +1,157 @@
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from src import async_database as adb
+from src import database as db
+from src import unit_of_work
+from src.activity_buffer import ActivityBuffer
+from src.database import Base, Poll, PollSetting, Response
+from src.handlers import base
+
+# --- Fixtures ---
+
+@pytest.fixture
+def engine(monkeypatch, tmp_path):
+    # A file database: other connections must not see uncommitted changes of the unit of work.
+    engine = create_engine(f"sqlite:///{tmp_path / 'uow.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+    monkeypatch.setattr(db, "SessionLocal", factory)
+    session = factory()
+    session.add_all([Poll(poll_id=1, chat_id=-1001, message="Опрос", options=["A", "B"], status='active'),
+                     PollSetting(poll_id=1, allow_multiple_answers=False)])
+    session.commit()
+    session.close()
+    yield engine
+    Base.metadata.drop_all(engine)
+
+def _count(engine, event_name):
+    calls = []
+    event.listen(engine, event_name, lambda *args: calls.append(1))
+    return calls
+
+def _stored_status(engine):
+    with engine.connect() as conn:
+        return conn.exec_driver_sql("SELECT status FROM polls WHERE poll_id = 1").scalar()
+
+# --- Tests ---
+
+@pytest.mark.asyncio
+async def test_update_shares_one_session(engine):
+    """All helpers of an update share one connection; loaded objects stay attached and come from the identity map."""
+    checkouts = _count(engine, "checkout")
+    selects = []
+    event.listen(engine, "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: selects.append(statement) if statement.startswith("SELECT polls") else None)
+    context = MagicMock()
+
+    await base.begin_unit_of_work(None, context)
+    poll = await adb.get_poll(1)
+    setting = await adb.run_sync(db.get_poll_setting, 1)
+    assert await adb.get_poll(1) is poll
+    assert len(selects) == 1
+    assert len(checkouts) == 1
+
+    poll.status = 'closed'
+    setting.allow_multiple_answers = True  # attached: no detached copy to merge
+    assert _stored_status(engine) == 'active'
+    await base.finish_unit_of_work(None, context)
+
+    assert _stored_status(engine) == 'closed'
+    assert db.get_poll_setting(1).allow_multiple_answers is True
+    assert unit_of_work.current() is None
+
+@pytest.mark.asyncio
+async def test_helpers_commit_before_the_handler_goes_on(engine):
+    """No write lock is held after a helper returns: its write is committed, the handler's own changes wait."""
+    context = MagicMock()
+    await base.begin_unit_of_work(None, context)
+    try:
+        (await adb.get_poll(1)).message = "Новый заголовок"
+        await adb.run_sync(db.update_known_chats, -1001, "Чат", "group")
+        with engine.connect() as conn:
+            assert conn.exec_driver_sql("SELECT title FROM known_chats").scalar() == "Чат"
+        # Changes pending in the session go with the helper's commit.
+        with engine.connect() as conn:
+            assert conn.exec_driver_sql("SELECT message FROM polls").scalar() == "Новый заголовок"
+        (await adb.get_poll(1)).status = 'closed'
+        assert _stored_status(engine) == 'active'
+        await adb.commit_session()
+        assert _stored_status(engine) == 'closed'
+    finally:
+        await base.finish_unit_of_work(None, context)
+
+@pytest.mark.asyncio
+async def test_failing_helper_rolls_back_only_its_savepoint(engine, monkeypatch):
+    context = MagicMock()
+    await base.begin_unit_of_work(None, context)
+    try:
+        await adb.run_sync(db.add_response, Response(poll_id=1, user_id=5, option_index=0))
+        (await adb.get_poll(1)).status = 'closed'
+
+        def fail(*args, **kwargs):
+            raise RuntimeError("boom")
+        monkeypatch.setattr(db, "bump_poll_versions", fail)
+        await adb.run_sync(db.delete_responses_for_poll, 1)  # logged and undone
+    finally:
+        await base.finish_unit_of_work(None, context)
+
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("SELECT COUNT(*) FROM responses").scalar() == 1
+    assert _stored_status(engine) == 'closed'
+
+@pytest.mark.asyncio
+async def test_error_handler_rolls_back(engine):
+    context = MagicMock()
+    await base.begin_unit_of_work(None, context)
+    (await adb.get_poll(1)).status = 'closed'
+    error_context = MagicMock()
+    error_context.error = RuntimeError("boom")
+    await base.error_handler(None, error_context)
+    await base.finish_unit_of_work(None, context)
+    assert _stored_status(engine) == 'active'
+
+@pytest.mark.asyncio
+async def test_activity_written_during_an_update_survives_its_rollback(engine):
+    """The buffer marks entries written once record_activity returns: they are committed apart from the update."""
+    buffer = ActivityBuffer(interval=0)
+    context = MagicMock()
+    await base.begin_unit_of_work(None, context)
+    (await adb.get_poll(1)).status = 'closed'
+    await buffer.note_chat(-1001, "Чат", "group")
+    error_context = MagicMock()
+    error_context.error = RuntimeError("boom")
+    await base.error_handler(None, error_context)
+    await base.finish_unit_of_work(None, context)
+
+    assert buffer.pending() == 0
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("SELECT title FROM known_chats WHERE chat_id = -1001").scalar() == "Чат"
+    assert _stored_status(engine) == 'active'
+
+@pytest.mark.asyncio
+async def test_spawned_tasks_use_their_own_sessions(engine):
+    context = MagicMock()
+    await base.begin_unit_of_work(None, context)
+    uow = context.unit_of_work
+    try:
+        async def background():
+            assert unit_of_work.current() is None
+            return await adb.get_poll(1)
+
+        poll = await asyncio.create_task(background())
+        assert poll is not None and poll not in uow.session
+        assert unit_of_work.current() is uow
+    finally:
+        await base.finish_unit_of_work(None, context)
+
+def test_helpers_without_unit_of_work_return_usable_objects(engine):
+    """Outside an update helpers keep opening (and closing) their own sessions."""
+    setting = db.get_poll_setting(1)
+    setting.allow_multiple_answers = True
+    db.commit_session(setting)
+    assert db.get_poll_setting(1).allow_multiple_answers is True
@@ -0,0 +1,94 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from src import database as db
+from src import metrics
+from src.database import Base, ProcessedUpdate
+from src.update_dedup import DatabaseUpdateDeduplicator, UpdateDeduplicator, make_deduplicator
+
+
+class FakeClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+# --- In-process ---
+
+@pytest.mark.asyncio
+async def test_redelivery_is_suppressed_and_counted():
+    metrics.reset()
+    dedup = UpdateDeduplicator(ttl=60, max_entries=10)
+
+    assert await dedup.claim(1) is True
+    assert await dedup.claim(2) is True
+    assert await dedup.claim(1) is False
+
+    assert metrics.get('update_dedup_hits') == 1
+    assert metrics.get('update_dedup_misses') == 2
+
+@pytest.mark.asyncio
+async def test_entries_expire_and_are_bounded():
+    clock = FakeClock()
+    dedup = UpdateDeduplicator(ttl=60, max_entries=3, clock=clock)
+
+    for update_id in range(5):
+        await dedup.claim(update_id)
+    assert len(dedup) == 3
+    assert await dedup.claim(0) is True       # dropped as the oldest
+    assert await dedup.claim(4) is False
+
+    clock.now = 61
+    assert await dedup.claim(4) is True       # expired
+    assert len(dedup) == 1                    # the other expired entries were dropped too
+
+@pytest.mark.asyncio
+async def test_released_update_is_processed_on_redelivery():
+    dedup = UpdateDeduplicator(ttl=60)
+    await dedup.claim(7)
+    await dedup.release(7)
+    assert await dedup.claim(7) is True
+
+@pytest.mark.asyncio
+async def test_off_mode_never_drops_updates():
+    dedup = make_deduplicator('off')
+    assert await dedup.claim(1) and await dedup.claim(1)
+
+# --- Shared through the database ---
+
+@pytest.fixture
+def engine(monkeypatch, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'dedup.db'}")
+    Base.metadata.create_all(engine)
+    monkeypatch.setattr(db, "SessionLocal", sessionmaker(bind=engine, autocommit=False, autoflush=False))
+    yield engine
+    Base.metadata.drop_all(engine)
+
+@pytest.mark.asyncio
+async def test_processes_share_claims_through_the_database(engine):
+    wall = FakeClock(1_000_000.0)
+    worker_a = DatabaseUpdateDeduplicator(ttl=60, wall_clock=wall)
+    worker_b = DatabaseUpdateDeduplicator(ttl=60, wall_clock=wall)
+
+    assert await worker_a.claim(10) is True
+    assert await worker_b.claim(10) is False  # delivered again, to the other process
+    assert await worker_a.claim(10) is False  # answered from memory
+    assert len(worker_b) == 0                 # not its own claim: worker_a may still release it
+
+    await worker_a.release(10)
+    assert await worker_b.claim(10) is True
+
+def test_prune_processed_updates(engine):
+    assert db.claim_update(1, received_at=100.0)
+    assert db.claim_update(2, received_at=200.0)
+    assert not db.claim_update(2, received_at=300.0)
+
+    assert db.prune_processed_updates(before=150.0) == 1
+    session = db.SessionLocal()
+    try:
+        assert [row.update_id for row in session.query(ProcessedUpdate)] == [2]
+    finally:
+        session.close()
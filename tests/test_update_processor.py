@@ -0,0 +1,133 @@
+import asyncio
+import random
+import time
+
+import pytest
+from telegram import Update
+
+from src.update_processor import KeyedUpdateProcessor, update_key
+
+
+def _vote(update_id, chat_id, user_id=1):
+    return Update.de_json({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id), "chat_instance": "ci", "data": f"vote:{chat_id}:0",
+            "from": {"id": user_id, "is_bot": False, "first_name": "U"},
+            "message": {"message_id": 1, "date": 0, "chat": {"id": chat_id, "type": "supergroup"}},
+        },
+    }, None)
+
+
+class Recorder:
+    """Handler stand-in: records the order updates were handled in, per chat, and overlaps."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.order = {}
+        self.running = 0
+        self.max_running = 0
+        self.running_per_chat = {}
+
+    async def handle(self, update, delay=None):
+        chat_id = update.effective_chat.id
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        self.running_per_chat[chat_id] = self.running_per_chat.get(chat_id, 0) + 1
+        assert self.running_per_chat[chat_id] == 1, f"two updates of chat {chat_id} ran at once"
+        try:
+            await asyncio.sleep(self.delay if delay is None else delay)
+            self.order.setdefault(chat_id, []).append(update.update_id)
+        finally:
+            self.running -= 1
+            self.running_per_chat[chat_id] -= 1
+
+
+def test_update_key():
+    assert update_key(_vote(1, -1001)) == ('chat', -1001)
+    answer = Update.de_json({"update_id": 2, "poll_answer": {"poll_id": "p1", "option_ids": [0],
+                                                             "user": {"id": 5, "is_bot": False, "first_name": "U"}}}, None)
+    assert update_key(answer) == ('poll', 'p1')
+    assert update_key(Update(update_id=3)) is None
+    assert update_key("not an update") is None
+
+@pytest.mark.asyncio
+async def test_chats_run_in_parallel_and_in_order():
+    recorder = Recorder(delay=0.01)
+    processor = KeyedUpdateProcessor(max_concurrent_updates=4)
+    updates = [_vote(n, -1000 - n % 4) for n in range(20)]
+
+    await asyncio.gather(*(processor.process_update(u, recorder.handle(u)) for u in updates))
+
+    assert recorder.max_running == 4
+    for chat_id, handled in recorder.order.items():
+        assert handled == sorted(handled)
+    assert processor.pending() == 0 and processor.busy_keys() == 0
+
+@pytest.mark.asyncio
+async def test_busy_chat_does_not_stall_other_chats():
+    recorder = Recorder()
+    processor = KeyedUpdateProcessor(max_concurrent_updates=2)
+    busy = [_vote(n, -1001) for n in range(10)]
+    for update in busy:
+        await processor.submit(update, recorder.handle(update, delay=0.02))
+
+    started = time.perf_counter()
+    quiet = _vote(100, -1002)
+    await (await processor.submit(quiet, recorder.handle(quiet, delay=0)))
+    assert time.perf_counter() - started < 0.05   # not behind the ten updates of the busy chat
+    assert len(recorder.order.get(-1001, [])) < 10
+
+    await processor.shutdown()
+    assert recorder.order[-1001] == list(range(10))
+
+@pytest.mark.asyncio
+async def test_backpressure_keeps_submission_order():
+    recorder = Recorder(delay=0.001)
+    processor = KeyedUpdateProcessor(max_concurrent_updates=3, max_pending=3)
+    updates = [_vote(n, -1000 - n % 2) for n in range(30)]
+
+    # Submitted from concurrent tasks in order, most of them have to wait for a place.
+    waiting = [asyncio.create_task(processor.submit(u, recorder.handle(u))) for u in updates]
+    await asyncio.gather(*await asyncio.gather(*waiting))
+
+    assert recorder.order[-1000] == list(range(0, 30, 2))
+    assert recorder.order[-1001] == list(range(1, 30, 2))
+
+@pytest.mark.asyncio
+async def test_failing_update_does_not_block_its_chat():
+    processor = KeyedUpdateProcessor()
+    handled = []
+
+    async def handle(n):
+        if n == 1:
+            raise RuntimeError("boom")
+        handled.append(n)
+
+    futures = [await processor.submit(_vote(n, -1001), handle(n)) for n in range(3)]
+    await asyncio.gather(*futures, return_exceptions=True)
+
+    assert handled == [0, 2]
+    assert isinstance(futures[1].exception(), RuntimeError)
+
+@pytest.mark.asyncio
+async def test_interleaved_vote_traffic_for_100_chats():
+    """Load test: 100 chats, 20 votes each, interleaved as they would arrive; handlers take 0-2 ms."""
+    rng = random.Random(7)
+    arrivals = [chat for chat in range(100) for _ in range(20)]
+    rng.shuffle(arrivals)
+    updates = [_vote(update_id, -1000 - chat, user_id=rng.randrange(50)) for update_id, chat in enumerate(arrivals)]
+    delays = {u.update_id: rng.random() * 0.002 for u in updates}
+
+    recorder = Recorder()
+    processor = KeyedUpdateProcessor(max_concurrent_updates=16, max_pending=64)
+    started = time.perf_counter()
+    await asyncio.gather(*(processor.process_update(u, recorder.handle(u, delays[u.update_id])) for u in updates))
+    elapsed = time.perf_counter() - started
+
+    assert sum(len(handled) for handled in recorder.order.values()) == 2000
+    for chat_id, handled in recorder.order.items():
+        assert handled == sorted(handled), f"chat {chat_id} out of order"
+    assert recorder.max_running == 16
+    # Serially this takes about sum(delays) (~2 s); in parallel a fraction of it.
+    assert elapsed < sum(delays.values()) / 3
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+from telegram import Update
+
+from src import metrics
+from src.update_queue import UpdateQueue, parse_update
+
+
+class SlowProcessor:
+    """Records processed update ids; every update takes ``delay`` seconds."""
+
+    def __init__(self, delay=0.0, fail_on=()):
+        self.delay = delay
+        self.fail_on = set(fail_on)
+        self.processed = []
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, update):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+            if update.update_id in self.fail_on:
+                raise RuntimeError("boom")
+            self.processed.append(update.update_id)
+        finally:
+            self.running -= 1
+
+
+def _update(update_id):
+    return Update(update_id=update_id)
+
+
+def test_parse_update_validates_payload():
+    assert parse_update({"update_id": 7, "message": None}, None).update_id == 7
+    assert parse_update({"message": {}}, None) is None
+    assert parse_update({"update_id": "7"}, None) is None
+    assert parse_update([1, 2], None) is None
+
+@pytest.mark.asyncio
+async def test_enqueue_returns_before_processing_and_workers_drain():
+    processor = SlowProcessor(delay=0.02)
+    queue = UpdateQueue(processor, workers=3, max_size=10)
+    queue.start()
+
+    assert all(queue.enqueue(_update(n)) for n in range(6))
+    assert processor.processed == []
+    await queue.stop()
+
+    assert sorted(processor.processed) == list(range(6))
+    assert processor.max_running == 3
+
+@pytest.mark.asyncio
+async def test_full_queue_rejects_updates():
+    metrics.reset()
+    processor = SlowProcessor(delay=0.05)
+    queue = UpdateQueue(processor, workers=1, max_size=2)
+    queue.start()
+
+    results = [queue.enqueue(_update(n)) for n in range(4)]
+    assert results == [True, True, False, False]
+    assert queue.depth() == 2
+    await queue.stop()
+
+    assert processor.processed == [0, 1]
+    assert metrics.get('webhook_updates_rejected') == 2
+    assert metrics.get('webhook_updates_processed') == 2
+    assert metrics.get('webhook_queue_wait_us') > 0
+
+@pytest.mark.asyncio
+async def test_failing_update_does_not_stop_the_worker():
+    processor = SlowProcessor(fail_on={1})
+    queue = UpdateQueue(processor, workers=1, max_size=10)
+    queue.start()
+
+    for n in range(3):
+        queue.enqueue(_update(n))
+    await queue.stop()
+
+    assert processor.processed == [0, 2]
+
+@pytest.mark.asyncio
+async def test_stop_drops_updates_after_the_drain_timeout():
+    processor = SlowProcessor(delay=1)
+    queue = UpdateQueue(processor, workers=1, max_size=10)
+    queue.start()
+    queue.enqueue(_update(1))
+
+    await queue.stop(drain_timeout=0.01)
+
+    assert not queue.running
+    assert not queue.enqueue(_update(2))